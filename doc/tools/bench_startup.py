@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Time "glu <module> --help" in fresh interpreters to measure the fixed
+startup cost paid by every GLU invocation.
+
+Usage: python doc/tools/bench_startup.py [-r REPEAT] [MODULE ...]
+'''
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+
+
+DEFAULT_MODULES = ['qc.summary','transform','split']
+
+
+def bench_startup(module, repeat):
+  command = 'import glu.lib.glu_launcher as g; g.main()'
+  devnull = open(os.devnull,'w')
+  times   = []
+
+  try:
+    for i in xrange(repeat):
+      t0 = time.time()
+      subprocess.call([sys.executable,'-c',command,module,'--help'],stdout=devnull,stderr=devnull)
+      times.append(time.time()-t0)
+  finally:
+    devnull.close()
+
+  times.sort()
+  return times[0],times[len(times)//2]
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] [module...]')
+  parser.add_option('-r', '--repeat', type='int', default=10,
+                    help='Number of times to run each module (default=10)')
+
+  options,modules = parser.parse_args()
+
+  for module in modules or DEFAULT_MODULES:
+    best,median = bench_startup(module, options.repeat)
+    print 'glu %-20s --help: best=%.3fs median=%.3fs' % (module,best,median)
+
+
+if __name__ == '__main__':
+  main()
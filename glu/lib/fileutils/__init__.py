@@ -11,5 +11,6 @@ from glu.lib.fileutils.parser import parse_augmented_name, parse_augmented_filen
 from glu.lib.fileutils.auto   import autofile, namefile, hyphen, guess_format, related_file, guess_related_file, \
                                      compressed_filename
 from glu.lib.fileutils.table  import list_reader, map_reader, table_reader, table_writer, \
-                                     resolve_column_headers, resolve_column_header, table_columns
+                                     table_column_arrays, resolve_column_headers, resolve_column_header, \
+                                     table_columns
 from glu.lib.fileutils.tools  import cook_table, table_options
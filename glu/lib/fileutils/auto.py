@@ -1,27 +1,114 @@
 # -*- coding: utf-8 -*-
 
+from __future__ import with_statement
+
 __abstract__  = 'file related utility functions'
 __copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
 __license__   = 'See GLU license for terms by running: glu license'
 __revision__  = '$Id$'
 
 import os
+import sys
+
+from   itertools                  import chain, imap
+from   cStringIO                  import StringIO
 
 from   glu.lib.utils              import is_str
 from   glu.lib.fileutils.parser   import parse_augmented_filename
 
 
-__all__ = ['autofile','namefile','hyphen','guess_format','related_file','guess_related_file']
+__all__ = ['autofile','namefile','hyphen','guess_format','related_file','guess_related_file',
+           'compressed_filename','find_compressor','compression_threads','ReadAheadFile']
 
 
 COMPRESSED_SUFFIXES = {'gz':'gzip', 'Z'  :'gzip',
-                       'bz':'bzip2','bz2':'bzip2'}
+                       'bz':'bzip2','bz2':'bzip2',
+                       'bgz':'bgzf'}
+
+# External compressors in order of preference, the environment variables
+# that override them, and the options that set the number of threads used
+# by parallel implementations
+COMPRESSORS        = {'gzip' : ['pigz','gzip'],
+                      'bzip2': ['pbzip2','lbzip2','bzip2']}
+COMPRESSOR_ENV     = {'gzip' : 'GLU_GZIP',
+                      'bzip2': 'GLU_BZIP2'}
+COMPRESSOR_THREADS = {'pigz'  : lambda n: ['-p',str(n)],
+                      'pbzip2': lambda n: ['-p%d' % n],
+                      'lbzip2': lambda n: ['-n',str(n)]}
+
+READAHEAD_SIZE     = 16*1024*1024
 
+_compressors = {}
 
-def spawn_compressor(binary, filename, mode, bufsize=-1):
+
+def find_compressor(comp):
+  '''
+  Return the external compressor binary to use for a compression format.
+  The GLU_GZIP and GLU_BZIP2 environment variables override the search,
+  otherwise parallel compressors (pigz, pbzip2, lbzip2) are preferred when
+  installed.
+
+  @param  comp: compression format, either 'gzip' or 'bzip2'
+  @type   comp: str
+  @return     : compressor executable name or path
+  @rtype      : str
+
+  >>> find_compressor('gzip') in ('gzip','pigz') or 'GLU_GZIP' in os.environ
+  True
+  '''
+  binary = os.environ.get(COMPRESSOR_ENV[comp])
+
+  if binary:
+    return binary
+
+  binary = _compressors.get(comp)
+
+  if binary is None:
+    from distutils.spawn import find_executable
+
+    for binary in COMPRESSORS[comp]:
+      if find_executable(binary):
+        break
+
+    _compressors[comp] = binary
+
+  return binary
+
+
+def compression_threads(threads=None):
+  '''
+  Return the number of threads to use for compression and decompression.
+  Defaults to the GLU_COMPRESS_THREADS environment variable, if set, or the
+  number of processors.
+
+  @param  threads: requested number of threads or None
+  @type   threads: int or None
+  @return        : number of threads
+  @rtype         : int
+
+  >>> compression_threads(3)
+  3
+  >>> compression_threads(0)
+  1
+  '''
+  if threads is None:
+    threads = os.environ.get('GLU_COMPRESS_THREADS')
+
+    if threads is None:
+      try:
+        from multiprocessing import cpu_count
+        threads = cpu_count()
+      except (ImportError,NotImplementedError):
+        threads = 1
+
+  return max(1,int(threads))
+
+
+def spawn_compressor(binary, filename, mode, bufsize=-1, threads=None):
   '''
   Spawn a subprocess to run a compressor like gzip or bzip2 and connect to
-  input/output pipes
+  input/output pipes.  Parallel compressors (pigz, pbzip2, lbzip2) are
+  passed the number of threads to use, if specified.
 
   @param    binary: executable name
   @type     binary: str
@@ -33,6 +120,8 @@ def spawn_compressor(binary, filename, mode, bufsize=-1):
   @param   bufsize: buffering mode and size.  0=unbuffered, 1=linebuffered, >1 buffer size,
                     -1 default buffering (default)
   @type    bufsize: int
+  @param   threads: number of compression threads or None for the compressor default
+  @type    threads: int or None
   @return         : file object to read from or write to
   @rtype          : file object
   '''
@@ -41,17 +130,228 @@ def spawn_compressor(binary, filename, mode, bufsize=-1):
 
   from subprocess import Popen,PIPE
 
+  options = COMPRESSOR_THREADS.get(os.path.basename(binary))
+  options = options(threads) if options and threads else []
+
   if 'w' in mode:
     out = file(filename,mode)
-    cmd = [binary,'-c']
+    cmd = [binary,'-c'] + options
     f   = Popen(cmd, stdin=PIPE, stdout=out, bufsize=bufsize).stdin
   else:
-    cmd = [binary,'-d','-c',filename]
+    cmd = [binary,'-d','-c'] + options + [filename]
     f   = Popen(cmd, stdout=PIPE, universal_newlines='U' in mode, bufsize=bufsize).stdout
 
   return f
 
 
+class _ReadAhead(object):
+  '''
+  Background thread and queue of chunks of complete lines read from a file
+  object.  Kept separate from ReadAheadFile so that the thread does not
+  keep an abandoned ReadAheadFile alive.
+  '''
+  def __init__(self, f, size):
+    import Queue
+    import threading
+
+    chunksize    = max(1,min(size,1024*1024))
+
+    self.f       = f
+    self.queue   = Queue.Queue(max(1,size//chunksize))
+    self.lock    = threading.Lock()
+    self.stopped = False
+    self.done    = False
+    self.closef  = False
+    self.eof     = False
+    self.error   = None
+    self.thread  = threading.Thread(target=self.run, args=(chunksize,))
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def run(self, chunksize):
+    read  = self.f.read
+    put   = self.queue.put
+    carry = ''
+
+    try:
+      while not self.stopped:
+        data = read(chunksize)
+
+        if not data:
+          break
+
+        if carry:
+          data = carry + data
+
+        # Queue only complete lines so that chunks can be iterated over
+        # independently
+        i = data.rfind('\n')+1
+
+        if i:
+          carry = data[i:]
+          put(data[:i])
+        else:
+          carry = data
+
+      if carry and not self.stopped:
+        put(carry)
+
+    except Exception:
+      self.error = sys.exc_info()
+
+    if not self.stopped:
+      put(None)
+
+    with self.lock:
+      self.done = True
+      if self.closef:
+        self.f.close()
+
+  def get(self):
+    if self.eof:
+      return None
+
+    data = self.queue.get()
+
+    if data is None:
+      self.eof = True
+      if self.error is not None:
+        error,self.error = self.error,None
+        raise error[0],error[1],error[2]
+
+    return data
+
+  def stop(self, wait=True):
+    self.stopped = True
+
+    # Drain the queue until the reader thread notices that it should stop
+    queue = self.queue
+    while self.thread.isAlive():
+      while not queue.empty():
+        queue.get_nowait()
+      if not wait:
+        break
+      self.thread.join(0.01)
+
+  def close_when_done(self):
+    '''
+    Close the file once the reader thread exits, or now if it already has
+    '''
+    with self.lock:
+      if self.done:
+        self.f.close()
+      else:
+        self.closef = True
+
+
+class ReadAheadFile(object):
+  '''
+  Read-only text file object that reads ahead from another file object in a
+  background thread.  Up to size bytes are buffered in chunks that end on
+  line boundaries, so that reading and decompressing the underlying file
+  overlaps with processing its contents.
+
+  As with built-in file objects, iteration cannot be followed by calls to
+  read methods.
+
+  >>> f = ReadAheadFile(StringIO(''.join('line %d\\n' % i for i in xrange(1000))), size=100)
+  >>> f.readline()
+  'line 0\\n'
+  >>> lines = list(f)
+  >>> len(lines),lines[-1]
+  (999, 'line 999\\n')
+  >>> f.readline()
+  Traceback (most recent call last):
+       ...
+  ValueError: Mixing iteration and read methods would lose data
+  >>> f.close()
+  >>> ReadAheadFile(StringIO('a\\nb\\nc'), size=1).read()
+  'a\\nb\\nc'
+  '''
+  def __init__(self, f, size=READAHEAD_SIZE):
+    self.f       = f
+    self.name    = getattr(f,'name',repr(f))
+    self.mode    = 'r'
+    self.closed  = False
+    self.buffer  = StringIO('')
+    self.lines   = None
+    self.source  = _ReadAhead(f, size)
+
+  def _check_read(self):
+    if self.closed:
+      raise ValueError('I/O operation on closed file')
+    if self.lines is not None:
+      raise ValueError('Mixing iteration and read methods would lose data')
+
+  def readline(self):
+    self._check_read()
+
+    line = self.buffer.readline()
+
+    if not line:
+      data = self.source.get()
+      if data is None:
+        return ''
+      self.buffer = StringIO(data)
+      line = self.buffer.readline()
+
+    return line
+
+  def read(self, size=-1):
+    self._check_read()
+
+    parts = []
+    while size:
+      data = self.buffer.read(size) if size>0 else self.buffer.read()
+
+      if not data:
+        data = self.source.get()
+        if data is None:
+          break
+        self.buffer = StringIO(data)
+        continue
+
+      parts.append(data)
+      if size>0:
+        size -= len(data)
+
+    return ''.join(parts)
+
+  def readlines(self):
+    return list(self)
+
+  def __iter__(self):
+    if self.lines is None:
+      if self.closed:
+        raise ValueError('I/O operation on closed file')
+      # Lines are split from each chunk in C, avoiding per-line overhead
+      chunks     = imap(StringIO, iter(self.source.get, None))
+      self.lines = chain(self.buffer, chain.from_iterable(chunks))
+    return self.lines
+
+  def next(self):
+    return next(iter(self))
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      self.source.stop()
+      self.f.close()
+
+  def __del__(self):
+    # Release the reader thread, which then closes the underlying file
+    # when it exits
+    if not self.closed:
+      self.source.stop(wait=False)
+      self.source.close_when_done()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
 def hyphen(filename,defaultfile,args=None):
   '''
   Return the default if input is '-', otherwise itself
@@ -137,16 +437,33 @@ def compressed_filename(filename):
   return COMPRESSED_SUFFIXES.get(ext,'')
 
 
-def autofile(filename, mode='r', bufsize=-1):
+def autofile(filename, mode='r', bufsize=-1, threads=None, readahead=None):
   '''
   Return a file object in the correct compressed format as specified, which
-  is ready to read from or write to
+  is ready to read from or write to.
+
+  Compressed files are processed by external compressors, preferring the
+  parallel pigz and pbzip2 when installed.  Files with a '.bgz' extension
+  are written in BGZF (blocked gzip) format, compressed by a pool of
+  threads.  Files made entirely of BGZF blocks, including those with a
+  '.gz' extension, are read by decompressing blocks in parallel when more
+  than one thread is available.  Compressed files opened for reading in text mode are read
+  ahead by a background thread.
 
   @param  filename: file name or file object
   @type   filename: str or file object
   @param      mode: determine whether the file objects should be opened for input or output,
                     either 'w' or 'r'
   @type       mode: str
+  @param   threads: number of compression threads.  Defaults to the
+                    GLU_COMPRESS_THREADS environment variable or the number
+                    of processors.
+  @type    threads: int or None
+  @param readahead: size in bytes of the read-ahead buffer for compressed
+                    text input, 0 to disable.  Defaults to the GLU_READAHEAD
+                    environment variable or 16MiB when more than one thread
+                    is available.
+  @type  readahead: int or None
   @return         : file object to read from or write to
   @rtype          : file object
   '''
@@ -158,20 +475,41 @@ def autofile(filename, mode='r', bufsize=-1):
   comp     = compressed_filename(filename)
 
   if not comp:
-    f = file(filename, mode)
-  elif comp == 'gzip':
+    return file(filename, mode)
+
+  writing = 'w' in mode or 'a' in mode
+  threads = compression_threads(threads)
+
+  if comp=='bgzf' and writing:
+    from glu.lib.fileutils.bgzf import BGZFWriter
+    return BGZFWriter(filename, mode, threads=threads)
+
+  # Only files made entirely of BGZF blocks are read in parallel, since a
+  # gzip file may append ordinary gzip members to BGZF blocks
+  if comp in ('gzip','bgzf') and not writing and threads>1 and 'U' not in mode:
+    from glu.lib.fileutils.bgzf import BGZFReader, is_bgzf
+    if is_bgzf(filename, full=True):
+      return BGZFReader(filename, threads=threads)
+
+  if comp in ('gzip','bgzf'):
     try:
-      f = spawn_compressor(os.environ.get('GLU_GZIP','gzip'), filename, mode, bufsize=bufsize)
+      f = spawn_compressor(find_compressor('gzip'), filename, mode, bufsize=bufsize, threads=threads)
     except _autofile_errors:
       import gzip
       f = gzip.GzipFile(filename, mode)
   elif comp == 'bzip2':
     try:
-      f = spawn_compressor(os.environ.get('GLU_BZIP2','bzip2'), filename, mode, bufsize=bufsize)
+      f = spawn_compressor(find_compressor('bzip2'), filename, mode, bufsize=bufsize, threads=threads)
     except _autofile_errors:
       import bz2
       f = bz2.BZ2File(filename, mode, buffering=max(0,bufsize))
 
+  if not writing and 'b' not in mode:
+    if readahead is None:
+      readahead = int(os.environ.get('GLU_READAHEAD',READAHEAD_SIZE if threads>1 else 0))
+    if readahead>0:
+      f = ReadAheadFile(f, readahead)
+
   return f
 
 
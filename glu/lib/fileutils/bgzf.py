@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+
+__abstract__  = 'BGZF (blocked gzip) file reading and writing with parallel block compression'
+__copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
+__license__   = 'See GLU license for terms by running: glu license'
+__revision__  = '$Id$'
+
+
+import zlib
+import struct
+
+from   cStringIO   import StringIO
+from   collections import deque
+
+
+__all__ = ['BGZFReader','BGZFWriter','is_bgzf','make_virtual_offset','split_virtual_offset']
+
+
+# BGZF files are a series of gzip members of at most 64KiB, each of which
+# carries its compressed size in a 'BC' extra subfield.  Blocks are
+# independent, so they can be compressed and decompressed in parallel and
+# any block can be located by its file offset.
+
+BGZF_MAGIC      = '\x1f\x8b\x08\x04'
+BGZF_HEADER     = struct.Struct('<4sIBBHccHH')
+BGZF_TRAILER    = struct.Struct('<II')
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_MAX_BLOCK  = 0x10000
+BGZF_EOF        = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00' \
+                  '\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def make_virtual_offset(block_offset, within_block):
+  '''
+  Return a BGZF virtual file offset from the file offset of a block and an
+  offset within its uncompressed data
+
+  >>> make_virtual_offset(100000, 10)
+  6553600010
+  >>> make_virtual_offset(0, 70000)
+  Traceback (most recent call last):
+       ...
+  ValueError: invalid offset within BGZF block: 70000
+  '''
+  if not 0<=within_block<BGZF_MAX_BLOCK:
+    raise ValueError('invalid offset within BGZF block: %d' % within_block)
+  return (block_offset<<16) | within_block
+
+
+def split_virtual_offset(offset):
+  '''
+  Return the block file offset and offset within the block of a BGZF
+  virtual file offset
+
+  >>> split_virtual_offset(6553600010)
+  (100000, 10)
+  '''
+  return offset>>16, offset&0xffff
+
+
+def is_bgzf(filename, full=False):
+  '''
+  Return True if the file begins with a BGZF block header.  If full is
+  True, the header of every block is checked, so that gzip files that
+  contain ordinary gzip members after BGZF blocks are not reported as BGZF.
+  Only block headers are read, so the check is fast even for large files.
+
+  >>> import gzip,tempfile
+  >>> f = tempfile.NamedTemporaryFile()
+  >>> out = BGZFWriter(f.name)
+  >>> out.write('bgzf data\\n')
+  >>> out.flush()
+  >>> out.close()
+  >>> is_bgzf(f.name),is_bgzf(f.name,full=True)
+  (True, True)
+  >>> g = gzip.GzipFile(f.name,'ab')
+  >>> g.writelines(['gzip data\\n'])
+  >>> g.close()
+  >>> is_bgzf(f.name),is_bgzf(f.name,full=True)
+  (True, False)
+  >>> gzip.GzipFile(f.name).read()
+  'bgzf data\\ngzip data\\n'
+  >>> is_bgzf(__file__)
+  False
+  '''
+  try:
+    f = open(filename,'rb')
+  except (IOError,OSError):
+    return False
+
+  try:
+    header = f.read(BGZF_HEADER.size)
+    offset = 0
+
+    while 1:
+      bsize = _block_size(header)
+
+      if bsize is None:
+        return False
+      elif not full:
+        return True
+
+      offset += bsize
+      f.seek(offset)
+      header = f.read(BGZF_HEADER.size)
+
+      if not header:
+        return True
+  finally:
+    f.close()
+
+
+def _block_size(header):
+  '''
+  Return the total size of a BGZF block given its header, or None if the
+  header is not a valid BGZF header
+  '''
+  if len(header)<BGZF_HEADER.size:
+    return None
+
+  magic,mtime,xfl,osflag,xlen,s1,s2,slen,bsize = BGZF_HEADER.unpack(header)
+
+  if magic!=BGZF_MAGIC or xlen!=6 or s1!='B' or s2!='C' or slen!=2:
+    return None
+
+  return bsize+1
+
+
+def _deflate_block(data, level=6):
+  '''
+  Compress data into one or more complete BGZF blocks
+  '''
+  comp  = zlib.compressobj(level, zlib.DEFLATED, -15)
+  cdata = comp.compress(data) + comp.flush()
+  bsize = BGZF_HEADER.size + len(cdata) + BGZF_TRAILER.size
+
+  # Incompressible data can expand past the maximum block size
+  if bsize>BGZF_MAX_BLOCK:
+    mid = len(data)//2
+    return _deflate_block(data[:mid],level) + _deflate_block(data[mid:],level)
+
+  header  = BGZF_HEADER.pack(BGZF_MAGIC,0,0,255,6,'B','C',2,bsize-1)
+  trailer = BGZF_TRAILER.pack(zlib.crc32(data)&0xffffffff,len(data))
+
+  return header + cdata + trailer
+
+
+def _inflate_block(block):
+  '''
+  Decompress a complete BGZF block and verify its size and checksum
+  '''
+  offset,block = block
+  data = zlib.decompress(block[BGZF_HEADER.size:-BGZF_TRAILER.size],-15)
+  crc,isize = BGZF_TRAILER.unpack(block[-BGZF_TRAILER.size:])
+
+  if len(data)!=isize or zlib.crc32(data)&0xffffffff!=crc:
+    raise IOError('corrupt BGZF block at offset %d' % offset)
+
+  return offset,len(block),data
+
+
+def _thread_pool(threads):
+  if threads is None or threads<=1:
+    return None
+
+  from multiprocessing.pool import ThreadPool
+  return ThreadPool(threads)
+
+
+class BGZFWriter(object):
+  '''
+  Write a BGZF file.  Data are buffered into blocks of up to 65280 bytes,
+  which are compressed by a pool of threads when threads>1.  The zlib
+  module releases the interpreter lock while compressing, so blocks are
+  compressed concurrently with each other and with the caller.  Output is
+  written in order with a bounded number of blocks in flight.
+
+  >>> import tempfile
+  >>> f = tempfile.NamedTemporaryFile()
+  >>> out = BGZFWriter(f.name, threads=2)
+  >>> for i in xrange(10000):
+  ...   out.write('line %d\\n' % i)
+  >>> out.close()
+  >>> import gzip
+  >>> lines = gzip.GzipFile(f.name).readlines()
+  >>> len(lines),lines[-1]
+  (10000, 'line 9999\\n')
+  '''
+  def __init__(self, filename, mode='wb', level=6, threads=None):
+    if 'r' in mode:
+      raise ValueError('BGZFWriter supports only write and append modes')
+
+    self.out     = open(filename,mode.replace('b','')+'b') if isinstance(filename,basestring) else filename
+    self.name    = getattr(self.out,'name',filename)
+    self.level   = level
+    self.buffer  = []
+    self.buflen  = 0
+    self.pool    = _thread_pool(threads)
+    self.pending = deque()
+    self.depth   = 4*threads if self.pool is not None else 0
+    self.closed  = False
+
+  def write(self, data):
+    if self.closed:
+      raise ValueError('I/O operation on closed file')
+
+    self.buffer.append(data)
+    self.buflen += len(data)
+
+    if self.buflen>=BGZF_BLOCK_SIZE:
+      self._flush_blocks(final=False)
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def _flush_blocks(self, final):
+    data = ''.join(self.buffer)
+    n    = len(data) if final else len(data)-len(data)%BGZF_BLOCK_SIZE
+
+    for i in xrange(0,n,BGZF_BLOCK_SIZE):
+      self._submit(data[i:i+BGZF_BLOCK_SIZE])
+
+    rest        = data[n:]
+    self.buffer = [rest] if rest else []
+    self.buflen = len(rest)
+
+  def _submit(self, block):
+    if self.pool is None:
+      self.out.write(_deflate_block(block,self.level))
+      return
+
+    pending = self.pending
+    pending.append(self.pool.apply_async(_deflate_block,(block,self.level)))
+
+    while len(pending)>self.depth:
+      self.out.write(pending.popleft().get())
+
+  def _drain(self):
+    pending = self.pending
+    while pending:
+      self.out.write(pending.popleft().get())
+
+  def flush(self):
+    '''
+    Write all buffered data as complete blocks.  Flushing frequently
+    produces small blocks and reduces compression.
+    '''
+    if self.buflen:
+      self._flush_blocks(final=True)
+    self._drain()
+    self.out.flush()
+
+  def close(self):
+    if self.closed:
+      return
+
+    try:
+      self.flush()
+      self.out.write(BGZF_EOF)
+      self.out.close()
+    finally:
+      self.closed = True
+      if self.pool is not None:
+        self.pool.terminate()
+
+  def __del__(self):
+    # Flush and release the thread pool of writers that are not closed,
+    # as is done for built-in file objects
+    if not getattr(self,'closed',True):
+      self.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+class BGZFReader(object):
+  '''
+  Read a BGZF file.  Blocks are decompressed by a pool of threads when
+  threads>1, with up to readahead blocks decompressed ahead of the
+  caller.  Virtual offsets from tell() may be passed to seek() for random
+  access.
+
+  >>> import tempfile
+  >>> f = tempfile.NamedTemporaryFile()
+  >>> out = BGZFWriter(f.name)
+  >>> for i in xrange(20000):
+  ...   out.write('line %d\\n' % i)
+  >>> out.close()
+  >>> r = BGZFReader(f.name, threads=2)
+  >>> r.readline()
+  'line 0\\n'
+  >>> offsets = {}
+  >>> for i in xrange(1,20000):
+  ...   offsets[i] = r.tell()
+  ...   assert r.readline() == 'line %d\\n' % i
+  >>> r.readline()
+  ''
+  >>> r.seek(offsets[15000])
+  >>> r.readline()
+  'line 15000\\n'
+  >>> len(list(r))
+  4999
+  >>> r.seek(0)
+  >>> len(r.read())
+  208890
+  >>> r.close()
+  '''
+  def __init__(self, filename, mode='rb', threads=None, readahead=None):
+    if 'r' not in mode:
+      raise ValueError('BGZFReader supports only read modes')
+    if 'U' in mode:
+      raise ValueError('BGZFReader does not support universal newline mode')
+
+    self.raw       = open(filename,'rb') if isinstance(filename,basestring) else filename
+    self.name      = getattr(self.raw,'name',filename)
+    self.pool      = _thread_pool(threads)
+    self.readahead = readahead or (4*threads if self.pool is not None else 1)
+    self.closed    = False
+    self._reset(0)
+
+  def _reset(self, offset):
+    self.raw.seek(offset)
+    self.raw_offset   = offset
+    self.pending      = deque()
+    self.block_offset = offset
+    self.block_len    = 0
+    self.data         = ''
+    self.pos          = 0
+
+  def _read_raw_block(self):
+    offset = self.raw_offset
+    header = self.raw.read(BGZF_HEADER.size)
+
+    if not header:
+      return None
+
+    bsize = _block_size(header)
+    if bsize is None:
+      raise IOError('invalid BGZF block header at offset %d' % offset)
+
+    block = header + self.raw.read(bsize-BGZF_HEADER.size)
+    if len(block)!=bsize:
+      raise IOError('truncated BGZF block at offset %d' % offset)
+
+    self.raw_offset += bsize
+    return offset,block
+
+  def _fill(self):
+    '''
+    Keep up to readahead blocks pending and return the next decompressed
+    block, or None at end of file
+    '''
+    pending = self.pending
+    pool    = self.pool
+
+    while len(pending)<self.readahead:
+      block = self._read_raw_block()
+      if block is None:
+        break
+      if pool is None:
+        pending.append(_inflate_block(block))
+      else:
+        pending.append(pool.apply_async(_inflate_block,(block,)))
+
+    if not pending:
+      return None
+
+    result = pending.popleft()
+    return result if pool is None else result.get()
+
+  def _next_block(self):
+    '''
+    Advance to the next non-empty block; return False at end of file
+    '''
+    while 1:
+      result = self._fill()
+
+      if result is None:
+        self.block_offset += self.block_len
+        self.block_len     = 0
+        self.data          = ''
+        self.pos           = 0
+        return False
+
+      self.block_offset,self.block_len,self.data = result
+      self.pos = 0
+
+      if self.data:
+        return True
+
+  def tell(self):
+    '''
+    Return the current virtual offset
+    '''
+    if self.pos==len(self.data) and self.data:
+      return make_virtual_offset(self.block_offset+self.block_len,0)
+    return make_virtual_offset(self.block_offset,self.pos)
+
+  def seek(self, offset, whence=0):
+    '''
+    Seek to a virtual offset returned by tell()
+    '''
+    if whence!=0:
+      raise ValueError('BGZF files support only absolute seeks to virtual offsets')
+
+    block_offset,within = split_virtual_offset(offset)
+
+    self._reset(block_offset)
+
+    if within:
+      if not self._next_block() or within>len(self.data):
+        raise IOError('invalid BGZF virtual offset %d' % offset)
+      self.pos = within
+
+  def read(self, size=-1):
+    parts = []
+
+    while size<0 or size>0:
+      if self.pos>=len(self.data) and not self._next_block():
+        break
+
+      if size<0:
+        chunk = self.data[self.pos:]
+      else:
+        chunk = self.data[self.pos:self.pos+size]
+        size -= len(chunk)
+
+      self.pos += len(chunk)
+      parts.append(chunk)
+
+    return ''.join(parts)
+
+  def readline(self):
+    parts = []
+
+    while 1:
+      if self.pos>=len(self.data) and not self._next_block():
+        break
+
+      data = self.data
+      i    = data.find('\n',self.pos)
+
+      if i>=0:
+        parts.append(data[self.pos:i+1])
+        self.pos = i+1
+        break
+
+      parts.append(data[self.pos:])
+      self.pos = len(data)
+
+    return ''.join(parts)
+
+  def __iter__(self):
+    '''
+    Iterate over lines, splitting whole blocks at a time.  As with file
+    objects, tell() does not reflect lines consumed during iteration.
+    '''
+    while 1:
+      line = self.readline()
+
+      if not line:
+        break
+
+      yield line
+
+      data,pos = self.data,self.pos
+      end      = data.rfind('\n',pos)+1
+
+      if end>pos:
+        self.pos = end
+        for line in StringIO(data[pos:end]):
+          yield line
+
+  def next(self):
+    line = self.readline()
+    if not line:
+      raise StopIteration
+    return line
+
+  def readlines(self):
+    return list(self)
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      self.raw.close()
+      if self.pool is not None:
+        self.pool.terminate()
+
+  def __del__(self):
+    if not getattr(self,'closed',True):
+      self.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
+if __name__ == '__main__':
+  _test()
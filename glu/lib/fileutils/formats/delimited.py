@@ -6,13 +6,17 @@ __license__   = 'See GLU license for terms by running: glu license'
 __revision__  = '$Id$'
 
 
+import os
 import csv
 
-from   glu.lib.fileutils.auto   import guess_format, autofile
+from   operator                 import itemgetter
+from   itertools                import chain, islice, izip
+
+from   glu.lib.fileutils.auto   import guess_format, autofile, compressed_filename
 from   glu.lib.fileutils.parser import parse_augmented_filename, trybool, get_arg
 
 
-__all__ = ['get_csv_dialect','table_reader_delimited','delimited_table_writer']
+__all__ = ['get_csv_dialect','table_reader_delimited','delimited_table_writer','DelimitedReader']
 
 
 # Create more standard aliases for Python CSV module dialects.  'excel' is
@@ -71,9 +75,343 @@ def get_csv_dialect(args,default_dialect='tsv'):
   return dargs
 
 
+def simple_dialect(dialect):
+  '''
+  Return the delimiter and quote character of a csv dialect if lines
+  without quote characters can be parsed by splitting them on the
+  delimiter, otherwise None
+
+  >>> simple_dialect(dict(dialect='tsv'))
+  ('\\t', '"')
+  >>> simple_dialect(dict(dialect='csv',quoting=csv.QUOTE_NONE))
+  (',', None)
+  >>> simple_dialect(dict(dialect='csv',skipinitialspace=True)) is None
+  True
+  '''
+  base = dialect.get('dialect','excel')
+  if isinstance(base,basestring):
+    base = csv.get_dialect(base)
+
+  get = lambda attr: dialect.get(attr,getattr(base,attr))
+
+  delimiter = get('delimiter')
+  quoting   = get('quoting')
+
+  if get('skipinitialspace') or get('escapechar') or quoting==csv.QUOTE_NONNUMERIC \
+                             or len(delimiter)!=1 or delimiter in '\r\n':
+    return None
+
+  quotechar = get('quotechar') if quoting!=csv.QUOTE_NONE else None
+
+  return delimiter,quotechar
+
+
+class DelimitedReader(object):
+  '''
+  Reader for delimited files that splits lines directly on the delimiter,
+  which is considerably faster than the csv module while returning the
+  same rows.  Parsing falls back to the csv module from the first line
+  that contains a quote character or a carriage return within the line.
+
+  Rows are stripped of leading and trailing whitespace if strip is True.
+  The project method returns an iterator over selected columns, which
+  avoids splitting fields beyond the last column required and allows
+  large uncompressed files to be parsed in parallel.
+
+  >>> from StringIO import StringIO
+  >>> data = 'a\\tb \\tc\\n\\n1\\t2\\n4\\t"5\\t6"\\t7\\n'
+  >>> list(DelimitedReader(StringIO(data),dict(dialect='tsv')))
+  [['a', 'b ', 'c'], [], ['1', '2'], ['4', '5\\t6', '7']]
+  >>> list(csv.reader(StringIO(data),dialect='tsv'))
+  [['a', 'b ', 'c'], [], ['1', '2'], ['4', '5\\t6', '7']]
+  >>> reader = DelimitedReader(StringIO(data),dict(dialect='tsv'),strip=True)
+  >>> iter(reader).next()
+  ['a', 'b', 'c']
+  >>> reader.skip(1)
+  >>> list(reader.project([2,0]))
+  [['', '1'], ['7', '4']]
+  '''
+  stripped = False
+
+  def __init__(self, lfile, dialect, strip=False, jobs=1, chunksize=16*1024*1024):
+    self.delimiter,self.quotechar = simple_dialect(dialect)
+
+    self.lfile     = lfile
+    self.lines     = iter(lfile)
+    self.dialect   = dialect
+    self.stripped  = strip
+    self.jobs      = jobs
+    self.chunksize = chunksize
+    self.nlines    = 0
+    self.fallback  = False
+    self.generator = None
+
+  def __iter__(self):
+    if self.generator is None:
+      self.generator = self.rows()
+    return self.generator
+
+  def skip(self, n):
+    '''
+    Skip the next n rows
+    '''
+    next(islice(iter(self),n,n),None)
+
+  def rows(self):
+    '''
+    Generate rows from the remaining lines of the file
+    '''
+    lines      = self.lines
+    delimiter  = self.delimiter
+    quotechar  = self.quotechar or '\r'
+    stripchars = _strip_chars(delimiter) if self.stripped else None
+    strip      = str.strip
+
+    # Inlined equivalent of _special_line and _split_line
+    for line in lines:
+      self.nlines += 1
+
+      if quotechar in line or '\r' in line:
+        if _special_line(line,self.quotechar):
+          for row in self.csv_rows(chain([line],lines)):
+            yield row
+          return
+        line = line.rstrip('\r\n')
+      elif line[-1:]=='\n':
+        line = line[:-1]
+
+      if not line:
+        yield []
+      elif stripchars is not None and len(line.translate(None,stripchars))!=len(line):
+        yield map(strip,line.split(delimiter))
+      else:
+        yield line.split(delimiter)
+
+  def csv_rows(self, lines):
+    self.fallback = True
+
+    rows = csv.reader(lines,**self.dialect)
+
+    if self.stripped:
+      rows = ( map(str.strip,row) for row in rows )
+
+    return rows
+
+  def project(self, indices):
+    '''
+    Return an iterator over the remaining rows of the file that returns the
+    specified column indices, with missing columns returned as empty
+    strings, or None if the projection cannot be performed by the reader
+    '''
+    if self.fallback or not indices:
+      return None
+
+    if self.jobs>1:
+      chunks = self.file_chunks()
+      if chunks is not None:
+        return self.parallel_project(chunks,indices)
+
+    return self.project_lines(indices)
+
+  def project_lines(self, indices):
+    lines      = self.lines
+    delimiter  = self.delimiter
+    quotechar  = self.quotechar or '\r'
+    stripchars = _strip_chars(delimiter) if self.stripped else None
+    strip      = str.strip
+
+    # Split only as far as the last column required
+    maxsplit   = max(indices)+1
+    pad        = ['']*maxsplit
+
+    if len(indices)==1:
+      j   = indices[0]
+      get = lambda row: (row[j],)
+    else:
+      get = itemgetter(*indices)
+
+    # Inlined equivalent of _special_line and _split_line
+    for line in lines:
+      if quotechar in line or '\r' in line:
+        if _special_line(line,self.quotechar):
+          for row in self.csv_rows(chain([line],lines)):
+            if len(row)<maxsplit:
+              row += pad[len(row):]
+            yield list(get(row))
+          return
+        line = line.rstrip('\r\n')
+      elif line[-1:]=='\n':
+        line = line[:-1]
+
+      row = line.split(delimiter,maxsplit) if line else []
+
+      if stripchars is not None and len(line.translate(None,stripchars))!=len(line):
+        row = map(strip,row)
+
+      if len(row)<maxsplit:
+        row += pad[len(row):]
+
+      yield list(get(row))
+
+  def file_chunks(self):
+    '''
+    Return the byte ranges of the remaining lines of the file split into
+    chunks, or None if the file cannot be parsed in parallel
+    '''
+    import mmap
+
+    filename = getattr(self.lfile,'name',None)
+
+    if not filename or not os.path.isfile(filename) or compressed_filename(filename):
+      return None
+
+    f = open(filename,'rb')
+
+    try:
+      size = os.fstat(f.fileno()).st_size
+
+      if not size:
+        return None
+
+      # Quoted fields may span lines and thus chunks
+      data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+      try:
+        if self.quotechar and data.find(self.quotechar)!=-1:
+          return None
+      finally:
+        data.close()
+
+      # Skip lines that have already been read
+      for i in xrange(self.nlines):
+        f.readline()
+
+      start  = f.tell()
+      chunks = []
+
+      while start<size:
+        f.seek(min(start+self.chunksize,size))
+        f.readline()
+        end = min(f.tell(),size)
+        chunks.append( (filename,start,end) )
+        start = end
+
+      return chunks
+
+    finally:
+      f.close()
+
+  def parallel_project(self, chunks, indices):
+    from multiprocessing import Pool
+
+    tasks = [ chunk+(self.delimiter,self.stripped,indices) for chunk in chunks ]
+    pool  = Pool(self.jobs)
+
+    try:
+      for n,columns in pool.imap(_parse_chunk,tasks):
+        if n:
+          for row in izip(*[ c.split('\n') for c in columns ]):
+            yield list(row)
+    finally:
+      pool.terminate()
+
+
+def _special_line(line, quotechar):
+  '''
+  Return True for lines that must be parsed by the csv module: those with
+  quote characters or carriage returns other than in the line terminator
+
+  >>> [ _special_line(line,'"') for line in ['a\\tb\\r\\n','a\\rb\\n','"a"\\n','a\\tb\\r'] ]
+  [False, True, True, False]
+  '''
+  return bool(quotechar and quotechar in line or '\r' in line and '\r' in line.rstrip('\r\n'))
+
+
+def _strip_chars(delimiter):
+  '''
+  Return the whitespace characters that may appear at the start or end of
+  fields split on delimiter
+  '''
+  return ' \t\x0b\x0c'.replace(delimiter,'')
+
+
+def _split_line(line, delimiter, stripchars, maxsplit=-1):
+  '''
+  Split a line on delimiter and strip the fields if stripchars is not None
+  and the line contains any of them
+
+  >>> _split_line('a\\t b \\tc\\n','\\t',_strip_chars('\\t'))
+  ['a', 'b', 'c']
+  >>> _split_line('a\\t b \\tc\\n','\\t',None,1)
+  ['a', ' b \\tc']
+  >>> _split_line('\\r\\n','\\t',None)
+  []
+  '''
+  line = line.rstrip('\r\n')
+
+  if not line:
+    return []
+
+  row = line.split(delimiter,maxsplit)
+
+  if stripchars is not None and len(line.translate(None,stripchars))!=len(line):
+    row = map(str.strip,row)
+
+  return row
+
+
+def _project(rows, indices):
+  k   = max(indices)+1
+  pad = ['']*k
+
+  if len(indices)==1:
+    j = indices[0]
+    for row in rows:
+      yield [row[j] if j<len(row) else '']
+  else:
+    get = itemgetter(*indices)
+    for row in rows:
+      if len(row)<k:
+        row = row+pad[len(row):]
+      yield list(get(row))
+
+
+def _parse_chunk(task):
+  '''
+  Parse the lines in a byte range of a file and return the number of rows
+  and the selected columns, each joined by newlines to minimize the cost of
+  returning results to the parent process
+  '''
+  filename,start,end,delimiter,strip,indices = task
+
+  f = open(filename,'rb')
+  try:
+    f.seek(start)
+    lines = f.read(end-start).split('\n')
+  finally:
+    f.close()
+
+  # Drop the empty string following the final newline
+  if lines and not lines[-1]:
+    lines.pop()
+
+  # Chunks contain no quote characters, so only carriage returns within
+  # lines are special and the csv module would reject them
+  for line in lines:
+    if _special_line(line,None):
+      raise csv.Error('new-line character seen in unquoted field')
+
+  maxsplit   = max(indices)+1
+  stripchars = _strip_chars(delimiter) if strip else None
+  rows       = ( _split_line(line,delimiter,stripchars,maxsplit) for line in lines )
+  columns    = izip(*_project(rows,indices))
+
+  return len(lines),[ '\n'.join(c) for c in columns ]
+
+
 def table_reader_delimited(filename, extra_args=None, **kwargs):
   '''
-  Return a configured delimited table reader
+  Return a configured delimited table reader.  A DelimitedReader is
+  returned for dialects that it supports, otherwise a csv module reader.
   '''
   if extra_args is None:
     args = kwargs
@@ -84,12 +422,17 @@ def table_reader_delimited(filename, extra_args=None, **kwargs):
   name    = parse_augmented_filename(filename,args)
   dialect = get_csv_dialect(args, guess_format(name, ['csv']) or 'tsv')
   hyin    = get_arg(args, ['hyphen'])
+  strip   = trybool(get_arg(args, ['strip'], False))
+  jobs    = int(get_arg(args, ['jobs','j'], 1))
 
   if extra_args is None and args:
     raise ValueError('Unexpected filename arguments: %s' % ','.join(sorted(args)))
 
   lfile = autofile(name) if name!='-' or hyin is None else hyin
 
+  if simple_dialect(dialect) is not None:
+    return DelimitedReader(lfile,dialect,strip=strip,jobs=jobs)
+
   return csv.reader(lfile,**dialect)
 
 
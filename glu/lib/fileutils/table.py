@@ -7,14 +7,14 @@ __revision__  = '$Id$'
 
 import os
 
-from   itertools                import islice
+from   itertools                import islice, izip
 
 from   glu.lib.utils            import is_str,deprecated_by
 from   glu.lib.fileutils.auto   import guess_format, namefile
 from   glu.lib.fileutils.parser import parse_augmented_filename, tryint1, get_arg
 
 
-__all__ = ['list_reader', 'map_reader', 'table_reader', 'table_writer',
+__all__ = ['list_reader', 'map_reader', 'table_reader', 'table_writer', 'table_column_arrays',
            'resolve_column_headers', 'resolve_column_header', 'table_columns']
 
 
@@ -651,8 +651,10 @@ def table_columns(rows, columns, drop=None, rename=None, header=None, want_heade
   >>> list(table_columns([['loc1'],['loc2'],['loc1','loc1'],['loc2']],['c2','c1'],header=['c1','c2']))
   [['', 'loc1'], ['', 'loc2'], ['loc1', 'loc1'], ['', 'loc2']]
   '''
-  rows   = iter(rows)
-  rename = parse_rename(rename)
+  reader   = rows
+  rows     = iter(rows)
+  rename   = parse_rename(rename)
+  stripped = getattr(reader,'stripped',False)
 
   # All columns are to be returned
   if not columns and not drop:
@@ -664,7 +666,8 @@ def table_columns(rows, columns, drop=None, rename=None, header=None, want_heade
           return
 
         # Process row 1 (may or may not be a header)
-        row = map(str.strip,row)
+        if not stripped:
+          row = map(str.strip,row)
         n   = len(row)
 
         if rename:
@@ -680,10 +683,16 @@ def table_columns(rows, columns, drop=None, rename=None, header=None, want_heade
             header = [ rename.get(h,h) for h in header ]
           yield header
 
-      for row in rows:
-        result  = map(str.strip,row)
-        result += ['']*(n-len(result))
-        yield result
+      if stripped:
+        for row in rows:
+          if len(row)<n:
+            row += ['']*(n-len(row))
+          yield row
+      else:
+        for row in rows:
+          result  = map(str.strip,row)
+          result += ['']*(n-len(result))
+          yield result
 
     return _table_reader_all(header)
 
@@ -704,6 +713,10 @@ def table_columns(rows, columns, drop=None, rename=None, header=None, want_heade
   if not want_header:
     header = None
 
+  # Push the column projection down to the reader, if supported
+  project   = getattr(reader,'project',None)
+  projected = project(indices) if project is not None else None
+
   def _table_reader_columns(header):
     if header is not None:
       header = [ header[j] for j in indices ]
@@ -712,10 +725,18 @@ def table_columns(rows, columns, drop=None, rename=None, header=None, want_heade
       yield header
 
     # Build result rows
-    for row in rows:
-      m = len(row)
-      result  = [ (row[j].strip() if j<m else '') for j in indices ]
-      yield result
+    if projected is not None:
+      for row in projected:
+        yield row
+    elif stripped:
+      for row in rows:
+        m = len(row)
+        yield [ (row[j] if j<m else '') for j in indices ]
+    else:
+      for row in rows:
+        m = len(row)
+        result  = [ (row[j].strip() if j<m else '') for j in indices ]
+        yield result
 
   return _table_reader_columns(header)
 
@@ -762,10 +783,19 @@ def table_reader(filename,want_header=False,extra_args=None,**kwargs):
   to specifying ':skip=1:columns=0,1,0,1,0'.  No escaping or quoting is
   allowed.
 
+  Delimited files are parsed by splitting lines directly on the delimiter
+  unless the dialect requires the csv module, and the csv module is used
+  from the first line containing a quote character.  Column selections are
+  applied as lines are split, so fields after the last column selected are
+  never split.  Large uncompressed files without quote characters may be
+  parsed in parallel when columns are selected by specifying a number of
+  jobs.
+
   The following parameters and aliases are accepted as part of the augmented
   filename:
      columns, c: indices, names, or ranges of columns to select, comma delimited
         skip, s: number of header lines to skip
+        jobs, j: number of processes used to parse delimited files
         dialect: csv module dialect name ('csv' or 'tsv')
       delimiter: single field delimiter character
     doublequote: one-character string used to quote fields containing
@@ -878,7 +908,7 @@ def table_reader(filename,want_header=False,extra_args=None,**kwargs):
     rows = table_reader_xlsx(name, extra_args=args)
   elif format in ('delimited','tsv','csv'):
     from glu.lib.fileutils.formats.delimited import table_reader_delimited
-    rows = table_reader_delimited(name, extra_args=args)
+    rows = table_reader_delimited(name, extra_args=args, strip=True)
   elif format in ('db','sqlite'):
     from glu.lib.fileutils.formats.sqlite import table_reader_sqlite
     rows = table_reader_sqlite(name, extra_args=args)
@@ -892,11 +922,89 @@ def table_reader(filename,want_header=False,extra_args=None,**kwargs):
     raise ValueError('Unexpected filename arguments: %s' % ','.join(sorted(args)))
 
   if skip:
-    rows = islice(rows,skip,None)
+    # Skip rows within readers that support it to retain their interface
+    skip_rows = getattr(rows,'skip',None)
+    if skip_rows is not None:
+      skip_rows(skip)
+    else:
+      rows = islice(rows,skip,None)
 
   return table_columns(rows,columns,drop=drop,rename=rename,header=header,want_header=want_header)
 
 
+def float_column(values):
+  '''
+  Return a sequence of numeric strings as a NumPy float array, with empty
+  strings as NaN
+
+  >>> float_column(['1','','2.5'])
+  array([1. , nan, 2.5])
+  '''
+  import numpy as np
+
+  values = np.asarray(values, dtype=str)
+  values = np.where(values=='', 'nan', values)
+
+  return values.astype(float)
+
+
+def table_column_arrays(filename,numeric=None,extra_args=None,**kwargs):
+  '''
+  Return the header and columns of a table read by table_reader, with the
+  specified numeric columns as NumPy float arrays and all other columns as
+  lists of strings.  Empty values in numeric columns are returned as NaN.
+
+  @param     filename: file name or file object
+  @type      filename: str or file object
+  @param      numeric: indices, names, or ranges of numeric columns, or True
+                       to return all columns that contain only numbers as
+                       arrays
+  @type       numeric: list of strings, integers, or 2-tuples for ranges, or bool
+  @return            : header and list of columns
+  @rtype             : tuple of list and list
+
+  All other arguments are as for table_reader.
+
+  >>> from StringIO import StringIO
+  >>> data = 'ID\\tAGE\\tBMI\\nS1\\t40\\t21.5\\nS2\\t\\t30\\n'
+  >>> header,columns = table_column_arrays(StringIO(data),numeric=['AGE'])
+  >>> header
+  ['ID', 'AGE', 'BMI']
+  >>> columns
+  [['S1', 'S2'], array([40., nan]), ['21.5', '30']]
+  >>> table_column_arrays(StringIO(data),numeric=True)[1]
+  [['S1', 'S2'], array([40., nan]), array([21.5, 30. ])]
+  >>> table_column_arrays(StringIO(data),numeric=['ID'])
+  Traceback (most recent call last):
+     ...
+  ValueError: Invalid numeric value in column ID
+  '''
+  rows = table_reader(filename,want_header=True,extra_args=extra_args,**kwargs)
+
+  try:
+    header = rows.next()
+  except StopIteration:
+    return [],[]
+
+  columns = map(list,izip(*rows)) or [ [] for h in header ]
+
+  if numeric is True:
+    for i,column in enumerate(columns):
+      try:
+        columns[i] = float_column(column)
+      except ValueError:
+        pass
+
+  elif numeric:
+    for i in resolve_column_headers(header,numeric):
+      try:
+        columns[i] = float_column(columns[i])
+      except ValueError:
+        raise ValueError('Invalid numeric value in column %s' % (header[i] or i+1))
+
+  return header,columns
+
+
 class TableWriter(object):
   '''
   Write selected columns to a lower-level tabular data writer object
@@ -21,9 +21,35 @@ DEFAULT_PATHS  = [os.path.join(os.path.dirname(__file__),'data'),
 
 
 class GeneDBSQLite(object):
-  def __init__(self, filename):
-    self.filename = filename
-    self.con = sqlite3.connect(filename)
+  '''
+  Connection to a genedb database.  Read-only connections are tuned for
+  queries: writes to the database are disabled, the database file is
+  memory-mapped and a larger page cache is used.  A read-only snapshot of
+  the database, built by glu genedb.snapshot, is opened on demand when
+  available.
+  '''
+  def __init__(self, filename, readonly=True, mmap_size=1<<30, cache_size=65536):
+    self.filename  = filename
+    self.con       = sqlite3.connect(filename)
+    self.readonly  = readonly
+    self._snapshot = None
+
+    if readonly:
+      cur = self.con.cursor()
+      cur.execute('PRAGMA query_only=ON;')
+      cur.execute('PRAGMA temp_store=MEMORY;')
+      cur.execute('PRAGMA mmap_size=%d;'  % mmap_size)
+      cur.execute('PRAGMA cache_size=%d;' % -cache_size)
+
+  @property
+  def snapshot(self):
+    '''
+    Read-only snapshot of the database or None if no current snapshot exists
+    '''
+    if self._snapshot is None:
+      from glu.lib.genedb.snapshot import open_snapshot
+      self._snapshot = open_snapshot(self.filename) or False
+    return self._snapshot or None
 
   def cursor(self):
     return self.con.cursor()
@@ -51,7 +77,7 @@ def search_file(filename, path):
   return None
 
 
-def open_genedb(dbname=None,path=None):
+def open_genedb(dbname=None,path=None,readonly=True):
   '''
   Open a genedb instance based on an optional database name and search path.
   If not specified, a series of standard database names and paths will be
@@ -76,6 +102,6 @@ def open_genedb(dbname=None,path=None):
 
     if filename:
       sys.stderr.write('[INFO] Opening genedb: %s\n' % filename)
-      return GeneDBSQLite(filename)
+      return GeneDBSQLite(filename,readonly=readonly)
 
   raise IOError('Cannot open genedb')
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+__abstract__  = 'Batched genedb queries using in-memory or memory-mapped interval indexes'
+__copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
+__license__   = 'See GLU license for terms by running: glu license'
+__revision__  = '$Id$'
+
+
+from   collections                 import defaultdict
+
+from   glu.lib.utils               import chunk
+from   glu.lib.seqlib.intervaltree import IntervalTree
+
+from   glu.lib.genedb.snapshot     import IntervalMap
+
+from   glu.lib.genedb.queries      import KGENOME_CHRMAP, cytoband_name, query_snps_by_name, \
+                                          query_genes_by_name, query_cytoband_by_name, \
+                                          query_contig_by_name
+
+
+class ResultCache(object):
+  '''
+  Simple bounded cache of query results.  The cache is cleared when it
+  reaches its maximum size, which is adequate for the locality of typical
+  annotation inputs and much cheaper than maintaining LRU order.  Batches
+  of results reserve room before they are loaded, so that a batch is never
+  discarded while it is in use.
+
+  >>> cache = ResultCache(2)
+  >>> cache['a'] = 1
+  >>> cache.get('a')
+  1
+  >>> cache['b'] = 2
+  >>> cache['c'] = 3
+  >>> cache.get('a') is None
+  True
+  >>> cache.reserve(2)
+  >>> cache.update([('d',4),('e',5),('f',6)])
+  >>> sorted(cache.data)
+  ['d', 'e', 'f']
+  '''
+  def __init__(self, maxsize=100000):
+    self.maxsize = maxsize
+    self.data    = {}
+
+  def get(self, key, default=None):
+    return self.data.get(key, default)
+
+  def __contains__(self, key):
+    return key in self.data
+
+  def __getitem__(self, key):
+    return self.data[key]
+
+  def __setitem__(self, key, value):
+    if len(self.data)>=self.maxsize:
+      self.data.clear()
+    self.data[key] = value
+
+  def reserve(self, n):
+    '''
+    Clear the cache if adding n more results would exceed its maximum size
+    '''
+    if len(self.data)+n>self.maxsize:
+      self.data.clear()
+
+  def update(self, items):
+    '''
+    Add a batch of results without evicting any entries
+    '''
+    self.data.update(items)
+
+
+def resolve_1kgenome_snp(name):
+  '''
+  Return a SNP record for a 1000 Genomes SNP name of the form
+  SNP<chrom>-<end> or None if the name is not of that form
+
+  >>> resolve_1kgenome_snp('SNP23-1000')
+  ('SNP23-1000', 'chrX', 999, 1000, '+', '?', '?', '?', '?', None)
+  >>> resolve_1kgenome_snp('rs1234') is None
+  True
+  '''
+  if name.startswith('SNP') and '-' in name:
+    try:
+      chrom,end = name[3:].split('-')
+      chrom = 'chr%s' % KGENOME_CHRMAP[int(chrom)]
+      end   = int(end)
+      return (name,chrom,end-1,end,'+','?','?','?','?',None)
+    except (ValueError,IndexError,KeyError):
+      pass
+  return None
+
+
+class GeneDBSession(object):
+  '''
+  Batched and cached genedb queries for annotating large numbers of
+  features.
+
+  SNP names are resolved in bulk using chunked queries against the SNP
+  table.  Genes and cytobands are loaded once per session into
+  per-chromosome interval trees, so that location queries do not require
+  any SQL statements.  When the database has a snapshot, SNP names, genes
+  and cytobands are resolved using its memory-mapped indexes instead.
+  Results of name based queries are cached.
+
+  Methods return the same results as the corresponding functions in
+  glu.lib.genedb.queries.
+  '''
+  def __init__(self, con, cache_size=100000, chunksize=500):
+    self.con        = con
+    self.snapshot   = getattr(con,'snapshot',None)
+    self.chunksize  = chunksize
+    self.snp_cache  = ResultCache(cache_size)
+    self.gene_cache = ResultCache(cache_size)
+    self.cyto_cache = ResultCache(cache_size)
+    self.genes      = None
+    self.cytobands  = None
+
+  # ---- SNPs ---------------------------------------------------------------
+
+  def _query_snp_chunk(self, names, canonical):
+    if self.snapshot is not None:
+      return dict( (name,self.snapshot.snps_by_name(name,canonical)) for name in names )
+
+    # Chunks must not exceed the SQLite limit of 999 parameters per statement
+    sql = '''
+    SELECT   name,chrom,start,end,strand,refAllele,alleles,vclass,func,weight
+    FROM     snp
+    WHERE    name IN (%s)''' % ','.join('?'*len(names))
+
+    if canonical:
+      sql += "\n      AND    chrom NOT LIKE '%!_%' ESCAPE '!'"
+
+    cur = self.con.cursor()
+    cur.execute(sql, names)
+
+    results = dict( (name,[]) for name in names )
+    for row in cur:
+      results[row[0]].append(row)
+
+    return results
+
+  def prefetch_snps(self, names, canonical=True):
+    '''
+    Resolve and cache a sequence of SNP names in bulk
+    '''
+    cache   = self.snp_cache
+    names   = set(name for name in names if name)
+    pending = []
+    results = {}
+
+    # Evict before loading, so that results for this batch remain cached
+    # until they are used
+    cache.reserve(len(names))
+
+    for name in names:
+      if (name,canonical) in cache:
+        continue
+
+      snp = resolve_1kgenome_snp(name)
+
+      if snp is not None:
+        results[name,canonical] = [snp]
+      elif '%' in name:
+        results[name,canonical] = query_snps_by_name(self.con,name,canonical)
+      else:
+        pending.append(name)
+
+    for block in chunk(pending,self.chunksize):
+      for name,snps in self._query_snp_chunk(block,canonical).iteritems():
+        results[name,canonical] = snps
+
+    cache.update(results)
+
+  def snps_by_names(self, names, canonical=True):
+    '''
+    Return a dictionary of SNP names to lists of SNP records
+    '''
+    names = list(names)
+    self.prefetch_snps(names,canonical)
+    return dict( (name,self.snps_by_name(name,canonical)) for name in names if name )
+
+  def snps_by_name(self, name, canonical=True):
+    results = self.snp_cache.get( (name,canonical) )
+
+    if results is None:
+      results = query_snps_by_name(self.con,name,canonical)
+      self.snp_cache[name,canonical] = results
+
+    return results
+
+  # ---- Genes --------------------------------------------------------------
+
+  def load_genes(self):
+    '''
+    Load all mapped gene transcripts into per-chromosome interval trees
+    '''
+    if self.genes is not None:
+      return self.genes
+
+    if self.snapshot is not None:
+      table  = self.snapshot.tables['gene']
+      fields = ('symbol','txStart','txEnd','strand')
+      self.genes = IntervalMap(table, lambda i: table.values(i,fields))
+      return self.genes
+
+    sql = '''
+    SELECT   symbol,chrom,txStart,txEnd,strand
+    FROM     gene
+    WHERE    txStart<>"" AND txEnd<>""
+    ORDER BY chrom,txStart,txEnd;
+    '''
+
+    genes = defaultdict(IntervalTree)
+    cur   = self.con.cursor()
+    cur.execute(sql)
+
+    for symbol,chrom,start,end,strand in cur:
+      genes[chrom].insert(start,end,(symbol,start,end,strand))
+
+    self.genes = genes
+    return genes
+
+  def gene_neighborhood(self, chrom, start, end, up, dn):
+    '''
+    Return genes with transcripts within up bases upstream and dn bases
+    downstream of the region [start,end), as done by
+    query_gene_neighborhood
+    '''
+    tree = self.load_genes().get(chrom)
+
+    if tree is None:
+      return []
+
+    d       = max(dn,up)
+    symbols = {}
+
+    for symbol,tx_start,tx_end,strand in tree.find_values(start-d,end+d):
+      if strand=='+':
+        near = tx_start<end+dn and tx_end>start-up
+      elif strand=='-':
+        near = tx_start<end+up and tx_end>start-dn
+      else:
+        near = False
+
+      if not near:
+        continue
+
+      gene = symbols.get(symbol)
+      if gene is None:
+        symbols[symbol] = [symbol,chrom,tx_start,tx_end,strand]
+      else:
+        gene[2] = min(gene[2],tx_start)
+        gene[3] = max(gene[3],tx_end)
+
+    genes = sorted(symbols.itervalues(), key=lambda g: (g[2],g[3],g[0]))
+
+    return [ tuple(g) for g in genes ]
+
+  def genes_by_name(self, gene, canonical_contig=True, canonical_transcript=None, mapped=None):
+    key     = gene,canonical_contig,canonical_transcript,mapped
+    results = self.gene_cache.get(key)
+
+    if results is None:
+      results = query_genes_by_name(self.con,gene,canonical_contig=canonical_contig,
+                                                  canonical_transcript=canonical_transcript,
+                                                  mapped=mapped)
+      self.gene_cache[key] = results
+
+    return results
+
+  # ---- Cytobands and contigs ----------------------------------------------
+
+  def load_cytobands(self):
+    '''
+    Load all cytobands into per-chromosome interval trees
+    '''
+    if self.cytobands is not None:
+      return self.cytobands
+
+    if self.snapshot is not None:
+      table  = self.snapshot.tables['cytoband']
+      fields = ('band','start','stop','color')
+      self.cytobands = IntervalMap(table, lambda i: table.values(i,fields))
+      return self.cytobands
+
+    sql = '''
+    SELECT   band,chrom,start,stop,color
+    FROM     cytoband
+    ORDER BY chrom,MIN(start,stop);
+    '''
+
+    bands = defaultdict(IntervalTree)
+    cur   = self.con.cursor()
+    cur.execute(sql)
+
+    for band,chrom,start,stop,color in cur:
+      bands[chrom].insert(min(start,stop),max(start,stop),(band,start,stop,color))
+
+    self.cytobands = bands
+    return bands
+
+  def _find_cytobands(self, chrom, start, end):
+    if chrom is None:
+      return None
+
+    if chrom.startswith('chr'):
+      chrom = chrom[3:]
+
+    tree = self.load_cytobands().get(chrom)
+
+    if tree is None:
+      return []
+
+    bands = tree.find_values(start,end)
+    bands.sort(key=lambda b: min(b[1],b[2]))
+    return bands
+
+  def cytoband_by_location(self, chrom, loc):
+    '''
+    Return the name of the cytoband containing loc and the list of
+    matching cytobands, as done by query_cytoband_by_location
+    '''
+    # Cytoband intervals are closed, so find intervals overlapping
+    # [loc-1,loc+1) in the half-open interval tree
+    bands = self._find_cytobands(chrom,loc-1,loc+1)
+
+    if bands is None:
+      return '',[]
+
+    return cytoband_name(bands),bands
+
+  def cytobands_by_location(self, chrom, start, end):
+    '''
+    Return the common name of the cytobands overlapping [start,end) and the
+    list of cytobands, as done by query_cytobands_by_location
+    '''
+    if start is None or end is None:
+      return '',[]
+
+    bands = self._find_cytobands(chrom,start,end)
+
+    if bands is None:
+      return '',[]
+
+    # Intervals are strictly overlapping, so exclude bands that only touch
+    bands = [ b for b in bands if b[1]<end and b[2]>start ]
+
+    return cytoband_name(bands),bands
+
+  def cytoband_by_name(self, name):
+    key = 'band',name
+    if key not in self.cyto_cache:
+      self.cyto_cache[key] = query_cytoband_by_name(self.con,name)
+    return self.cyto_cache[key]
+
+  def contig_by_name(self, name):
+    key = 'contig',name
+    if key not in self.cyto_cache:
+      self.cyto_cache[key] = query_contig_by_name(self.con,name)
+    return self.cyto_cache[key]
+
+
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
+if __name__ == '__main__':
+  _test()
@@ -0,0 +1,621 @@
+# -*- coding: utf-8 -*-
+
+__abstract__  = 'Read-only memory-mapped genedb snapshots'
+__copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
+__license__   = 'See GLU license for terms by running: glu license'
+__revision__  = '$Id$'
+
+
+import os
+import sys
+import json
+import bisect
+import shutil
+import sqlite3
+
+import numpy as np
+
+
+SNAPSHOT_VERSION   = 1
+SNAPSHOT_META      = 'snapshot.json'
+
+# Number of rows fetched and encoded at a time when building a snapshot
+SNAPSHOT_CHUNKSIZE = 100000
+
+# Column value codes for values that cannot be represented in numeric columns
+VALUE, NULL, EMPTY = 0,1,2
+
+# Tables are stored in the order of their interval index, which is computed
+# by SQLite, so that large tables are never sorted or held in memory
+SNAPSHOT_TABLES  = [ ('gene',     'SELECT * FROM gene',
+                                  'chrom,min(txStart,txEnd),rowid',
+                                  ('chrom','txStart','txEnd'), ['name','symbol']),
+                     ('alias',    'SELECT alias,name FROM alias',
+                                  'rowid',
+                                  None,                        ['alias']),
+                     ('snp',      'SELECT name,chrom,start,end,strand,refAllele,alleles,vclass,func,weight FROM snp',
+                                  'chrom,min(start,end),rowid',
+                                  ('chrom','start','end'),     ['name']),
+                     ('cytoband', 'SELECT band,chrom,start,stop,color FROM cytoband',
+                                  'chrom,min(start,stop),rowid',
+                                  ('chrom','start','stop'),    ['band']) ]
+
+
+def snapshot_path(filename):
+  '''
+  Return the snapshot directory name for a genedb database file
+
+  >>> snapshot_path('/data/genedb_hg19.db')
+  '/data/genedb_hg19.snapshot'
+  '''
+  if filename.endswith('.db'):
+    filename = filename[:-3]
+  return filename + '.snapshot'
+
+
+def load_array(filename):
+  '''
+  Memory-map an array file.  The array is returned as a plain ndarray view of
+  the map, since indexing np.memmap instances is several times slower.
+  '''
+  return np.asarray(np.load(filename, mmap_mode='r'))
+
+
+def column_kinds(con, sql, header):
+  '''
+  Determine the storage type of each column of a query by scanning the
+  column types in SQLite.  Columns are 'str' if any value other than NULL
+  or an empty string is text or a blob, otherwise 'float' if any value is
+  real and 'int' if not.
+
+  >>> con = sqlite3.connect(':memory:')
+  >>> cur = con.executescript("CREATE TABLE t (a,b,c); INSERT INTO t VALUES (1,2.5,'x');"
+  ...                   "INSERT INTO t VALUES (NULL,1,'');")
+  >>> column_kinds(con, 'SELECT * FROM t', ['a','b','c'])
+  ['int', 'float', 'str']
+  '''
+  terms = []
+  for name in header:
+    name = '"%s"' % name.replace('"','""')
+    terms.append("max(typeof(%s) IN ('text','blob') AND %s<>'')" % (name,name))
+    terms.append("max(typeof(%s)='real')" % name)
+
+  cur = con.cursor()
+  cur.execute('SELECT %s FROM (%s);' % (','.join(terms),sql))
+  flags = cur.fetchone()
+
+  return [ 'str' if is_str else 'float' if is_float else 'int'
+           for is_str,is_float in zip(flags[0::2],flags[1::2]) ]
+
+
+class ArrayWriter(object):
+  '''
+  Write a one-dimensional NumPy array file of unknown length in chunks.
+  Chunks are written to a temporary file, which is copied after the array
+  header once the length is known.
+  '''
+  def __init__(self, filename, dtype):
+    self.filename = filename
+    self.dtype    = np.dtype(dtype)
+    self.tmpname  = filename + '.tmp'
+    self.out      = open(self.tmpname,'wb')
+    self.length   = 0
+
+  def write(self, values):
+    values = np.asarray(values, dtype=self.dtype)
+    self.out.write(values.tostring())
+    self.length += len(values)
+
+  def close(self):
+    self.out.close()
+
+    header = dict(descr=np.lib.format.dtype_to_descr(self.dtype),
+                  fortran_order=False, shape=(self.length,))
+
+    with open(self.filename,'wb') as out:
+      np.lib.format.write_array_header_1_0(out, header)
+      with open(self.tmpname,'rb') as data:
+        shutil.copyfileobj(data, out, 1<<20)
+
+    os.unlink(self.tmpname)
+
+  def discard(self):
+    self.out.close()
+    os.unlink(self.tmpname)
+
+
+class ColumnEncoder(object):
+  '''
+  Encode a column of values of the specified kind into array files in
+  chunks of values
+  '''
+  def __init__(self, dirname, prefix, kind):
+    def _writer(name, dtype):
+      return ArrayWriter(os.path.join(dirname,'%s.%s.npy' % (prefix,name)), dtype)
+
+    self.kind       = kind
+    self.special    = _writer('special', np.int8)
+    self.anyspecial = False
+
+    if kind=='str':
+      self.offset  = 0
+      self.offsets = _writer('offsets', np.int64)
+      self.data    = _writer('data',    np.uint8)
+      self.offsets.write([0])
+    else:
+      self.values  = _writer('values', np.int64 if kind=='int' else float)
+
+  def write(self, values):
+    special = np.array([ NULL if v is None else EMPTY if v=='' else VALUE for v in values ], dtype=np.int8)
+    self.special.write(special)
+    self.anyspecial |= bool(special.any())
+
+    if self.kind=='str':
+      data    = [ v.encode('utf-8') if isinstance(v,unicode) else str(v) if v is not None else '' for v in values ]
+      lengths = np.fromiter( (len(v) for v in data), dtype=np.int64, count=len(data) )
+      self.offsets.write(self.offset+np.cumsum(lengths))
+      self.offset += int(lengths.sum())
+      data    = ''.join(data)
+      if data:
+        self.data.write(np.frombuffer(data, dtype=np.uint8))
+    else:
+      self.values.write([ v if v not in (None,'') else 0 for v in values ])
+
+  def close(self):
+    if self.anyspecial:
+      self.special.close()
+    else:
+      self.special.discard()
+
+    if self.kind=='str':
+      self.offsets.close()
+      self.data.close()
+    else:
+      self.values.close()
+
+
+class IntervalEncoder(object):
+  '''
+  Build the interval index of a table whose rows are supplied in chunks in
+  order of chromosome and start position
+  '''
+  def __init__(self, dirname, prefix):
+    def _writer(name):
+      return ArrayWriter(os.path.join(dirname,'%s.%s.npy' % (prefix,name)), np.int64)
+
+    self.dirname = dirname
+    self.prefix  = prefix
+    self.rows    = _writer('rows')
+    self.start   = _writer('start')
+    self.end     = _writer('end')
+    self.ranges  = {}
+    self.chrom   = None
+    self.lo      = 0
+    self.n       = 0
+
+  def write(self, row, chroms, starts, ends):
+    rows,lo,hi = [],[],[]
+
+    for i,(c,s,e) in enumerate(zip(chroms,starts,ends)):
+      if c is None or not isinstance(s,(int,long)) or not isinstance(e,(int,long)):
+        continue
+
+      if c!=self.chrom:
+        self._end_chrom(self.n+len(rows))
+        if c in self.ranges:
+          raise ValueError('Snapshot rows are not ordered by chromosome: %s' % c)
+        self.chrom = c
+        self.lo    = self.n+len(rows)
+
+      rows.append(row+i)
+      lo.append(min(s,e))
+      hi.append(max(s,e))
+
+    self.rows.write(rows)
+    self.start.write(lo)
+    self.end.write(hi)
+    self.n += len(rows)
+
+  def _end_chrom(self, hi):
+    if self.chrom is not None:
+      self.ranges[self.chrom] = (self.lo,hi)
+
+  def close(self):
+    self._end_chrom(self.n)
+    self.rows.close()
+    self.start.close()
+    self.end.close()
+
+    # Running maximum of end positions within each chromosome
+    end    = load_array(os.path.join(self.dirname,'%s.end.npy' % self.prefix))
+    maxend = ArrayWriter(os.path.join(self.dirname,'%s.maxend.npy' % self.prefix), np.int64)
+
+    for lo,hi in sorted(self.ranges.itervalues()):
+      carry = None
+      for i in xrange(lo,hi,SNAPSHOT_CHUNKSIZE):
+        chunk = np.maximum.accumulate(end[i:min(hi,i+SNAPSHOT_CHUNKSIZE)])
+        if carry is not None:
+          np.maximum(chunk,carry,out=chunk)
+        carry = chunk[-1]
+        maxend.write(chunk)
+
+    maxend.close()
+
+    return self.ranges
+
+
+def build_snapshot(con, dirname, source=None):
+  '''
+  Build a read-only snapshot of the gene, alias, SNP and cytoband tables
+  of a genedb database in directory dirname.  Each column is stored as a
+  separate NumPy array, along with sorted name indexes and interval
+  indexes, all of which are memory-mapped when the snapshot is opened.
+
+  Rows are read and encoded in chunks in the order of the interval index
+  and name indexes are sorted by SQLite, so memory use does not depend on
+  the size of the tables.
+
+  >>> import tempfile,shutil
+  >>> con = sqlite3.connect(':memory:')
+  >>> cur = con.executescript("CREATE TABLE snp (name,chrom,start,end,strand,refAllele,alleles,vclass,func,weight);"
+  ...                   "INSERT INTO snp VALUES ('rs2','chr1',300,301,'+','A','A/G','single','',1);"
+  ...                   "INSERT INTO snp VALUES ('rs1','chr1',100,101,'+','C','C/T','single','',1);"
+  ...                   "INSERT INTO snp VALUES ('rs3',NULL,NULL,NULL,'+','C','C/T','single','',1);"
+  ...                   "INSERT INTO snp VALUES ('rs1','chr2_hap',5,6,'+','C','C/T','single','',1);")
+  >>> dirname = tempfile.mkdtemp()
+  >>> meta = build_snapshot(con, dirname)
+  >>> snapshot = GeneDBSnapshot(dirname)
+  >>> snapshot.snps_by_name('rs1')
+  [(u'rs1', u'chr1', 100, 101, u'+', u'C', u'C/T', u'single', u'', 1)]
+  >>> len(snapshot.snps_by_name('rs1',canonical=False))
+  2
+  >>> snapshot.snps_by_name('rs3')
+  []
+  >>> snps = snapshot.tables['snp']
+  >>> [ snps.row(i)[0] for i in snps.intervals('chr1').find(0,1000) ]
+  [u'rs1', u'rs2']
+  >>> shutil.rmtree(dirname)
+  '''
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+
+  meta = dict(version=SNAPSHOT_VERSION, tables={})
+
+  if source:
+    st = os.stat(source)
+    meta['source'] = dict(size=st.st_size,mtime=int(st.st_mtime))
+
+  for table,sql,order,interval,names in SNAPSHOT_TABLES:
+    cur = con.cursor()
+
+    try:
+      cur.execute('%s LIMIT 0;' % sql)
+    except sqlite3.OperationalError:
+      continue
+
+    header = [ d[0] for d in cur.description ]
+    kinds  = column_kinds(con, sql, header)
+    names  = [ name for name in names if name in header ]
+    tmeta  = dict(rows=0,columns=zip(header,kinds),names=names,interval=None)
+
+    sys.stderr.write('[INFO] Building snapshot of %s table\n' % table)
+
+    columns = [ ColumnEncoder(dirname, '%s.%s' % (table,name), kind) for name,kind in zip(header,kinds) ]
+    icols   = [ header.index(name) for name in interval ] if interval else None
+    iindex  = IntervalEncoder(dirname, '%s.interval' % table) if interval else None
+    ncols   = [ header.index(name) for name in names ]
+
+    # Name indexes are sorted by SQLite from a temporary table of names and
+    # row numbers
+    if names:
+      con.execute('CREATE TEMP TABLE snapshot_names (col INTEGER, name, row INTEGER);')
+
+    cur.execute('%s ORDER BY %s;' % (sql,order))
+
+    while 1:
+      rows = cur.fetchmany(SNAPSHOT_CHUNKSIZE)
+
+      if not rows:
+        break
+
+      cols = zip(*rows)
+      row  = tmeta['rows']
+
+      for column,values in zip(columns,cols):
+        column.write(values)
+
+      if iindex is not None:
+        iindex.write(row, *[ cols[i] for i in icols ])
+
+      for j,i in enumerate(ncols):
+        con.executemany('INSERT INTO snapshot_names VALUES (?,?,?);',
+                        ( (j,v,row+k) for k,v in enumerate(cols[i]) if v is not None ))
+
+      tmeta['rows'] += len(rows)
+
+    for column in columns:
+      column.close()
+
+    if iindex is not None:
+      tmeta['interval'] = iindex.close()
+
+    for j,name in enumerate(names):
+      index = ArrayWriter(os.path.join(dirname,'%s.%s.index.npy' % (table,name)), np.int64)
+      ncur  = con.cursor()
+      ncur.execute('SELECT row FROM snapshot_names WHERE col=? ORDER BY name,row;', (j,))
+      while 1:
+        rows = ncur.fetchmany(SNAPSHOT_CHUNKSIZE)
+        if not rows:
+          break
+        index.write([ r[0] for r in rows ])
+      index.close()
+
+    if names:
+      con.execute('DROP TABLE snapshot_names;')
+
+    sys.stderr.write('[INFO] Built snapshot of %s table (%d rows)\n' % (table,tmeta['rows']))
+
+    meta['tables'][table] = tmeta
+
+  with open(os.path.join(dirname,SNAPSHOT_META),'w') as out:
+    json.dump(meta,out)
+
+  return meta
+
+
+class SnapshotColumn(object):
+  '''
+  Read-only column of a snapshot table
+  '''
+  def __init__(self, dirname, prefix, kind):
+    def _load(name):
+      filename = os.path.join(dirname,'%s.%s.npy' % (prefix,name))
+      if not os.path.exists(filename):
+        return None
+      return load_array(filename)
+
+    self.kind    = kind
+    self.special = _load('special')
+
+    if kind=='str':
+      self.data    = _load('data').data
+      self.offsets = _load('offsets')
+      self.values  = None
+    else:
+      self.values  = _load('values')
+
+  def __getitem__(self, i):
+    if self.special is not None:
+      code = self.special.item(i)
+      if code==NULL:
+        return None
+      elif code==EMPTY:
+        return u''
+
+    if self.values is not None:
+      return self.values.item(i)
+
+    offsets = self.offsets
+    return self.data[offsets.item(i):offsets.item(i+1)].decode('utf-8')
+
+
+class SnapshotTable(object):
+  '''
+  Read-only snapshot table with optional sorted name indexes and a
+  chromosome interval index
+  '''
+  def __init__(self, dirname, name, meta):
+    self.name         = name
+    self.rows         = meta['rows']
+    self.column_names = tuple( c for c,kind in meta['columns'] )
+    self.columns      = [ SnapshotColumn(dirname,'%s.%s' % (name,c),kind) for c,kind in meta['columns'] ]
+    self.column_map   = dict(zip(self.column_names,self.columns))
+
+    self.name_indexes = {}
+    for column in meta['names']:
+      index = load_array(os.path.join(dirname,'%s.%s.index.npy' % (name,column)))
+      self.name_indexes[column] = index
+
+    self.ranges = meta['interval']
+    if self.ranges is not None:
+      self.interval = dict( (key,load_array(os.path.join(dirname,'%s.interval.%s.npy' % (name,key))))
+                            for key in ('rows','start','end','maxend') )
+
+  def __len__(self):
+    return self.rows
+
+  def row(self, i):
+    return tuple( c[i] for c in self.columns )
+
+  def values(self, i, columns):
+    column_map = self.column_map
+    return tuple( column_map[c][i] for c in columns )
+
+  def find(self, column, value):
+    '''
+    Return the row numbers with the specified value of an indexed column
+    '''
+    index  = self.name_indexes[column]
+    values = IndexedColumn(self.column_map[column],index)
+    lo     = hi = bisect.bisect_left(values,value)
+    n      = len(values)
+
+    # Names are nearly unique, so scan forward rather than bisect again
+    while hi<n and values[hi]==value:
+      hi += 1
+
+    return index[lo:hi].tolist()
+
+  def intervals(self, chrom, factory=None):
+    '''
+    Return the interval index for a chromosome
+    '''
+    lo,hi = self.ranges.get(chrom,(0,0))
+    return IntervalIndex(self, lo, hi, factory or self.row)
+
+
+class IndexedColumn(object):
+  '''
+  Sequence view of a column in the order given by an index, for use with
+  bisect
+  '''
+  def __init__(self, column, index):
+    self.column = column
+    self.index  = index
+
+  def __len__(self):
+    return len(self.index)
+
+  def __getitem__(self, i):
+    return self.column[self.index.item(i)]
+
+
+class IntervalIndex(object):
+  '''
+  Interval index over the rows of a snapshot table on a single chromosome.
+  Intervals are sorted by start position and a running maximum of end
+  positions is kept, so that all intervals overlapping a query are found by
+  two binary searches.  Supports the same find_values query as IntervalTree
+  and may also be used as a sequence of values sorted by start position.
+  '''
+  def __init__(self, table, lo, hi, factory):
+    interval     = table.interval
+    self.rows    = interval['rows'][lo:hi]
+    self.start   = interval['start'][lo:hi]
+    self.end     = interval['end'][lo:hi]
+    self.maxend  = interval['maxend'][lo:hi]
+    self.factory = factory
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getitem__(self, i):
+    return self.factory(self.rows.item(i))
+
+  def __iter__(self):
+    factory = self.factory
+    for row in self.rows.tolist():
+      yield factory(row)
+
+  def find(self, start, end):
+    '''
+    Return row numbers of intervals overlapping [start,end) sorted by start
+    '''
+    lo = np.searchsorted(self.maxend, start, side='right')
+    hi = np.searchsorted(self.start,  end,   side='left')
+
+    if lo>=hi:
+      return []
+
+    mask = self.end[lo:hi]>start
+    return self.rows[lo:hi][mask].tolist()
+
+  def find_values(self, start, end):
+    factory = self.factory
+    return [ factory(row) for row in self.find(start,end) ]
+
+
+class IntervalMap(object):
+  '''
+  Mapping of chromosome names to interval indexes that returns an empty
+  index for unknown chromosomes
+  '''
+  def __init__(self, table, factory=None, prefix=''):
+    self.table   = table
+    self.factory = factory
+    self.prefix  = prefix
+    self.cache   = {}
+
+  def _chrom(self, chrom):
+    prefix = self.prefix
+    if prefix and chrom.startswith(prefix):
+      chrom = chrom[len(prefix):]
+    return chrom
+
+  def __getitem__(self, chrom):
+    index = self.cache.get(chrom)
+    if index is None:
+      index = self.cache[chrom] = self.table.intervals(self._chrom(chrom),self.factory)
+    return index
+
+  def get(self, chrom, default=None):
+    if self._chrom(chrom) not in self.table.ranges:
+      return default
+    return self[chrom]
+
+  def __contains__(self, chrom):
+    return self._chrom(chrom) in self.table.ranges
+
+
+class GeneDBSnapshot(object):
+  '''
+  Read-only memory-mapped snapshot of a genedb database.  Opening a
+  snapshot only maps its arrays, so startup does not depend on the size of
+  the database and the operating system page cache is shared by all
+  processes using the same snapshot.
+  '''
+  def __init__(self, dirname):
+    with open(os.path.join(dirname,SNAPSHOT_META)) as f:
+      meta = json.load(f)
+
+    if meta.get('version')!=SNAPSHOT_VERSION:
+      raise ValueError('Unsupported genedb snapshot version in %s' % dirname)
+
+    self.dirname = dirname
+    self.meta    = meta
+    self.tables  = dict( (str(name),SnapshotTable(dirname,str(name),tmeta))
+                         for name,tmeta in meta['tables'].iteritems() )
+
+  def is_current(self, filename):
+    '''
+    Return True if the snapshot was built from the current version of a
+    database file
+    '''
+    source = self.meta.get('source')
+    if not source:
+      return False
+    st = os.stat(filename)
+    return source['size']==st.st_size and source['mtime']==int(st.st_mtime)
+
+  def snps_by_name(self, name, canonical=True):
+    '''
+    Return SNP records with the specified name, as done by
+    query_snps_by_name for names without wildcards
+    '''
+    snps    = self.tables['snp']
+    results = [ snps.row(i) for i in snps.find('name',name) ]
+
+    # NULL chromosomes are excluded, as by the chrom NOT LIKE filter of
+    # query_snps_by_name
+    if canonical:
+      results = [ r for r in results if r[1] is not None and '_' not in r[1] ]
+
+    return results
+
+
+def open_snapshot(filename):
+  '''
+  Open the snapshot of a genedb database file, if one exists and was built
+  from the current version of the file.  Otherwise return None.
+  '''
+  dirname = snapshot_path(filename)
+
+  if not os.path.isfile(os.path.join(dirname,SNAPSHOT_META)):
+    return None
+
+  snapshot = GeneDBSnapshot(dirname)
+
+  if not snapshot.is_current(filename):
+    sys.stderr.write('[WARNING] Ignoring out of date genedb snapshot: %s\n' % dirname)
+    return None
+
+  return snapshot
+
+
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
+if __name__ == '__main__':
+  _test()
@@ -5,7 +5,7 @@ __copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Departmen
 __license__   = 'See GLU license for terms by running: glu license'
 __revision__  = '$Id$'
 
-from glu.lib.genolib.genoarray import genoarray_concordance, pick, \
+from glu.lib.genolib.genoarray import genoarray_concordance, genoarray_confusion, pick, \
                                       GenotypeLookupError, GenotypeRepresentationError, \
                                       build_model, build_descr
 from glu.lib.genolib.streams   import GenomatrixStream, GenotripleStream
@@ -2005,6 +2005,17 @@ genoarray_getcharbuf(GenotypeArrayObject *self, Py_ssize_t index, const char **p
 	return -1;
 }
 
+static int
+genoarray_getbuffer(GenotypeArrayObject *self, Py_buffer *view, int flags)
+{
+	/* Expose the packed genotype bytes as a read-only buffer without copying */
+	if( genoarray_checkstate(self) == -1 )
+		return -1;
+
+	return PyBuffer_FillInfo(view, (PyObject *)self, self->data,
+	                         self->descriptor->byte_size, 1, flags);
+}
+
 /******************************************************************************************************/
 
 typedef struct {
@@ -2073,6 +2084,184 @@ genotype_indices_func(PyObject *self, PyObject *args, PyObject *kw)
 
 /******************************************************************************************************/
 
+typedef struct {
+	signed char *indices;
+} genotype_index_matrix_state;
+
+static int index_matrix_foreach(Py_ssize_t i, GenotypeObject *geno, genotype_index_matrix_state *state)
+{
+	if(geno->index > 127)
+	{
+		PyErr_SetString(PyExc_OverflowError, "genotype index too large for an int8 matrix");
+		return -1;
+	}
+	state->indices[i] = geno->index;
+	return 0;
+}
+
+static int
+genoarray_unpack_indices(GenotypeArrayObject *genos, signed char *dest, Py_ssize_t len)
+{
+	const unsigned char *data = genos->data;
+	unsigned int *offsets;
+	Py_ssize_t i, j, datasize;
+	char *status;
+
+	offsets = (unsigned int *)PyArray_DATA(genos->descriptor->offsets);
+
+	if(offsets[0] == 0 && genos->descriptor->homogeneous == 2)
+	{
+		for(i=0; i < len; ++i)
+			dest[i] = (data[i>>2] >> (6-2*(i&3))) & 0x03;
+	}
+	else if(offsets[0] == 0 && genos->descriptor->homogeneous == 4)
+	{
+		for(i=0; i < len; ++i)
+			dest[i] = (data[i>>1] >> ((i&1) ? 0 : 4)) & 0x0F;
+	}
+	else if(offsets[0] == 0 && genos->descriptor->homogeneous == 8)
+	{
+		for(i=0; i < len; ++i)
+		{
+			if(data[i] > 127) goto overflow;
+			dest[i] = data[i];
+		}
+	}
+	else
+	{
+		datasize = genos->descriptor->byte_size;
+		for(i=0; i < len; ++i)
+		{
+			j = bitarray_getbits(data, datasize, offsets[i], offsets[i+1]-offsets[i], &status);
+
+			if(status)
+			{
+				PyErr_SetString(PyExc_IndexError, status);
+				return -1;
+			}
+			if(j > 127) goto overflow;
+			dest[i] = j;
+		}
+	}
+	return 0;
+
+overflow:
+	PyErr_SetString(PyExc_OverflowError, "genotype index too large for an int8 matrix");
+	return -1;
+}
+
+static PyObject *
+genotype_index_matrix(PyObject *rows, PyObject *out)
+{
+	genotype_index_matrix_state state;
+	PyObject *row, *matrix = NULL, *result;
+	Py_ssize_t i, n, m, len;
+	npy_intp dims[2], stride;
+	char *dest;
+
+	rows = PySequence_Fast(rows,"rows is not a sequence");
+	if(!rows) return NULL;
+
+	n = PySequence_Fast_GET_SIZE(rows);
+
+	if(out && out != Py_None)
+	{
+		if(!PyArray_Check(out) || PyArray_TYPE(out) != NPY_BYTE || PyArray_NDIM(out) != 2
+		                       || !PyArray_ISCARRAY((PyArrayObject *)out))
+		{
+			PyErr_SetString(PyExc_TypeError,"out must be a writable C-contiguous 2d int8 array");
+			goto error;
+		}
+
+		m = n ? PyObject_Size(PySequence_Fast_GET_ITEM(rows,0)) : PyArray_DIM(out,1);
+		if(m == -1) goto error;
+
+		if(PyArray_DIM(out,0) < n || PyArray_DIM(out,1) != m)
+		{
+			PyErr_Format(PyExc_ValueError,"out array cannot hold %zd rows of %zd genotypes", n, m);
+			goto error;
+		}
+
+		Py_INCREF(out);
+		matrix = out;
+	}
+	else
+	{
+		m = n ? PyObject_Size(PySequence_Fast_GET_ITEM(rows,0)) : 0;
+		if(m == -1) goto error;
+
+		dims[0] = n;
+		dims[1] = m;
+		matrix  = PyArray_SimpleNew(2,dims,NPY_BYTE);
+		if(!matrix) goto error;
+	}
+
+	dest   = PyArray_DATA(matrix);
+	stride = PyArray_STRIDE(matrix,0);
+
+	for(i=0; i < n; ++i, dest += stride)
+	{
+		row = PySequence_Fast_GET_ITEM(rows,i);
+
+		if( GenotypeArray_Check(row) )
+		{
+			if( genoarray_checkstate((GenotypeArrayObject *)row) == -1 )
+				goto error;
+			len = genoarray_length((GenotypeArrayObject *)row);
+		}
+		else
+			len = PyObject_Size(row);
+
+		if(len == -1) goto error;
+
+		if(len != m)
+		{
+			PyErr_Format(PyExc_ValueError,"row %zd has %zd genotypes, expected %zd", i, len, m);
+			goto error;
+		}
+
+		if( GenotypeArray_Check(row) )
+		{
+			if( genoarray_unpack_indices((GenotypeArrayObject *)row, (signed char *)dest, m) < 0)
+				goto error;
+		}
+		else
+		{
+			state.indices = (signed char *)dest;
+			if( for_each_genotype(row, (geno_foreach)index_matrix_foreach, &state) < 0)
+				goto error;
+		}
+	}
+
+	Py_DECREF(rows);
+
+	if(PyArray_DIM(matrix,0) == n)
+		return matrix;
+
+	result = PySequence_GetSlice(matrix,0,n);
+	Py_DECREF(matrix);
+	return result;
+
+error:
+	Py_DECREF(rows);
+	Py_XDECREF(matrix);
+	return NULL;
+}
+
+static PyObject *
+genotype_index_matrix_func(PyObject *self, PyObject *args, PyObject *kw)
+{
+	PyObject *rows, *out=NULL;
+	static char *kwlist[] = {"rows", "out", 0};
+
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "O|O:genotype_index_matrix", kwlist, &rows, &out))
+		return NULL;
+
+	return genotype_index_matrix(rows, out);
+}
+
+/******************************************************************************************************/
+
 typedef struct {
 	unsigned long *counts;
 } genotype_counts_state;
@@ -2307,6 +2496,8 @@ static PyBufferProcs genoarray_as_buffer = {
 	(writebufferproc)genoarray_getwritebuf,
 	(segcountproc)genoarray_getsegcount,
 	(charbufferproc)genoarray_getcharbuf,
+	(getbufferproc)genoarray_getbuffer,
+	0,
 };
 
 static PyGetSetDef genoarray_getsetlist[] = {
@@ -2364,7 +2555,7 @@ PyTypeObject GenotypeArrayType = {
 	0,					/* tp_getattro       */
 	0,					/* tp_setattro       */
 	&genoarray_as_buffer,			/* tp_as_buffer      */
-	Py_TPFLAGS_DEFAULT,			/* tp_flags          */
+	Py_TPFLAGS_DEFAULT|Py_TPFLAGS_HAVE_NEWBUFFER,	/* tp_flags          */
 	genoarray_doc,				/* tp_doc            */
 	(traverseproc)genoarray_traverse,	/* tp_traverse       */
 	(inquiry)genoarray_clear,		/* tp_clear          */
@@ -2823,6 +3014,358 @@ sample_summary_func(PyObject *self, PyObject *args, PyObject *kw)
 
 /******************************************************************************************************/
 
+static Py_ssize_t
+genotype_model_len(PyObject *genos)
+{
+	UnphasedMarkerModelObject *model = NULL;
+	GenotypeObject *geno;
+	Py_ssize_t len;
+
+	if(GenotypeArray_Check(genos))
+	{
+		GenotypeArrayObject *garray = (GenotypeArrayObject *)genos;
+		model = (UnphasedMarkerModelObject *)PyList_GetItem(garray->descriptor->models, 0); /* borrowed ref */
+		if(!model) return -1;
+	}
+	else
+	{
+		len = PyObject_Size(genos);
+		if(len==-1) return -1;
+		if(!len) return 1;
+
+		geno = (GenotypeObject *)PySequence_GetItem(genos, 0);
+		if(!geno || !Genotype_CheckExact(geno))
+		{
+			PyErr_Format(GenotypeRepresentationError,
+			    "invalid genotype object in genos at index %zd", 0L);
+			Py_XDECREF(geno);
+			return -1;
+		}
+		model = geno->model; /* borrowed ref */
+		Py_DECREF(geno);
+	}
+
+	if(!model || !UnphasedMarkerModel_CheckExact(model))
+	{
+		PyErr_SetString(PyExc_TypeError,"invalid genotype model");
+		return -1;
+	}
+
+	return PyList_Size(model->genotypes);
+}
+
+static PyObject *
+genoarray_confusion(PyObject *genos1, PyObject *genos2, PyObject *cols1, PyObject *cols2, PyObject *table)
+{
+	PyObject *indices1=NULL, *indices2=NULL, *ret=NULL;
+	const unsigned int *idx1, *idx2;
+	const npy_intp *c1=NULL, *c2=NULL;
+	npy_intp dims[2], len1, len2, len, i;
+	unsigned int a, b;
+	long *counts;
+
+	if(cols1==Py_None) cols1=NULL;
+	if(cols2==Py_None) cols2=NULL;
+	if(table==Py_None) table=NULL;
+
+	Py_XINCREF(table);
+
+	indices1 = genotype_indices(genos1, NULL);
+	if(!indices1) goto error;
+	indices2 = genotype_indices(genos2, NULL);
+	if(!indices2) goto error;
+
+	len1 = PyArray_DIMS(indices1)[0];
+	len2 = PyArray_DIMS(indices2)[0];
+
+	if(cols1)
+	{
+		cols1 = PyArray_ContiguousFromAny(cols1, NPY_INTP, 1, 1);
+		if(!cols1) goto error;
+		c1 = (const npy_intp *)PyArray_DATA(cols1);
+	}
+	if(cols2)
+	{
+		cols2 = PyArray_ContiguousFromAny(cols2, NPY_INTP, 1, 1);
+		if(!cols2) goto error;
+		c2 = (const npy_intp *)PyArray_DATA(cols2);
+	}
+
+	len = cols1 ? PyArray_DIMS(cols1)[0] : len1;
+
+	if( (cols2 ? PyArray_DIMS(cols2)[0] : len2) != len)
+	{
+		PyErr_Format(GenotypeRepresentationError,"genotype array sizes do not match: %zd != %zd",
+		             (Py_ssize_t)len, (Py_ssize_t)(cols2 ? PyArray_DIMS(cols2)[0] : len2));
+		goto error;
+	}
+
+	if(table)
+	{
+		if(!CountArray_Check2(table,PyArray_DIMS(table)[0],PyArray_DIMS(table)[1])
+		   || !PyArray_ISCARRAY(table))
+		{
+			PyErr_SetString(PyExc_ValueError,"invalid confusion table");
+			goto error;
+		}
+		dims[0] = PyArray_DIMS(table)[0];
+		dims[1] = PyArray_DIMS(table)[1];
+	}
+	else
+	{
+		dims[0] = genotype_model_len(genos1);
+		if(dims[0] < 0) goto error;
+		dims[1] = genotype_model_len(genos2);
+		if(dims[1] < 0) goto error;
+
+		table = PyArray_SimpleNew(2,dims,NPY_LONG);
+		if(!table) goto error;
+		PyArray_FILLWBYTE(table, 0);
+	}
+
+	idx1   = (const unsigned int *)PyArray_DATA(indices1);
+	idx2   = (const unsigned int *)PyArray_DATA(indices2);
+	counts = (long *)PyArray_DATA(table);
+
+	for(i = 0; i < len; ++i)
+	{
+		const npy_intp j = c1 ? c1[i] : i;
+		const npy_intp k = c2 ? c2[i] : i;
+
+		if(j < 0 || j >= len1 || k < 0 || k >= len2)
+		{
+			PyErr_SetString(PyExc_IndexError,"column index out of range");
+			goto error;
+		}
+
+		a = idx1[j];
+		b = idx2[k];
+
+		if(a >= dims[0] || b >= dims[1])
+		{
+			PyErr_SetString(PyExc_ValueError,"genotype index exceeds confusion table size");
+			goto error;
+		}
+
+		counts[a*dims[1] + b] += 1;
+	}
+
+	Py_INCREF(table);
+	ret = table;
+
+error:
+	Py_XDECREF(indices1);
+	Py_XDECREF(indices2);
+	Py_XDECREF(cols1);
+	Py_XDECREF(cols2);
+	Py_XDECREF(table);
+	return ret;
+}
+
+static PyObject *
+genoarray_confusion_func(PyObject *self, PyObject *args, PyObject *kw)
+{
+	PyObject *genos1, *genos2, *cols1=NULL, *cols2=NULL, *table=NULL;
+	static char *kwlist[] = {"genos1", "genos2", "indices1", "indices2", "table", 0};
+
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "OO|OOO:genoarray_confusion", kwlist,
+	                                &genos1, &genos2, &cols1, &cols2, &table))
+		return NULL;
+
+	return genoarray_confusion(genos1, genos2, cols1, cols2, table);
+}
+
+/******************************************************************************************************/
+
+static PyObject *
+pick_recode(PyObject *descr, PyObject *genos, PyObject *cols, PyObject *tables, PyObject *ids)
+{
+	GenotypeArrayDescriptorObject *descriptor;
+	GenotypeArrayObject *result=NULL;
+	UnphasedMarkerModelObject *model;
+	PyObject *indices=NULL, *models, *ret=NULL;
+	const unsigned int *idx, *offsets;
+	const npy_intp *c=NULL, *t=NULL;
+	const int *table=NULL;
+	npy_intp srclen, len, ntables=1, width=0, i, j, tid;
+	long k;
+	char *status;
+
+	if(cols==Py_None)   cols=NULL;
+	if(tables==Py_None) tables=NULL;
+	if(ids==Py_None)    ids=NULL;
+
+	if(!GenotypeArrayDescriptor_CheckExact(descr))
+	{
+		PyErr_SetString(PyExc_TypeError,"invalid descriptor object");
+		return NULL;
+	}
+
+	descriptor = (GenotypeArrayDescriptorObject *)descr;
+	models     = descriptor->models;
+
+	if(!models || !PyList_Check(models))
+	{
+		PyErr_SetString(PyExc_TypeError,"models must be a list");
+		return NULL;
+	}
+
+	len = PyList_GET_SIZE(models);
+
+	/* Convert arguments to new array references, released on exit */
+	if(cols && !(cols = PyArray_ContiguousFromAny(cols, NPY_INTP, 1, 1)))
+		return NULL;
+
+	if(tables && !(tables = PyArray_ContiguousFromAny(tables, NPY_INT, 1, 2)))
+	{
+		Py_XDECREF(cols);
+		return NULL;
+	}
+
+	if(ids && !(ids = PyArray_ContiguousFromAny(ids, NPY_INTP, 1, 1)))
+	{
+		Py_XDECREF(cols);
+		Py_XDECREF(tables);
+		return NULL;
+	}
+
+	indices = genotype_indices(genos, NULL);
+	if(!indices) goto error;
+
+	srclen = PyArray_DIMS(indices)[0];
+
+	if(cols)
+	{
+		if(PyArray_DIMS(cols)[0] != len)
+		{
+			PyErr_SetString(PyExc_ValueError,"number of column indices does not match descriptor");
+			goto error;
+		}
+		c = (const npy_intp *)PyArray_DATA(cols);
+	}
+	else if(srclen != len)
+	{
+		PyErr_Format(GenotypeRepresentationError,"genotype array sizes do not match: %zd != %zd",
+		             (Py_ssize_t)srclen, (Py_ssize_t)len);
+		goto error;
+	}
+
+	if(tables)
+	{
+		if(PyArray_NDIM(tables) == 2)
+		{
+			ntables = PyArray_DIMS(tables)[0];
+			width   = PyArray_DIMS(tables)[1];
+		}
+		else
+			width   = PyArray_DIMS(tables)[0];
+
+		table = (const int *)PyArray_DATA(tables);
+
+		if(ids)
+		{
+			if(PyArray_DIMS(ids)[0] != len)
+			{
+				PyErr_SetString(PyExc_ValueError,"number of table indices does not match descriptor");
+				goto error;
+			}
+			t = (const npy_intp *)PyArray_DATA(ids);
+		}
+		else if(ntables != 1)
+		{
+			PyErr_SetString(PyExc_ValueError,"table indices are required for multiple recode tables");
+			goto error;
+		}
+	}
+
+	result = (GenotypeArrayObject *)GenotypeArrayType.tp_alloc(&GenotypeArrayType, descriptor->byte_size);
+	if(!result) goto error;
+
+	result->descriptor = descriptor;
+	Py_INCREF(descriptor);
+
+	idx     = (const unsigned int *)PyArray_DATA(indices);
+	offsets = (const unsigned int *)PyArray_DATA(descriptor->offsets);
+
+	for(i = 0; i < len; ++i)
+	{
+		j = c ? c[i] : i;
+
+		if(j < 0 || j >= srclen)
+		{
+			PyErr_SetString(PyExc_IndexError,"column index out of range");
+			goto error;
+		}
+
+		k = idx[j];
+
+		if(table)
+		{
+			tid = t ? t[i] : 0;
+
+			if(tid < 0 || tid >= ntables)
+			{
+				PyErr_SetString(PyExc_IndexError,"recode table index out of range");
+				goto error;
+			}
+
+			if(k >= width || (k = table[tid*width + k]) < 0)
+			{
+				PyErr_SetString(GenotypeRepresentationError,"genotype cannot be recoded");
+				goto error;
+			}
+		}
+
+		model = (UnphasedMarkerModelObject *)PyList_GET_ITEM(models, i); /* borrowed ref */
+
+		if(!UnphasedMarkerModel_CheckExact(model))
+		{
+			PyErr_SetString(PyExc_TypeError,"invalid genotype model");
+			goto error;
+		}
+
+		if(k >= PyList_GET_SIZE(model->genotypes))
+		{
+			PyErr_SetString(GenotypeRepresentationError,"Invalid genotype encoding");
+			goto error;
+		}
+
+		bitarray_setbits(result->data, descriptor->byte_size, offsets[i], k, offsets[i+1]-offsets[i], &status);
+
+		if(status)
+		{
+			PyErr_SetString(PyExc_IndexError, status);
+			goto error;
+		}
+	}
+
+	ret    = (PyObject *)result;
+	result = NULL;
+
+error:
+	Py_XDECREF(result);
+	Py_XDECREF(indices);
+	Py_XDECREF(cols);
+	Py_XDECREF(tables);
+	Py_XDECREF(ids);
+	return ret;
+}
+
+static PyObject *
+pick_recode_func(PyObject *self, PyObject *args, PyObject *kw)
+{
+	PyObject *descr, *genos, *cols=NULL, *tables=NULL, *ids=NULL;
+	static char *kwlist[] = {"descriptor", "genos", "indices", "tables", "table_indices", 0};
+
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "OO|OOO:pick_recode", kwlist,
+	                                &descr, &genos, &cols, &tables, &ids))
+		return NULL;
+
+	return pick_recode(descr, genos, cols, tables, ids);
+}
+
+/******************************************************************************************************/
+
 
 /******************************************************************************************************/
 
@@ -3803,6 +4346,8 @@ init_genoarray(void)
 	static PyMethodDef genoarraymodule_methods[] = {
 		{"genotype_indices",            (PyCFunction)genotype_indices_func,	METH_KEYWORDS,
 		 "Return an array of integer genotype indices"},
+		{"genotype_index_matrix",	(PyCFunction)genotype_index_matrix_func,	METH_KEYWORDS,
+		 "Decode a sequence of genotype rows into a 2d int8 matrix of genotype indices"},
 		{"count_genotypes",	(PyCFunction)count_genotypes_func,	METH_KEYWORDS,
 		 "Return an array of genotype counts by index"},
 		{"genotype_categories",	(PyCFunction)genotypes_categories_func,	METH_KEYWORDS,
@@ -3813,6 +4358,8 @@ init_genoarray(void)
 		 "Count genotypes and categories for genotypes for a single sample"},
 		{"genoarray_concordance",	genoarray_concordance,	METH_VARARGS,
 		 "Generate simple concordance statistics from two genotype arrays"},
+		{"genoarray_confusion",	(PyCFunction)genoarray_confusion_func,	METH_KEYWORDS,
+		 "Count pairs of genotype indices from two genotype arrays"},
 		{"genoarray_concordance_8bit",	genoarray_concordance_8bit,	METH_VARARGS,
 		 "Generate simple concordance statistics from two genotype arrays stored in 8-bit format"},
 		{"genoarray_concordance_4bit",genoarray_concordance_4bit,	METH_VARARGS,
@@ -3829,6 +4376,8 @@ init_genoarray(void)
 		 "Generate counts of alleles shared IBS between two genotype arrays stored in 2-bit format"},
 		{"pick",	pick,	METH_VARARGS,
 		 "Pick items from a sequence given indices"},
+		{"pick_recode",	(PyCFunction)pick_recode_func,	METH_KEYWORDS,
+		 "Pick genotypes from a genotype sequence and recode their indices into a new genotype array"},
 		{"pick_columns",	pick_columns,	METH_VARARGS,
 		 "Pick one or more columns from a two dimensional sequence"},
 		{"place",	place,	METH_VARARGS,
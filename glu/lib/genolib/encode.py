@@ -13,12 +13,14 @@ import sys
 from   operator                  import getitem
 from   itertools                 import izip,imap,repeat,count
 
+import numpy as np
+
 from   glu.lib.utils             import is_str
 
 from   glu.lib.genolib.locus     import Genome
 from   glu.lib.genolib.genoarray import GenotypeArrayDescriptor,GenotypeArray,            \
                                         GenotypeLookupError, GenotypeRepresentationError, \
-                                        build_model, build_descr
+                                        build_model, build_descr, pick, pick_recode
 
 
 def _sample_encoding_error(loci,models,genos,warn=False):
@@ -66,7 +68,7 @@ def merge_locus(loc,new_model):
     loc.model = new_model
   else:
     # Recoding needed
-    loc.model = build_model(alleles=new_model.alleles[1:],base=loc.model)
+    loc.model = merged_model(loc.model,new_model)
 
     return True
 
@@ -82,7 +84,41 @@ def merge_locus2(old_model,new_model):
     return False,new_model
 
   # Recoding needed
-  return True,build_model(alleles=new_model.alleles[1:],base=old_model)
+  return True,merged_model(old_model,new_model)
+
+
+_merged_models = {}
+
+
+def merged_model(base, model):
+  '''
+  Return a model that extends base with the alleles of model.  Results are
+  remembered for each pair of models and their current sizes, since
+  streams typically contain few distinct models and building a model
+  requires constructing a lookup key.
+
+  >>> base  = build_model('AB',max_alleles=3)
+  >>> model = build_model('BC')
+  >>> merged = merged_model(base,model)
+  >>> merged.alleles
+  [None, 'A', 'B', 'C']
+  >>> merged_model(base,model) is merged
+  True
+  >>> merged is build_model(alleles=model.alleles[1:],base=base)
+  True
+  '''
+  key   = id(base),id(model),len(base.genotypes),len(model.alleles)
+  entry = _merged_models.get(key)
+
+  if entry is None or entry[0] is not base or entry[1] is not model:
+    merged = build_model(alleles=model.alleles[1:],base=base)
+
+    if len(_merged_models)>=10000:
+      _merged_models.clear()
+
+    entry = _merged_models[key] = base,model,merged
+
+  return entry[2]
 
 
 def update_model(old_model, new_model):
@@ -170,7 +206,7 @@ def pack_genomatrixstream(genos):
   return genos.clone(_pack(genos),packed=True,materialized=False,updates=updates)
 
 
-def recode_genomatrixstream(genos, genome, warn=False):
+def recode_genomatrixstream(genos, genome, warn=False, columns=None):
   '''
   Returns a new genomatrix with the genotypes encoded with representations
   defined by the supplied genome object.  Locus metadata other than models
@@ -178,10 +214,16 @@ def recode_genomatrixstream(genos, genome, warn=False):
   all genotypes are recoded to use the same representation provided the
   models are compatible.
 
+  Columns may optionally be selected by index, in which case selection and
+  recoding of packed rows are performed together by pick_recode using
+  integer recode tables for each pair of models.
+
   @param        genos: genomatrix stream
   @type         genos: sequence
   @param       genome: genome descriptor
   @type        genome: Genome instance
+  @param      columns: indices of columns to select (optional)
+  @type       columns: sequence of int
   @return            : new genomatrixstream with encoding identical to the
                        supplied genome
   @rtype             : GenomatrixStream
@@ -292,6 +334,31 @@ def recode_genomatrixstream(genos, genome, warn=False):
   ...   assert genome.get_model(locus) is model
   >>> for locus,model in genos2.model_pairs:
   ...   assert genome.get_model(locus) is model
+
+  Test column selection while recoding
+
+  >>> genome = Genome()
+  >>> genome.set_locus('l1',build_model('TG'))
+  >>> genos = GenomatrixStream.from_tuples(rows1,'ldat',samples=samples)
+  >>> genos = recode_genomatrixstream(genos, genome, columns=[2,0]).materialize()
+  >>> genos.samples
+  ('s3', 's1')
+  >>> for locus,row in genos:
+  ...   print locus,row
+  l1 [('T', 'T'), ('G', 'G')]
+  l2 [('A', 'T'), ('A', 'A')]
+  >>> genos.models[0] is genome.get_model('l1')
+  True
+
+  >>> genos = GenomatrixStream.from_tuples(rows1,'ldat',samples=samples).as_sdat()
+  >>> genos = recode_genomatrixstream(genos, genome, columns=[1]).materialize()
+  >>> genos.loci
+  ('l2',)
+  >>> for sample,row in genos:
+  ...   print sample,row
+  s1 [('A', 'A')]
+  s2 [('T', 'T')]
+  s3 [('A', 'T')]
   '''
   # Fastpath for null recoding -- DISABLED due to some operations leaving
   # streams with inconsistent encoding (like renaming ldat rows)
@@ -302,9 +369,18 @@ def recode_genomatrixstream(genos, genome, warn=False):
   models  = []
   updates = []
 
+  if columns is not None:
+    columns = np.asarray(columns,dtype=int)
+
   if genos.format=='ldat':
+    samples = genos.samples
+    loci    = genos.loci
+
+    if columns is not None:
+      samples = tuple(pick(samples,columns))
+
     def _recode_genomatrixstream():
-      n = len(genos.samples)
+      n = len(samples)
 
       for (lname,row),old_model in izip(genos,genos.models):
         old_locus = genos.genome.loci[lname]
@@ -326,10 +402,10 @@ def recode_genomatrixstream(genos, genome, warn=False):
 
         model = loc.model
 
-        # If recoding or packing is required
-        if recode or not genos.packed:
+        # If recoding, selection or packing is required
+        if recode or not genos.packed or columns is not None:
           descr = build_descr(model,n)
-          row   = GenotypeArray(descr,row)
+          row   = _recode_row(descr,row,columns)
 
         # N.B. Does not aggressively recode model to loc.model unless
         # encoding changed or stream is not packed
@@ -341,7 +417,16 @@ def recode_genomatrixstream(genos, genome, warn=False):
   elif genos.format=='sdat':
     assert genos.loci is not None and len(genos.loci) == len(genos.models)
 
-    for i,lname in enumerate(genos.loci):
+    samples  = genos.samples
+    loci     = genos.loci
+    selected = xrange(len(loci))
+
+    if columns is not None:
+      loci     = tuple(pick(loci,columns))
+      selected = columns
+
+    for i in selected:
+      lname = genos.loci[i]
       old_locus = genos.genome.loci[lname]
       old_model = old_locus.model or genos.models[i]
 
@@ -364,11 +449,17 @@ def recode_genomatrixstream(genos, genome, warn=False):
     # No FASTPATH is generally possible, since other streams may be updating our genome
 
     def _recode_genomatrixstream():
-      descr = GenotypeArrayDescriptor(models)
+      descr    = GenotypeArrayDescriptor(models)
+      plan     = RecodePlan(descr,columns)
+      indexmap = dict( (i,j) for j,i in enumerate(selected) )
 
       for sample,row in genos:
         if genos.updates:
           for i,model in genos.updates:
+            j = indexmap.get(i)
+            if j is None:
+              continue
+
             loc = genome.get_locus(genos.loci[i])
             old_model = loc.model
 
@@ -377,21 +468,218 @@ def recode_genomatrixstream(genos, genome, warn=False):
             except GenotypeRepresentationError:
               _encoding_error(genos.loci[i],set(old_model.alleles)-set(model.alleles),model,warn)
 
-            if loc.model is not models[i]:
-              descr[i] = models[i] = loc.model
-              updates.append( (i,loc.model) )
+            if loc.model is not models[j]:
+              descr[j] = models[j] = loc.model
+              updates.append( (j,loc.model) )
 
           genos.updates[:] = []
+          plan.invalidate()
 
-        row = GenotypeArray(descr,row)
-
-        yield sample,row
+        yield sample,plan(row)
 
   else:
     raise ValueError('Unknown format')
 
   return genos.clone(_recode_genomatrixstream(),models=models,updates=updates,
-                     genome=genome,packed=True,materialized=False)
+                     genome=genome,samples=samples,loci=loci,packed=True,materialized=False)
+
+
+class RecodeTableCache(object):
+  '''
+  Bounded cache of recode tables for pairs of models.  Entries hold
+  references to both models, so that the model ids used as keys remain
+  valid, and are rebuilt when either model has gained genotypes since the
+  table was built.  The cache is cleared when it reaches its maximum size.
+
+  >>> cache = RecodeTableCache()
+  >>> old_model = build_model('AB')
+  >>> new_model = build_model(genotypes=[('B','B'),('A','B'),('A','A')])
+  >>> table = cache.get(old_model,new_model)
+  >>> table.tolist()
+  [0, 3, 2, 1]
+  >>> cache.get(old_model,new_model) is table
+  True
+  '''
+  def __init__(self, maxsize=10000):
+    self.maxsize = maxsize
+    self.data    = {}
+
+  def get(self, old_model, new_model):
+    key   = id(old_model),id(new_model)
+    entry = self.data.get(key)
+
+    if entry is not None and len(entry[2])==len(old_model.genotypes) \
+                         and entry[3]==len(new_model.genotypes):
+      return entry[2]
+
+    table = _build_recode_table(old_model,new_model)
+    table.flags.writeable = False
+
+    if len(self.data)>=self.maxsize:
+      self.data.clear()
+
+    self.data[key] = (old_model,new_model,table,len(new_model.genotypes))
+
+    return table
+
+
+def _build_recode_table(old_model, new_model):
+  if old_model is new_model:
+    return np.arange(len(old_model.genotypes),dtype=np.int32)
+
+  genomap = new_model.genomap
+  table   = [ getattr(genomap.get(g.alleles()),'index',-1) for g in old_model.genotypes ]
+
+  return np.array(table,dtype=np.int32)
+
+
+recode_table_cache = RecodeTableCache()
+
+
+def recode_table(old_model, new_model):
+  '''
+  Return an array that maps genotype indices of old_model to the indices of
+  the same genotypes in new_model.  Genotypes not present in new_model are
+  mapped to -1.  Tables are shared through a cache, since loci of large
+  streams typically share a small number of distinct models, and must not
+  be modified.
+
+  >>> old_model = build_model('AB')
+  >>> new_model = build_model(genotypes=[('B','B'),('A','B'),('A','A'),('C','C')])
+  >>> old_model.genotypes
+  [(None, None), ('A', 'A'), ('A', 'B'), ('B', 'B')]
+  >>> new_model.genotypes
+  [(None, None), ('B', 'B'), ('A', 'B'), ('A', 'A'), ('C', 'C'), ('A', 'C'), ('B', 'C')]
+  >>> recode_table(old_model, new_model).tolist()
+  [0, 3, 2, 1]
+  >>> recode_table(new_model, old_model).tolist()
+  [0, 3, 2, 1, -1, -1, -1]
+
+  Tables are rebuilt once models gain genotypes:
+
+  >>> new_model = build_model(alleles='AB',max_alleles=3)
+  >>> recode_table(old_model, new_model).tolist()
+  [0, 1, 2, 3]
+  >>> recode_table(new_model, old_model).tolist()
+  [0, 1, 2, 3]
+  >>> g = new_model.add_genotype(('A','C'))
+  >>> recode_table(new_model, old_model).tolist()
+  [0, 1, 2, 3, -1]
+  '''
+  return recode_table_cache.get(old_model,new_model)
+
+
+def recode_tables(old_models, new_models):
+  '''
+  Return a two dimensional array with a recode table for each distinct pair
+  of old and new models and the index of the table used by each pair.
+  Tables are padded with -1.
+
+  >>> model1 = build_model('AB')
+  >>> model2 = build_model(genotypes=[('B','B'),('A','B'),('A','A')])
+  >>> tables,indices = recode_tables([model1,model1,model2],[model2,model2,model2])
+  >>> tables.tolist()
+  [[0, 3, 2, 1], [0, 1, 2, 3]]
+  >>> indices.tolist()
+  [0, 0, 1]
+  '''
+  tableindex = {}
+  tables     = []
+  indices    = []
+
+  for old_model,new_model in izip(old_models,new_models):
+    key = id(old_model),id(new_model)
+    i   = tableindex.get(key)
+
+    if i is None:
+      i = tableindex[key] = len(tables)
+      tables.append(recode_table(old_model,new_model))
+
+    indices.append(i)
+
+  width  = max(len(table) for table in tables) if tables else 0
+  result = np.empty( (len(tables),width), dtype=np.int32 )
+  result.fill(-1)
+
+  for i,table in enumerate(tables):
+    result[i,:len(table)] = table
+
+  return result,np.array(indices,dtype=int)
+
+
+def _recode_row(descr, row, columns=None, tables=None, table_indices=None):
+  '''
+  Select and recode the genotypes of a row into a new genotype array
+  '''
+  if isinstance(row,GenotypeArray):
+    if tables is None and len(row) and len(descr):
+      source = row.descriptor[0]
+      target = descr[0]
+      if source is not target:
+        tables = recode_table(source,target)
+
+    try:
+      return pick_recode(descr,row,columns,tables,table_indices)
+    except GenotypeRepresentationError:
+      pass
+
+  # Genotypes not yet in the new models are added implicitly when encoding
+  # genotype-by-genotype, which also reports any invalid genotypes
+  if columns is not None:
+    row = pick(row,columns)
+
+  return GenotypeArray(descr,row)
+
+
+class RecodePlan(object):
+  '''
+  Selection and recoding of genotype arrays into a fixed descriptor, as
+  applied to each row of an sdat genomatrix stream.  Packed rows are
+  selected and recoded by a single call to pick_recode using recode tables
+  built for the models of their descriptor.  Tables are rebuilt when a row
+  descriptor changes, when invalidated due to model updates, or after a
+  row contains genotypes that have not been tabulated.
+
+  >>> model1 = build_model('AB')
+  >>> model2 = build_model(genotypes=[('B','B'),('A','B'),('A','A')])
+  >>> NN,AA,AB,BB = model1.genotypes
+  >>> row  = GenotypeArray(GenotypeArrayDescriptor([model1,model2]),[AA,AB])
+  >>> plan = RecodePlan(GenotypeArrayDescriptor([model2]),[0])
+  >>> recoded = plan(row)
+  >>> recoded, recoded[0].model is model2
+  ([('A', 'A')], True)
+  >>> plan([BB,NN])
+  [('B', 'B')]
+  '''
+  def __init__(self, descr, columns=None):
+    self.descr   = descr
+    self.columns = columns
+    self.source  = None
+    self.tables  = None
+    self.indices = None
+
+  def invalidate(self):
+    self.source = None
+
+  def __call__(self, row):
+    if not isinstance(row,GenotypeArray):
+      return _recode_row(self.descr,row,self.columns)
+
+    source = row.descriptor
+
+    if source is not self.source:
+      old_models = list(source)
+      if self.columns is not None:
+        old_models = pick(old_models,self.columns)
+
+      self.tables,self.indices = recode_tables(old_models,self.descr)
+      self.source = source
+
+    try:
+      return pick_recode(self.descr,row,self.columns,self.tables,self.indices)
+    except GenotypeRepresentationError:
+      self.source = None
+      return _recode_row(self.descr,row,self.columns)
 
 
 def encode_genomatrixstream_from_tuples(columns, genos, format, genome=None,
@@ -861,7 +1149,7 @@ def recode_genotriples(triples,genome,warn=False):
           loc.model = model = geno.model
         elif geno.model is not loc.model:
           try:
-            loc.model = model = build_model(alleles=old_model.alleles[1:],base=loc.model)
+            loc.model = model = merged_model(loc.model,old_model)
             updates.append( (lname,model) )
           except GenotypeRepresentationError:
             _encoding_error(lname,set(old_model.alleles)-set(loc.model.alleles),loc.model,warn)
@@ -877,7 +1165,7 @@ def recode_genotriples(triples,genome,warn=False):
       except GenotypeLookupError:
         loc = genome.get_locus(lname)
         try:
-          loc.model = model = build_model(alleles=geno.model.alleles[1:],base=loc.model)
+          loc.model = model = merged_model(loc.model,geno.model)
           updates.append( (lname,model) )
         except GenotypeRepresentationError:
           _encoding_error(lname,set(geno.model.alleles)-set(model.alleles),model,warn)
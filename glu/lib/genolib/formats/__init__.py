@@ -56,21 +56,21 @@ def guess_outformat(filename):
 
 def get_genostream_loader(format):
   try:
-    return LOADERS[format]
+    return LOADERS[format].resolve()
   except KeyError:
     raise NotImplementedError("File format '%s' is not supported" % format)
 
 
 def get_genostream_saver(format):
   try:
-    return SAVERS[format]
+    return SAVERS[format].resolve()
   except KeyError:
     raise NotImplementedError("File format '%s' is not supported" % format)
 
 
 def get_genostream_writer(format):
   try:
-    return WRITERS[format]
+    return WRITERS[format].resolve()
   except KeyError:
     raise NotImplementedError("File format '%s' is not supported" % format)
 
@@ -80,75 +80,175 @@ def genostream_preferred_format(format):
 
 
 ########################################################################################################
-# Format discovery function
+# Lazy format registry
 
-def discover_modules():
+class FormatFunction(object):
+  '''
+  Reference to a loader, saver or writer in a format module that is only
+  imported when the function is first requested
+
+  >>> f = FormatFunction('text','load_genomatrix_text')
+  >>> f
+  FormatFunction('text', 'load_genomatrix_text')
+  >>> f.resolve().__name__
+  'load_genomatrix_text'
+  '''
+  __slots__ = ('module','name','func')
+
+  def __init__(self, module, name):
+    self.module = module
+    self.name   = name
+    self.func   = None
+
+  def resolve(self):
+    func = self.func
+    if func is None:
+      module = __import__('%s.%s' % (__name__,self.module), fromlist=['*'])
+      func   = self.func = getattr(module,self.name)
+    return func
+
+  def __repr__(self):
+    return 'FormatFunction(%r, %r)' % (self.module,self.name)
+
+
+def register_formats(formats):
+  '''
+  Register genotype formats from a sequence of (module, loader, saver,
+  writer, pformat, aliases, extensions) tuples
+  '''
+  from   glu.lib.utils import is_str
+
+  for module,loader,saver,writer,pformat,aliases,extensions in formats:
+    loader = FormatFunction(module,loader) if loader else None
+    saver  = FormatFunction(module,saver)  if saver  else None
+    writer = FormatFunction(module,writer) if writer else None
+
+    aliases = aliases or []
+    if is_str(aliases):
+      aliases = [aliases]
+
+    extensions = extensions or []
+    if is_str(extensions):
+      extensions = [extensions]
+
+    allnames = set(aliases) | set(extensions)
+
+    if loader:
+      for name in extensions:
+        INPUT_EXTS.add(name)
+      for name in allnames:
+        if name in LOADERS:
+          raise ValueError('Conflicting genotype loader for format %s' % name)
+        LOADERS[name] = loader
+
+    if saver:
+      for name in extensions:
+        OUTPUT_EXTS.add(name)
+      for name in allnames:
+        if name in SAVERS:
+          raise ValueError('Conflicting genotype saver for format %s' % name)
+        SAVERS[name] = saver
+
+    if writer:
+      for name in extensions:
+        OUTPUT_EXTS.add(name)
+      for name in allnames:
+        if name in WRITERS:
+          raise ValueError('Conflicting genotype writer for format %s' % name)
+        WRITERS[name] = writer
+
+
+########################################################################################################
+# Format discovery and registry generation
+
+def discover_formats():
+  '''
+  Return the formats declared by modules in this package by reading the
+  __genoformats__ attribute from their source, without importing them.
+
+  The result must match the generated registry:
+
+  >>> from glu.lib.genolib.formats.registry import FORMATS
+  >>> discover_formats() == FORMATS
+  True
+  '''
+  import os
+  import ast
   import pkgutil
 
-  path     = __path__
-  prefix   = __name__ + '.'
+  formats = []
 
-  for (i,name,ispkg) in pkgutil.walk_packages(path,prefix=prefix):
-    try:
-      module = __import__(name,fromlist=['*'])
-    except:
+  for i,name,ispkg in pkgutil.iter_modules(__path__):
+    if ispkg:
       continue
 
-    # Skip all but explicitly indexable modules and packages
-    if not getattr(module,'__genoformats__',False):
+    filename = os.path.join(i.path, name + '.py')
+
+    try:
+      tree = ast.parse(open(filename).read(), filename)
+    except (IOError,SyntaxError):
       continue
 
-    # Strip module prefix
-    if name.startswith(prefix):
-      name = name[len(prefix):]
+    for node in tree.body:
+      if isinstance(node,ast.Assign) and any(isinstance(t,ast.Name) and t.id=='__genoformats__'
+                                             for t in node.targets):
+        for format in ast.literal_eval(node.value):
+          formats.append( (name,) + tuple(format) )
 
-    yield name,module
+  return formats
 
 
-def discover_formats():
-  from   glu.lib.utils import is_str
+def build_registry(filename=None):
+  '''
+  Write the static format registry module.  This must be re-run whenever a
+  format module adds or changes its __genoformats__ declaration:
+
+    python -c 'from glu.lib.genolib.formats import build_registry; build_registry()'
+  '''
+  import os
+
+  if filename is None:
+    filename = os.path.join(__path__[0], 'registry.py')
+
+  out = open(filename, 'w')
+  out.write('''# -*- coding: utf-8 -*-
+#
+# Generated by glu.lib.genolib.formats.build_registry.  Do not edit.
+
+__abstract__  = 'Static registry of GLU genotype input/output formats'
+__copyright__ = %r
+__license__   = %r
+__revision__  = '$Id$'
+
+
+FORMATS = [
+  # MODULE, LOADER, SAVER, WRITER, PFORMAT, ALIASES, EXTS
+''' % (__copyright__,__license__))
+
+  for format in discover_formats():
+    out.write('  %r,\n' % (format,))
+
+  out.write(']\n')
+  out.close()
+
+
+def _load_registry():
+  # Fall back to discovery if the registry has not been generated
+  try:
+    from glu.lib.genolib.formats.registry import FORMATS
+  except ImportError:
+    FORMATS = discover_formats()
+
+  register_formats(FORMATS)
+
+
+_load_registry()
+
+
+def _test():
+  import doctest
+  return doctest.testmod()
+
 
-  for name,module in discover_modules():
-    formats = module.__genoformats__
-
-    for loader,saver,writer,pformat,aliases,extensions in formats:
-      loader = getattr(module,loader,None) if loader else None
-      saver  = getattr(module,saver, None) if saver  else None
-      writer = getattr(module,writer,None) if writer else None
-
-      aliases = aliases or []
-      if is_str(aliases):
-        aliases = [aliases]
-
-      extensions = extensions or []
-      if is_str(extensions):
-        extensions = [extensions]
-
-      allnames = set(aliases) | set(extensions)
-
-      if loader:
-        for name in extensions:
-          INPUT_EXTS.add(name)
-        for name in allnames:
-          if name in LOADERS:
-            raise ValueError('Conflicting genotype loader for format %s' % name)
-          LOADERS[name] = loader
-
-      if saver:
-        for name in extensions:
-          OUTPUT_EXTS.add(name)
-        for name in allnames:
-          if name in SAVERS:
-            raise ValueError('Conflicting genotype saver for format %s' % name)
-          SAVERS[name] = saver
-
-      if writer:
-        for name in extensions:
-          OUTPUT_EXTS.add(name)
-        for name in allnames:
-          if name in WRITERS:
-            raise ValueError('Conflicting genotype writer for format %s' % name)
-          WRITERS[name] = writer
-
-
-discover_formats()
+if __name__ == '__main__':
+  _test()
@@ -9,7 +9,8 @@ __revision__  = '$Id$'
 
 __all__ = ['BinaryGenomatrixWriter', 'BinaryGenotripleWriter',
            'save_genotriples_binary','load_genotriples_binary',
-           'save_genomatrix_binary', 'load_genomatrix_binary']
+           'save_genomatrix_binary', 'load_genomatrix_binary',
+           'load_genomatrix_binary_summary']
 
 __genoformats__ = [
   #      LOADER                      SAVER                    WRITER            PFORMAT   ALIAS   EXTS
@@ -18,20 +19,28 @@ __genoformats__ = [
   ('load_genomatrix_binary', 'save_genomatrix_binary', 'BinaryGenomatrixWriter', 'sdat',  None,  'sbat') ]
 
 
+from   zlib                      import crc32
 from   operator                  import itemgetter
 from   itertools                 import groupby
 from   contextlib                import closing
 
+import numpy as np
+
 from   glu.lib.utils             import izip_exact,is_str,gcdisabled
 from   glu.lib.fileutils         import parse_augmented_filename,get_arg,trybool,compressed_filename,\
                                         namefile
 from   glu.lib.genolib.locus     import Genome,Locus
 from   glu.lib.genolib.phenos    import Phenome,SEX_UNKNOWN,PHENO_UNKNOWN,merge_phenome_list
-from   glu.lib.genolib.streams   import GenomatrixStream,GenotripleStream
-from   glu.lib.genolib.genoarray import GenotypeArrayDescriptor,GenotypeArray,build_model,build_descr
+from   glu.lib.genolib.streams   import GenomatrixStream,GenotripleStream,GenotripleBatch,\
+                                        GENOTRIPLE_BATCHSIZE
+from   glu.lib.genolib.transform import GenoTransform
+from   glu.lib.genolib.genoarray import GenotypeArrayDescriptor,GenotypeArray,build_model,build_descr,\
+                                        locus_summary,sample_summary
 
 
-GENOMATRIX_COMPAT_VERSION,GENOMATRIX_VERSION=1,3
+# Version 4 genomatrix files add genotype summary statistics and name hash
+# indices to the version 3 layout, so earlier readers remain compatible
+GENOMATRIX_COMPAT_VERSION,GENOMATRIX_VERSION=1,4
 GENOTRIPLE_COMPAT_VERSION,GENOTRIPLE_VERSION=1,3
 
 CLOSED,NOTOPEN,OPEN = range(3)
@@ -46,6 +55,22 @@ def _get_v_attr(gfile,names,default=None):
   return default
 
 
+def _remap_names(namemap,names,ids):
+  '''
+  Map name ids onto the ids of namemap, adding names in the order they first
+  appear in ids
+  '''
+  seen,first = np.unique(ids, return_index=True)
+  remap      = np.zeros(len(names), dtype=np.int32)
+  nd         = namemap.setdefault
+  nl         = namemap.__len__
+
+  for i in seen[np.argsort(first, kind='mergesort')].tolist():
+    remap[i] = nd(names[i],nl())
+
+  return remap[ids]
+
+
 def _model_key(model):
   return (model.allow_hemizygote,model.max_alleles)+tuple(g.alleles() for g in model.genotypes[1:])
 
@@ -73,6 +98,17 @@ class BinaryGenomatrixWriter(object):
     @param     compress: flag indicating if compression should be used when writing a binary genotype file.
                          Default is True.
     @type      compress: bool
+    @param      complib: compression library used when compress is True: zlib (default), blosc, lzo,
+                         bzip2, or any other library supported by PyTables
+    @type       complib: str
+    @param    complevel: compression level from 1 to 9.  Default is 5.
+    @type     complevel: int
+    @param      shuffle: flag indicating if the byte shuffle filter is applied before compression.
+                         Default is True for sbat and False for lbat.
+    @type       shuffle: bool
+    @param        stats: flag indicating if genotype summary statistics should be stored.
+                         Default is True.
+    @type         stats: bool
     @param      scratch: the buffer space available to use while reading or writing a binary file.
     @type       scratch: int
 
@@ -128,9 +164,13 @@ class BinaryGenomatrixWriter(object):
 
     filename = parse_augmented_filename(filename,args)
 
-    compress = get_arg(args,['compress'],True)
-    scratch  = int(get_arg(args,['scratch'],16*1024*1024))
+    compress  = get_arg(args,['compress'],True)
+    complib   = get_arg(args,['complib'],'zlib')
+    complevel = int(get_arg(args,['complevel'],5))
+    shuffle   = get_arg(args,['shuffle'])
+    scratch   = int(get_arg(args,['scratch'],16*1024*1024))
 
+    self.stats        = trybool(get_arg(args,['stats'],True))
     self.ignoreloci   = trybool(get_arg(args,['ignoreloci']))
     self.ignorephenos = trybool(get_arg(args,['ignorephenos']))
 
@@ -155,8 +195,9 @@ class BinaryGenomatrixWriter(object):
     self.scratch  = scratch
     self.state    = NOTOPEN
 
-    if compress:
-      self.filters = tables.Filters(complevel=5,complib='zlib',shuffle=(format=='sbat'),fletcher32=True)
+    if trybool(compress):
+      shuffle = trybool(shuffle) if shuffle is not None else (format=='sbat')
+      self.filters = compression_filters(complib,complevel,shuffle)
     else:
       self.filters = tables.Filters(fletcher32=True)
 
@@ -184,11 +225,73 @@ class BinaryGenomatrixWriter(object):
                                'Matrix of binary encoded genotypes values',
                                chunkshape=(crows,ccols), filters=self.filters, expectedrows=50000)
 
+    # V4 summary statistics: genotype counts for each row are accumulated
+    # per chunk and column counts over all rows (see save_genomatrix_stats)
+    if self.stats:
+      class ChunkStatsDesc(tables.IsDescription):
+        start        = tables.Int64Col(pos=0)
+        stop         = tables.Int64Col(pos=1)
+        missing      = tables.Int64Col(pos=2)
+        hemizygote   = tables.Int64Col(pos=3)
+        homozygote   = tables.Int64Col(pos=4)
+        heterozygote = tables.Int64Col(pos=5)
+
+      if self.format == 'lbat':
+        self.row_counts = self.gfile.createEArray(self.gfile.root, 'locus_counts', tables.UInt32Atom(), (0,),
+                                 'Concatenated genotype counts for each locus', filters=self.filters)
+      else:
+        self.row_counts = self.gfile.createEArray(self.gfile.root, 'sample_counts', tables.UInt32Atom(), (0,4),
+                                 'Genotype category counts for each sample', filters=self.filters)
+
+      self.chunk_stats  = self.gfile.createTable(self.gfile.root, 'chunk_stats', ChunkStatsDesc,
+                                 'Genotype category counts for each chunk of rows', filters=self.filters)
+      self.chunk_counts = []
+      self.col_counts   = None
+      self.col_totals   = np.zeros(4,dtype=int)
+      self.row_lengths  = []
+
     self.chunkrows = crows
     self.rowkeys   = []
     self.chunk     = []
     self.state     = OPEN
 
+  def _count(self, genos):
+    if self.format == 'lbat':
+      row_counts,self.col_counts = locus_summary(genos,self.col_counts)
+    else:
+      row_counts,self.col_counts = sample_summary(genos,self.col_counts)
+    self.chunk_counts.append(row_counts)
+
+  def _flush(self):
+    chunk = self.chunk
+
+    if not chunk:
+      return
+
+    self.genotypes.append(chunk)
+    chunk[:] = []
+
+    if self.stats:
+      counts = self.chunk_counts
+      self.chunk_counts = []
+
+      # Category totals for the chunk are the change in column totals for
+      # lbat and the sum of row category counts for sbat
+      if self.format == 'lbat':
+        self.row_counts.append(np.concatenate(counts))
+        self.row_lengths.extend(len(c) for c in counts)
+        col_totals      = self.col_counts.sum(axis=0)
+        totals          = col_totals - self.col_totals
+        self.col_totals = col_totals
+      else:
+        counts = np.array(counts)
+        self.row_counts.append(counts)
+        totals = counts.sum(axis=0)
+
+      stop  = len(self.rowkeys)
+      start = stop - len(counts)
+      self.chunk_stats.append([ (start,stop)+tuple(totals.tolist()) ])
+
   def writerow(self, rowkey, genos):
     '''
     Write a row of genotypes given the row key and list of genotypes
@@ -211,9 +314,11 @@ class BinaryGenomatrixWriter(object):
     chunk = self.chunk
     chunk.append(genos.data)
 
+    if self.stats:
+      self._count(genos)
+
     if len(chunk) >= self.chunkrows:
-      self.genotypes.append(chunk)
-      chunk[:] = []
+      self._flush()
 
   def writerows(self, rows):
     '''
@@ -239,24 +344,24 @@ class BinaryGenomatrixWriter(object):
 
     assert self.state == OPEN
 
-    rowkeys = self.rowkeys
-    chunk   = self.chunk
+    rowkeys   = self.rowkeys
+    chunk     = self.chunk
+    chunkrows = self.chunkrows
 
-    if self.format == 'sbat':
+    if self.stats:
+      count = self._count
       for rowkey,genos in rows:
         rowkeys.append(rowkey)
         chunk.append(genos.data)
-        if len(chunk) >= self.chunkrows:
-          self.genotypes.append(chunk)
-          chunk[:] = []
-
-    elif self.format == 'lbat':
+        count(genos)
+        if len(chunk) >= chunkrows:
+          self._flush()
+    else:
       for rowkey,genos in rows:
         rowkeys.append(rowkey)
         chunk.append(genos.data)
-        if len(chunk) >= self.chunkrows:
-          self.genotypes.append(chunk)
-          chunk[:] = []
+        if len(chunk) >= chunkrows:
+          self._flush()
 
   def close(self):
     '''
@@ -274,14 +379,12 @@ class BinaryGenomatrixWriter(object):
       return
     assert self.state != NOTOPEN
 
+    self._flush()
+
     self.state = CLOSED
     gfile      = self.gfile
     genotypes  = self.genotypes
     self.gfile = self.genotypes = None
-
-    if self.chunk:
-      genotypes.append(self.chunk)
-
     self.chunk = None
 
     genotypes.flush()
@@ -289,6 +392,9 @@ class BinaryGenomatrixWriter(object):
     save_strings(gfile, 'rows', self.rowkeys, filters=self.filters)
     save_strings(gfile, 'cols', self.header,  filters=self.filters)
 
+    save_name_index(gfile, 'row_index', self.rowkeys, filters=self.filters)
+    save_name_index(gfile, 'col_index', self.header,  filters=self.filters)
+
     if self.format == 'lbat':
       loci    = self.rowkeys
       samples = self.header
@@ -300,6 +406,11 @@ class BinaryGenomatrixWriter(object):
     save_models(gfile, loci, self.genome, models, filters=self.filters, ignoreloci=self.ignoreloci)
     save_phenos(gfile, samples, self.phenome, filters=self.filters, ignorephenos=self.ignorephenos)
 
+    if self.stats:
+      save_genomatrix_stats(gfile, self.format, models, self.row_counts, self.row_lengths,
+                                   self.col_counts, filters=self.filters)
+      self.row_counts = self.chunk_stats = self.col_counts = self.row_lengths = None
+
     self.rowkeys = self.header = self.genome = self.phenome = None
 
     gfile.close()
@@ -355,6 +466,20 @@ class BinaryGenotripleWriter(object):
   ('s1', 'l2', (None, None))
   ('s1', 'l3', ('A', 'A'))
   ('s2', 'l2', ('C', 'C'))
+
+  Columnar batches of genotriples may be written directly:
+
+  >>> triples = [('s1', 'l1', ('C','T')),
+  ...            ('s2', 'l2', ('C','C')),
+  ...            ('s3', 'l1', ('T','T'))]
+  >>> triples = GenotripleStream.from_tuples(triples)
+  >>> with BinaryGenotripleWriter(f.name,'tbat',None,triples.genome,triples.phenome) as w:
+  ...   w.writebatches(triples.as_batches(batchsize=2))
+  >>> for row in load_genotriples_binary(f.name,'tbat'):
+  ...   print row
+  ('s1', 'l1', ('C', 'T'))
+  ('s2', 'l2', ('C', 'C'))
+  ('s3', 'l1', ('T', 'T'))
   '''
   def __init__(self,filename,format,header,genome,phenome,extra_args=None,**kwargs):
     '''
@@ -482,6 +607,33 @@ class BinaryGenotripleWriter(object):
       row['geno']   = geno.index
       row.append()
 
+  def writebatch(self, batch):
+    '''
+    Write a columnar batch of genotype triples
+
+    @param   batch: genotriple batch
+    @type    batch: GenotripleBatch
+    '''
+    if self.gfile is None:
+      raise IOError('Cannot write to closed writer object')
+
+    rows = np.empty(len(batch), dtype=[('sample',np.int32),('locus',np.int32),('geno',np.int32)])
+    rows['sample'] = _remap_names(self.samplemap, batch.samples, batch.sample_ids)
+    rows['locus']  = _remap_names(self.locusmap,  batch.loci,    batch.locus_ids)
+    rows['geno']   = batch.geno_ids
+
+    self.genotypes.append(rows)
+
+  def writebatches(self, batches):
+    '''
+    Write a sequence of columnar batches of genotype triples
+
+    @param   batches: sequence of genotriple batches
+    @type    batches: sequence of GenotripleBatch
+    '''
+    for batch in batches:
+      self.writebatch(batch)
+
   def close(self):
     '''
     Close the writer and write all of the necessary auxiliary data structures
@@ -566,7 +718,7 @@ def save_genotriples_binary(filename,genos,format,extra_args=None,**kwargs):
   '''
   with BinaryGenotripleWriter(filename,format,None,genos.genome,genos.phenome,
                                        extra_args=extra_args,**kwargs) as writer:
-    writer.writerows(genos.as_genotriples())
+    writer.writebatches(genos.as_genotriples().as_batches())
 
 
 def load_genotriples_binary(filename,format,genome=None,phenome=None,extra_args=None,**kwargs):
@@ -648,16 +800,23 @@ def load_genotriples_binary(filename,format,genome=None,phenome=None,extra_args=
       # so that gfile is closed properly when it shuts down
       yield
 
-      for row in gfile.root.genotypes:
-        locusid = row[1]
-        yield samples[row[0]],loci[locusid],models[locusid].genotypes[row[2]]
+      # Read the triple table in chunks of columnar batches that share the
+      # sample, locus and model dictionaries of the file
+      genotypes = gfile.root.genotypes
+      for start in xrange(0,genotypes.nrows,GENOTRIPLE_BATCHSIZE):
+        rows = genotypes.read(start,start+GENOTRIPLE_BATCHSIZE)
+        sample_ids,locus_ids,geno_ids = (rows[name] for name in rows.dtype.names)
+        yield GenotripleBatch(samples,loci,models,sample_ids.astype(np.int32),
+                                                  locus_ids.astype(np.int32),
+                                                  geno_ids.astype(np.uint16))
 
   # Create the loader and fire it up by requesting the first dummy element
   _loader = _load()
   _loader.next()
 
   # FIXME: Order must be restored
-  genos = GenotripleStream(_loader,samples=set(samples),loci=set(loci),genome=file_genome,phenome=phenome)
+  genos = GenotripleStream.from_batches(_loader,file_genome,samples=set(samples),loci=set(loci),
+                                                phenome=phenome)
 
   if genome:
     genos = genos.transformed(recode_models=genome)
@@ -694,6 +853,300 @@ def save_strings(gfile,name,data,filters=None,maxlen=None):
   a.flush()
 
 
+def compression_filters(complib='zlib',complevel=5,shuffle=False):
+  '''
+  Return PyTables filters with checksums enabled for the requested
+  compression library, level and shuffle setting.  Libraries may include a
+  codec where supported by PyTables, e.g. blosc:lz4.
+
+  @param    complib: compression library
+  @type     complib: str
+  @param  complevel: compression level from 1 to 9
+  @type   complevel: int
+  @param    shuffle: flag indicating if the byte shuffle filter is applied
+  @type     shuffle: bool
+  @return          : filter settings
+  @rtype           : PyTables Filters instance
+  '''
+  import tables
+
+  if tables.whichLibVersion(complib.split(':')[0]) is None:
+    raise ValueError('Compression library %s is not available' % complib)
+
+  return tables.Filters(complevel=complevel,complib=complib,shuffle=shuffle,fletcher32=True)
+
+
+def save_name_index(gfile,name,names,filters=None):
+  '''
+  Save a hash index of the supplied list of strings to an HDF5 table.  Each
+  record contains the CRC32 of a string and its position in the list, and
+  records are ordered by hash so that positions of specific strings may be
+  found without loading the entire list (see find_names).
+
+  @param   gfile: output file
+  @type    gfile: PyTables HDF5 file instance
+  @param    name: output table name
+  @type     name: str
+  @param   names: strings to index
+  @type    names: sequence of str
+  @param filters: compression and filter settings to apply
+  @type  filters: PyTables HDF5 file filter instance
+  '''
+  import tables
+
+  class NameIndexDesc(tables.IsDescription):
+    hash  = tables.UInt32Col(pos=0)
+    index = tables.Int64Col(pos=1)
+
+  index = np.empty(len(names), dtype=[('hash',np.uint32),('index',np.int64)])
+  index['hash']  = [ crc32(n) & 0xffffffff for n in names ]
+  index['index'] = np.arange(len(names))
+  index.sort(order=['hash','index'])
+
+  table = gfile.createTable(gfile.root, name, NameIndexDesc, 'name hash index',
+                                        filters=filters, expectedrows=max(1,len(names)))
+  if len(index):
+    table.append(index)
+  table.flush()
+
+
+def find_names(gfile,name,index,names):
+  '''
+  Find the positions of names in an HDF5 string array using a hash index
+  saved by save_name_index.  Only the strings with matching hashes are read.
+
+  @param   gfile: input file
+  @type    gfile: PyTables HDF5 file instance
+  @param    name: string array name
+  @type     name: str
+  @param   index: hash index table name
+  @type    index: str
+  @param   names: names to find
+  @type    names: iterable of str
+  @return       : ordered positions of all strings found, or None if the
+                  file has no index
+  @rtype        : list of int or None
+  '''
+  if not hasattr(gfile.root,index):
+    return None
+
+  strings = getattr(gfile.root,name)
+  index   = getattr(gfile.root,index)[:]
+  hashes  = index['hash']
+  entries = index['index'].tolist()
+  n       = len(hashes)
+
+  positions = set()
+  for name in names:
+    h = crc32(name) & 0xffffffff
+    i = int(np.searchsorted(hashes,h))
+    while i<n and hashes[i]==h:
+      if strings[entries[i]] == name:
+        positions.add(entries[i])
+      i += 1
+
+  return sorted(positions)
+
+
+def save_genomatrix_stats(gfile, format, models, row_counts, row_lengths, col_counts, filters=None):
+  '''
+  Save the genotype summary statistics accumulated while writing a binary
+  genotype matrix.  Genotype counts for each locus are stored as a single
+  array indexed by offsets, since loci have differing numbers of genotypes.
+
+  Tables:
+    /locus_counts       : concatenated genotype counts for each locus
+    /locus_count_offsets: start of the counts of each locus and the total length
+    /sample_counts      : missing, hemizygote, homozygote, and heterozygote
+                          genotype counts for each sample
+    /chunk_stats        : genotype category totals for each chunk of rows
+
+  @param       gfile: output file
+  @type        gfile: PyTables HDF5 file instance
+  @param      format: lbat or sbat
+  @type       format: str
+  @param      models: models of each locus
+  @type       models: list of model instances
+  @param  row_counts: array of counts written for each row
+  @type   row_counts: PyTables EArray
+  @param row_lengths: number of genotype counts written for each lbat row
+  @type  row_lengths: list of int
+  @param  col_counts: counts accumulated for each column
+  @type   col_counts: 2d array
+  @param     filters: compression and filter settings to apply
+  @type      filters: PyTables HDF5 file filter instance
+  '''
+  import tables
+
+  row_counts.flush()
+
+  if format == 'lbat':
+    lengths = row_lengths
+    sample_counts = col_counts
+  else:
+    # Trim the padded per-locus counts to the genotypes of each model
+    lengths = np.array([ len(model.genotypes) for model in models ],dtype=int)
+    width   = max(col_counts.shape[1],lengths.max() if len(lengths) else 0)
+    counts  = np.zeros( (len(lengths),width), dtype=np.uint32 )
+    counts[:,:col_counts.shape[1]] = col_counts
+    counts  = counts[np.arange(width)<lengths[:,np.newaxis]]
+
+    a = gfile.createCArray(gfile.root, 'locus_counts', tables.UInt32Atom(), (len(counts),),
+                           'Concatenated genotype counts for each locus', filters=filters)
+    if len(counts):
+      a[:] = counts
+    a.flush()
+
+  offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+  np.cumsum(lengths, out=offsets[1:])
+
+  a = gfile.createCArray(gfile.root, 'locus_count_offsets', tables.Int64Atom(), (len(offsets),),
+                         'Offsets of the genotype counts of each locus', filters=filters)
+  a[:] = offsets
+  a.flush()
+
+  if format == 'lbat':
+    a = gfile.createCArray(gfile.root, 'sample_counts', tables.UInt32Atom(), sample_counts.shape,
+                           'Genotype category counts for each sample', filters=filters)
+    a[:] = sample_counts
+    a.flush()
+
+
+class GenomatrixSummary(object):
+  '''
+  Genotype summary statistics stored in a binary genotype matrix file, in
+  the form computed by glu.modules.qc.summary.summarize
+  '''
+  __slots__ = ('genome','loci','locus_counts','samples','sample_counts','chunk_stats')
+
+  def __init__(self, genome, loci, locus_counts, samples, sample_counts, chunk_stats):
+    self.genome        = genome
+    self.loci          = loci
+    self.locus_counts  = locus_counts
+    self.samples       = samples
+    self.sample_counts = sample_counts
+    self.chunk_stats   = chunk_stats
+
+  def totals(self):
+    '''
+    Return the total number of missing, hemizygote, homozygote, and
+    heterozygote genotypes
+    '''
+    stats = self.chunk_stats
+    return np.array([ stats[c].sum() for c in ('missing','hemizygote','homozygote','heterozygote') ],dtype=int)
+
+
+def load_genomatrix_binary_summary(filename,format,extra_args=None,**kwargs):
+  '''
+  Load the genotype summary statistics stored in a version 4 or later binary
+  genotype matrix file without decoding any genotypes
+
+  @param     filename: a file name
+  @type      filename: str
+  @param       format: lbat or sbat
+  @type        format: str
+  @return            : summary statistics, or None if the file does not contain them
+  @rtype             : GenomatrixSummary or None
+
+  >>> samples =         (    's1',       's2',       's3'   )
+  >>> rows    = [('l1', ( ('A', 'A'), (None,None),  ('T','T'))),
+  ...            ('l2', ((None,None),  ('T','T'),   ('G','T'))),
+  ...            ('l3', ( ('A', 'T'),  ('T','A'),   ('T','T')))]
+  >>> genos = GenomatrixStream.from_tuples(rows,'ldat',samples=samples)
+  >>> import tempfile
+  >>> f = tempfile.NamedTemporaryFile()
+  >>> save_genomatrix_binary(f.name,genos,'lbat')
+  >>> summary = load_genomatrix_binary_summary(f.name,'lbat')
+  >>> summary.loci,summary.samples
+  (('l1', 'l2', 'l3'), ('s1', 's2', 's3'))
+  >>> def show(summary):
+  ...   for lname,counts in zip(summary.loci,summary.locus_counts):
+  ...     genos = summary.genome.loci[lname].model.genotypes
+  ...     print lname,sorted( (g,n) for g,n in zip(genos,counts.tolist()) if n )
+  >>> show(summary)
+  l1 [((None, None), 1), (('A', 'A'), 1), (('T', 'T'), 1)]
+  l2 [((None, None), 1), (('G', 'T'), 1), (('T', 'T'), 1)]
+  l3 [(('A', 'T'), 2), (('T', 'T'), 1)]
+  >>> summary.sample_counts.tolist()
+  [[1, 0, 1, 1], [1, 0, 1, 1], [0, 0, 2, 1]]
+  >>> summary.totals().tolist()
+  [2, 0, 4, 3]
+  >>> genos = GenomatrixStream.from_tuples(rows,'ldat',samples=samples)
+  >>> save_genomatrix_binary(f.name,genos,'sbat')
+  >>> summary = load_genomatrix_binary_summary(f.name,'sbat')
+  >>> show(summary)
+  l1 [((None, None), 1), (('A', 'A'), 1), (('T', 'T'), 1)]
+  l2 [((None, None), 1), (('G', 'T'), 1), (('T', 'T'), 1)]
+  l3 [(('A', 'T'), 2), (('T', 'T'), 1)]
+  >>> summary.sample_counts.tolist()
+  [[1, 0, 1, 1], [1, 0, 1, 1], [0, 0, 2, 1]]
+  '''
+  import tables
+
+  if extra_args is None:
+    args = kwargs
+  else:
+    args = extra_args
+    args.update(kwargs)
+
+  filename = parse_augmented_filename(filename,args)
+
+  ignoreloci = trybool(get_arg(args,['ignoreloci']))
+
+  if extra_args is None and args:
+    raise ValueError('Unexpected filename arguments: %s' % ','.join(sorted(args)))
+
+  if not is_str(filename):
+    raise ValueError('Invalid filename')
+
+  with closing(tables.openFile(filename,mode='r')) as gfile:
+    format_found   = _get_v_attr(gfile,['GLU_FORMAT', 'format'])
+    version        = _get_v_attr(gfile,['GLU_VERSION','version'],1)
+    compat_version = _get_v_attr(gfile,['GLU_COMPAT_VERSION'],version)
+
+    if format_found not in ('ldat','sdat'):
+      raise ValueError('Unknown genomatrix format: %s' % format_found)
+
+    format_found = {'ldat':'lbat','sdat':'sbat'}[format_found]
+    if format not in (format_found,{'lbat':'ldat','sbat':'sdat'}[format_found]):
+      raise ValueError('Input file "%s" does not appear to be in %s format.  Found %s.' \
+                          % (namefile(filename),format,format_found))
+
+    if version < 4 or not hasattr(gfile.root,'chunk_stats'):
+      return None
+
+    if version > GENOMATRIX_VERSION:
+      version = compat_version
+
+    columns = tuple(gfile.root.cols[:].tolist())
+    rows    = tuple(gfile.root.rows[:].tolist())
+
+    if format_found == 'lbat':
+      samples,loci = columns,rows
+    else:
+      samples,loci = rows,columns
+
+    file_genome,file_models = load_models(gfile,loci,version,compat_version,ignoreloci)
+    models = list(file_models)
+
+    counts  = gfile.root.locus_counts[:].astype(int)
+    offsets = gfile.root.locus_count_offsets[:].tolist()
+
+    # Models may have gained genotypes after counts were written
+    locus_counts = []
+    for model,start,stop in izip_exact(models,offsets[:-1],offsets[1:]):
+      c = counts[start:stop]
+      m = len(model.genotypes)
+      if len(c) < m:
+        c = np.concatenate([c,np.zeros(m-len(c),dtype=int)])
+      locus_counts.append(c)
+
+    sample_counts = gfile.root.sample_counts[:].astype(int)
+    chunk_stats   = gfile.root.chunk_stats[:]
+
+  return GenomatrixSummary(file_genome,loci,locus_counts,samples,sample_counts,chunk_stats)
+
+
 def save_models(gfile, loci, genome, models, filters=None, ignoreloci=False):
   '''
   Save the supplied list of models that correspond to specific genetic loci
@@ -827,7 +1280,7 @@ def save_models(gfile, loci, genome, models, filters=None, ignoreloci=False):
   save_strings(gfile,'model_alleles',alleles,filters=filters)
 
 
-def load_models(gfile,loci,version,compat_version,ignoreloci):
+def load_models(gfile,loci,version,compat_version,ignoreloci,positions=None):
   '''
   Load models from an HDF5 binary genotype file
 
@@ -839,25 +1292,30 @@ def load_models(gfile,loci,version,compat_version,ignoreloci):
   @type         version: int
   @param compat_version: genotype file version backward compatibility number
   @type  compat_version: int
+  @param      positions: file positions of each locus, if only a subset is loaded
+  @type       positions: list of int
   '''
   if version == 1 or ignoreloci:
-    return load_models_v1(gfile,loci)
-  elif version in (2,3) or compat_version in (2,3):
-    return load_models_v2(gfile,loci)
+    return load_models_v1(gfile,loci,positions)
+  elif version in (2,3,4) or compat_version in (2,3,4):
+    return load_models_v2(gfile,loci,positions)
   else:
     raise ValueError('Unknown genotype file version: %s' % version)
 
 
-def load_models_v1(gfile,loci):
+def load_models_v1(gfile,loci,positions=None):
   '''
   Load models from an HDF5 binary genotype file
 
   Implements model compression upon input.
 
-  @param   gfile: output file
-  @type    gfile: PyTables HDF5 file instance
+  @param       gfile: output file
+  @type        gfile: PyTables HDF5 file instance
+  @param   positions: file positions of each locus, if only a subset is loaded
+  @type    positions: list of int
   '''
-  assert len(gfile.root.locus_models) == len(loci)
+  if positions is None:
+    assert len(gfile.root.locus_models) == len(loci)
 
   alleles         = gfile.root.model_alleles[:].tolist()
   alleles[0]      = None
@@ -871,7 +1329,11 @@ def load_models_v1(gfile,loci):
   def _models():
     empty = ()
     modelcache = {}
-    for locus,lmod in izip_exact(loci,gfile.root.locus_models[:].tolist()):
+    lmodels    = gfile.root.locus_models[:].tolist()
+    if positions is not None:
+      lmodels  = [ lmodels[i] for i in positions ]
+
+    for locus,lmod in izip_exact(loci,lmodels):
       max_alleles,allow_hemizygote = mods[lmod[0]]
 
       genotypes = model_genotypes.get(lmod[0],empty)
@@ -886,16 +1348,19 @@ def load_models_v1(gfile,loci):
   return genome,_models()
 
 
-def load_models_v2(gfile,loci):
+def load_models_v2(gfile,loci,positions=None):
   '''
   Load models from an HDF5 binary genotype file
 
   Implements model compression upon input.
 
-  @param   gfile: output file
-  @type    gfile: PyTables HDF5 file instance
+  @param       gfile: output file
+  @type        gfile: PyTables HDF5 file instance
+  @param   positions: file positions of each locus, if only a subset is loaded
+  @type    positions: list of int
   '''
-  assert len(gfile.root.locus_models) == len(loci)
+  if positions is None:
+    assert len(gfile.root.locus_models) == len(loci)
 
   alleles         = gfile.root.model_alleles[:].tolist()
   alleles[0]      = None
@@ -913,6 +1378,8 @@ def load_models_v2(gfile,loci):
     empty      = ()
     strands    = STRANDS
     lmodels    = gfile.root.locus_models[:].tolist()
+    if positions is not None:
+      lmodels  = [ lmodels[i] for i in positions ]
 
     for locus,lmod in izip_exact(loci,lmodels):
       max_alleles,allow_hemizygote = mods[lmod[0]]
@@ -1016,7 +1483,7 @@ def save_phenos(gfile, samples, phenome, filters=None, ignorephenos=False):
   save_strings(gfile,'names', names, filters=filters)
 
 
-def load_phenos(gfile,samples,phenome,version,compat_version,ignorephenos):
+def load_phenos(gfile,samples,phenome,version,compat_version,ignorephenos,positions=None):
   '''
   Load models from an HDF5 binary genotype file
 
@@ -1030,11 +1497,13 @@ def load_phenos(gfile,samples,phenome,version,compat_version,ignorephenos):
   @type         version: int
   @param compat_version: genotype file version backward compatibility number
   @type  compat_version: int
+  @param      positions: file positions of each sample, if only a subset is loaded
+  @type       positions: list of int
   '''
   if ignorephenos or version < 3:
     return phenome or Phenome()
-  elif version == 3 or compat_version == 3:
-    file_phenome = load_phenos_v3(gfile,samples)
+  elif version in (3,4) or compat_version in (3,4):
+    file_phenome = load_phenos_v3(gfile,samples,positions)
   else:
     raise ValueError('Unknown genotype file version: %s' % version)
 
@@ -1044,20 +1513,26 @@ def load_phenos(gfile,samples,phenome,version,compat_version,ignorephenos):
   return merge_phenome_list([phenome,file_phenome])
 
 
-def load_phenos_v3(gfile,samples):
+def load_phenos_v3(gfile,samples,positions=None):
   '''
   Load phenome from an HDF5 binary genotype file
 
   Implements model compression upon input.
 
-  @param   gfile: output file
-  @type    gfile: PyTables HDF5 file instance
+  @param       gfile: output file
+  @type        gfile: PyTables HDF5 file instance
+  @param   positions: file positions of each sample, if only a subset is loaded
+  @type    positions: list of int
   '''
   names  = gfile.root.names[:].tolist()
   phenos = gfile.root.phenotypes[:].tolist()
 
   names[0] = None
 
+  if positions is not None:
+    positions = dict( (i,j) for j,i in enumerate(positions) )
+    phenos    = [ (positions[p[0]],)+p[1:] for p in phenos if p[0] in positions ]
+
   phenome = Phenome()
   for sample,family,individual,parent1,parent2,sex,phenoclass in phenos:
     if sex == -1:
@@ -1216,6 +1691,9 @@ def load_genomatrix_binary(filename,format,genome=None,phenome=None,extra_args=N
   ignoreloci   = trybool(get_arg(args,['ignoreloci']))
   ignorephenos = trybool(get_arg(args,['ignorephenos']))
 
+  # Peek at any transformation, which is applied in full by the caller
+  transform    = args.get('transform')
+
   if extra_args is None and args:
     raise ValueError('Unexpected filename arguments: %s' % ','.join(sorted(args)))
 
@@ -1240,19 +1718,12 @@ def load_genomatrix_binary(filename,format,genome=None,phenome=None,extra_args=N
   if version > GENOMATRIX_VERSION:
     version = compat_version
 
-  columns = tuple(gfile.root.cols[:].tolist())
-  rows    = tuple(gfile.root.rows[:].tolist())
-
   if format_found in ('sdat','sbat'):
     format_found = 'sbat'
     gformat      = 'sdat'
-    samples      = rows
-    loci         = columns
   elif format_found in ('ldat','lbat'):
     format_found = 'lbat'
     gformat      = 'ldat'
-    samples      = columns
-    loci         = rows
   else:
     raise ValueError('Unknown genomatrix format: %s' % format_found)
 
@@ -1260,10 +1731,64 @@ def load_genomatrix_binary(filename,format,genome=None,phenome=None,extra_args=N
     raise ValueError('Input file "%s" does not appear to be in %s format.  Found %s.' \
                         % (namefile(filename),format,format_found))
 
+  columns   = tuple(gfile.root.cols[:].tolist())
+  rows      = None
+  positions = None
+
+  # Push row includes down to the file, so that only the selected rows are
+  # read and decoded.  Small includes are resolved via the row name index.
+  if transform is not None:
+    transform = GenoTransform.from_object(transform)
+    include   = transform.loci.include if format_found=='lbat' else transform.samples.include
+
+    if include is not None:
+      if len(include)*16 < len(gfile.root.rows):
+        positions = find_names(gfile,'rows','row_index',include)
+
+      if positions is None:
+        rows      = gfile.root.rows[:].tolist()
+        positions = [ i for i,row in enumerate(rows) if row in include ]
+
+      rows = tuple(gfile.root.rows[i] for i in positions) if rows is None \
+        else tuple(rows[i] for i in positions)
+
+  if rows is None:
+    rows = tuple(gfile.root.rows[:].tolist())
+
+  if format_found == 'sbat':
+    samples,loci = rows,columns
+  else:
+    samples,loci = columns,rows
+
   unique = len(set(columns))==len(columns) and len(set(rows))==len(rows)
 
-  file_genome,file_models = load_models(gfile,loci,version,compat_version,ignoreloci)
-  phenome = load_phenos(gfile,samples,phenome,version,compat_version,ignorephenos)
+  file_genome,file_models = load_models(gfile,loci,version,compat_version,ignoreloci,
+                                        positions if format_found=='lbat' else None)
+  phenome = load_phenos(gfile,samples,phenome,version,compat_version,ignorephenos,
+                                        positions if format_found=='sbat' else None)
+
+  def _chunks(rowsize):
+    '''
+    Generate contiguous runs of file rows that fit within scratch space
+    '''
+    chunksize = max(2, int(scratch//rowsize))
+
+    if positions is None:
+      for start in xrange(0,len(rows),chunksize):
+        yield start,min(start+chunksize,len(rows))
+      return
+
+    start = stop = None
+    for i in positions:
+      if stop is not None and i==stop and stop-start<chunksize:
+        stop += 1
+      else:
+        if stop is not None:
+          yield start,stop
+        start,stop = i,i+1
+
+    if stop is not None:
+      yield start,stop
 
   if format == 'sbat':
     with gcdisabled():
@@ -1275,22 +1800,15 @@ def load_genomatrix_binary(filename,format,genome=None,phenome=None,extra_args=N
         # so that gfile is closed properly when it shuts down
         yield
 
-        descr = GenotypeArrayDescriptor(models)
-
-        chunksize = max(2, int(scratch//gfile.root.genotypes.rowsize))
-        chunks    = int(len(rows)+chunksize-1)//chunksize
+        descr  = GenotypeArrayDescriptor(models)
+        labels = iter(rows)
 
-        stop = 0
-        for i in xrange(chunks):
-          start,stop = stop,stop+chunksize
-          labels = rows[start:stop]
-          chunk  = gfile.root.genotypes[start:stop]
-
-          for j,label in enumerate(labels):
+        for start,stop in _chunks(gfile.root.genotypes.rowsize):
+          for data in gfile.root.genotypes[start:stop]:
             g = GenotypeArray(descr)
-            g.data = chunk[j]
+            g.data = data
 
-            yield label,g
+            yield labels.next(),g
 
   elif format == 'lbat':
     models  = []
@@ -1301,23 +1819,17 @@ def load_genomatrix_binary(filename,format,genome=None,phenome=None,extra_args=N
         # so that gfile is closed properly when it shuts down
         yield
 
-        chunksize = max(2, int(scratch//gfile.root.genotypes.rowsize))
-        chunks    = int(len(rows)+chunksize-1)//chunksize
-
-        stop = 0
-        for i in xrange(chunks):
-          start,stop = stop,stop+chunksize
-          labels = rows[start:stop]
-          chunk  = gfile.root.genotypes[start:stop]
+        labels = iter(rows)
 
-          for j,label in enumerate(labels):
+        for start,stop in _chunks(gfile.root.genotypes.rowsize):
+          for data in gfile.root.genotypes[start:stop]:
             model = file_models.next()
             descr = build_descr(model,len(samples))
             g = GenotypeArray(descr)
-            g.data = chunk[j]
+            g.data = data
 
             models.append(model)
-            yield label,g
+            yield labels.next(),g
 
   # Create the loader and fire it up by requesting the first dummy element
   _loader = _load()
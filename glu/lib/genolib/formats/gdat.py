@@ -17,9 +17,8 @@ from   itertools                 import izip
 from   contextlib                import closing
 
 import numpy as np
-import h5py
 
-from   glu.lib.utils             import is_str
+from   glu.lib.utils             import is_str,lazy_import
 from   glu.lib.fileutils         import parse_augmented_filename,get_arg,trybool,tryfloat, \
                                         compressed_filename,namefile,table_writer
 from   glu.lib.genolib.locus     import Genome,Locus
@@ -28,6 +27,8 @@ from   glu.lib.genolib.streams   import GenomatrixStream
 from   glu.lib.genolib.genoarray import GenotypeArrayDescriptor,GenotypeArray,build_model
 from   glu.lib.genolib.helpers   import encode_ab_to_snps
 
+h5py = lazy_import('h5py')
+
 
 class GCSummary(object):
   def __init__(self, data, loci):
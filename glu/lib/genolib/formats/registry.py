@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+#
+# Generated by glu.lib.genolib.formats.build_registry.  Do not edit.
+
+__abstract__  = 'Static registry of GLU genotype input/output formats'
+__copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
+__license__   = 'See GLU license for terms by running: glu license'
+__revision__  = '$Id$'
+
+
+FORMATS = [
+  # MODULE, LOADER, SAVER, WRITER, PFORMAT, ALIASES, EXTS
+  ('binary', 'load_genotriples_binary', 'save_genotriples_binary', 'BinaryGenotripleWriter', 'trip', None, 'tbat'),
+  ('binary', 'load_genomatrix_binary', 'save_genomatrix_binary', 'BinaryGenomatrixWriter', 'ldat', None, 'lbat'),
+  ('binary', 'load_genomatrix_binary', 'save_genomatrix_binary', 'BinaryGenomatrixWriter', 'sdat', None, 'sbat'),
+  ('eigensoft', 'load_eigensoft_smartpca', 'save_eigensoft_smartpca', 'EigensoftSmartPCAWriter', 'ldat', ['eigensoft', 'eigenstrat', 'smartpca'], None),
+  ('fud', 'load_fud', 'save_fud', 'FUDWriter', 'ldat', None, 'fud'),
+  ('gdat', 'load_gdat', None, None, 'sdat', None, 'gdat'),
+  ('hapmap', 'load_hapmap', None, None, 'ldat', 'hapmap', None),
+  ('mach', 'load_mach', None, None, 'sdat', 'mach', 'geno'),
+  ('merlin', 'load_merlin', 'save_merlin', 'MerlinWriter', 'sdat', ['merlin', 'linkage'], None),
+  ('phase', None, 'save_phase', 'PhaseWriter', 'sdat', None, 'phase'),
+  ('plink', 'load_plink_ped', 'save_plink_ped', 'PlinkPedWriter', 'sdat', 'plink_ped', 'ped'),
+  ('plink', 'load_plink_tped', 'save_plink_tped', 'PlinkTPedWriter', 'ldat', 'plink_tped', 'tped'),
+  ('plink', 'load_plink_bed', 'save_plink_bed', 'PlinkBedWriter', 'ldat', ['plink_bed', 'lbed', 'plink_lbed'], 'bed'),
+  ('plink', 'load_plink_bed', 'save_plink_bed', 'PlinkBedWriter', 'sdat', ['plink_sbed', 'sbed'], None),
+  ('prettybase', 'load_prettybase', 'save_prettybase', 'PrettybaseWriter', 'trip', 'prettybase', 'pb'),
+  ('structure', None, 'save_structure', 'StructureWriter', 'sdat', 'structure', None),
+  ('text', 'load_genotriples_text', 'save_genotriples_text', 'TextGenotripleWriter', 'trip', 'genotriple', ['trip', 'tdat']),
+  ('text', 'load_genomatrix_text', 'save_genomatrix_text', 'TextGenomatrixWriter', 'ldat', None, ['ldat', 'imat']),
+  ('text', 'load_genomatrix_text', 'save_genomatrix_text', 'TextGenomatrixWriter', 'sdat', None, 'sdat'),
+  ('vcf', 'load_vcf', None, None, 'vcf', None, 'vcf'),
+  ('wtccc', 'load_wtccc', 'save_wtccc', 'WTCCCWriter', 'ldat', 'wtccc', None),
+  ('wtccc_raw', 'load_wtccc_raw', None, None, 'sdat', 'wtccc-raw', None),
+]
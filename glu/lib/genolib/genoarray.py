@@ -30,12 +30,12 @@ try:
     raise ImportError
 
   from   glu.lib.genolib._genoarray import (GenotypeArray, Genotype, GenotypeArrayDescriptor,
-                                            UnphasedMarkerModel, genotype_indices,
+                                            UnphasedMarkerModel, genotype_indices, genotype_index_matrix,
                                             count_genotypes, genotype_categories,
                                             locus_summary, sample_summary, genoarray_concordance,
-                                            genoarray_ibs,
+                                            genoarray_confusion, genoarray_ibs,
                                             GenotypeLookupError, GenotypeRepresentationError,
-                                            pick, pick_columns, place, place_list)
+                                            pick, pick_columns, pick_recode, place, place_list)
 
   GENO_ARRAY_VERSION='C'
 
@@ -731,6 +731,51 @@ except ImportError:
     return concordant,comparisons
 
 
+  def genoarray_confusion(genos1, genos2, indices1=None, indices2=None, table=None):
+    '''
+    Count pairs of genotype indices from two genotype arrays, optionally
+    pairing the columns given by two sequences of indices
+
+    @param   genos1: first input
+    @type    genos1: sequence of genotypes
+    @param   genos2: second input
+    @type    genos2: sequence of genotypes
+    @param indices1: columns of genos1 to compare, or None for all
+    @type  indices1: sequence of int
+    @param indices2: columns of genos2 to compare, or None for all
+    @type  indices2: sequence of int
+    @param    table: table to which counts are added or None to create a new table
+                     with a row for each genotype in the model of genos1 and a
+                     column for each genotype in the model of genos2
+    @type     table: 2d ndarray of int
+    @return        : table of counts
+    @rtype         : 2d ndarray of int
+    '''
+    def model_len(genos):
+      if isinstance(genos, GenotypeArray):
+        return len(genos.descriptor[0].genotypes)
+      return len(genos[0].model.genotypes) if len(genos) else 1
+
+    if table is None:
+      table = np.zeros( (model_len(genos1),model_len(genos2)), dtype=int )
+
+    genos1 = np.asarray(genotype_indices(genos1), dtype=int)
+    genos2 = np.asarray(genotype_indices(genos2), dtype=int)
+
+    if indices1 is not None:
+      genos1 = genos1[np.asarray(indices1, dtype=int)]
+    if indices2 is not None:
+      genos2 = genos2[np.asarray(indices2, dtype=int)]
+
+    if len(genos1) != len(genos2):
+      raise GenotypeRepresentationError('genotype array sizes do not match: %d != %d' % (len(genos1),len(genos2)))
+
+    n = table.shape[1]
+    table += np.bincount(genos1*n + genos2, minlength=table.size).reshape(table.shape)
+
+    return table
+
+
   def genoarray_ibs(genos1, genos2):
     '''
     Generate counts of alleles shared IBS between two genotype arrays
@@ -768,6 +813,43 @@ except ImportError:
     return [ g.index for g in genos ]
 
 
+  def genotype_index_matrix(rows, out=None):
+    '''
+    Decode a sequence of genotype rows into a 2d int8 matrix of genotype
+    indices
+
+    @param rows: sequence of genotype sequences of equal length
+    @type  rows: sequence
+    @param  out: optional output array with at least len(rows) rows
+    @type   out: 2d int8 ndarray
+    @return    : matrix of genotype indices with one row per input row
+    @rtype     : 2d int8 ndarray
+    '''
+    rows = list(rows)
+    n    = len(rows)
+
+    if out is not None:
+      if not isinstance(out,np.ndarray) or out.dtype != np.int8 or out.ndim != 2 \
+                                        or not out.flags.carray:
+        raise TypeError('out must be a writable C-contiguous 2d int8 array')
+      m = len(rows[0]) if n else out.shape[1]
+      if out.shape[0] < n or out.shape[1] != m:
+        raise ValueError('out array cannot hold %d rows of %d genotypes' % (n,m))
+    else:
+      m   = len(rows[0]) if n else 0
+      out = np.empty( (n,m), dtype=np.int8 )
+
+    for i,row in enumerate(rows):
+      if len(row) != m:
+        raise ValueError('row %d has %d genotypes, expected %d' % (i,len(row),m))
+      indices = genotype_indices(row)
+      if m and max(indices) > 127:
+        raise OverflowError('genotype index too large for an int8 matrix')
+      out[i] = indices
+
+    return out[:n] if out.shape[0] != n else out
+
+
   def count_genotypes(genos,counts=None,model=None):
     '''
     Count the number of occurrences of each genotypes belonging to a single
@@ -1143,6 +1225,66 @@ except ImportError:
     return dest
 
 
+  def pick_recode(descriptor, genos, indices=None, tables=None, table_indices=None):
+    '''
+    Pick genotypes from a genotype sequence and recode their indices into a
+    new genotype array
+
+    @param     descriptor: descriptor of the resulting genotype array
+    @type      descriptor: GenotypeArrayDescriptor
+    @param          genos: genotype sequence
+    @type           genos: sequence
+    @param        indices: sequence of column indices to pick, or None for all columns
+    @type         indices: sequence
+    @param         tables: recode table or two dimensional array of recode tables that
+                           map genotype indices, where negative values cannot be recoded
+    @type          tables: array
+    @param  table_indices: index of the recode table for each resulting column
+    @type   table_indices: sequence
+    @return              : genotype array with the picked and recoded genotypes
+    @rtype               : GenotypeArray
+    '''
+    src = genotype_indices(genos)
+
+    if indices is None:
+      if len(src) != len(descriptor):
+        raise GenotypeRepresentationError('genotype array sizes do not match: %d != %d' % (len(src),len(descriptor)))
+      indices = xrange(len(src))
+    elif len(indices) != len(descriptor):
+      raise ValueError('number of column indices does not match descriptor')
+
+    if tables is not None:
+      tables = np.asarray(tables,dtype=int)
+      if tables.ndim==1:
+        tables = tables.reshape(1,-1)
+      if table_indices is None:
+        if len(tables)!=1:
+          raise ValueError('table indices are required for multiple recode tables')
+        table_indices = [0]*len(descriptor)
+
+    result = GenotypeArray(descriptor)
+
+    for i,j in enumerate(indices):
+      if not 0 <= j < len(src):
+        raise IndexError('column index out of range')
+
+      k = src[j]
+
+      if tables is not None:
+        table = tables[table_indices[i]]
+        if k >= len(table) or table[k] < 0:
+          raise GenotypeRepresentationError('genotype cannot be recoded')
+        k = table[k]
+
+      genotypes = descriptor[i].genotypes
+      if k >= len(genotypes):
+        raise GenotypeRepresentationError('Invalid genotype encoding')
+
+      result[i] = genotypes[k]
+
+    return result
+
+
 ###############################################################################
 
 
@@ -1886,6 +2028,49 @@ def test_indices():
   '''
 
 
+def test_index_matrix():
+  '''
+  >>> model = build_model('AB')
+  >>> NN,AA,AB,BB = model.genotypes
+  >>> rows = [ GenotypeArray(GenotypeArrayDescriptor([model]*5),genos)
+  ...          for genos in ([NN,AA,AB,BB,AA],[BB,BB,NN,AB,AA]) ]
+
+  >>> genotype_index_matrix(rows)
+  array([[0, 1, 2, 3, 1],
+         [3, 3, 0, 2, 1]], dtype=int8)
+  >>> genotype_index_matrix([ r.tolist() for r in rows ]).tolist()
+  [[0, 1, 2, 3, 1], [3, 3, 0, 2, 1]]
+
+  Decode into a preallocated buffer, returning only the filled rows:
+
+  >>> out = np.zeros( (3,5), dtype=np.int8 )
+  >>> genotype_index_matrix(rows[1:],out).tolist()
+  [[3, 3, 0, 2, 1]]
+  >>> out.tolist()
+  [[3, 3, 0, 2, 1], [0, 0, 0, 0, 0], [0, 0, 0, 0, 0]]
+
+  Heterogeneous and 4-bit rows:
+
+  >>> model2 = build_model('ABC')
+  >>> descr  = GenotypeArrayDescriptor([model,model2,model,model2])
+  >>> genos  = GenotypeArray(descr,[AB,model2['C','C'],NN,model2['A','C']])
+  >>> genotype_index_matrix([genos]).tolist() == [genos.indices().tolist()]
+  True
+  >>> genos  = GenotypeArray(GenotypeArrayDescriptor([model2]*3),[model2['C','C'],NN,model2['A','C']])
+  >>> genotype_index_matrix([genos]).tolist() == [genos.indices().tolist()]
+  True
+
+  >>> genotype_index_matrix([rows[0],rows[0][:3]])
+  Traceback (most recent call last):
+  ...
+  ValueError: row 1 has 3 genotypes, expected 5
+  >>> genotype_index_matrix(rows,np.zeros((1,5),dtype=np.int8))
+  Traceback (most recent call last):
+  ...
+  ValueError: out array cannot hold 2 rows of 5 genotypes
+  '''
+
+
 def test_count_genotypes():
   '''
   >>> import random
@@ -2056,6 +2241,61 @@ def test_concordance_generic():
   '''
 
 
+def test_confusion():
+  '''
+  >>> model1 = build_model('AB')
+  >>> model2 = build_model('AB',max_alleles=5)
+  >>> NN,AA,AB,BB = model1.genotypes
+  >>> genos1 = GenotypeArray(GenotypeArrayDescriptor([model1]*6),[NN,AA,AB,AB,BB,BB])
+  >>> genos2 = GenotypeArray(GenotypeArrayDescriptor([model2]*6),[NN,AA,AB,BB,BB,NN])
+  >>> genoarray_confusion(genos1,genos2).tolist()
+  [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 1], [1, 0, 0, 1]]
+  >>> genoarray_confusion(genos1,genos2,[1,2],[4,0]).tolist()
+  [[0, 0, 0, 0], [0, 0, 0, 1], [1, 0, 0, 0], [0, 0, 0, 0]]
+  >>> table = genoarray_confusion(genos1,genos2)
+  >>> genoarray_confusion(genos1,genos2,table=table) is table
+  True
+  >>> int(table.sum())
+  12
+  >>> genoarray_confusion(genos1,genos2[:3])
+  Traceback (most recent call last):
+     ...
+  GenotypeRepresentationError: genotype array sizes do not match: 6 != 3
+  '''
+
+
+def test_pick_recode():
+  '''
+  >>> model1 = build_model('AB')
+  >>> model2 = build_model(genotypes=[('B','B'),('A','B'),('A','A')])
+  >>> NN,AA,AB,BB = model1.genotypes
+  >>> genos = GenotypeArray(GenotypeArrayDescriptor([model1]*4),[NN,AA,AB,BB])
+  >>> pick_recode(GenotypeArrayDescriptor([model1]*2),genos,[3,1])
+  [('B', 'B'), ('A', 'A')]
+
+  >>> table = [ int(model2[g.alleles()].index) for g in model1.genotypes ]
+  >>> table
+  [0, 3, 2, 1]
+  >>> recoded = pick_recode(GenotypeArrayDescriptor([model2]*3),genos,[1,2,3],table)
+  >>> recoded
+  [('A', 'A'), ('A', 'B'), ('B', 'B')]
+  >>> recoded[0].model is model2
+  True
+
+  >>> tables = [range(4),table]
+  >>> pick_recode(GenotypeArrayDescriptor([model1,model2]),genos,[1,1],tables,[0,1])
+  [('A', 'A'), ('A', 'A')]
+  >>> pick_recode(GenotypeArrayDescriptor([model2]*2),genos,[0,1],[0,-1,2,3])
+  Traceback (most recent call last):
+     ...
+  GenotypeRepresentationError: genotype cannot be recoded
+  >>> pick_recode(GenotypeArrayDescriptor([model1]*2),genos,[0,4])
+  Traceback (most recent call last):
+     ...
+  IndexError: column index out of range
+  '''
+
+
 def test_concordance_4bit():
   '''
   >>> model = build_model('AB',max_alleles=5)
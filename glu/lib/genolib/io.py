@@ -209,6 +209,54 @@ def load_genostream(filename, transform=None, extra_args=None, **kwargs):
   return genos
 
 
+def load_genostream_summary(filename, format=None, genome=None, transform=None):
+  '''
+  Load the genotype summary statistics stored in a genotype file, if
+  available, without decoding any genotypes.  Statistics are only returned
+  when they describe the genotypes that load_genostream would produce, i.e.
+  for lbat and sbat files loaded without genome metadata or transformations.
+
+  @param  filename: a file name
+  @type   filename: str
+  @param    format: format of input file.  Default is None, which attempts to
+                    autodetect the file type.
+  @type     format: str
+  @param    genome: Genome metadata or filename
+  @type     genome: str or Genome instance
+  @param transform: transformation object (optional)
+  @type  transform: GenoTransform object or options
+  @return         : stored summary statistics or None
+  @rtype          : GenomatrixSummary or None
+  '''
+  if not is_str(filename) or filename == '-' or genome is not None:
+    return None
+
+  args     = {}
+  filename = parse_augmented_filename(filename,args)
+  format   = get_arg(args, ['format']) or format
+
+  # Other filename arguments may alter the genotypes loaded
+  if args:
+    return None
+
+  filename = os.path.expanduser(filename)
+  if not os.path.isfile(filename):
+    return None
+
+  if format is None:
+    format = guess_informat(filename)
+
+  if format not in ('lbat','sbat'):
+    return None
+
+  if transform is not None and not GenoTransform.from_object(transform).is_null():
+    return None
+
+  from glu.lib.genolib.formats.binary import load_genomatrix_binary_summary
+
+  return load_genomatrix_binary_summary(filename,format)
+
+
 def save_genostream(filename, genos, extra_args=None, **kwargs):
   '''
   Write genotype data to file
@@ -11,7 +11,9 @@ __revision__  = '$Id$'
 from   types                     import NoneType
 from   operator                  import itemgetter
 from   collections               import defaultdict
-from   itertools                 import izip,ifilter,imap,chain,groupby
+from   itertools                 import izip,ifilter,imap,chain,groupby,islice
+
+import numpy as np
 
 from   glu.lib.utils             import as_set,Counter,izip_exact,gcdisabled
 from   glu.lib.xtab              import xtab,rowsby
@@ -21,7 +23,8 @@ from   glu.lib.genolib.locus     import Genome
 from   glu.lib.genolib.phenos    import Phenome,merge_phenome_list
 from   glu.lib.genolib.transform import GenoTransform, prove_unique_transform
 from   glu.lib.genolib.merge     import UniqueMerger, VoteMerger
-from   glu.lib.genolib.genoarray import GenotypeArray,Genotype,pick,pick_columns,place_list
+from   glu.lib.genolib.genoarray import GenotypeArray,Genotype,GenotypeRepresentationError, \
+                                        pick,pick_columns,place_list
 from   glu.lib.genolib.encode    import pack_genomatrixstream, recode_genomatrixstream,      \
                                         encode_genomatrixstream_from_tuples,                 \
                                         encode_genomatrixstream_from_strings,                \
@@ -32,6 +35,9 @@ from   glu.lib.genolib.encode    import pack_genomatrixstream, recode_genomatrix
 # Debugging flag
 DEBUG=False
 
+# Default number of genotypes per columnar genotriple batch
+GENOTRIPLE_BATCHSIZE = 65536
+
 
 class GenotypeStream(object):
   __slots__ = []
@@ -127,7 +133,9 @@ class GenotripleStream(GenotypeStream):
     assert isinstance(genome,Genome)
     assert phenome is not None
     assert isinstance(phenome,Phenome)
-    assert not materialized or isinstance(triples, (list,tuple))
+    assert not materialized or isinstance(triples, (list,tuple)) \
+                            or (isinstance(triples, GenotripleBatches)
+                                and isinstance(triples.batches, (list,tuple)))
 
     if order not in (None,'locus','sample'):
       raise ValueError('invalid GenotripleStream order specified')
@@ -148,6 +156,7 @@ class GenotripleStream(GenotypeStream):
     self.unique       = bool(unique)
     self.materialized = materialized or isinstance(triples, (list,tuple))
     self.updates      = updates
+    self.batched      = isinstance(triples, GenotripleBatches)
 
   if DEBUG:
     def __iter__(self):
@@ -330,6 +339,52 @@ class GenotripleStream(GenotypeStream):
     return GenotripleStream(triples, samples=samples, loci=loci, order=order, updates=updates,
                                      genome=genome, phenome=phenome, unique=unique)
 
+  @staticmethod
+  def from_batches(batches, genome, samples=None, loci=None, order=None, unique=False,
+                                    phenome=None, materialized=False):
+    '''
+    Alternate constructor that builds a new GenotripleStream object from a
+    sequence of columnar genotriple batches.  The models of each batch must
+    be consistent with the genome.
+
+    @param      batches: sequence of genotriple batches
+    @type       batches: sequence of GenotripleBatch
+    @param       genome: genome descriptor
+    @type        genome: Genome instance
+    @param      samples: optional set of samples referred to by the triples. Default is None
+    @type       samples: sequence, set, or None
+    @param         loci: optional set of loci referred to by the triples. Default is None
+    @type          loci: sequence, set, or None
+    @param        order: sort order, 'sample' or 'locus', or None, Default is None
+    @type         order: str or None
+    @param       unique: flag indicating if repeated elements do not exist within the stream. Default is 'False'
+    @type        unique: bool
+    @param      phenome: phenome descriptor
+    @type       phenome: Phenome instance
+    @param materialized: flag indicating if batches is a materialized list of batches
+    @type  materialized: bool
+
+    >>> triples = [('s1','l1', ('G', 'G')),('s1','l2', ('A', 'A')),
+    ...            ('s2','l1', ('G', 'T')),('s2','l2', ('T', 'T'))]
+    >>> triples = GenotripleStream.from_tuples(triples)
+    >>> batches = list(triples.as_batches(batchsize=3))
+    >>> [ len(batch) for batch in batches ]
+    [3, 1]
+    >>> triples = GenotripleStream.from_batches(batches, triples.genome, materialized=True)
+    >>> for row in triples:
+    ...   print row
+    ('s1', 'l1', ('G', 'G'))
+    ('s1', 'l2', ('A', 'A'))
+    ('s2', 'l1', ('G', 'T'))
+    ('s2', 'l2', ('T', 'T'))
+    '''
+    if phenome is None:
+      phenome = Phenome()
+
+    return GenotripleStream(GenotripleBatches(batches), samples=samples, loci=loci, order=order,
+                                     genome=genome, phenome=phenome, unique=unique,
+                                     materialized=materialized)
+
   def to_tuples(self):
     '''
     Iterate over genotriples with genotypes coded as tuples
@@ -435,6 +490,16 @@ class GenotripleStream(GenotypeStream):
     if self.materialized:
       return self
 
+    if self.batched:
+      batches = list(self.as_batches())
+      samples = set()
+      loci    = set()
+      for batch in batches:
+        samples.update(batch.used_samples())
+        loci.update(batch.used_loci())
+
+      return self.clone(GenotripleBatches(batches), loci=loci, samples=samples, materialized=True)
+
     genos   = list(self.use_stream())
 
     # FIXME: These extraction operators should work in parallel to avoid thrashing
@@ -443,6 +508,32 @@ class GenotripleStream(GenotypeStream):
 
     return self.clone(genos, loci=loci, samples=samples, materialized=True)
 
+  def as_batches(self, batchsize=GENOTRIPLE_BATCHSIZE):
+    '''
+    Iterate over the genotriples of this stream as columnar batches.  Streams
+    built from batches return their batches directly, otherwise genotriples
+    are grouped into new batches of at most batchsize genotypes.
+
+    @param batchsize: maximum number of genotypes per new batch
+    @type  batchsize: int
+    @return         : sequence of genotriple batches
+    @rtype          : sequence of GenotripleBatch
+
+    >>> triples = [('s1','l1', ('G', 'G')),('s1','l2', ('A', 'A')),
+    ...            ('s2','l1', ('G', 'T')),('s2','l2', ('T', 'T'))]
+    >>> triples = GenotripleStream.from_tuples(triples)
+    >>> for batch in triples.as_batches(batchsize=3):
+    ...   print batch.samples,batch.loci,batch.geno_ids.tolist()
+    ['s1', 's2'] ['l1', 'l2'] [1, 1, 2]
+    ['s2'] ['l2'] [3]
+    '''
+    triples = self.use_stream()
+
+    if isinstance(triples, GenotripleBatches):
+      return iter(triples.batches)
+
+    return genotriple_batches(triples, batchsize)
+
   def transformed(self, transform=None, mergefunc=None, **kwargs):
     '''
     Apply filtering and renaming transformations to a genotriple stream.
@@ -1287,6 +1378,22 @@ class GenomatrixStream(GenotypeStream):
     >>> for row in genos:
     ...   print row
     ('l1', [('G', 'G'), ('G', 'T')])
+
+    Column selection is applied while recoding packed streams:
+
+    >>> genome = Genome()
+    >>> from glu.lib.genolib.genoarray import build_model
+    >>> genome.set_locus('l1',build_model('TG'))
+    >>> genos = GenomatrixStream.from_tuples(rows,'ldat',samples=samples)
+    >>> genos = genos.transformed(exclude_samples=['s1'],recode_models=genome)
+    >>> genos.samples
+    ('s2', 's3')
+    >>> for row in genos:
+    ...   print row
+    ('l1', [('G', 'T'), ('T', 'T')])
+    ('l2', [('T', 'T'), ('A', 'T')])
+    >>> genos.models[0] is genome.get_model('l1')
+    True
     '''
     # FIXME: Allow for merging transformations
     if transform and kwargs:
@@ -1334,20 +1441,36 @@ class GenomatrixStream(GenotypeStream):
     if rowtransform.include is not None:
       genos = filter_genomatrixstream_by_row(genos,rowtransform.include)
 
-    # Apply column includes and excludes
-    if coltransform.exclude:
-      genos = filter_genomatrixstream_by_column(genos,coltransform.exclude,exclude=True)
-    if coltransform.include is not None:
-      genos = filter_genomatrixstream_by_column(genos,coltransform.include)
+    # Apply column includes and excludes.  When packed rows are recoded
+    # without renaming alleles, column selection is planned as an array of
+    # column indices that is applied along with the recoding of each row.
+    # Otherwise, columns are filtered in a separate pass.
+    columns = None
+    if coltransform.exclude or coltransform.include is not None:
+      if genos.packed and transform.recode_models is not None and not transform.rename_alleles:
+        columns = genomatrixstream_column_indices(genos,coltransform.include,coltransform.exclude)
+      else:
+        if coltransform.exclude:
+          genos = filter_genomatrixstream_by_column(genos,coltransform.exclude,exclude=True)
+        if coltransform.include is not None:
+          genos = filter_genomatrixstream_by_column(genos,coltransform.include)
+
+    loci,samples = genos.loci,genos.samples
+    if columns is not None:
+      if genos.format=='ldat':
+        samples = columns[0]
+      else:
+        loci    = columns[0]
+      columns   = columns[1]
 
-    genos.unique = prove_unique_transform(transform=transform,loci=genos.loci,samples=genos.samples,unique=genos.unique)
+    genos.unique = prove_unique_transform(transform=transform,loci=loci,samples=samples,unique=genos.unique)
 
     # Apply model updates
     # FIXME: recoding and renaming can be combined
     if transform.rename_alleles:
       genos = rename_genomatrixstream_alleles(genos,transform.rename_alleles)
     if transform.recode_models is not None:
-      genos = recode_genomatrixstream(genos, transform.recode_models)
+      genos = recode_genomatrixstream(genos, transform.recode_models, columns=columns)
 
     # Apply renamings
     if rowtransform.rename:
@@ -1712,6 +1835,414 @@ def unique_check_genomatrixstream(genos):
 #######################################################################################
 
 
+class GenotripleBatch(object):
+  '''
+  A columnar batch of genotriples
+
+  Each batch stores its genotypes as three parallel arrays: sample ids and
+  locus ids that index dictionaries of sample and locus names, and genotype
+  indices that refer to the model of each locus.  Batches are a compact
+  alternative to one tuple per genotype and allow sorting and grouping to be
+  performed on whole arrays at once.  The dictionaries may be shared by many
+  batches, e.g. all batches loaded from a single file.
+
+  >>> triples = [('s2','l1', ('G', 'G')),('s1','l2', ('A', 'A')),
+  ...            ('s2','l2', ('A', 'T')),('s1','l1', ('G', 'T'))]
+  >>> triples = GenotripleStream.from_tuples(triples)
+  >>> batch = GenotripleBatch.from_triples(triples)
+  >>> len(batch)
+  4
+  >>> batch.samples
+  ['s2', 's1']
+  >>> batch.loci
+  ['l1', 'l2']
+  >>> batch.sample_ids
+  array([0, 1, 0, 1], dtype=int32)
+  >>> batch.locus_ids
+  array([0, 1, 1, 0], dtype=int32)
+  >>> for triple in batch:
+  ...   print triple
+  ('s2', 'l1', ('G', 'G'))
+  ('s1', 'l2', ('A', 'A'))
+  ('s2', 'l2', ('A', 'T'))
+  ('s1', 'l1', ('G', 'T'))
+  '''
+  __slots__ = ('samples','loci','models','sample_ids','locus_ids','geno_ids')
+
+  def __init__(self, samples, loci, models, sample_ids, locus_ids, geno_ids):
+    '''
+    @param    samples: sample names indexed by sample id
+    @type     samples: sequence of str
+    @param       loci: locus names indexed by locus id
+    @type        loci: sequence of str
+    @param     models: genotype models indexed by locus id
+    @type      models: sequence of GenotypeModel
+    @param sample_ids: sample id of each genotype
+    @type  sample_ids: int32 ndarray
+    @param  locus_ids: locus id of each genotype
+    @type   locus_ids: int32 ndarray
+    @param   geno_ids: index of each genotype within the model of its locus
+    @type    geno_ids: uint16 ndarray
+    '''
+    assert len(sample_ids) == len(locus_ids) == len(geno_ids)
+
+    self.samples    = samples
+    self.loci       = loci
+    self.models     = models
+    self.sample_ids = sample_ids
+    self.locus_ids  = locus_ids
+    self.geno_ids   = geno_ids
+
+  def __len__(self):
+    return len(self.geno_ids)
+
+  def __iter__(self):
+    samples,loci,models = self.samples,self.loci,self.models
+    for sid,lid,gid in izip(self.sample_ids.tolist(),self.locus_ids.tolist(),self.geno_ids.tolist()):
+      yield samples[sid],loci[lid],models[lid].genotypes[gid]
+
+  @staticmethod
+  def from_triples(triples):
+    '''
+    Build a batch from a sequence of encoded genotriples
+
+    Genotypes of the same locus that belong to different models are
+    represented in the most general of the two models, or added to the
+    existing model when neither can represent the other.
+
+    @param triples: sequence of genotriples(str,str,genotype)
+    @type  triples: sequence
+    @return       : genotriple batch
+    @rtype        : GenotripleBatch
+    '''
+    samples    = []
+    loci       = []
+    models     = []
+    samplemap  = {}
+    locusmap   = {}
+    sample_ids = []
+    locus_ids  = []
+    geno_ids   = []
+
+    for sample,locus,geno in triples:
+      sid = samplemap.get(sample)
+      if sid is None:
+        sid = samplemap[sample] = len(samples)
+        samples.append(sample)
+
+      lid = locusmap.get(locus)
+      if lid is None:
+        lid = locusmap[locus] = len(loci)
+        loci.append(locus)
+        models.append(geno.model)
+      elif geno.model is not models[lid]:
+        try:
+          models[lid] = update_model(models[lid], geno.model)
+        except GenotypeRepresentationError:
+          geno = models[lid].add_genotype(geno)
+
+      sample_ids.append(sid)
+      locus_ids.append(lid)
+      geno_ids.append(geno.index)
+
+    return GenotripleBatch(samples, loci, models, np.array(sample_ids, dtype=np.int32),
+                                                  np.array(locus_ids,  dtype=np.int32),
+                                                  np.array(geno_ids,   dtype=np.uint16))
+
+  @staticmethod
+  def concatenate(batches):
+    '''
+    Concatenate a sequence of batches into a single batch.  Batches that
+    share dictionaries are joined directly, otherwise sample and locus ids
+    are remapped onto merged dictionaries.
+
+    @param batches: sequence of genotriple batches
+    @type  batches: sequence of GenotripleBatch
+    @return       : genotriple batch
+    @rtype        : GenotripleBatch
+
+    >>> b1 = GenotripleBatch.from_triples(GenotripleStream.from_tuples([('s1','l1',('A','A')),('s2','l2',('C','T'))]))
+    >>> b2 = GenotripleBatch.from_triples(GenotripleStream.from_tuples([('s3','l2',('T','T')),('s1','l1',('A','G'))]))
+    >>> batch = GenotripleBatch.concatenate([b1,b2])
+    >>> batch.samples
+    ['s1', 's2', 's3']
+    >>> batch.loci
+    ['l1', 'l2']
+    >>> for triple in batch:
+    ...   print triple
+    ('s1', 'l1', ('A', 'A'))
+    ('s2', 'l2', ('C', 'T'))
+    ('s3', 'l2', ('T', 'T'))
+    ('s1', 'l1', ('A', 'G'))
+    '''
+    batches = list(batches)
+
+    if not batches:
+      empty = np.empty(0, dtype=np.int32)
+      return GenotripleBatch([], [], [], empty, empty, np.empty(0, dtype=np.uint16))
+
+    first = batches[0]
+    if all(b.samples is first.samples and b.loci is first.loci and b.models is first.models
+           for b in batches):
+      if len(batches) == 1:
+        return first
+      return GenotripleBatch(first.samples, first.loci, first.models,
+                             np.concatenate([ b.sample_ids for b in batches ]),
+                             np.concatenate([ b.locus_ids  for b in batches ]),
+                             np.concatenate([ b.geno_ids   for b in batches ]))
+
+    samples    = []
+    loci       = []
+    models     = []
+    samplemap  = {}
+    locusmap   = {}
+    sample_ids = []
+    locus_ids  = []
+    geno_ids   = []
+
+    for batch in batches:
+      smap = np.empty(len(batch.samples), dtype=np.int32)
+      for i,sample in enumerate(batch.samples):
+        sid = samplemap.get(sample)
+        if sid is None:
+          sid = samplemap[sample] = len(samples)
+          samples.append(sample)
+        smap[i] = sid
+
+      lmap    = np.empty(len(batch.loci), dtype=np.int32)
+      recodes = []
+      for i,(locus,model) in enumerate(izip(batch.loci,batch.models)):
+        lid = locusmap.get(locus)
+        if lid is None:
+          lid = locusmap[locus] = len(loci)
+          loci.append(locus)
+          models.append(model)
+        elif model is not models[lid]:
+          try:
+            models[lid] = update_model(models[lid], model)
+          except GenotypeRepresentationError:
+            recode = [ models[lid].add_genotype(g).index for g in model.genotypes ]
+            recodes.append( (i,np.array(recode, dtype=np.uint16)) )
+        lmap[i] = lid
+
+      gids = batch.geno_ids
+      if recodes:
+        gids = gids.copy()
+        for i,recode in recodes:
+          mask       = batch.locus_ids == i
+          gids[mask] = recode[gids[mask]]
+
+      sample_ids.append(smap[batch.sample_ids])
+      locus_ids.append(lmap[batch.locus_ids])
+      geno_ids.append(gids)
+
+    return GenotripleBatch(samples, loci, models, np.concatenate(sample_ids),
+                                                  np.concatenate(locus_ids),
+                                                  np.concatenate(geno_ids))
+
+  def take(self, indices):
+    '''
+    Return a new batch with the genotypes at the specified positions.  The
+    dictionaries of the new batch are shared with this batch.
+
+    @param indices: positions of the genotypes to select
+    @type  indices: integer ndarray
+    @return       : genotriple batch
+    @rtype        : GenotripleBatch
+    '''
+    return GenotripleBatch(self.samples, self.loci, self.models, self.sample_ids[indices],
+                                                                 self.locus_ids[indices],
+                                                                 self.geno_ids[indices])
+
+  def genotype_ranks(self):
+    '''
+    Return the rank of each genotype among the genotypes of its model, such
+    that comparing ranks of genotypes at the same locus is equivalent to
+    comparing the genotypes themselves.
+
+    @return: genotype ranks
+    @rtype : int32 ndarray
+    '''
+    offsets = np.zeros(len(self.loci), dtype=np.int32)
+    ranks   = []
+    n       = 0
+
+    for lid in np.unique(self.locus_ids).tolist():
+      genotypes = self.models[lid].genotypes
+      rank = np.empty(len(genotypes), dtype=np.int32)
+      rank[sorted(xrange(len(genotypes)), key=genotypes.__getitem__)] = np.arange(len(genotypes))
+      offsets[lid] = n
+      n += len(genotypes)
+      ranks.append(rank)
+
+    if not ranks:
+      return np.empty(0, dtype=np.int32)
+
+    return np.concatenate(ranks)[offsets[self.locus_ids]+self.geno_ids]
+
+  def sorted(self, order, locusorder=None, sampleorder=None):
+    '''
+    Return a new batch sorted by the specified order, as described by
+    sort_genotriples.
+
+    @param       order: sort order, either 'samples', 'locus'
+    @type        order: str
+    @param  locusorder: ordered list of loci (optional)
+    @type   locusorder: sequence
+    @param sampleorder: ordered list of samples (optional)
+    @type  sampleorder: sequence
+    @return           : sorted genotriple batch
+    @rtype            : GenotripleBatch
+    '''
+    def name_ranks(names, nameorder):
+      od = {}
+      for x in nameorder or []:
+        od.setdefault(x, (len(od),x) )
+      n    = len(od)
+      keys = [ od.get(name, (n,name)) for name in names ]
+      rank = np.empty(len(names), dtype=np.int32)
+      rank[sorted(xrange(len(names)), key=keys.__getitem__)] = np.arange(len(names))
+      return rank
+
+    samplerank = name_ranks(self.samples, sampleorder)[self.sample_ids]
+    locusrank  = name_ranks(self.loci,    locusorder)[self.locus_ids]
+    genorank   = self.genotype_ranks()
+
+    if order == 'sample':
+      indices = np.lexsort( (genorank,locusrank,samplerank) )
+    elif order == 'locus':
+      indices = np.lexsort( (genorank,samplerank,locusrank) )
+    else:
+      raise ValueError("Unknown ordering specified: '%s'" % order)
+
+    return self.take(indices)
+
+  def used_samples(self):
+    '''
+    @return: set of sample names referred to by this batch
+    @rtype : set
+    '''
+    samples = self.samples
+    return set( samples[i] for i in np.unique(self.sample_ids).tolist() )
+
+  def used_loci(self):
+    '''
+    @return: set of locus names referred to by this batch
+    @rtype : set
+    '''
+    loci = self.loci
+    return set( loci[i] for i in np.unique(self.locus_ids).tolist() )
+
+
+class GenotripleBatches(object):
+  '''
+  A genotriple data source stored as a sequence of GenotripleBatch objects.
+  Iteration yields genotriples, while the underlying batches remain available
+  to operations that can process whole batches at once.
+  '''
+  __slots__ = ('batches',)
+
+  def __init__(self, batches):
+    '''
+    @param batches: sequence of genotriple batches
+    @type  batches: sequence of GenotripleBatch
+    '''
+    self.batches = batches
+
+  def __iter__(self):
+    return chain.from_iterable(self.batches)
+
+
+def genotriple_batches(triples, batchsize=GENOTRIPLE_BATCHSIZE):
+  '''
+  Split a sequence of encoded genotriples into batches of at most batchsize
+  genotypes
+
+  @param   triples: sequence of genotriples(str,str,genotype)
+  @type    triples: sequence
+  @param batchsize: maximum number of genotypes per batch
+  @type  batchsize: int
+  @return         : sequence of genotriple batches
+  @rtype          : generator of GenotripleBatch
+  '''
+  triples = iter(triples)
+  while 1:
+    batch = GenotripleBatch.from_triples(islice(triples,batchsize))
+    if not len(batch):
+      break
+    yield batch
+
+
+def xtab_genotriple_batch(batch, format, aggfunc):
+  '''
+  Cross-tabulate a genotriple batch into a genomatrix with the same results
+  as xtab, i.e. rows and columns appear in the order they are first seen and
+  the genotypes of each cell are sorted before being passed to aggfunc.
+  Empty cells are passed to aggfunc as None.
+
+  @param   batch: genotriple batch
+  @type    batch: GenotripleBatch
+  @param  format: format genomatrix, either 'sdat' or 'ldat'
+  @type   format: str
+  @param aggfunc: function to aggregate the genotypes of each cell
+  @type  aggfunc: callable
+  @return       : columns, rows, and a generator of aggregated rows
+  @rtype        : tuple of list, list, generator
+  '''
+  if format == 'sdat':
+    row_ids,rownames,col_ids,colnames = batch.sample_ids,batch.samples,batch.locus_ids,batch.loci
+  elif format == 'ldat':
+    row_ids,rownames,col_ids,colnames = batch.locus_ids,batch.loci,batch.sample_ids,batch.samples
+  else:
+    raise NotImplementedError('triple to %s format conversion is not supported' % format)
+
+  def first_seen(ids, n):
+    unique,first = np.unique(ids, return_index=True)
+    seen         = unique[np.argsort(first, kind='mergesort')]
+    rank         = np.empty(n, dtype=np.int32)
+    rank[seen]   = np.arange(len(seen))
+    return seen.tolist(),rank
+
+  rowseen,rowrank = first_seen(row_ids, len(rownames))
+  colseen,colrank = first_seen(col_ids, len(colnames))
+
+  rows    = [ rownames[i] for i in rowseen ]
+  columns = [ colnames[j] for j in colseen ]
+
+  def _xtab():
+    if not len(batch):
+      return
+
+    r       = rowrank[row_ids]
+    c       = colrank[col_ids]
+    indices = np.lexsort( (batch.genotype_ranks(),c,r) )
+    r       = r[indices]
+    c       = c[indices].tolist()
+    lids    = batch.locus_ids[indices].tolist()
+    gids    = batch.geno_ids[indices].tolist()
+    models  = batch.models
+    ncols   = len(columns)
+    stops   = np.flatnonzero(np.diff(r)).tolist()
+    stops   = [ i+1 for i in stops ] + [len(r)]
+    start   = 0
+
+    for rowkey,stop in izip(rows,stops):
+      row = [None]*ncols
+      for k in xrange(start,stop):
+        j    = c[k]
+        geno = models[lids[k]].genotypes[gids[k]]
+        cell = row[j]
+        if cell is None:
+          row[j] = [geno]
+        else:
+          cell.append(geno)
+
+      yield [ aggfunc(rowkey,colkey,cell) for colkey,cell in izip(columns,row) ]
+      start = stop
+
+  return columns,rows,_xtab()
+
+
 def sort_genotriples(triples,order,locusorder=None,sampleorder=None,maxincore=1000000):
   '''
   Sort genotriples by the specified order.  When
@@ -1723,10 +2254,10 @@ def sort_genotriples(triples,order,locusorder=None,sampleorder=None,maxincore=10
   sampleorder, if specified, and the remaining loci or samples are sorted in
   lexicographical order.
 
-  This current version fully materializes the input triple-stream and
-  performs the sort in core memory.  Future versions will honor the in-core
-  parameter and spill very large streams to disk and perform a multi-phase
-  offline merge sort.
+  This current version fully materializes the input triple-stream as a
+  single columnar GenotripleBatch and performs the sort in core memory.
+  Future versions will honor the in-core parameter and spill very large
+  streams to disk and perform a multi-phase offline merge sort.
 
   @param     triples: sequence of genotriples(str,str,genotype representation)
   @type      triples: sequence
@@ -1770,42 +2301,26 @@ def sort_genotriples(triples,order,locusorder=None,sampleorder=None,maxincore=10
   ['l1', 'l2']
   >>> list(striples)
   [('s3', 'l1', ('G', 'G')), ('s3', 'l2', ('A', 'A')), ('s2', 'l2', ('A', 'A')), ('s2', 'l2', ('A', 'T')), ('s1', 'l1', ('G', 'G')), ('s1', 'l1', ('T', 'T'))]
-  '''
-  def makeorderdict(o):
-    od = {}
-    for x in o or []:
-      od.setdefault(x, (len(od),x) )
-    return od
-
-  def keyfunctor(i1,orderdict1,i2,orderdict2):
-    n1 = len(orderdict1)
-    n2 = len(orderdict2)
-    def _keyfunc(r):
-      r1,r2 = r[i1],r[i2]
-      k1 = orderdict1.get(r1, (n1,r1))
-      k2 = orderdict2.get(r2, (n2,r2))
-      return k1,k2,r[2]
-    return _keyfunc
-
-  locusorder  = makeorderdict(locusorder)
-  sampleorder = makeorderdict(sampleorder)
+  >>> striples.batched
+  True
 
-  if order == 'sample':
-    keyfunc = keyfunctor(0, sampleorder, 1, locusorder)
-  elif order == 'locus':
-    keyfunc = keyfunctor(1, locusorder,  0, sampleorder)
-  else:
+  >>> striples = sort_genotriples(triples,order='locus',sampleorder=['s3','s2','s1'])
+  >>> list(striples)
+  [('s3', 'l1', ('G', 'G')), ('s1', 'l1', ('G', 'G')), ('s1', 'l1', ('T', 'T')), ('s3', 'l2', ('A', 'A')), ('s2', 'l2', ('A', 'A')), ('s2', 'l2', ('A', 'T'))]
+  '''
+  if order not in ('sample','locus'):
     raise ValueError("Unknown ordering specified: '%s'" % order)
 
   # In memory sort should eventually be augmented by an offline multiphase
   # merge sort for very large sets.
-  striples = sorted(triples,key=keyfunc)
+  batch = GenotripleBatch.concatenate(triples.as_batches())
+  batch = batch.sorted(order, locusorder=locusorder, sampleorder=sampleorder)
 
-  # Extract sample and locus sets since this can be done quickly with materialized lists
-  samples = set(imap(itemgetter(0), striples))
-  loci    = set(imap(itemgetter(1), striples))
+  # Extract sample and locus sets since this can be done quickly from the batch dictionaries
+  samples = batch.used_samples()
+  loci    = batch.used_loci()
 
-  return triples.clone(striples,samples=samples,loci=loci,materialized=True,order=order)
+  return triples.clone(GenotripleBatches([batch]),samples=samples,loci=loci,materialized=True,order=order)
 
 
 def combine_unsorted_genotriple_list(triplelist):
@@ -2650,6 +3165,26 @@ def build_genomatrixstream_from_genotriples(triples, format, mergefunc):
   [('s1', [2, 0, 0, 0, 0]), ('s2', [2, 0, 0, 0, 0]), ('s3', [2, 0, 0, 0, 0])]
   >>> sorted( (l,list(c)) for l,c in merger.locusstats.iteritems())
   [('l1', [3, 0, 0, 0, 0]), ('l2', [3, 0, 0, 0, 0])]
+
+  Unordered streams of columnar batches are cross-tabulated as whole
+  batches:
+
+  >>> triples = [('s2','l2', ('T', 'T')),('s1','l1', ('G', 'G')),
+  ...            ('s1','l2', ('A', 'A')),('s2','l1', ('G', 'T')),
+  ...            ('s3','l1', ('G', 'G')),('s1','l1', ('G', 'G'))]
+  >>> triples = GenotripleStream.from_tuples(triples)
+  >>> triples = GenotripleStream.from_batches(triples.as_batches(batchsize=4),triples.genome)
+  >>> merger = VoteMerger(trackstats=True)
+  >>> genos = build_genomatrixstream_from_genotriples(triples,'sdat',merger)
+  >>> genos.loci
+  ('l2', 'l1')
+  >>> for row in genos:
+  ...   print row
+  ('s2', [('T', 'T'), ('G', 'T')])
+  ('s1', [('A', 'A'), ('G', 'G')])
+  ('s3', [(None, None), ('G', 'G')])
+  >>> sorted( (l,list(c)) for l,c in merger.samplestats.iteritems())
+  [('s1', [1, 1, 0, 0, 0]), ('s2', [2, 0, 0, 0, 0]), ('s3', [1, 0, 0, 0, 1])]
   '''
   genome = triples.genome
   merger = mergefunc.merge_geno
@@ -2680,7 +3215,11 @@ def build_genomatrixstream_from_genotriples(triples, format, mergefunc):
 
   # SLOWPATH: full xtab because of unknown columns or unordered rows
   if not order:
-    columns,rows,data = xtab(triples, rowkeyfunc, colkeyfunc, valuefunc, aggfunc)
+    if triples.batched:
+      batch = GenotripleBatch.concatenate(triples.as_batches())
+      columns,rows,data = xtab_genotriple_batch(batch, format, aggfunc)
+    else:
+      columns,rows,data = xtab(triples, rowkeyfunc, colkeyfunc, valuefunc, aggfunc)
     genos  = tuple(izip(rows,data))
     rows   = tuple(rows)
 
@@ -3448,6 +3987,46 @@ def rename_genomatrixstream_column(genos,colmap,warn=False):
   return genos
 
 
+def genomatrixstream_column_indices(genos,include=None,exclude=None):
+  '''
+  Return the names and indices of the columns of a genomatrix stream that
+  appear in the include set, if specified, and do not appear in the exclude
+  set.  None is returned if all columns are selected.
+
+  @param   genos: genomatrix stream
+  @type    genos: sequence
+  @param include: set of the column names to include (optional)
+  @type  include: set
+  @param exclude: set of the column names to exclude (optional)
+  @type  exclude: set
+  @return       : tuples of selected column names and indices, or None
+  @rtype        : tuple of tuples
+
+  >>> samples = ('s1','s2','s3')
+  >>> rows = [('l1',['AA','AG','GG'])]
+  >>> genos = GenomatrixStream.from_strings(rows,'ldat',snp,samples=samples)
+  >>> genomatrixstream_column_indices(genos,include=['s1','s3'])
+  (('s1', 's3'), (0, 2))
+  >>> genomatrixstream_column_indices(genos,include=['s1','s3'],exclude=['s1'])
+  (('s3',), (2,))
+  >>> genomatrixstream_column_indices(genos,exclude=['s4']) is None
+  True
+  '''
+  include = as_set(include) if include is not None else None
+  exclude = as_set(exclude) if exclude else None
+
+  columns = genos.columns
+  columns = ((name,i) for i,name in enumerate(columns)
+                      if (include is None or name in include) and (exclude is None or name not in exclude))
+
+  columns,indices = tuple(izip(*columns)) or ((),())
+
+  if columns == genos.columns:
+    return None
+
+  return columns,indices
+
+
 def filter_genomatrixstream_by_column(genos,colset,exclude=False):
   '''
   Filter the genotype matrix data by a column set.  Depending on the
@@ -3510,19 +4089,16 @@ def filter_genomatrixstream_by_column(genos,colset,exclude=False):
   ('s2', [('A', 'T')])
   ('s3', [('T', 'T')])
   '''
-  colset = as_set(colset)
-
-  columns = genos.columns
   if exclude:
-    columns = ((name,i) for i,name in enumerate(columns) if name not in colset)
+    selection = genomatrixstream_column_indices(genos,exclude=colset)
   else:
-    columns = ((name,i) for i,name in enumerate(columns) if name     in colset)
-
-  columns,indices = tuple(izip(*columns)) or ((),())
+    selection = genomatrixstream_column_indices(genos,include=colset)
 
-  if columns == genos.columns:
+  if selection is None:
     return genos
 
+  columns,indices = selection
+
   if genos.format=='ldat':
     def _filter():
       for lname,row in genos:
@@ -316,6 +316,26 @@ class GenoTransform(object):
                       filter_nonfounders=filter_nonfounders,
                           filter_missing=filter_missing_genotypes)
 
+  def is_null(self):
+    '''
+    Return True if the transformation does not alter the genotypes, names,
+    encoding or order of a stream, so that data derived from the
+    untransformed stream remain valid
+
+    >>> GenoTransform.from_kwargs().is_null()
+    True
+    >>> GenoTransform.from_kwargs(repack=True).is_null()
+    True
+    >>> GenoTransform.from_kwargs(include_loci=['l1']).is_null()
+    False
+    >>> GenoTransform.from_kwargs(filter_missing=True).is_null()
+    False
+    '''
+    return (self.samples.is_null() and self.loci.is_null()
+            and self.recode_models is None and not self.rename_alleles
+            and not self.filter_founders and not self.filter_nonfounders
+            and not self.filter_missing_genotypes)
+
 
 def _merge_rename_alleles(amap1, amap2):
   if amap1 is None:
@@ -413,6 +433,9 @@ class GenoSubTransform(object):
 
     return GenoSubTransform(include, exclude, rename, order)
 
+  def is_null(self):
+    return self.include is None and not self.exclude and not self.rename and not self.order
+
 
 def prove_bijective_mapping(items,transform):
   '''
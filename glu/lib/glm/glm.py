@@ -12,10 +12,12 @@ from   itertools    import izip
 
 import numpy as np
 
-import scipy.stats
-
 from   numpy        import dot
-from   scipy.linalg import svd,cholesky,norm,inv,schur,rsf2csf,LinAlgError
+from   numpy.linalg import LinAlgError
+
+from   glu.lib.utils import lazy_import
+
+scipy = lazy_import('scipy.stats','scipy.linalg')
 
 CONV = 1e-8
 COND = 1e-8
@@ -271,7 +273,7 @@ def linear_least_squares(a, b, weights=None, sqrtweights=False, cond=None):
         raise ValueError('incompatible weight matrix dimensions')
 
       if not sqrtweights:
-        weights = cholesky(weights,lower=False)
+        weights = scipy.linalg.cholesky(weights,lower=False)
 
       a1 = np.dot(weights,a1)
       b1 = np.dot(weights,b1)
@@ -361,7 +363,7 @@ def sqrtm(x):
          [ 0.33907405,  0.35263109,  0.24780888,  0.18047398],
          [ 0.19263836,  0.24780888,  0.24041034,  0.20900738],
          [ 0.13100093,  0.18047398,  0.20900738,  0.22244957]])
-  >>> error = norm(x-np.dot(y,y))
+  >>> error = scipy.linalg.norm(x-np.dot(y,y))
   >>> error < 1e-14
   True
 
@@ -375,7 +377,7 @@ def sqrtm(x):
   array([[ 1.97119712,  0.23914631,  0.23914631],
          [ 0.51131184,  1.95468751,  0.2226367 ],
          [-0.03301922,  0.25565592,  1.98770673]])
-  >>> error = norm(x-np.dot(y,y))
+  >>> error = scipy.linalg.norm(x-np.dot(y,y))
   >>> error < 1e-14
   True
   '''
@@ -384,8 +386,8 @@ def sqrtm(x):
     raise ValueError('Non-matrix input to matrix function')
 
   # Refactor into complex Schur form
-  T,Z = schur(A)
-  T,Z = rsf2csf(T,Z)
+  T,Z = scipy.linalg.schur(A)
+  T,Z = scipy.linalg.rsf2csf(T,Z)
   n,n = T.shape
 
   # Compute upper triangular square root R of T a column at a tim
@@ -426,7 +428,7 @@ def sqrtm_svd(x):
          [ 0.33907405,  0.35263109,  0.24780888,  0.18047398],
          [ 0.19263836,  0.24780888,  0.24041034,  0.20900738],
          [ 0.13100093,  0.18047398,  0.20900738,  0.22244957]])
-  >>> error = norm(x-np.dot(y,y))
+  >>> error = scipy.linalg.norm(x-np.dot(y,y))
   >>> error < 1e-14
   True
 
@@ -440,11 +442,11 @@ def sqrtm_svd(x):
   array([[ 1.94181569,  0.11454081,  0.37488366],
          [ 0.63982574,  1.94044655,  0.2169288 ],
          [-0.16206229,  0.28998723,  1.97233742]])
-  >>> error = norm(x-np.dot(y,y))
+  >>> error = scipy.linalg.norm(x-np.dot(y,y))
   >>> error < 1e-14
   False
   '''
-  u,s,vt = svd(x)
+  u,s,vt = scipy.linalg.svd(x)
   return np.dot(u,((s**0.5)*vt.T).T)
 
 
@@ -468,7 +470,7 @@ def sqrtm_eig(x):
          [ 0.33907405,  0.35263109,  0.24780888,  0.18047398],
          [ 0.19263836,  0.24780888,  0.24041034,  0.20900738],
          [ 0.13100093,  0.18047398,  0.20900738,  0.22244957]])
-  >>> error = norm(x-np.dot(y,y))
+  >>> error = scipy.linalg.norm(x-np.dot(y,y))
   >>> error < 1e-14
   True
 
@@ -482,7 +484,7 @@ def sqrtm_eig(x):
   array([[ 0.76018647,  1.01358196,  0.50679098],
          [ 1.01358196,  3.08349342, -1.0563295 ],
          [ 0.50679098, -1.0563295 ,  2.06991146]])
-  >>> error = norm(x-np.dot(y,y))
+  >>> error = scipy.linalg.norm(x-np.dot(y,y))
   >>> error > 1e-14
   True
   '''
@@ -511,7 +513,7 @@ def sqrtm_symmetric(x,cond=1e-7):
          [ 0.33907405,  0.35263109,  0.24780888,  0.18047398],
          [ 0.19263836,  0.24780888,  0.24041034,  0.20900738],
          [ 0.13100093,  0.18047398,  0.20900738,  0.22244957]])
-  >>> error = norm(x-np.dot(y,y))
+  >>> error = scipy.linalg.norm(x-np.dot(y,y))
   >>> error < 1e-14
   True
   '''
@@ -541,12 +543,12 @@ def sqrtm_symmetric2(x):
          [ 0.33907405,  0.35263109,  0.24780888,  0.18047398],
          [ 0.19263836,  0.24780888,  0.24041034,  0.20900738],
          [ 0.13100093,  0.18047398,  0.20900738,  0.22244957]])
-  >>> error = norm(x-np.dot(y,y))
+  >>> error = scipy.linalg.norm(x-np.dot(y,y))
   >>> error < 1e-14
   True
   '''
-  l=cholesky(x,lower=1)
-  u,s,vt = svd(l)
+  l=scipy.linalg.cholesky(x,lower=1)
+  u,s,vt = scipy.linalg.svd(l)
   return np.dot(u,(s*u).T)
 
 
@@ -630,7 +632,7 @@ def block_cholesky(w,lower=True):
 
   Perform a lower Cholesky decomposition on the expanded form:
 
-  >>> l = np.array(cholesky(x.astype(float),lower=1))
+  >>> l = np.array(scipy.linalg.cholesky(x.astype(float),lower=1))
   >>> l
   array([[ 4.        ,  0.        ,  0.        ,  0.        ],
          [ 0.        ,  6.        ,  0.        ,  0.        ],
@@ -639,7 +641,7 @@ def block_cholesky(w,lower=True):
 
   Verify x=l*l':
 
-  >>> norm(np.dot(l,l.T)-x) < 1e-14
+  >>> scipy.linalg.norm(np.dot(l,l.T)-x) < 1e-14
   True
 
   Now do the same thing using our algorithm, still using the packed format:
@@ -653,9 +655,9 @@ def block_cholesky(w,lower=True):
 
   Verify the factorization matches the expanded version above and solves x=l*l':
 
-  >>> norm(l2-l) < 1e-14
+  >>> scipy.linalg.norm(l2-l) < 1e-14
   True
-  >>> norm(np.dot(l2,l2.T)-x) < 1e-14
+  >>> scipy.linalg.norm(np.dot(l2,l2.T)-x) < 1e-14
   True
 
   Derivation:
@@ -753,13 +755,13 @@ def block_inverse_from_triangular(u,lower=True):
 
   Find the inverse using the expanded form:
 
-  >>> y = inv(x)
+  >>> y = scipy.linalg.inv(x)
   >>> y
   array([[ 0.06349206,  0.        ,  0.00396825,  0.        ],
          [ 0.        ,  0.03881988,  0.        ,  0.02484472],
          [ 0.00396825,  0.        ,  0.01587302,  0.        ],
          [ 0.        ,  0.02484472,  0.        ,  0.05590062]])
-  >>> norm(np.dot(x,y)-np.eye(4)) < 1e-14
+  >>> scipy.linalg.norm(np.dot(x,y)-np.eye(4)) < 1e-14
   True
 
   Now with our algorithm, starting with a packed lower block cholesky
@@ -775,9 +777,9 @@ def block_inverse_from_triangular(u,lower=True):
 
   Verify the solution matches above and solves x*y=I:
 
-  >>> norm(z-y) < 1e-14
+  >>> scipy.linalg.norm(z-y) < 1e-14
   True
-  >>> norm(np.dot(x,z)-np.eye(4)) < 1e-14
+  >>> scipy.linalg.norm(np.dot(x,z)-np.eye(4)) < 1e-14
   True
   '''
   m = len(u[0][0])
@@ -830,13 +832,13 @@ def block_inverse(w):
 
   Find the inverse using the expanded form:
 
-  >>> y = inv(x)
+  >>> y = scipy.linalg.inv(x)
   >>> y
   array([[ 0.06349206,  0.        ,  0.00396825,  0.        ],
          [ 0.        ,  0.03881988,  0.        ,  0.02484472],
          [ 0.00396825,  0.        ,  0.01587302,  0.        ],
          [ 0.        ,  0.02484472,  0.        ,  0.05590062]])
-  >>> norm(np.dot(x,y)-np.eye(4)) < 1e-14
+  >>> scipy.linalg.norm(np.dot(x,y)-np.eye(4)) < 1e-14
   True
 
   Now with our algorithm, starting with the packed input:
@@ -850,9 +852,9 @@ def block_inverse(w):
 
   Verify the solution matches above and solves x*y=I:
 
-  >>> norm(z-y) < 1e-14
+  >>> scipy.linalg.norm(z-y) < 1e-14
   True
-  >>> norm(np.dot(x,z)-np.eye(4)) < 1e-14
+  >>> scipy.linalg.norm(np.dot(x,z)-np.eye(4)) < 1e-14
   True
   '''
   a = block_cholesky(w,lower=False)
@@ -940,7 +942,7 @@ def linreg(y, X, add_mean=False):
   # Fit using normal equations
   # FIXME: not a good idea for numerical stability when posed with
   # rank-deficient or ill-conditioned designs
-  W  = inv(dot(X.T,X))
+  W  = scipy.linalg.inv(dot(X.T,X))
   b  = dot(W,dot(X.T,y))
   ss = ((y - dot(X,b))**2).sum()/(n-m)
   return b,W,ss
@@ -1480,7 +1482,7 @@ class GLogitWaldTest(object):
 
     # FIXME: Use robust inverse of covariance matrix
     b  = beta[indices,:]
-    w  = inv(self.model.covariance_matrix(self.model.weights)[indices,:][:,indices])
+    w  = scipy.linalg.inv(self.model.covariance_matrix(self.model.weights)[indices,:][:,indices])
     x2 = float(dot(b.T,dot(w,b)))
 
     return x2,df
@@ -1815,7 +1817,7 @@ class LinearWaldTest(object):
 
     # FIXME: Use robust inverse of covariance matrix
     b  = beta[indices,:]
-    w  = inv(W[indices,:][:,indices])/ss
+    w  = scipy.linalg.inv(W[indices,:][:,indices])/ss
     x2 = float(dot(b.T,dot(w,b)))
 
     return x2,df
@@ -1,6 +1,8 @@
 import numpy as np
-import scipy as sp
-import scipy.sparse, scipy.linalg
+
+from   glu.lib.utils import lazy_import
+
+scipy = lazy_import('scipy.sparse','scipy.linalg')
 
 import glu.lib.glm._glmnet
 
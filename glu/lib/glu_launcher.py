@@ -56,6 +56,108 @@ def format_elapsed_time(t):
   return ''.join(elapsed) or '0.00s'
 
 
+class ImportTimer(object):
+  '''
+  Report the time taken by each import statement that loads new modules,
+  in the same format as the "-X importtime" option of later Python
+  versions.  Self times exclude the time spent in nested imports.
+  '''
+  def __init__(self, out=sys.stderr):
+    self.out    = out
+    self.nested = [0.]
+
+  def install(self):
+    import __builtin__
+    self.real_import = __builtin__.__import__
+    __builtin__.__import__ = self.timed_import
+    self.out.write('import time: self [us] | cumulative | imported package\n')
+
+  def uninstall(self):
+    import __builtin__
+    __builtin__.__import__ = self.real_import
+
+  def timed_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+    label = name
+
+    # Name packages imported by "from . import x" statements
+    if not name and globals:
+      label = '%s.{%s}' % (globals.get('__package__') or globals.get('__name__'),
+                           ','.join(fromlist or []))
+
+    return self.timed(label, self.real_import, name, globals, locals, fromlist, level)
+
+  def module_count(self):
+    # Failed implicit relative imports leave None entries in sys.modules
+    return sum(1 for m in sys.modules.itervalues() if m is not None)
+
+  def timed(self, name, func, *args, **kwargs):
+    nested  = self.nested
+    nmods   = self.module_count()
+    depth   = len(nested)-1
+
+    nested.append(0.)
+    start = time.time()
+
+    try:
+      return func(*args, **kwargs)
+    finally:
+      elapsed = time.time() - start
+      inner   = nested.pop()
+      nested[-1] += elapsed
+
+      if self.module_count() > nmods:
+        self.out.write('import time: %9d | %10d | %s%s\n' % (1e6*(elapsed-inner), 1e6*elapsed,
+                                                            '  '*depth, name))
+
+
+def write_callgrind(stats, out):
+  '''
+  Write profile statistics in callgrind format, as read by KCachegrind and
+  related tools.  Costs are in microseconds.
+  '''
+  callees = {}
+  for func,(cc,nc,tt,ct,callers) in stats.stats.iteritems():
+    for caller,cstats in callers.iteritems():
+      callees.setdefault(caller,[]).append( (func,cstats) )
+
+  out.write('events: Microseconds\n')
+
+  for func,(cc,nc,tt,ct,callers) in stats.stats.iteritems():
+    filename,line,name = func
+    out.write('\nfl=%s\nfn=%s:%d\n%d %d\n' % (filename,name,line,line,int(1e6*tt)))
+
+    for (cfilename,cline,cname),cstats in callees.get(func,[]):
+      # Caller statistics are (cc,nc,tt,ct) tuples, except for the old
+      # profile module which records only call counts
+      if isinstance(cstats,tuple):
+        ncalls,cost = cstats[1],cstats[3]
+      else:
+        ncalls,cost = cstats,0
+      out.write('cfl=%s\ncfn=%s:%d\ncalls=%d %d\n%d %d\n' % (cfilename,cname,cline,
+                                                            ncalls,cline,line,int(1e6*cost)))
+
+
+def write_profile(options,stats):
+  if options.profile_output:
+    if options.profile_format == 'callgrind':
+      out = open(options.profile_output,'w')
+      write_callgrind(stats,out)
+      out.close()
+    elif options.profile_format == 'pstats':
+      stats.dump_stats(options.profile_output)
+    else:
+      raise GLUError('ERROR: Unknown profile output format "%s"' % options.profile_format)
+
+    sys.stderr.write('[%s] Profile written to %s\n' % (time.asctime(),options.profile_output))
+    return
+
+  stats.stream = sys.stderr
+  stats.strip_dirs()
+  stats.sort_stats(*options.profile_sort.split(','))
+  stats.print_stats(options.profile_lines)
+  stats.print_callers(options.profile_lines)
+
+
 def run_profile(options,progmain):
   if options.profiler == 'python':
     try:
@@ -68,11 +170,7 @@ def run_profile(options,progmain):
     try:
       return prof.runcall(progmain)
     finally:
-      stats = pstats.Stats(prof,stream=sys.stderr)
-      stats.strip_dirs()
-      stats.sort_stats('time', 'calls')
-      stats.print_stats(25)
-      stats.print_callers(25)
+      write_profile(options,pstats.Stats(prof))
 
   elif options.profiler == 'hotshot':
     import hotshot, hotshot.stats
@@ -88,12 +186,7 @@ def run_profile(options,progmain):
       return prof.runcall(progmain)
     finally:
       prof.close()
-      stats = hotshot.stats.load(statfile)
-      stats.stream = sys.stderr
-      stats.strip_dirs()
-      stats.sort_stats('time', 'calls')
-      stats.print_stats(25)
-      stats.print_callers(25)
+      write_profile(options,hotshot.stats.load(statfile))
 
   else:
     raise GLUError('ERROR: Unknown profiling option provided "%s"' % options.profiler)
@@ -151,6 +244,16 @@ def option_parser():
                        help='Profile GLU code to find performance bottlenecks')
   devopts.add_argument('--profiler', metavar='P', default='python',
                        help='Set the profiler to use when -p is specified')
+  devopts.add_argument('--profile-output', metavar='FILE',
+                       help='Write profile data to FILE rather than printing a summary')
+  devopts.add_argument('--profile-format', metavar='F', default='pstats', choices=['pstats','callgrind'],
+                       help='Format of profile data written by --profile-output: pstats (default) or callgrind')
+  devopts.add_argument('--profile-sort', metavar='KEYS', default='time,calls',
+                       help='Comma separated list of keys used to sort the profile summary (default=time,calls)')
+  devopts.add_argument('--profile-lines', metavar='N', type=int, default=25,
+                       help='Number of lines of profile summary to print (default=25)')
+  devopts.add_argument('--importtime', action='store_true',
+                       help='Report the time taken to import each module')
   devopts.add_argument('--gcstats', action='store_true',
                        help='Generate statistics from the runtime object garbage collector')
   devopts.add_argument('--gcthreshold', metavar='N', type=int, default=1000000,
@@ -192,13 +295,21 @@ def main():
 
   ret = 0
 
+  importtimer = None
+  if options.importtime:
+    importtimer = ImportTimer()
+    importtimer.install()
+
   try:
     loader = pkgutil.get_loader(module_fullname)
 
     if loader is None:
       raise ModuleMissingError()
 
-    module = loader.load_module(module_fullname)
+    if importtimer:
+      module = importtimer.timed(module_fullname, loader.load_module, module_fullname)
+    else:
+      module = loader.load_module(module_fullname)
 
     module_info(module_name,module)
 
@@ -294,6 +405,9 @@ Command line:
       sys.stdout.flush()
       sys.stderr.write('[%s] Execution completed successfully\n' % time.asctime())
 
+  if importtimer:
+    importtimer.uninstall()
+
   if options.stats:
     sys.stdout.flush()
     sys.stderr.write('[%s] Clock time: %s, CPU time: %s\n' % (time.asctime(),
@@ -8,11 +8,16 @@ __license__   = 'See GLU license for terms by running: glu license'
 __revision__  = '$Id$'
 
 
+import numpy as np
+
 from glu.lib.utils import izip_exact
 
 
 HWP_EXACT_THRESHOLD=8000
 
+# Maximum number of probabilities evaluated at once by the batch exact test
+HWP_BATCH_CELLS=1<<20
+
 
 def hwp_exact_biallelic(hom1_count, het_count, hom2_count):
   '''
@@ -204,6 +209,174 @@ def hwp_biallelic_counts(hom1_count,het_count,hom2_count,exact_threshold=None):
   return p
 
 
+def _hwp_exact_block(rare, common, het_counts):
+  '''
+  Exact HWP p-values for a block of loci given arrays of rare, common and
+  heterozygote counts.  Relative probabilities are computed by the
+  recurrence used by hwp_exact_biallelic, with the same sequence of
+  floating point operations, one step for all loci at a time.
+  '''
+  rows  = np.arange(len(rare))
+  hets  = rare*common//np.maximum(rare+common,1)
+  hets += rare%2 != hets%2
+  hom_r = (rare-hets)/2
+  hom_c = (common-hets)/2
+  mid   = hets//2
+  up    = (rare-hets)//2
+
+  probs = np.zeros( (len(rare),int(rare.max())//2+1) )
+  probs[rows,mid] = 1.0
+
+  # Fill in relative probabilities for less than the expected hets
+  for i in xrange(int(mid.max())):
+    k = rows[mid>i]
+    h = hets[k]-2*i
+    probs[k,mid[k]-i-1] = probs[k,mid[k]-i]*h*(h-1) / (4*(hom_r[k]+i+1)*(hom_c[k]+i+1))
+
+  # Fill in relative probabilities for greater than the expected hets
+  for i in xrange(int(up.max())):
+    k = rows[up>i]
+    h = hets[k]+2*i
+    probs[k,mid[k]+i+1] = probs[k,mid[k]+i]*4*(hom_r[k]-i)*(hom_c[k]-i) / ((h+1)*(h+2))
+
+  # Sum probabilities <= to that of the observed number of heterozygotes in
+  # order, as cumsum accumulates sequentially like the scalar test
+  p_obs   = probs[rows,het_counts//2][:,None]
+  pvalues = np.cumsum(np.where(probs<=p_obs,probs,0.),axis=1)[:,-1] \
+          / np.cumsum(probs,axis=1)[:,-1]
+
+  pvalues[rare==0] = 1.
+
+  return pvalues
+
+
+def hwp_exact_biallelic_batch(hom1_counts, het_counts, hom2_counts):
+  '''
+  Exact SNP tests for deviations from Hardy-Weinberg proportions for arrays
+  of genotype counts.  See hwp_exact_biallelic for details.
+
+  Each distinct count triple is tested only once.  Loci are ordered by the
+  number of rare alleles and processed in blocks, where each step of the
+  recurrence used by hwp_exact_biallelic is applied to all loci in the
+  block at once.  Floating point operations are performed in the same order
+  as hwp_exact_biallelic, so results are identical.
+
+  @param  hom1_counts: Counts of observed homozygote 1
+  @type   hom1_counts: sequence of int
+  @param   het_counts: Counts of observed heterozygote
+  @type    het_counts: sequence of int
+  @param  hom2_counts: Counts of observed homozygote 2
+  @type   hom2_counts: sequence of int
+  @return            : Exact p-values for deviation (2-sided) from Hardy-Weinberg Proportions (HWP)
+  @rtype             : ndarray of float
+
+  >>> hom1 = [3,14,32,3,32,7,3,13,100,57,15]
+  >>> het  = [100,57,31,47,150,122,99,146,177,184,36]
+  >>> hom2 = [5,50,51,5,55,32,14,54,57,155,20]
+  >>> p1   = hwp_exact_biallelic_batch(hom1,het,hom2)
+  >>> p2   = [ hwp_exact_biallelic(*c) for c in zip(hom1,het,hom2) ]
+  >>> (p1==p2).all()
+  True
+  >>> hwp_exact_biallelic_batch([0,5,1],[0,0,0],[0,0,1])
+  array([1.        , 1.        , 0.33333333])
+  '''
+  hom1_counts = np.asarray(hom1_counts,dtype=int)
+  het_counts  = np.asarray(het_counts, dtype=int)
+  hom2_counts = np.asarray(hom2_counts,dtype=int)
+
+  rare    = 2*np.minimum(hom1_counts,hom2_counts)+het_counts
+  common  = 2*np.maximum(hom1_counts,hom2_counts)+het_counts
+
+  if not len(rare):
+    return np.empty(0)
+
+  # Test each distinct triple of rare, common and heterozygote counts once
+  keys,inverse = np.unique(np.column_stack( (rare,common,het_counts) ), axis=0, return_inverse=True)
+  pvalues      = np.ones(len(keys))
+
+  # Order by rare allele count, so that blocks contain distributions of
+  # similar size
+  order = np.argsort(keys[:,0], kind='mergesort')
+
+  start = 0
+  while start<len(keys):
+    width = keys[order[start],0]//2+1
+    stop  = start+1
+    while stop<len(keys) and (stop-start+1)*(keys[order[stop],0]//2+1)<=max(HWP_BATCH_CELLS,width):
+      stop += 1
+
+    block = order[start:stop]
+    pvalues[block] = _hwp_exact_block(keys[block,0],keys[block,1],keys[block,2])
+
+    start = stop
+
+  return pvalues[inverse.ravel()]
+
+
+def hwp_biallelic_batch(hom1_counts, het_counts, hom2_counts, exact_threshold=None):
+  '''
+  Return Hardy-Weinberg p-values for arrays of genotype counts, using the
+  exact test when there are fewer than exact_threshold rare alleles and the
+  asymptotic test otherwise, as done by hwp_biallelic_counts
+
+  >>> hwp_biallelic_batch([15,15],[36,36],[20,10])
+  array([1.        , 0.19960651])
+  >>> hwp_biallelic_batch([15,15],[36,36],[20,10],0)
+  array([0.87188388, 0.14135568])
+  '''
+  if exact_threshold is None:
+    exact_threshold = HWP_EXACT_THRESHOLD
+
+  hom1_counts = np.asarray(hom1_counts,dtype=int)
+  het_counts  = np.asarray(het_counts, dtype=int)
+  hom2_counts = np.asarray(hom2_counts,dtype=int)
+
+  rare    = 2*np.minimum(hom1_counts,hom2_counts)+het_counts
+  exact   = rare<exact_threshold
+  pvalues = np.empty(len(rare))
+
+  if exact.any():
+    pvalues[exact] = hwp_exact_biallelic_batch(hom1_counts[exact],het_counts[exact],hom2_counts[exact])
+
+  if not exact.all():
+    pvalues[~exact] = hwp_chisq_biallelic_batch(hom1_counts[~exact],het_counts[~exact],hom2_counts[~exact])
+
+  return pvalues
+
+
+def hwp_chisq_biallelic_batch(hom1_counts, het_counts, hom2_counts):
+  '''
+  Return asymptotic Hardy-Weinberg p-values for arrays of genotype counts
+
+  >>> hwp_chisq_biallelic_batch([15,0],[36,0],[20,0])
+  array([0.87188388, 1.        ])
+  '''
+  import scipy.stats
+
+  hom1 = np.asarray(hom1_counts,dtype=int)
+  het  = np.asarray(het_counts, dtype=int)
+  hom2 = np.asarray(hom2_counts,dtype=int)
+  n    = hom1+het+hom2
+
+  # Operations follow hwp_chisq_biallelic, including pow for squares, so
+  # that results are identical
+  with np.errstate(divide='ignore',invalid='ignore'):
+    p = (2*hom1+het).astype(float)/(2*n)
+    q = (2*hom2+het).astype(float)/(2*n)
+
+    def score(o,e):
+      return np.where(e>0,np.power(o-e,2.)/e,0.)
+
+    xx = (score(hom1,   n*p*p)
+       +  score( het, 2*n*p*q)
+       +  score(hom2,   n*q*q))
+
+  pvalues = scipy.stats.distributions.chi2.sf(xx,1)
+  pvalues[n==0] = 1.0
+
+  return pvalues
+
+
 def _test():
   import doctest
   return doctest.testmod()
@@ -13,8 +13,6 @@ import csv
 from   collections import defaultdict
 from   itertools   import groupby, count
 
-import pysam
-
 from   glu.lib.fileutils import autofile
 
 
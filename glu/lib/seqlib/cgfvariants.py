@@ -5,10 +5,11 @@ from __future__ import division
 
 from   collections          import defaultdict, namedtuple
 
-import pysam
-
+from   glu.lib.utils        import lazy_import
 from   glu.lib.recordtype   import recordtype
 
+pysam = lazy_import('pysam')
+
 
 VarInfo    = namedtuple('VarInfo',   'exact_vars inexact_vars common_score function_info')
 VarRecord  = recordtype('VarRecord', 'chromosome start stop allele common_score function_score source')
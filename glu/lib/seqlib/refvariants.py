@@ -3,10 +3,11 @@
 from __future__ import division
 
 
-import pysam
-
+from   glu.lib.utils        import lazy_import
 from   glu.lib.fileutils    import list_reader
 
+pysam = lazy_import('pysam')
+
 
 class ReferenceVariants(object):
   def __init__(self, refvariant, ingroupfile=None):
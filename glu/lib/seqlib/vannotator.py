@@ -6,18 +6,19 @@ __abstract__  = 'Annotate genomic coordinates and nucleotide variation'
 __copyright__ = 'Copyright (c) 2010, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
 __license__   = 'See GLU license for terms by running: glu license'
 
+import os
 import re
 import sys
+import cPickle as pickle
 
-from   operator                     import itemgetter
+from   operator                     import itemgetter, attrgetter
 from   itertools                    import imap, count, izip, groupby
 from   collections                  import defaultdict, namedtuple, OrderedDict
 
-from   pysam                        import Fastafile
-
 from   Bio.Seq                      import Seq
 from   Bio.Data.CodonTable          import TranslationError
 
+from   glu.lib.utils                import lazy_import
 from   glu.lib.progressbar          import progress_loop
 from   glu.lib.recordtype           import recordtype
 
@@ -25,6 +26,9 @@ from   glu.lib.seqlib.edits         import reduce_match
 from   glu.lib.seqlib.intervaltree  import IntervalTree
 
 from   glu.lib.genedb               import open_genedb
+from   glu.lib.genedb.snapshot      import IntervalMap
+
+pysam = lazy_import('pysam')
 
 
 cyto_re = re.compile('(\d+|X|Y)(?:([p|q])(?:(\d+)(.\d+)?)?)?$')
@@ -141,6 +145,27 @@ def get_cytobands(con):
   return imap(BandRecord._make, iter(cur))
 
 
+def get_snapshot_maps(snapshot):
+  '''
+  Return transcript and cytoband interval maps backed by a genedb snapshot or
+  None if the snapshot does not contain the required tables
+  '''
+  genes = snapshot.tables.get('gene')
+  bands = snapshot.tables.get('cytoband')
+
+  if genes is None or bands is None or len(genes.column_names)!=len(GeneRecord._fields):
+    return None
+
+  def _gene(i):
+    return GeneRecord._make(genes.row(i))
+
+  def _band(i):
+    name,chrom,start,end,color = bands.row(i)
+    return BandRecord(name,'chr'+chrom,start,end,color)
+
+  return IntervalMap(genes,_gene),IntervalMap(bands,_band,prefix='chr')
+
+
 def split_cytoband(band):
   m = cyto_re.match(str(band))
   return m.groups() if m is not None else None
@@ -171,6 +196,71 @@ def cytoband_name(bands):
   return ''.join(ref[:match])
 
 
+ANNOTATION_CACHE_VERSION = 1
+
+
+def annotation_cache_sources(*filenames):
+  '''
+  Return the path, size and modification time of each file an annotation
+  cache is built from
+  '''
+  sources = []
+  for filename in filenames:
+    st = os.stat(filename)
+    sources.append( (os.path.abspath(filename),st.st_size,int(st.st_mtime)) )
+  return sources
+
+
+def save_annotation_cache(filename, transcripts, bands, gene_parts, sources=None):
+  '''
+  Save transcripts, cytobands and decoded transcript structures to a
+  compact binary cache file along with the sources they were built from
+  '''
+  transcripts = [ tuple(gene) for gene in transcripts ]
+  bands       = [ tuple(band) for band in bands ]
+  gene_parts  = dict( (key,[ tuple(part) for part in parts ]) for key,parts in gene_parts.iteritems() )
+  header      = dict(version=ANNOTATION_CACHE_VERSION, sources=sources)
+
+  with open(filename,'wb') as out:
+    pickle.dump(header, out, pickle.HIGHEST_PROTOCOL)
+    pickle.dump( (transcripts,bands,gene_parts), out, pickle.HIGHEST_PROTOCOL)
+
+
+def load_annotation_cache(filename, sources=None):
+  '''
+  Load transcripts, cytobands and decoded transcript structures saved by
+  save_annotation_cache.  None is returned if the cache was written by
+  another version or, when sources are given, was built from different
+  sources.
+
+  >>> import tempfile
+  >>> f = tempfile.NamedTemporaryFile()
+  >>> band = BandRecord('p11','chr1',0,100,'gneg')
+  >>> save_annotation_cache(f.name, [], [band], {}, [('/genedb.db',10,20)])
+  >>> load_annotation_cache(f.name, [('/genedb.db',10,20)])
+  ([], [BandRecord(name='p11', chrom='chr1', start=0, end=100, color='gneg')], {})
+  >>> load_annotation_cache(f.name, [('/genedb.db',10,21)]) is None
+  True
+  '''
+  with open(filename,'rb') as data:
+    header = pickle.load(data)
+
+    if not isinstance(header,dict) or header.get('version')!=ANNOTATION_CACHE_VERSION:
+      return None
+
+    if sources is not None and header.get('sources')!=sources:
+      return None
+
+    transcripts,bands,gene_parts = pickle.load(data)
+
+  transcripts = [ GeneRecord._make(gene) for gene in transcripts ]
+  bands       = [ BandRecord._make(band) for band in bands ]
+  gene_parts  = dict( (key,[ GeneFeature._make(part) for part in parts ])
+                      for key,parts in gene_parts.iteritems() )
+
+  return transcripts,bands,gene_parts
+
+
 def group_evidence(orig):
   key_func = itemgetter(0,1,3,4,5,6,7,8)
   orig.sort(key=key_func)
@@ -185,24 +275,201 @@ def group_evidence(orig):
   return new
 
 
+class BlockFastafile(object):
+  '''
+  Wrapper around a FASTA file that serves sequence requests from cached
+  blocks of contiguous sequence, so that nearby requests, such as those
+  made when annotating position-sorted variants, are served by a small
+  number of large reads.
+
+  >>> class Fasta(object):
+  ...   def __init__(self): self.reads = 0
+  ...   def fetch(self, chrom, start, end):
+  ...     self.reads += 1
+  ...     return 'ACGTACGTACGTACGTACGT'[start:end]
+  >>> fasta = BlockFastafile(Fasta(), block_size=8, max_blocks=2)
+  >>> fasta.fetch('chr1',2,5), fasta.fetch('chr1',6,10), fasta.fetch('chr1',3,4)
+  ('GTA', 'GTAC', 'T')
+  >>> fasta.fasta.reads
+  2
+  >>> fasta.fetch('chr1',18,25)
+  'GT'
+  '''
+  def __init__(self, fasta, block_size=1000000, max_blocks=16):
+    self.fasta      = fasta
+    self.block_size = block_size
+    self.max_blocks = max_blocks
+    self.blocks     = OrderedDict()
+
+  def _block(self, chrom, index):
+    key = chrom,index
+
+    try:
+      block = self.blocks.pop(key)
+    except KeyError:
+      start = index*self.block_size
+      block = self.fasta.fetch(chrom, start, start+self.block_size)
+
+      if len(self.blocks)>=self.max_blocks:
+        self.blocks.popitem(0)
+
+    # Add block to end of LRU
+    self.blocks[key] = block
+
+    return block
+
+  def fetch(self, chrom, start, end):
+    block_size = self.block_size
+    first      = start//block_size
+    last       = (end-1)//block_size
+
+    if end<=start:
+      return ''
+    elif last-first>=self.max_blocks:
+      return self.fasta.fetch(chrom, start, end)
+
+    seq    = ''.join(self._block(chrom, i) for i in xrange(first,last+1))
+    offset = first*block_size
+
+    return seq[start-offset:end-offset]
+
+
+class TranscriptSweep(object):
+  '''
+  Cursor over transcripts sorted by start position that tracks the set of
+  transcripts overlapping a window that moves along a contig.  Decoded
+  transcript structures are kept while a transcript remains active.
+
+  >>> Tx = namedtuple('Tx', 'id txStart txEnd')
+  >>> sweep = TranscriptSweep([Tx(1,0,10),Tx(2,5,30),Tx(3,20,25),Tx(4,40,50)], lambda t: 'parts%d' % t.id)
+  >>> [ t.id for t in sweep.advance(8,12) ]
+  [1, 2]
+  >>> [ sweep.decode_gene(t) for t in sweep.advance(12,22) ]
+  ['parts2', 'parts3']
+  >>> [ t.id for t in sweep.advance(12,15) ]
+  [2]
+  >>> sorted(sweep.parts)
+  [2, 3]
+  >>> [ t.id for t in sweep.advance(35,45) ]
+  [4]
+  >>> sorted(sweep.parts)
+  []
+  '''
+  def __init__(self, transcripts, decode):
+    self.transcripts = transcripts
+    self.decode      = decode
+    self.reset()
+
+  def reset(self):
+    self.next   = 0
+    self.last   = None
+    self.active = []
+    self.parts  = {}
+
+  def advance(self, start, end):
+    '''
+    Return all transcripts that overlap [start,end).  Successive calls must
+    be made with non-decreasing values of start or the sweep will restart
+    from the beginning of the contig.
+    '''
+    if self.last is not None and start<self.last:
+      self.reset()
+
+    self.last   = start
+    transcripts = self.transcripts
+    active      = self.active
+    parts       = self.parts
+    n           = len(transcripts)
+
+    while self.next<n and transcripts[self.next].txStart<end:
+      active.append(transcripts[self.next])
+      self.next += 1
+
+    if any(t.txEnd<=start for t in active):
+      for t in active:
+        if t.txEnd<=start:
+          parts.pop(t.id,None)
+      active[:] = [ t for t in active if t.txEnd>start ]
+
+    return [ t for t in active if t.txStart<end ]
+
+  def decode_gene(self, gene):
+    try:
+      return self.parts[gene.id]
+    except KeyError:
+      parts = self.parts[gene.id] = self.decode(gene)
+      return parts
+
+
 class VariantAnnotator(object):
-  def __init__(self, gene_db, reference_fasta):
-    self.reference  = Fastafile(reference_fasta)
+  def __init__(self, gene_db, reference_fasta, cache=None):
+    self.reference  = BlockFastafile(pysam.Fastafile(reference_fasta))
     self.con        = open_genedb(gene_db)
     self.gene_cache = OrderedDict()
+    self.sweep      = None
+
+    snapshot_maps   = None
+    sources         = None
+
+    # The cache is only valid for the genedb and reference it was built from
+    if cache:
+      sources = annotation_cache_sources(self.con.filename, reference_fasta)
+
+    if not (cache and os.path.exists(cache)) and self.con.snapshot is not None:
+      snapshot_maps = get_snapshot_maps(self.con.snapshot)
+
+    if snapshot_maps is not None:
+      # Transcripts and cytobands are read on demand from the memory-mapped
+      # snapshot.  Its interval indexes are sorted by start position, so they
+      # also serve as the transcript lists used by annotate_batch.
+      self.feature_map,self.band_map = snapshot_maps
+      self.transcripts = self.feature_map
+      self.gene_parts  = {}
+    else:
+      self.load_maps(cache, sources)
+
+    sys.stderr.write('Loading complete.\n')
+
+
+  def load_maps(self, cache=None, sources=None):
+    '''
+    Load transcripts and cytobands from the database or an annotation cache
+    into interval trees.  An annotation cache that was not built from the
+    given sources is rebuilt.
+    '''
+    cached = None
+
+    if cache and os.path.exists(cache):
+      cached = load_annotation_cache(cache, sources)
+
+      if cached is None:
+        sys.stderr.write('[WARNING] Rebuilding out of date annotation cache: %s\n' % cache)
+
+    if cached is not None:
+      transcripts,bands,self.gene_parts = cached
+    else:
+      transcripts = get_transcripts(self.con)
+      transcripts = progress_loop(transcripts, label='Loading transcripts: ', units='transcripts')
+      transcripts = list(transcripts)
+      bands       = list(get_cytobands(self.con))
+
+      self.gene_parts = {}
+
+      if cache:
+        self.gene_parts = dict( (gene.id,list(decode_gene(gene))) for gene in transcripts )
+        save_annotation_cache(cache,transcripts,bands,self.gene_parts,sources)
 
     self.band_map = band_map = defaultdict(IntervalTree)
-    for band in get_cytobands(self.con):
+    for band in bands:
       band_map[band.chrom].insert(band.start,band.end,band)
       if band.chrom.startswith('chr') and band.chrom[3:] not in band_map:
         band_map[band.chrom[3:]] = band_map[band.chrom]
 
-    trans = get_transcripts(self.con)
-    trans = progress_loop(trans, label='Loading transcripts: ', units='transcripts')
-
     self.feature_map = feature_map = defaultdict(IntervalTree)
-    for gene in trans:
+    self.transcripts = defaultdict(list)
+    for gene in transcripts:
       feature_map[gene.chrom].insert(gene.txStart,gene.txEnd,gene)
+      self.transcripts[gene.chrom].append(gene)
 
       if 0: # DEBUG
         parts = self.decode_gene(gene)
@@ -210,21 +477,34 @@ class VariantAnnotator(object):
           if part.type not in ('intron','UTR5','UTR3','UTR') and '_' not in part.chrom:
             print '\t'.join(map(str,[part.chrom,part.start,part.end,gene.symbol]))
 
-    sys.stderr.write('Loading complete.\n')
+    for chrom_transcripts in self.transcripts.itervalues():
+      chrom_transcripts.sort(key=attrgetter('txStart'))
+
+
+  def build_gene_parts(self,gene):
+    try:
+      partlist = self.gene_parts[gene.id]
+    except KeyError:
+      partlist = decode_gene(gene)
+
+    parts = IntervalTree()
+    for part in partlist:
+      parts.insert(part.start,part.end,part)
+
+    return parts
 
 
   def decode_gene(self,gene):
+    if self.sweep is not None:
+      return self.sweep.decode_gene(gene)
+
     gene_cache = self.gene_cache
     key = gene.id
 
     try:
       parts = gene_cache.pop(key)
     except KeyError:
-      partlist = list(decode_gene(gene))
-
-      parts = IntervalTree()
-      for part in partlist:
-        parts.insert(part.start,part.end,part)
+      parts = self.build_gene_parts(gene)
 
       if len(gene_cache)>=300:
         gene_cache.popitem(0)
@@ -236,14 +516,44 @@ class VariantAnnotator(object):
 
 
   def annotate(self, chrom, ref_start, ref_end, variant, nsonly=False):
+    nearby = self.feature_map[chrom].find_values(ref_start-2000, ref_end+2000)
+    return self._annotate(chrom, ref_start, ref_end, variant, nearby)
+
+
+  def annotate_batch(self, variants, nsonly=False):
+    '''
+    Annotate a sequence of variants provided as (chrom, ref_start, ref_end,
+    variant) and sorted by position within each contig.  Returns a
+    generator of evidence lists in the same order as the input, as would be
+    returned by calling annotate for each variant.
+
+    Transcripts are located by sweeping a cursor along each contig rather
+    than querying an interval tree per variant, each transcript is decoded
+    once while it overlaps the sweep, and reference sequence is read in
+    contiguous blocks.
+    '''
+    try:
+      for chrom,chrom_variants in groupby(variants, itemgetter(0)):
+        self.sweep = TranscriptSweep(self.transcripts.get(chrom,[]), self.build_gene_parts)
+
+        for chrom,ref_start,ref_end,variant in chrom_variants:
+          nearby = self.sweep.advance(ref_start-2000, ref_end+2000)
+          yield self._annotate(chrom, ref_start, ref_end, variant, nearby)
+
+    finally:
+      self.sweep = None
+
+
+  def _annotate(self, chrom, ref_start, ref_end, variant, nearby):
     variant = variant.replace('-','')
 
     ref_nuc = self.reference.fetch(chrom,ref_start,ref_end).upper()
     var_nuc = variant.upper()
 
     evidence = []
-    for feature in self.feature_map[chrom].find(ref_start, ref_end):
-      evidence.extend( self.classify_feature(feature.value, ref_start, ref_end, ref_nuc, var_nuc) )
+    for gene in nearby:
+      if gene.txEnd>ref_start and gene.txStart<ref_end:
+        evidence.extend( self.classify_feature(gene, ref_start, ref_end, ref_nuc, var_nuc) )
 
     #ns = any('NON-SYNONYMOUS' in e[3] for e in evidence)
     #if nsonly and not ns:
@@ -254,8 +564,7 @@ class VariantAnnotator(object):
       five_prime  = set()
       three_prime = set()
 
-      for feature in self.feature_map[chrom].find(ref_start-2000, ref_end+2000):
-        gene = feature.value
+      for gene in nearby:
         if (0<ref_end-gene.txStart<=2000) ^ (gene.strand=='-'):
           five_prime.add(gene)
         else:
@@ -10,11 +10,12 @@ import sys
 
 from   collections                  import OrderedDict
 
-import pysam
-
 from   glu.lib                      import fileutils
+from   glu.lib.utils                import lazy_import
 from   glu.lib.recordtype           import recordtype
 
+pysam = lazy_import('pysam')
+
 
 VCFRecordBase = recordtype('VCFRecord',    'chrom start end names ref var qual filter info format genostr genolist')
 
@@ -10,9 +10,10 @@ __revision__  = '$Id$'
 
 __all__ = ['as_set','is_str','tally','ilen','pair_generator','percent','xenumerate','pick',
            'peekfirst','groups','unique','izip_exact','LengthMismatch','deprecated','deprecated_by',
-           'gcdisabled','chunk']
+           'gcdisabled','chunk','lazy_import']
 
 import gc
+import types
 
 from   collections      import deque
 from   itertools        import izip, count, chain, islice, repeat, imap
@@ -970,6 +971,55 @@ def lazy_property(fn):
   return _lazy_property
 
 
+class LazyModule(types.ModuleType):
+  '''
+  Module proxy returned by lazy_import that imports the named modules when
+  an attribute is first accessed
+  '''
+  def __init__(self, top, names):
+    types.ModuleType.__init__(self, top)
+    self.__dict__['_lazy_names'] = names
+
+  def __getattr__(self, attr):
+    names = self.__dict__.pop('_lazy_names', None)
+
+    if names is None:
+      raise AttributeError("'module' object has no attribute '%s'" % attr)
+
+    for name in names:
+      module = __import__(name)
+
+    # Replace the proxy contents with those of the real module, so that
+    # subsequent attribute lookups do not pass through this method
+    self.__dict__.update(module.__dict__)
+
+    return getattr(module, attr)
+
+
+def lazy_import(*names):
+  '''
+  Return a proxy for the top-level package of the named modules, which
+  are imported only when an attribute of the proxy is first accessed.
+  This has the same binding as "import name1, name2", but defers the cost
+  of importing heavy optional dependencies until they are used.
+
+  >>> import sys
+  >>> xml = lazy_import('xml.dom.minidom')
+  >>> xml.__name__
+  'xml'
+  >>> xml.dom.minidom.parseString('<a/>').documentElement.tagName
+  u'a'
+  >>> 'xml.dom.minidom' in sys.modules
+  True
+  '''
+  tops = set(name.split('.')[0] for name in names)
+
+  if len(tops)!=1:
+    raise ValueError('Lazily imported modules must share a top-level package')
+
+  return LazyModule(tops.pop(), names)
+
+
 def _test():
   import doctest
   doctest.testmod()
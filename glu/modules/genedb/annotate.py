@@ -12,7 +12,8 @@ import sys
 from   glu.lib.fileutils      import table_reader,table_writer,resolve_column_headers
 
 from   glu.lib.genedb         import open_genedb
-from   glu.lib.genedb.queries import query_snps_by_name,query_gene_neighborhood,query_cytoband_by_location
+from   glu.lib.utils          import chunk
+from   glu.lib.genedb.bulk    import GeneDBSession
 
 
 HEADER = ['CHROMOSOME','CYTOBAND','START','END','GENE NEIGHBORHOOD','dbSNP ANNOTATION']
@@ -47,10 +48,13 @@ def normalize(row,n):
   return row
 
 
-def annotate(con,header,rows,options):
+def annotate(con,header,rows,options,session=None):
   up = options.upstream   or 0
   dn = options.downstream or 0
 
+  if session is None:
+    session = GeneDBSession(con)
+
   column = resolve_column_headers(header,[options.column])
 
   if len(column) != 1:
@@ -59,32 +63,37 @@ def annotate(con,header,rows,options):
   column = column[0]
   n = len(header)
 
-  for row in rows:
-    if row.count('') == len(row):
-      continue
-
-    row = normalize(row,n)
-    snp = row[column]
-    results = query_snps_by_name(con,snp) if snp else None
-
-    if results is None:
-      info = ['']*3
-    elif not results:
-      info = ['UNKNOWN','','']
-    elif len(results) > 1:
-      info = ['Multiple mappings','','']
-    else:
-      name,chrom,start,end,strand,refAllele,alleles,vclass,func,weight = results[0]
-      near     = query_gene_neighborhood(con,chrom,start,end,up,dn)
-      cytoband = query_cytoband_by_location(con,chrom,start)[0]
-
-      info = [chrom,
-              cytoband,
-              start+1, end,
-              ','.join(n[0] for n in near),
-              func]
-
-    yield row + info
+  rows = ( normalize(row,n) for row in rows if row.count('') != len(row) )
+
+  for block in chunk(rows,session.chunksize):
+    session.prefetch_snps(row[column] for row in block)
+
+    for row in block:
+      yield annotate_row(session,row,column,up,dn)
+
+
+def annotate_row(session,row,column,up,dn):
+  snp     = row[column]
+  results = session.snps_by_name(snp) if snp else None
+
+  if results is None:
+    info = ['']*3
+  elif not results:
+    info = ['UNKNOWN','','']
+  elif len(results) > 1:
+    info = ['Multiple mappings','','']
+  else:
+    name,chrom,start,end,strand,refAllele,alleles,vclass,func,weight = results[0]
+    near     = session.gene_neighborhood(chrom,start,end,up,dn)
+    cytoband = session.cytoband_by_location(chrom,start)[0]
+
+    info = [chrom,
+            cytoband,
+            start+1, end,
+            ','.join(n[0] for n in near),
+            func]
+
+  return row + info
 
 
 def main():
@@ -12,8 +12,8 @@ import sys
 from   glu.lib.fileutils      import table_reader,table_writer,tryint
 
 from   glu.lib.genedb         import open_genedb
-from   glu.lib.genedb.queries import query_genes_by_name, query_snps_by_name, query_cytoband_by_name, \
-                                     query_contig_by_name, query_cytobands_by_location
+from   glu.lib.utils          import chunk
+from   glu.lib.genedb.bulk    import GeneDBSession
 
 
 HEADER = ['FEATURE_NAME','CHROMOSOME','CYTOBAND','STRAND','FEATURE_START','FEATURE_END','BASES_UP',
@@ -55,7 +55,10 @@ def is_int(i):
   return isinstance(i, (int,long))
 
 
-def resolve_feature(con,feature,options):
+def resolve_feature(con,feature,options,session=None):
+  if session is None:
+    session = GeneDBSession(con)
+
   name        = feature[0]
   chrom       = feature[1] or None
   strand      = feature[2] or '+'
@@ -74,14 +77,14 @@ def resolve_feature(con,feature,options):
 
   if not found and chrom and start and end:
     found = True
-    geneinfo = query_genes_by_name(con,name)
+    geneinfo = session.genes_by_name(name)
     if any( (chrom,start,end) == (gi[2],gi[3],gi[4]) for gi in geneinfo):
       feature = 'GENE'
     else:
       feature = 'REGION'
 
   if not found:
-    geneinfo = query_genes_by_name(con,name)
+    geneinfo = session.genes_by_name(name)
     if len(geneinfo) == 1:
       name,chrom,start,end,strand = geneinfo[0][1:6]
       feature = geneinfo[0][6]
@@ -91,7 +94,7 @@ def resolve_feature(con,feature,options):
       found = True
 
   if not found:
-    cytoinfo = query_cytoband_by_name(con,name)
+    cytoinfo = session.cytoband_by_name(name)
     if cytoinfo:
       chrom,start,end,color = cytoinfo
       strand = '+'
@@ -99,7 +102,7 @@ def resolve_feature(con,feature,options):
       found = True
 
   if not found:
-    contiginfo = query_contig_by_name(con,name)
+    contiginfo = session.contig_by_name(name)
     if contiginfo:
       chrom,start,end = contiginfo
       strand = '+'
@@ -107,7 +110,7 @@ def resolve_feature(con,feature,options):
       found = True
 
   if not found:
-    snpinfo = query_snps_by_name(con,name)
+    snpinfo = session.snps_by_name(name)
     if len(snpinfo)==1:
       name,chrom,start,end,strand,refAllele,alleles,vclass,func,weight = snpinfo[0]
       feature = 'SNP'
@@ -120,15 +123,25 @@ def resolve_feature(con,feature,options):
   if not found:
     feature = 'UNKNOWN'
 
-  bands = query_cytobands_by_location(con,chrom,start,end)[0]
+  bands = session.cytobands_by_location(chrom,start,end)[0]
 
   return name,chrom,bands,strand,start,end,upbases,downbases,upsnps,downsnps,feature
 
 
-def resolve_features(con,features,options):
-  for feature in features:
-    feature += [None]*(10-len(feature))
-    yield resolve_feature(con,feature,options)
+def resolve_features(con,features,options,session=None):
+  '''
+  Resolve features in chunks, first resolving all feature names that may
+  be SNPs in bulk
+  '''
+  if session is None:
+    session = GeneDBSession(con)
+
+  for block in chunk(features,session.chunksize):
+    session.prefetch_snps(feature[0] for feature in block if feature)
+
+    for feature in block:
+      feature += [None]*(10-len(feature))
+      yield resolve_feature(con,feature,options,session)
 
 
 def bed_format(results):
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+__gluindex__  = True
+__abstract__  = 'Build a read-only memory-mapped snapshot of a genedb database'
+__copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
+__license__   = 'See GLU license for terms by running: glu license'
+__revision__  = '$Id$'
+
+
+import sys
+
+from   glu.lib.genedb          import open_genedb
+from   glu.lib.genedb.snapshot import build_snapshot, snapshot_path
+
+
+def option_parser():
+  from glu.lib.glu_argparse import GLUArgumentParser
+
+  parser = GLUArgumentParser(description=__abstract__)
+
+  parser.add_argument('-g', '--genedb',   metavar='NAME',
+                      help='Genedb genome annotation database name or file')
+  parser.add_argument('-o', '--output',   metavar='DIR',
+                      help='Output snapshot directory.  The default is the database file name with a '
+                           '.snapshot extension, where the snapshot will be found automatically')
+  return parser
+
+
+def snapshot_genedb(dbname, output=None):
+  '''
+  Build the snapshot of a genedb database in directory output or, if not
+  specified, where it will be found automatically by open_genedb.  The
+  database is opened for writing, since read-only connections cannot
+  create the temporary tables used to sort name indexes.
+
+  >>> import os,sqlite3,tempfile,shutil
+  >>> dirname  = tempfile.mkdtemp()
+  >>> filename = os.path.join(dirname,'test.db')
+  >>> con = sqlite3.connect(filename)
+  >>> cur = con.executescript("CREATE TABLE snp (name,chrom,start,end,strand,refAllele,alleles,vclass,func,weight);"
+  ...                   "INSERT INTO snp VALUES ('rs1','chr1',100,101,'+','C','C/T','single','',1);")
+  >>> con.close()
+  >>> output = snapshot_genedb(filename)
+  >>> open_genedb(filename).snapshot.snps_by_name('rs1')
+  [(u'rs1', u'chr1', 100, 101, u'+', u'C', u'C/T', u'single', u'', 1)]
+  >>> shutil.rmtree(dirname)
+  '''
+  con    = open_genedb(dbname,readonly=False)
+  output = output or snapshot_path(con.filename)
+
+  sys.stderr.write('[INFO] Writing genedb snapshot: %s\n' % output)
+
+  build_snapshot(con.con, output, source=con.filename)
+
+  return output
+
+
+def main():
+  parser  = option_parser()
+  options = parser.parse_args()
+
+  snapshot_genedb(options.genedb, options.output)
+
+
+if __name__=='__main__':
+  main()
@@ -11,7 +11,7 @@ import sys
 
 from   glu.lib.fileutils      import table_writer,autofile,namefile,hyphen
 
-from   glu.lib.genolib.io     import load_genostream, geno_options
+from   glu.lib.genolib.io     import load_genostream, load_genostream_summary, geno_options
 from   glu.lib.genolib.phenos import SEX_UNKNOWN,SEX_MALE,SEX_FEMALE, \
                                      PHENO_UNKNOWN,PHENO_UNAFFECTED,PHENO_AFFECTED
 
@@ -59,6 +59,15 @@ def ginfo(filename,options,out):
   if genos.loci is not None:
     out.write('locus  count: %d\n' % len(genos.loci))
 
+  summary = load_genostream_summary(filename,format=options.informat,genome=options.loci,
+                                             transform=options)
+
+  if summary is not None:
+    missing,hemizygote,homozygote,heterozygote = summary.totals()
+    genotypes = missing+hemizygote+homozygote+heterozygote
+    out.write('genotypes   : %d\n' % genotypes)
+    out.write('missing     : %d (%.4f%%)\n' % (missing,100.*missing/max(1,genotypes)))
+
   out.write('\n')
 
   if options.outputsamples:
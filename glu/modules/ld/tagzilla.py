@@ -31,9 +31,11 @@ import time
 from   math                      import log, ceil
 from   operator                  import itemgetter
 from   collections               import defaultdict
-from   itertools                 import chain, groupby, izip, dropwhile, count
+from   itertools                 import chain, groupby, izip, islice, dropwhile, count
 
-from   glu.lib.hwp               import hwp_biallelic
+import numpy as np
+
+from   glu.lib.hwp               import hwp_biallelic_batch, biallelic_counts
 from   glu.lib.stats             import mean, median
 from   glu.lib.utils             import pair_generator, percent
 from   glu.lib.fileutils         import autofile, hyphen, list_reader, table_reader, table_writer
@@ -161,15 +163,36 @@ def filter_loci_by_inclusion(loci, include):
       yield locus
 
 
-def filter_loci_by_hwp(loci, pvalue):
+def filter_loci_by_hwp(loci, pvalue, chunksize=10000):
   '''
   Generator that filters loci based on significance of deviation from
-  Hardy-Weinberg proportions
+  Hardy-Weinberg proportions.  Loci are tested in chunks using the batch
+  HWP test.  Loci that are not biallelic cannot be tested and are retained.
   '''
-  for locus in loci:
-    p = hwp_biallelic(locus.genos)
-    if p >= pvalue:
-      yield locus
+  loci = iter(loci)
+
+  while 1:
+    chunk = list(islice(loci,chunksize))
+
+    if not chunk:
+      break
+
+    counts = []
+    for locus in chunk:
+      try:
+        counts.append(biallelic_counts(locus.genos.descriptor[0],locus.genos.counts()))
+      except ValueError:
+        counts.append(None)
+
+    tested = [ c for c in counts if c is not None ]
+
+    if tested:
+      hom1,het,hom2 = np.array(tested,dtype=int).T
+      pvalues = iter(hwp_biallelic_batch(hom1,het,hom2).tolist())
+
+    for locus,c in izip(chunk,counts):
+      if c is None or pvalues.next() >= pvalue:
+        yield locus
 
 
 range_all = (-sys.maxint,sys.maxint)
@@ -11,10 +11,13 @@ import sys
 from   operator                  import itemgetter
 from   collections               import defaultdict
 
+import numpy as np
+
 from   glu.lib.fileutils         import map_reader, table_writer
 from   glu.lib.remap             import remap_alleles, remap_category
 from   glu.lib.hwp               import hwp_exact_biallelic
 from   glu.lib.genolib           import GenotripleStream, load_genostream
+from   glu.lib.genolib.genoarray import genoarray_confusion
 from   glu.lib.genolib.transform import load_rename_alleles_file
 
 
@@ -265,6 +268,286 @@ def concordance(refgenos,compgenos,sampleeq,locuseq,sampleconcord,locusconcord):
             locusconcord.update(refgeno, reflocus,  compgeno, locus)
 
 
+# Concordance codes for pairs of non-missing genotypes: 0-3 are discordant
+# genotype pair modes (see geno_pair_mode) and 4 is concordant
+CONCORDANT = 4
+
+
+def chromosome_key(chrom):
+  '''
+  Return a key that orders chromosome names numerically, followed by the
+  sex and mitochondrial chromosomes and then any others
+
+  >>> sorted(['chrX','10','2','chr1','M','Un'], key=chromosome_key)
+  ['chr1', '2', '10', 'chrX', 'M', 'Un']
+  '''
+  chrom = chrom or ''
+  if chrom.lower().startswith('chr'):
+    chrom = chrom[3:]
+
+  if chrom.isdigit():
+    return 0,int(chrom),''
+
+  special = ('X','Y','XY','M','MT')
+  if chrom.upper() in special:
+    return 1,special.index(chrom.upper()),''
+
+  return 2,0,chrom
+
+
+def locus_key_function(genos, join):
+  '''
+  Return a function that computes the join key of a locus name
+  '''
+  if join=='name':
+    return lambda lname: lname
+
+  genome = genos.genome
+
+  def position_key(lname):
+    locus = genome.get_locus(lname)
+    if locus.location is None:
+      raise ValueError('Locus %s has no known position' % lname)
+    return chromosome_key(locus.chromosome),locus.location
+
+  return position_key
+
+
+def join_order(join):
+  '''
+  Return a description of the locus order required by a join
+  '''
+  if join=='name':
+    return 'lexicographically by name to use --join name'
+  return 'by chromosome and location to use --join %s' % join
+
+
+def ordered_groups(genos, key, order='by key'):
+  '''
+  Generate groups of consecutive (locus,genotypes) pairs with equal keys,
+  verifying that keys are non-decreasing
+
+  >>> genos = [('a',1),('b',2),('b',3),('c',4)]
+  >>> list(ordered_groups(genos, lambda l: l))
+  [('a', [('a', 1)]), ('b', [('b', 2), ('b', 3)]), ('c', [('c', 4)])]
+  >>> list(ordered_groups(genos[::-1], lambda l: l))
+  Traceback (most recent call last):
+     ...
+  ValueError: Loci must be sorted by key: b follows c
+  '''
+  group = None
+  last  = None
+
+  for lname,g in genos:
+    k = key(lname)
+
+    if group is not None:
+      if k==last:
+        group.append( (lname,g) )
+        continue
+      if k<last:
+        raise ValueError('Loci must be sorted %s: %s follows %s' % (order,lname,group[-1][0]))
+      yield last,group
+
+    last,group = k,[(lname,g)]
+
+  if group is not None:
+    yield last,group
+
+
+def check_locus_order(genos, key, join):
+  '''
+  Verify that the loci of a genotype stream, when known in advance, are
+  ordered by the join key so that unordered input fails before any
+  genotypes are compared
+
+  >>> from glu.lib.genolib import GenomatrixStream
+  >>> rows  = [('l10',[('A','A')]),('l9',[('A','A')])]
+  >>> genos = GenomatrixStream.from_tuples(rows,'ldat',samples=['s1'],loci=['l10','l9'])
+  >>> check_locus_order(genos, lambda l: l, 'name')
+  >>> genos = GenomatrixStream.from_tuples(rows[::-1],'ldat',samples=['s1'],loci=['l9','l10'])
+  >>> check_locus_order(genos, lambda l: l, 'name')
+  Traceback (most recent call last):
+     ...
+  ValueError: Loci must be sorted lexicographically by name to use --join name: l10 follows l9
+  '''
+  if genos.loci is None:
+    return
+
+  last = None
+  for i,lname in enumerate(genos.loci):
+    k = key(lname)
+    if i and k<last:
+      raise ValueError('Loci must be sorted %s: %s follows %s'
+                          % (join_order(join),lname,genos.loci[i-1]))
+    last = k
+
+
+def merge_join(refgenos, compgenos, refkey, compkey, order='by key'):
+  '''
+  Join two streams of (locus,genotypes) pairs ordered by a common key.
+  Loci with equal keys are paired if they have the same name or if they
+  are the only loci with that key in each stream.
+
+  >>> ref  = [('l1',1),('l2',2),('l4',4),('l5',5)]
+  >>> comp = [('l0',0),('l2',20),('l3',30),('l5',50)]
+  >>> key  = lambda lname: lname
+  >>> list(merge_join(ref,comp,key,key))
+  [(('l2', 2), ('l2', 20)), (('l5', 5), ('l5', 50))]
+  '''
+  ref  = ordered_groups(refgenos,  refkey,  order)
+  comp = ordered_groups(compgenos, compkey, order)
+
+  r = next(ref,  None)
+  c = next(comp, None)
+
+  while r is not None and c is not None:
+    rkey,rgroup = r
+    ckey,cgroup = c
+
+    if rkey<ckey:
+      r = next(ref,  None)
+    elif ckey<rkey:
+      c = next(comp, None)
+    else:
+      if len(rgroup)==1 and len(cgroup)==1:
+        yield rgroup[0],cgroup[0]
+      else:
+        for rlocus in rgroup:
+          for clocus in cgroup:
+            if rlocus[0]==clocus[0]:
+              yield rlocus,clocus
+
+      r = next(ref,  None)
+      c = next(comp, None)
+
+
+def sample_pairs(refsamples, compsamples, sampleeq=None):
+  '''
+  Return arrays of reference and comparison sample indices to compare and
+  the corresponding sample name pairs.  sampleeq maps comparison samples
+  to lists of equivalent reference samples.  If not specified, samples
+  with the same name are compared.
+
+  >>> sample_pairs(['s1','s2','s3'],['s3','s1','s4'])
+  (array([2, 0]), array([0, 1]), [('s3', 's3'), ('s1', 's1')])
+  >>> sample_pairs(['s1','s2'],['c1','c2'],{'c1':['s1','s2'],'c2':['s3']})
+  (array([0, 1]), array([0, 0]), [('s1', 'c1'), ('s2', 'c1')])
+  '''
+  refindex = dict( (s,i) for i,s in enumerate(refsamples) )
+  pairs    = []
+
+  for j,csample in enumerate(compsamples):
+    rsamples = sampleeq.get(csample,[]) if sampleeq is not None else [csample]
+    for rsample in rsamples:
+      i = refindex.get(rsample)
+      if i is not None:
+        pairs.append( (i,j,rsample,csample) )
+
+  refcols  = np.array([ p[0] for p in pairs ], dtype=int)
+  compcols = np.array([ p[1] for p in pairs ], dtype=int)
+  names    = [ (p[2],p[3]) for p in pairs ]
+
+  return refcols,compcols,names
+
+
+def concordance_codes(model1, model2):
+  '''
+  Return a table of concordance codes for all pairs of genotype indices of
+  two models, with -1 for pairs that include a missing genotype
+
+  >>> from glu.lib.genolib.genoarray import build_model
+  >>> model = build_model('AB',max_alleles=2)
+  >>> concordance_codes(model,model).tolist()
+  [[-1, -1, -1, -1], [-1, 4, 2, 3], [-1, 1, 4, 1], [-1, 3, 2, 4]]
+  '''
+  codes = np.empty( (len(model1.genotypes),len(model2.genotypes)), dtype=int )
+  codes.fill(-1)
+
+  for i,g1 in enumerate(model1.genotypes):
+    if not g1:
+      continue
+    for j,g2 in enumerate(model2.genotypes):
+      if not g2:
+        continue
+      codes[i,j] = CONCORDANT if g1==g2 else geno_pair_mode(g1,g2)
+
+  return codes
+
+
+def concordance_join(refgenos, compgenos, sampleeq, join, sampleconcord, locusconcord):
+  '''
+  Compute concordance between reference and comparison genotypes by
+  streaming both inputs in locus order and joining matching loci, so that
+  neither input is held in memory.  Both inputs must be ordered by the join
+  key: lexicographically by locus name (e.g. l10 before l9) for join='name'
+  or by chromosome and location for join='position'.
+
+  >>> from glu.lib.genolib import GenomatrixStream
+  >>> ref  = [('l1',[('A','A'),('A','G')]),('l2',[('C','C'),(None,None)]),('l3',[('T','T'),('G','T')])]
+  >>> comp = [('l1',[('A','A'),('G','G')]),('l2',[(None,None),('C','T')]),('l3',[('T','T'),('G','T')])]
+  >>> ref  = GenomatrixStream.from_tuples(ref, 'ldat',samples=['s1','s2'])
+  >>> comp = GenomatrixStream.from_tuples(comp,'ldat',samples=['s1','s2'])
+  >>> sampleconcord = SampleConcordStat()
+  >>> locusconcord  = LocusConcordStat()
+  >>> concordance_join(ref,comp,None,'name',sampleconcord,locusconcord)
+  >>> sorted(sampleconcord.stats.items())
+  [(('s1', 's1'), [0, 0, 0, 0, 2]), (('s2', 's2'), [0, 1, 0, 0, 1])]
+  >>> sorted(locusconcord.stats)
+  [('l1', 'l1'), ('l3', 'l3')]
+  >>> for row in generate_locus_output(locusconcord,None):
+  ...   print row[:8]
+  ['l1', 'l1', 1, 0, 1, 0, 0, '0.500000']
+  ['l3', 'l3', 2, 0, 0, 0, 0, '1.000000']
+  '''
+  refgenos  = refgenos.as_ldat()
+  compgenos = compgenos.as_ldat()
+
+  refcols,compcols,names = sample_pairs(refgenos.samples, compgenos.samples, sampleeq)
+
+  npairs   = len(names)
+  pairidx  = 5*np.arange(npairs)
+  counts   = np.zeros(5*npairs, dtype=int)
+  codecache = {}
+
+  refkey   = locus_key_function(refgenos,  join)
+  compkey  = locus_key_function(compgenos, join)
+
+  check_locus_order(refgenos,  refkey,  join)
+  check_locus_order(compgenos, compkey, join)
+
+  for (reflocus,rgenos),(complocus,cgenos) in merge_join(refgenos,compgenos,refkey,compkey,join_order(join)):
+    model1 = rgenos.descriptor[0]
+    model2 = cgenos.descriptor[0]
+
+    # Locus statistics from the table of genotype index pairs.  Only loci
+    # with at least one pair of called genotypes are recorded, as when
+    # missing genotypes are filtered in the default mode.
+    table  = genoarray_confusion(rgenos, cgenos, refcols, compcols)
+
+    if table[1:,1:].any():
+      stats = locusconcord.stats[reflocus,complocus]
+      for i,j in zip(*np.nonzero(table[1:,1:])):
+        stats[model1.genotypes[i+1],model2.genotypes[j+1]] += int(table[i+1,j+1])
+
+    # Sample statistics from concordance codes for each sample pair
+    key    = model1,len(model1.genotypes),model2,len(model2.genotypes)
+    codes  = codecache.get(key)
+
+    if codes is None:
+      codes = codecache[key] = concordance_codes(model1,model2)
+
+    pcodes = codes[rgenos.indices()[refcols],cgenos.indices()[compcols]]
+    valid  = pcodes>=0
+    counts += np.bincount( (pairidx+pcodes)[valid], minlength=5*npairs )
+
+  counts = counts.reshape(npairs,5)
+
+  for (refsample,compsample),values in zip(names,counts.tolist()):
+    if sum(values):
+      sampleconcord.stats[refsample,compsample] = values
+
+
 def compute_allele_maps(locusconcord):
   for (reflocus,complocus),stats in locusconcord.stats.iteritems():
     concord,bestmap = remap_alleles(stats)
@@ -308,6 +591,11 @@ def option_parser():
                      help='Equivalence mapping between the sample ids from the comparison data and the reference data')
   parser.add_argument('--locuseq',    metavar='FILE',
                      help='Equivalence mapping between the locus ids from the comparison data and the reference data')
+  parser.add_argument('--join',       metavar='KEY', choices=['name','position'],
+                     help='Stream both inputs and join loci in the order of KEY (name or position), '
+                          'rather than loading the reference genotypes into memory.  Both inputs '
+                          'must be ordered by KEY, with names sorted lexicographically (e.g. l10 '
+                          'before l9) and positions ordered by chromosome and location')
   return parser
 
 
@@ -334,12 +622,21 @@ def main():
     sampleeq = map_reader(options.sampleeq)
     eqsample = invert_dict(sampleeq)
 
+  if options.join and locuseq is not None:
+    parser.error('--locuseq may not be used with --join')
+
+  if options.join and len(options.comparison)!=1:
+    parser.error('--join requires a single comparison genotype file')
+
   refgenos  = load_reference_genotypes(options.reference,options.refformat,locuseq,sampleeq)
 
   compgenos = [ load_comparison_genotypes(filename, options.compformat, eqlocus, eqsample,
                 options.locusmap, options.samplemap) for filename in options.comparison ]
 
-  compgenos = GenotripleStream.from_streams(compgenos).transformed(filter_missing=True)
+  if options.join:
+    compgenos = compgenos[0]
+  else:
+    compgenos = GenotripleStream.from_streams(compgenos).transformed(filter_missing=True)
 
   allelemaps = None
   if options.allelemap:
@@ -349,7 +646,10 @@ def main():
   sampleconcord = SampleConcordStat()
   locusconcord  = LocusConcordStat()
 
-  concordance(refgenos,compgenos,eqsample,eqlocus,sampleconcord,locusconcord)
+  if options.join:
+    concordance_join(refgenos,compgenos,eqsample,options.join,sampleconcord,locusconcord)
+  else:
+    concordance(refgenos,compgenos,eqsample,eqlocus,sampleconcord,locusconcord)
 
   if options.remap:
     sys.stderr.write('Computing best allele mappings...')
@@ -366,5 +666,10 @@ def main():
     output_locus_concordstat(options.locusout,locusconcord,allelemaps)
 
 
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
 if __name__=='__main__':
   main()
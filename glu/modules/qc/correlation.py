@@ -15,14 +15,12 @@ from   itertools                     import izip
 
 import numpy as np
 
-from   glu.lib.utils                  import Counter
+from   glu.lib.utils                  import chunk
 from   glu.lib.fileutils              import table_writer, guess_format
 from   glu.lib.progressbar            import progress_loop
-from   glu.lib.association            import estimate_maf
 
 from   glu.lib.genolib                import load_genostream, geno_options
 from   glu.lib.genolib.transform      import GenoTransform
-from   glu.lib.genolib.ld             import count_diplotypes, estimate_ld
 
 from   glu.lib.genolib.formats.wtccc  import load_wtccc_dosage
 from   glu.lib.genolib.formats.beagle import load_beagle_dosage
@@ -267,77 +265,414 @@ def trend_r2_dips(dips):
    return r2
 
 
-def correlation_genos(options,filename1,filename2):
-  genos1,genos2 = load_genos(options,filename1,filename2)
-  genos         = izip(genos1,genos2)
+def genotype_categories(model):
+  '''
+  Return an array that maps genotype indices to the diplotype categories
+  used by count_diplotypes: 0 for the first homozygote, 1 for the
+  heterozygote, 2 for the second homozygote and -1 for missing genotypes
+
+  >>> from glu.lib.genolib.genoarray import UnphasedMarkerModel, build_model
+  >>> genotype_categories(build_model('AB',max_alleles=2)).tolist()
+  [-1, 0, 1, 2]
+  >>> model = UnphasedMarkerModel(max_alleles=2)
+  >>> model.add_genotype(('A','B')), model.add_genotype(('B','B'))
+  (('A', 'B'), ('B', 'B'))
+  >>> genotype_categories(model).tolist()
+  [-1, 1, 0]
+  '''
+  cats  = np.empty(len(model.genotypes), dtype=np.int8)
+  homoz = 0
+
+  for i,g in enumerate(model.genotypes):
+    if not g:
+      cats[i] = -1
+    elif g.hemizygote():
+      raise ValueError('Hemizygote LD estimation is not currently supported')
+    elif g.heterozygote():
+      cats[i] = 1
+    elif homoz>2:
+      raise ValueError('invalid genotypes: loci may have no more than 2 alleles')
+    else:
+      cats[i] = homoz
+      homoz  += 2
+
+  return cats
+
+
+def genotype_recode(model1,model2):
+  '''
+  Return an array that maps genotype indices of model2 to the indices of
+  equal genotypes in model1 or -1 if model1 has no such genotype
+
+  >>> from glu.lib.genolib.genoarray import UnphasedMarkerModel, build_model
+  >>> model1 = build_model('AB',max_alleles=2)
+  >>> model2 = UnphasedMarkerModel(max_alleles=3)
+  >>> for g in [('B','B'),('A','B'),('C','C')]:
+  ...   g = model2.add_genotype(g)
+  >>> genotype_recode(model1,model2).tolist()
+  [0, 3, 2, -1]
+  '''
+  genomap = model1.genomap
+  recode  = np.empty(len(model2.genotypes), dtype=np.int16)
+
+  for i,g in enumerate(model2.genotypes):
+    g1 = genomap.get(tuple(g))
+    recode[i] = g1.index if g1 is not None else -1
+
+  return recode
+
+
+def stack_tables(tables, fill):
+  '''
+  Stack a sequence of one dimensional lookup tables into a matrix padded with fill
+  '''
+  width  = max(len(t) for t in tables)
+  result = np.empty( (len(tables),width), dtype=tables[0].dtype )
+  result.fill(fill)
+
+  for i,t in enumerate(tables):
+    result[i,:len(t)] = t
+
+  return result
+
+
+def encode_genos_chunk(chunk):
+  '''
+  Encode a chunk of matched loci from two genotype sources as matrices of
+  genotype indices and per-locus lookup tables
+  '''
+  lnames   = []
+  indices1 = []
+  indices2 = []
+  cats1    = []
+  cats2    = []
+  recodes  = []
+  tables   = {}
+
+  for (lname1,locus1),(lname2,locus2) in chunk:
+    assert lname1==lname2
+
+    model1 = locus1.descriptor[0]
+    model2 = locus2.descriptor[0]
+    key    = model1,len(model1.genotypes),model2,len(model2.genotypes)
+    table  = tables.get(key)
+
+    if table is None:
+      table = tables[key] = (genotype_categories(model1),genotype_categories(model2),
+                             genotype_recode(model1,model2))
+
+    lnames.append(lname1)
+    indices1.append(locus1.indices())
+    indices2.append(locus2.indices())
+    cats1.append(table[0])
+    cats2.append(table[1])
+    recodes.append(table[2])
+
+  indices1 = np.array(indices1, dtype=np.intp)
+  indices2 = np.array(indices2, dtype=np.intp)
+
+  return lnames,indices1,indices2,stack_tables(cats1,-1),stack_tables(cats2,-1),stack_tables(recodes,-1)
+
+
+def count_diplotypes_block(cats1,cats2):
+  '''
+  Count diplotypes for each row of two matrices of diplotype categories,
+  as done by count_diplotypes
+
+  >>> cats1 = np.array([[0,1,1,2,-1]])
+  >>> cats2 = np.array([[0,1,2,2, 0]])
+  >>> count_diplotypes_block(cats1,cats2).tolist()
+  [[1, 0, 0, 0, 1, 1, 0, 0, 1]]
+  '''
+  n     = len(cats1)
+  valid = (cats1>=0)&(cats2>=0)
+  rows  = np.arange(n)[:,np.newaxis]
+  codes = (9*rows + 3*cats1 + cats2)[valid]
+
+  return np.bincount(codes, minlength=9*n).reshape(n,9)
+
+
+def _sum9(values):
+  '''
+  Sum rows of nine values in the order used by numpy to sum a single
+  vector of nine values, so that results match trend_r2_dips exactly
+  '''
+  v = values
+  return (((v[:,0]+v[:,1])+(v[:,2]+v[:,3]))+((v[:,4]+v[:,5])+(v[:,6]+v[:,7])))+v[:,8]
+
+
+def trend_r2_dips_block(dips):
+  '''
+  Vectorized trend_r2_dips for each row of a matrix of diplotype counts.
+  Uninformative loci, for which trend_r2_dips returns an integer zero, are
+  returned as NaN.
+
+  >>> dips = [[10,2,0,3,20,1,0,2,9],[0,0,0,0,5,0,0,0,0],[1,0,0,1,0,0,0,0,3]]
+  >>> r2 = trend_r2_dips_block(np.array(dips))
+  >>> [ trend_r2_dips(d) for d in dips ]==[ r if r==r else 0 for r in r2.tolist() ]
+  True
+  '''
+  xvals = np.array([0,0,0,1,1,1,2,2,2],dtype=int)
+  yvals = np.array([0,1,2,0,1,2,0,1,2],dtype=int)
+  dips  = np.asarray(dips, dtype=float)
+  n     = _sum9(dips)
+
+  with np.errstate(all='ignore'):
+    x     = _sum9(dips * xvals      )/n
+    xx    = _sum9(dips * xvals**2   )/n
+    y     = _sum9(dips * yvals      )/n
+    yy    = _sum9(dips * yvals**2   )/n
+    xy    = _sum9(dips * xvals*yvals)/n
+
+    covxy = xy - x*y
+    varx  = xx - x*x
+    vary  = yy - y*y
+
+    # Square with pow, as done for the scalars in trend_r2_dips
+    r2    = np.power(covxy, np.repeat(2.,len(covxy))) / varx / vary
+
+    return np.where( (n>0)&(varx>0)&(vary>0), r2, np.nan )
+
+
+def diplotype_haplotypes(dips):
+  '''
+  Return arrays of haplotype counts c11, c12, c21, c22 and double
+  heterozygotes for each row of a matrix of diplotype counts, as done by
+  count_haplotypes
+
+  >>> diplotype_haplotypes(np.array([[1,2,3,4,5,6,7,8,9]])).ravel().tolist()
+  [8, 14, 26, 32, 5]
+  '''
+  dips = np.asarray(dips, dtype=np.int64)
+  c11  = 2*dips[:,0] + dips[:,1] + dips[:,3]
+  c12  = 2*dips[:,2] + dips[:,1] + dips[:,5]
+  c21  = 2*dips[:,6] + dips[:,3] + dips[:,7]
+  c22  = 2*dips[:,8] + dips[:,5] + dips[:,7]
+  dh   =   dips[:,4]
+  return np.array([c11,c12,c21,c22,dh])
+
+
+def estimate_ld_block(dips):
+  '''
+  Vectorized estimate_ld for each row of a matrix of diplotype counts.
+  The EM iterations of all rows proceed together, with each row retaining
+  its estimates from the iteration at which it converged.
+
+  >>> from glu.lib.genolib.ld import estimate_ld
+  >>> dips   = np.array([[10,2,0,3,20,1,0,2,9],[5,0,0,0,0,0,0,0,5],[3,3,0,0,0,0,0,0,0]])
+  >>> haplos = diplotype_haplotypes(dips).T.tolist()
+  >>> r2,dprime = estimate_ld_block(dips)
+  >>> np.allclose(r2,[ estimate_ld(*h)[0] for h in haplos ])
+  True
+  >>> np.allclose(dprime,[ estimate_ld(*h)[1] for h in haplos ])
+  True
+  '''
+  TOLERANCE = 10e-7
+  EPSILON   = 10e-10
+
+  c11,c12,c21,c22,dh = diplotype_haplotypes(dips)
+
+  bail = (dh==0) & ( (c11+c12==0)|(c21+c22==0)|(c11+c21==0)|(c12+c22==0) )
+
+  with np.errstate(all='ignore'):
+    n   = (c11 + c12 + c21 + c22 + 2*dh).astype(float)
+    p   = (c11 + c12 + dh)/n
+    q   = (c11 + c21 + dh)/n
+
+    p11 = p*q
+    p12 = p*(1-q)
+    p21 = (1-p)*q
+    p22 = (1-p)*(1-q)
+
+    active = ~bail
+
+    for i in xrange(100):
+      if not active.any():
+        break
+
+      old_p11 = p11
+
+      # Force estimates away from boundaries
+      e11 = np.maximum(EPSILON, p11)
+      e12 = np.maximum(EPSILON, p12)
+      e21 = np.maximum(EPSILON, p21)
+      e22 = np.maximum(EPSILON, p22)
+
+      a   = e11*e22 + e12*e21
+
+      nx1 = dh*e11*e22/a
+      nx2 = dh*e12*e21/a
+
+      p11 = np.where(active, (c11+nx1)/n, p11)
+      p12 = np.where(active, (c12+nx2)/n, p12)
+      p21 = np.where(active, (c21+nx2)/n, p21)
+      p22 = np.where(active, (c22+nx1)/n, p22)
+
+      active &= ~(np.abs(old_p11-p11) < TOLERANCE)
+
+    d      = p11*p22 - p12*p21
+    dmax   = np.where(d>0, np.minimum(p*(1-q),(1-p)*q), -np.minimum(p*q,(1-p)*(1-q)))
+    dprime = d/dmax
+    r2     = d*d/(p*(1-p)*q*(1-q))
+
+  r2[bail]     = 0.
+  dprime[bail] = 0.
+
+  return r2,dprime
 
-  out = table_writer(options.output,hyphen=sys.stdout)
-  out.writerow(['LOCUS','SAMPLES','MISSING1','MAF1','MISSING2','MAF2','CONCORDANCE','COMPS','R2_EM','R2_TREND'])
 
-  if options.progress:
-    genos = progress_loop(genos, length=len(genos1.loci), units='loci')
+def maf_block(counts):
+  '''
+  Vectorized estimate_maf for rows of counts of diplotype categories
+  (homozygote, heterozygote, homozygote)
+
+  >>> maf_block(np.array([[1000,2000,1000],[2000,2000,0],[0,0,0]])).tolist()
+  [0.5, 0.25, 0.0]
+  '''
+  counts = np.asarray(counts, dtype=float)
+  hom    = np.minimum(counts[:,0],counts[:,2])
+  n      = 2*counts.sum(axis=1)
+
+  with np.errstate(all='ignore'):
+    maf  = (2*hom + counts[:,1])/n
+
+  return np.where(n>0, maf, 0.)
+
+
+def genos_chunk_stats(encoded):
+  '''
+  Compute correlation statistics for an encoded chunk of matched loci
+
+  >>> cats    = np.array([[-1,0,1,2]]*3)
+  >>> recodes = np.array([[0,1,2,3]]*3)
+  >>> indices1 = np.array([[1,2],[0,0],[3,3]])
+  >>> indices2 = np.array([[1,3],[1,2],[3,0]])
+  >>> for row in genos_chunk_stats((['l1','l2','l3'],indices1,indices2,cats,cats,recodes)):
+  ...   print row[0],row[6],row[7]
+  l1 0.5 2
+  l2 1 0
+  l3 1.0 1
+  '''
+  lnames,indices1,indices2,cats1,cats2,recodes = encoded
 
-  for (lname1,locus1),(lname2,locus2) in genos:
+  n,m      = indices1.shape
+  rows     = np.arange(n)[:,np.newaxis]
+  c1       = cats1[rows,indices1]
+  c2       = cats2[rows,indices2]
+
+  dips     = count_diplotypes_block(c1,c2)
+  counts1  = np.bincount((3*rows+c1)[c1>=0], minlength=3*n).reshape(n,3)
+  counts2  = np.bincount((3*rows+c2)[c2>=0], minlength=3*n).reshape(n,3)
+
+  missing1 = (indices1==0).sum(axis=1)/m if m else np.zeros(n)
+  missing2 = (indices2==0).sum(axis=1)/m if m else np.zeros(n)
+
+  r2_em    = estimate_ld_block(dips)[0]
+  r2_trend = trend_r2_dips_block(dips)
+
+  both     = (indices1!=0)&(indices2!=0)
+  comps    = both.sum(axis=1)
+  concord  = (both&(recodes[rows,indices2]==indices1)).sum(axis=1)
+
+  # Loci without comparisons report an integer concordance of 1
+  with np.errstate(all='ignore'):
+    concord = [ ratio if count else 1 for ratio,count in izip((concord/comps).tolist(),comps.tolist()) ]
+
+  # trend_r2_dips returns an integer zero for uninformative loci
+  r2_trend = [ r if r==r else 0 for r in r2_trend.tolist() ]
+
+  return zip(lnames, [m]*n, missing1.tolist(), maf_block(counts1).tolist(),
+                            missing2.tolist(), maf_block(counts2).tolist(),
+             concord, comps.tolist(), r2_em.tolist(), r2_trend)
+
+
+def dosage_chunk_stats(chunk):
+  '''
+  Compute masked dosage correlation statistics for a chunk of matched loci
+  '''
+  for (lname1,d1),(lname2,d2) in chunk:
     assert lname1==lname2
 
-    counts1  = Counter(locus1)
-    counts2  = Counter(locus2)
+  lnames  = [ lname for (lname,d1),(lname2,d2) in chunk ]
+  dosage1 = np.array([ d1 for (lname1,d1),(lname2,d2) in chunk ], dtype=float)
+  dosage2 = np.array([ d2 for (lname1,d1),(lname2,d2) in chunk ], dtype=float)
 
-    maf1     = estimate_maf(counts1)
-    missing1 = counts1.get( (None,None), 0 ) / len(locus1)
-    maf2     = estimate_maf(counts2)
-    missing2 = counts2.get( (None,None), 0 ) / len(locus2)
+  m       = dosage1.shape[1]
+  mask1   = np.isfinite(dosage1)
+  mask2   = np.isfinite(dosage2)
+  mask    = mask1&mask2
+  n1      = mask1.sum(axis=1)
+  n2      = mask2.sum(axis=1)
+  n       = mask.sum(axis=1)
 
-    dips     = count_diplotypes(locus1, locus2)
+  with np.errstate(all='ignore'):
+    maf1  = np.where(mask1,dosage1,0).sum(axis=1)/n1
+    maf2  = np.where(mask2,dosage2,0).sum(axis=1)/n2
+    maf1  = np.minimum(maf1,1-maf1)
+    maf2  = np.minimum(maf2,1-maf2)
 
-    #r2_em,dp = estimate_ld(dips)
-    r2_em,dp = estimate_ld(locus1,locus2)
-    #r2_trend= trend_r2(locus1,locus2)
-    r2_trend = trend_r2_dips(dips)
+    # Masked Pearson correlation of each row
+    x     = np.where(mask,dosage1,0)
+    y     = np.where(mask,dosage2,0)
+    x     = np.where(mask,x-(x.sum(axis=1)/n)[:,np.newaxis],0)
+    y     = np.where(mask,y-(y.sum(axis=1)/n)[:,np.newaxis],0)
+    r     = (x*y).sum(axis=1)/np.sqrt((x*x).sum(axis=1)*(y*y).sum(axis=1))
+    r2    = np.clip(r,-1,1)**2
 
-    concord  = comps = 0
-    for a,b in izip(locus1,locus2):
-      if a and b:
-        if a==b:
-          concord += 1
-        comps += 1
+  r2 = np.where( (n>=2)&np.isfinite(r2), r2, 0. )
 
-    concord = concord/comps if comps else 1
+  return zip(lnames, [m]*len(lnames), (1-n1/m).tolist(), maf1.tolist(),
+                                      (1-n2/m).tolist(), maf2.tolist(), r2.tolist())
 
-    out.writerow([lname1,len(locus1),missing1,maf1,missing2,maf2,concord,comps,r2_em,r2_trend])
 
+def map_chunks(func, chunks, jobs=1):
+  '''
+  Apply func to each chunk, using a pool of worker processes when jobs>1,
+  and generate the results in input order
+  '''
+  if jobs<=1:
+    for chunk in chunks:
+      yield func(chunk)
+    return
 
-def correlation_dosage(options,filename1,filename2):
+  from multiprocessing import Pool
 
-  dosage1,dosage2 = load_dosage(options,filename1,filename2)
-  dosage          = izip(dosage1,dosage2)
+  pool = Pool(jobs)
+
+  try:
+    for result in pool.imap(func, chunks):
+      yield result
+  finally:
+    pool.terminate()
+
+
+def correlation_genos(options,filename1,filename2):
+  genos1,genos2 = load_genos(options,filename1,filename2)
+  genos         = izip(genos1,genos2)
 
   out = table_writer(options.output,hyphen=sys.stdout)
-  out.writerow(['LOCUS','SAMPLES','MISSING1','MAF1','MISSING2','MAF2','R2'])
+  out.writerow(['LOCUS','SAMPLES','MISSING1','MAF1','MISSING2','MAF2','CONCORDANCE','COMPS','R2_EM','R2_TREND'])
+
+  if options.progress:
+    genos = progress_loop(genos, length=len(genos1.loci), units='loci')
+
+  chunks = ( encode_genos_chunk(block) for block in chunk(genos,options.blocksize) )
+
+  for rows in map_chunks(genos_chunk_stats, chunks, options.jobs):
+    out.writerows(rows)
 
-  for (lname1,dosage1),(lname2,dosage2) in dosage:
-    assert lname1==lname2
 
-    mask1    = np.isfinite(dosage1)
-    mask2    = np.isfinite(dosage2)
-    mask     = mask1&mask2
-    n1       = mask1.sum()
-    n2       = mask2.sum()
-    maf1     = dosage1[mask1].sum()/n1
-    maf2     = dosage2[mask2].sum()/n2
-    maf1     = min(maf1,1-maf1)
-    maf2     = min(maf2,1-maf2)
-    missing1 = 1 - n1/len(dosage1)
-    missing2 = 1 - n2/len(dosage2)
-    r2       = 0.
+def correlation_dosage(options,filename1,filename2):
+  dosage1,dosage2 = load_dosage(options,filename1,filename2)
+  dosage          = izip(dosage1,dosage2)
 
-    if mask.sum()>=2:
-      corr = np.corrcoef(dosage1[mask],dosage2[mask])
+  out = table_writer(options.output,hyphen=sys.stdout)
+  out.writerow(['LOCUS','SAMPLES','MISSING1','MAF1','MISSING2','MAF2','R2'])
 
-      if len(corr) and np.isfinite(corr[0,1]):
-        r2 = corr[0,1]**2
+  chunks = chunk(dosage,options.blocksize)
 
-    out.writerow([lname1,len(dosage1),missing1,maf1,missing2,maf2,r2])
+  for rows in map_chunks(dosage_chunk_stats, chunks, options.jobs):
+    out.writerows(rows)
 
 
 def option_parser():
@@ -354,6 +689,10 @@ def option_parser():
                     help='output table file name')
   parser.add_argument('-P', '--progress', action='store_true',
                     help='Show analysis progress bar, if possible')
+  parser.add_argument('--blocksize', metavar='N', type=int, default=1000,
+                    help='Number of loci processed per block (default=1000)')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Number of worker processes (default=1)')
 
   return parser
 
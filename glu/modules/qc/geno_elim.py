@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-__gluindex__  = False
+__gluindex__  = True
 __abstract__  = 'Perform genotype-elimination on a set of genotypes based on their relationships'
 __copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
 __license__   = 'See GLU license for terms by running: glu license'
@@ -8,11 +8,19 @@ __revision__  = '$Id$'
 
 import sys
 
-from   itertools         import izip,chain
-from   collections       import defaultdict
+from   itertools          import izip
+from   collections        import defaultdict,deque
 
-from   glu.lib.fileutils import table_reader,table_writer
-from   glu.lib.genolib   import load_genostream,geno_options
+import numpy as np
+
+from   glu.lib.utils      import chunk
+from   glu.lib.fileutils  import table_writer
+from   glu.lib.union_find import union_find
+from   glu.lib.genolib    import load_genostream,geno_options
+
+
+# Feasible genotype sets are represented as 64 bit masks
+MAX_GENOTYPES = 64
 
 
 errbylochead1 = ['','LEVEL_1_ERRORS','','LEVEL_2_ERRORS','','LEVEL_3_ERRORS']
@@ -29,593 +37,550 @@ def option_parser():
 
   geno_options(parser,input=True)
 
-  parser.add_argument('-o', '--errdetails',  default='-', metavar='FILE',
+  parser.add_argument('-o', '--errdetails', metavar='FILE',
                     help="The output file containing genotype matrix after elimination, '-' for standard out")
   parser.add_argument('--locsum', default='-', metavar='FILE',
-                    help="The output file containing summary of errors by locus, '-' for standard out")
-  parser.add_argument('--locdet', default='-', metavar='FILE',
+                    help="The output file containing summary of errors by locus, '-' for standard out (default)")
+  parser.add_argument('--locdet', metavar='FILE',
                     help="The output file containing details of errors by locus, '-' for standard out")
-  parser.add_argument('--pedsum', default='-', metavar='FILE',
+  parser.add_argument('--pedsum', metavar='FILE',
                     help="The output file containing summary of errors by pedigree, '-' for standard out")
-  parser.add_argument('--peddet', default='-', metavar='FILE',
+  parser.add_argument('--peddet', metavar='FILE',
                     help="The output file containing details of errors by pedigree, '-' for standard out")
+  parser.add_argument('--blocksize', metavar='N', type=int, default=1000,
+                    help='Number of loci processed per block (default=1000)')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Number of worker processes (default=1)')
 
   return parser
 
 
-def mkgeno(a,b):
-  return min(a,b)+max(a,b)
-
-
-def build_children_genos(p1geno,p2geno):
-  '''
-  Build a set of possible children genotypes from a pair of parents genotypes
-
-  @param p1geno: genotype of one of the parents
-  @type  p1geno: str
-  @param p2geno: genotype of the other parent
-  @type  p2geno: str
-  @return      : a set of possible children genotypes
-  @rtype       : set
-
-  >>> p1geno,p2geno = 'AA','AG'
-  >>> build_children_genos(p1geno,p2geno)
-  set(['AA', 'AG'])
-  '''
-  return set(mkgeno(a,b) for a in p1geno for b in p2geno)
-
-
-def build_uninformative_genoset(alleles):
+class EliminationTables(object):
   '''
-  Build a set of possible unphased genotypes given a set of alleles
-  @param alleles: a set of alleles
-  @type  alleles: set
-  @return       : a set of possible genotypes
-  @rtype        : set
-
-  >>> alleles = set(['A','G'])
-  >>> build_uninformative_genoset(alleles)
-  set(['AA', 'GG', 'AG'])
-  '''
-  return set(mkgeno(a,b) for a in alleles for b in alleles)
-
-
-def build_nuclear_families(pedfile,individuals):
-  '''
-  Build nuclear families based on a pedigree file
-  @param     pedfile: pedigree file
-  @type      pedfile: str
-  @param individuals: genotyped individuals
-  @type  individuals: list
-  @return           : nuclear families and the total number of built families
-  @rtype            : tuple
-
-  >>> import StringIO
-  >>> contents = "fam101\\tind01\\t0\\t0\\n\
-  fam101\\tind02\\t0\\t0\\n\
-  fam101\\tind11\\tind01\\tind02\\n\
-  fam101\\tind12\\tind01\\tind02\\n"
-  >>> f = StringIO.StringIO(contents)
-  >>> ind = ['fam101_ind01','fam101_ind02','fam101_ind11','fam101_ind12']
-  >>> fams,n=build_nuclear_families(f,ind)
-  >>> dict(fams)
-  {('fam101_ind01', 'fam101_ind02'): ['fam101_ind11', 'fam101_ind12']}
-  >>> n
-  1
-  '''
-
-  def concat_id(fam,id):
-    return '%s_%s' % (fam.strip(),id.strip())
-
-  def get_field(row,n,default=None):
-    try:
-      return row[n]
-    except IndexError:
-      return default
-
-  typed = {}
-  for individual in individuals:
-    typed[individual] = 1
-
-  peds = table_reader(pedfile)
-
-  nfam = defaultdict(list)
-  famset = set()
-  for ped in peds:
-    if len(ped) < 2:
+  Cache of genotype bitmask tables for each genotype model.  Bit k of a
+  genotype mask denotes the genotype with index k+1 in the model, so that
+  a set of feasible genotypes of an individual at a locus is a single
+  integer.  For each pair of parental genotype indices (i+1,j+1), trans[i,j]
+  is the mask of possible offspring genotypes and share[i+1,j+1] indicates
+  whether the genotypes have an allele in common.  Index 0 of share denotes
+  a missing genotype, which is compatible with any other.
+
+  >>> from glu.lib.genolib.genoarray import build_model
+  >>> model  = build_model('AB',max_alleles=2)
+  >>> tables = EliminationTables()
+  >>> trans,share,full = tables.block_tables([model])
+  >>> trans[0].tolist()
+  [[1L, 3L, 2L], [3L, 7L, 6L], [2L, 6L, 4L]]
+  >>> share[0].astype(int).tolist()
+  [[1, 1, 1, 1], [1, 1, 1, 0], [1, 1, 1, 1], [1, 0, 1, 1]]
+  >>> full.tolist()
+  [7L]
+  '''
+  def __init__(self):
+    self.tables = {}
+
+  def model_tables(self, model):
+    genotypes = model.genotypes
+    key       = model,len(genotypes)
+    tables    = self.tables.get(key)
+
+    if tables is not None:
+      return tables
+
+    n = len(genotypes)-1
+
+    if n>MAX_GENOTYPES:
+      raise ValueError('Genotype elimination supports at most %d genotypes per locus' % MAX_GENOTYPES)
+
+    genomap = model.genomap
+    trans   = np.zeros( (n,n),     dtype=np.uint64 )
+    share   = np.ones(  (n+1,n+1), dtype=bool      )
+
+    for i,g1 in enumerate(genotypes[1:]):
+      a1 = set(a for a in g1 if a is not None)
+
+      for j,g2 in enumerate(genotypes[1:]):
+        a2   = set(a for a in g2 if a is not None)
+        mask = 0
+        for a in g1:
+          for b in g2:
+            g = genomap.get( (a,b) )
+            if g is not None and g.index:
+              mask |= 1<<(g.index-1)
+
+        trans[i,j]     = mask
+        share[i+1,j+1] = bool(a1&a2)
+
+    tables = self.tables[key] = trans,share,(1<<n)-1
+    return tables
+
+  def block_tables(self, models):
+    '''
+    Return transmission tables, allele sharing tables and masks of all
+    genotypes for a sequence of locus models, padded to a common size
+    '''
+    tables = [ self.model_tables(model) for model in models ]
+    size   = max([ len(trans) for trans,share,full in tables ] or [0])
+    n      = len(tables)
+
+    block_trans = np.zeros( (n,size,size),     dtype=np.uint64 )
+    block_share = np.ones(  (n,size+1,size+1), dtype=bool      )
+    block_full  = np.zeros(  n,                dtype=np.uint64 )
+
+    for i,(trans,share,full) in enumerate(tables):
+      k = len(trans)
+      block_trans[i,:k,:k]     = trans
+      block_share[i,:k+1,:k+1] = share
+      block_full[i]            = full
+
+    return block_trans,block_share,block_full
+
+
+def genotype_masks(indices, full):
+  '''
+  Convert a matrix of genotype indices (individuals x loci) to feasible
+  genotype masks, where missing genotypes may take any genotype of the
+  locus model
+
+  >>> indices = np.array([[1,0],[3,2]])
+  >>> genotype_masks(indices, np.array([7,7],dtype=np.uint64)).tolist()
+  [[1L, 7L], [4L, 2L]]
+  '''
+  indices = np.asarray(indices, dtype=np.intp)
+  bits    = np.left_shift(np.uint64(1), (np.maximum(indices,1)-1).astype(np.uint64))
+  return np.where(indices>0, bits, full)
+
+
+def eliminate_family(masks, parent1, parent2, children, trans):
+  '''
+  Genotype elimination within a nuclear family over all loci at once.
+  Each parental genotype is retained if it is part of a pair of parental
+  genotypes for which every child retains at least one offspring genotype.
+  Each child genotype is retained if it is an offspring genotype of such
+  a pair.  Masks are updated in place and the return value indicates
+  whether any genotype was eliminated.
+
+  >>> from glu.lib.genolib.genoarray import build_model
+  >>> model = build_model('AG',max_alleles=2)
+  >>> [ ''.join(g) for g in model.genotypes[1:] ]
+  ['AA', 'AG', 'GG']
+  >>> trans,share,full = EliminationTables().block_tables([model])
+  >>> masks = np.array([[1],[7],[2],[7]],dtype=np.uint64)
+  >>> eliminate_family(masks, 0, 1, [2,3], trans)
+  True
+  >>> masks.ravel().tolist()
+  [1L, 6L, 2L, 3L]
+  >>> eliminate_family(masks, 0, 1, [2,3], trans)
+  False
+
+  The retained genotypes are exactly those that appear in some joint
+  assignment of genotypes to the family that is consistent with Mendelian
+  inheritance:
+
+  >>> import random
+  >>> from itertools import product
+  >>> def feasible(m):
+  ...   sets = [ [ k for k in range(3) if m[i]>>k&1 ] for i in range(len(m)) ]
+  ...   new  = [0]*len(m)
+  ...   for g in product(*sets):
+  ...     if all( int(trans[0,g[0],g[1]])>>c&1 for c in g[2:] ):
+  ...       for i,k in enumerate(g):
+  ...         new[i] |= 1<<k
+  ...   return new
+  >>> random.seed(1)
+  >>> for t in range(500):
+  ...   m       = [ random.randint(1,7) for i in range(random.randint(3,5)) ]
+  ...   masks   = np.array(m,dtype=np.uint64)[:,np.newaxis]
+  ...   changed = eliminate_family(masks, 0, 1, range(2,len(m)), trans)
+  ...   assert masks.ravel().tolist()==feasible(m), m
+  '''
+  children = np.asarray(children, dtype=np.intp)
+  m1       = masks[parent1]
+  m2       = masks[parent2]
+  mc       = masks[children]
+  new1     = np.zeros_like(m1)
+  new2     = np.zeros_like(m2)
+  newc     = np.zeros_like(mc)
+  bits     = [ np.uint64(1<<i) for i in xrange(trans.shape[1]) ]
+
+  for i,bit1 in enumerate(bits):
+    has1 = (m1&bit1)!=0
+
+    if not has1.any():
       continue
 
-    fam,ind = ped[:2]
+    for j,bit2 in enumerate(bits):
+      present = has1&((m2&bit2)!=0)
 
-    parent1 = get_field(ped,2,'0')
-    parent2 = get_field(ped,3,'0')
+      if not present.any():
+        continue
 
-    if '0' in (parent1,parent2):
-      continue
+      hits  = mc&trans[:,i,j]
+      valid = present&(hits!=0).all(axis=0)
 
-    if fam:
-      ind=concat_id(fam,ind)
-      parent1=concat_id(fam,parent1)
-      parent2=concat_id(fam,parent2)
-      if parent1 not in typed or parent2 not in typed or ind not in typed:
+      if not valid.any():
         continue
 
-    parents = min(parent1,parent2),max(parent1,parent2)
-    nfam[parents].append(ind)
-    famset.add(fam)
+      new1[valid] |= bit1
+      new2[valid] |= bit2
+      hits[:,~valid] = 0
+      newc |= hits
+
+  changed = (new1!=m1).any() or (new2!=m2).any() or (newc!=mc).any()
+
+  masks[parent1]  = new1
+  masks[parent2]  = new2
+  masks[children] = newc
 
-  return nfam,len(famset)
+  return bool(changed)
 
 
-def build_genodict(genos,individuals):
+def eliminate_pedigree(masks, families, trans):
   '''
-  Make a possible genotype list for each individual
-  @param       genos: genotypes
-  @type        genos: list
-  @param individuals: individuals
-  @type  individuals: list
-  @return           : genotype dictionary for each individual
-  @rtype            : dict
-
-  >>> genos = ['AA','AG','GG','AA','','']
-  >>> inds  = ['P1','P2','P3','P4','P5','P6']
-  >>> genodict = build_genodict(genos,inds)
-  >>> for ind,geno in genodict.iteritems():
-  ...   print ind,geno
-  P2 set(['AG'])
-  P3 set(['GG'])
-  P1 set(['AA'])
-  P6 set(['AA', 'GG', 'AG'])
-  P4 set(['AA'])
-  P5 set(['AA', 'GG', 'AG'])
+  Apply genotype elimination to each nuclear family of a pedigree until no
+  further genotypes can be eliminated
   '''
+  changed = True
+  while changed:
+    changed = False
+    for parent1,parent2,children in families:
+      if eliminate_family(masks, parent1, parent2, children, trans):
+        changed = True
+  return masks
 
-  alleles = set()
-  for geno in genos:
-    if geno:
-      alleles.update(geno)
 
-  missing = build_uninformative_genoset(alleles)
+def pedigree_errors(indices, families, trans, share):
+  '''
+  Find level 1 (parent-offspring) and level 2 (parent-parent-offspring)
+  errors among observed genotypes.  Returns lists of (locus, parent, child)
+  and (locus, parent1, parent2, child) tuples of locus offsets and member
+  indices.
 
-  genodict = {}
-  for ind,geno in izip(individuals,genos):
-    if geno:
-      genodict[ind] = set([mkgeno(*geno)])
-    else:
-      genodict[ind] = missing.copy()
+  >>> from glu.lib.genolib.genoarray import build_model
+  >>> trans,share,full = EliminationTables().block_tables([build_model('AB',max_alleles=2)]*3)
+  >>> indices = np.array([[1,1,1],[1,3,1],[1,3,2]])
+  >>> pedigree_errors(indices, [(0,1,[2])], trans, share)
+  ([(1, 0, 2)], [(2, 0, 1, 2)])
+  '''
+  indices = np.asarray(indices, dtype=np.intp)
+  loci    = np.arange(indices.shape[1])
+  level1  = []
+  level2  = []
 
-  return genodict
+  for parent1,parent2,children in families:
+    g1 = indices[parent1]
+    g2 = indices[parent2]
+    t  = trans[loci,np.maximum(g1,1)-1,np.maximum(g2,1)-1]
 
+    for child in children:
+      gc   = indices[child]
+      ok1  = share[loci,g1,gc]
+      ok2  = share[loci,g2,gc]
+      bits = np.left_shift(np.uint64(1), (np.maximum(gc,1)-1).astype(np.uint64))
+      bad2 = (g1>0)&(g2>0)&(gc>0)&ok1&ok2&((t&bits)==0)
 
-def genotype_elimination(nfams,genos,individuals,out):
-  '''
-  Implement the sequential Genotype-Elimination Algorithm
-
-  @param       nfams: nuclear families
-  @type        nfams: dict
-  @param       genos: genotypes
-  @type        genos: list
-  @param individuals: individuals
-  @type  individuals: list
-  @param         out: output file
-  @type          out: file
-  '''
+      level1.extend( (i,parent1,child) for i in np.flatnonzero(~ok1).tolist() )
+      level1.extend( (i,parent2,child) for i in np.flatnonzero(~ok2).tolist() )
+      level2.extend( (i,parent1,parent2,child) for i in np.flatnonzero(bad2).tolist() )
 
-  def norm_geno(g):
-    if not g:
-      return ''
-    else:
-      return intern(''.join(g))
+  level1.sort()
+  level2.sort()
 
-  errbyloc1 = {}
-  errbyloc2 = {}
-  errbyloc  = {}
+  return level1,level2
 
-  for ct,(lname,locusgenos) in enumerate(genos):
-    print '------------------------line: %d' % (ct+1)
-    locusgenos = map(norm_geno,locusgenos)
-    genos = build_genodict(locusgenos,individuals)
-    prev_genos = {}
-    while genos!=prev_genos:
-      prev_genos = genos.copy()
-      for parents,children in nfams.iteritems():
-        eliminate_nuclear_family(parents,children,lname,genos,errbyloc1,errbyloc2)
 
-    build_errbyloc(individuals,lname,genos,errbyloc)
-    if out:
-      emit_gea_details(out, individuals, lname, genos)
+def check_pedigree(indices, families, trans, share, full, keep_masks=False):
+  '''
+  Find genotype errors and perform genotype elimination for all loci of a
+  pedigree.  Returns level 1 and level 2 errors as by pedigree_errors, a
+  boolean array indicating the loci at which the pedigree is inconsistent
+  and, if requested, the resulting genotype masks.
+  '''
+  level1,level2 = pedigree_errors(indices, families, trans, share)
+  masks         = eliminate_pedigree(genotype_masks(indices, full), families, trans)
+  inconsistent  = (masks==0).any(axis=0)
 
-  return errbyloc1,errbyloc2,errbyloc
+  return level1,level2,inconsistent,masks if keep_masks else None
 
 
-def build_errbyloc(individuals, lname, genos, errbyloc):
+def check_pedigrees(task):
   '''
-  Output genotype errors by locus after elimination
+  Check a group of pedigrees for a block of loci
   '''
-  # FIXME: intern/split?
-  for ind in individuals:
-    if not genos[ind]:
-      errbyloc[lname].add(intern(ind.split('_')[0]))
+  trans,share,full,pedigrees,keep_masks = task
+  return [ check_pedigree(indices, families, trans, share, full, keep_masks)
+           for indices,families in pedigrees ]
 
 
-def emit_gea_details(outdetails, individuals, lname, genos):
+class Pedigree(object):
   '''
-  Output genotypes after elimination
+  A set of nuclear families connected by common members.  Families are
+  represented by tuples of member indices (parent1, parent2, children) and
+  rows gives the sample index of each member or -1 if the member was not
+  genotyped.
   '''
-  locusgenos=[lname]
-  for ind in individuals:
-    locusgenos.append(sorted(genos[ind]))
-  outdetails.writerow(locusgenos)
+  def __init__(self, name, members, families, rows):
+    self.name     = name
+    self.members  = members
+    self.families = families
+    self.rows     = rows
 
 
-def eliminate_nuclear_family(parents,children,lname,genos,errbyloc1,errbyloc2):
+def build_pedigrees(samples, phenome):
   '''
-  Genotype elimination within each nuclear family
-
-  @param   parents: ids for both parents
-  @type    parents: tuple
-  @param  children: ids for all the children
-  @type   children: list
-  @param     lname: locus name
-  @type      lname: str
-  @param     genos: current possible genotypes list for each person
-  @type      genos: dict
-  @param errbyloc1: ids for individuals with level 1 errors by locus
-  @type  errbyloc1: dict
-  @param errbyloc2: ids for individuals with level 2 errors by locus
-  @type  errbyloc2: dict
-
-  >>> parents = '1140_01','1140_02'
-  >>> children = ['1140_11','1140_12']
-  >>> lname = 'rs1167772'
-  >>> genos = {'1140_01':set(['AA']),'1140_02':set(['AA','AG','GG']),'1140_11':set(['AG']),'1140_12':set(['AA','AG','GG'])}
-  >>> errbyloc1=defaultdict(set)
-  >>> errbyloc2=defaultdict(set)
-  >>> eliminate_nuclear_family(parents,children,lname,genos,errbyloc1,errbyloc2)
-  >>> sorted( (i,sorted(g)) for i,g in genos.iteritems() )
-  [('1140_01', ['AA']), ('1140_02', ['AG', 'GG']), ('1140_11', ['AG']), ('1140_12', ['AA', 'AG'])]
+  Build pedigrees of nuclear families of genotyped samples whose parents
+  are both known.  Parents need not be genotyped.
+
+  >>> from glu.lib.genolib.phenos import Phenome
+  >>> phenome = Phenome()
+  >>> phenome.merge_phenos('c1', family='f1', parent1='p1', parent2='p2')
+  >>> phenome.merge_phenos('c2', family='f1', parent1='p2', parent2='p1')
+  >>> phenome.merge_phenos('c3', family='f2', parent1='p3', parent2='p4')
+  >>> for ped in build_pedigrees(['p1','c1','c2','c3','p4'], phenome):
+  ...   print ped.name,ped.members,ped.families,ped.rows.tolist()
+  f1 ['p1', 'p2', 'c1', 'c2'] [(0, 1, [2, 3])] [0, -1, 1, 2]
+  f2 ['p3', 'p4', 'c3'] [(0, 1, [2])] [-1, 4, 3]
   '''
-  p1,p2 = parents
+  index    = dict( (s,i) for i,s in enumerate(samples) )
+  nfams    = defaultdict(list)
+  pedsets  = union_find()
 
-  do_elim = False
-  for ind in chain(parents,children):
-    if not genos[ind] or len(genos[ind]) > 1:
-      do_elim = True
-      break
+  for child in samples:
+    phenos  = phenome.get_phenos(child)
+    parent1 = phenos.parent1
+    parent2 = phenos.parent2
 
-  if do_elim:
-    eliminate_single_genotypes(parents,children,genos)
+    if not parent1 or not parent2 or parent1==parent2 or child in (parent1,parent2):
+      continue
 
-    # Set saved genos to empty for all family members
-    saved_genos = dict( (i,set()) for i in chain(parents,children) )
+    parents = min(parent1,parent2),max(parent1,parent2)
+    nfams[parents].append(child)
+    pedsets.union(child,*parents)
 
-    # Eliminate p1 against p2 and children
-    eliminate_parents(p1,genos[p1],p2,genos[p2],children,genos,saved_genos)
+  peds = defaultdict(list)
+  for parents,children in nfams.iteritems():
+    peds[pedsets[parents[0]]].append( (parents,children) )
 
-    # Eliminate unsaved genotypes of p2 against p1 and children
-    p2genos   = genos[p2]-saved_genos[p2]
-    eliminate_parents(p2,p2genos,p1,genos[p1],children,genos,saved_genos)
+  pedigrees = []
+  for fams in peds.itervalues():
+    fams.sort(key=lambda (parents,children): min(index.get(c) for c in children))
 
-    # Eliminate children against parents
-    eliminate_children(parents,children,genos,saved_genos)
+    members = []
+    mindex  = {}
+    def member(name):
+      i = mindex.get(name)
+      if i is None:
+        i = mindex[name] = len(members)
+        members.append(name)
+      return i
 
-  elif not level1_check(parents,children,lname,genos,errbyloc1):
-    level2_check(parents,children,lname,genos,errbyloc2)
+    families = [ (member(p1),member(p2),[ member(c) for c in children ])
+                 for (p1,p2),children in fams ]
 
+    rows = np.array([ index.get(m,-1) for m in members ], dtype=np.intp)
+    name = phenome.get_phenos(fams[0][1][0]).family or members[0]
 
-def level1_check(parents,children,lname,genos,errbyloc1):
-  '''
-  Find genotype errors at parent-offspring level
-  '''
+    pedigrees.append(Pedigree(name,members,families,rows))
 
-  def pair_check(p,c):
-    return ( set(getitem(p)) & set(getitem(c)) )
+  pedigrees.sort(key=lambda ped: min(r for r in ped.rows if r>=0))
 
-  err = False
-  for p in parents:
-    for c in children:
-      pgeno,cgeno=genos[p],genos[c]
-      if not pair_check(pgeno,cgeno):
-        errbyloc1[lname].add( (p,c) )
-        err = True
-  return err
+  return pedigrees
 
 
-def level2_check(parents,children,lname,genos,errbyloc2):
+def pedigree_groups(pedigrees, groups):
   '''
-  Find genotype errors at parent-parent-offspring level
+  Partition pedigrees into groups of approximately equal numbers of members
   '''
-  p1geno,p2geno=getitem(genos[parents[0]]),getitem(genos[parents[1]])
-  for child in children:
-    if not compatible_genos(p1geno,p2geno,[child],genos):
-      errbyloc2[lname].add( (parents[0],parents[1],child) )
+  bins = [ [0,[]] for i in xrange(groups) ]
+  for ped in sorted(pedigrees, key=lambda ped: -len(ped.members)):
+    b = min(bins)
+    b[0] += len(ped.members)
+    b[1].append(ped)
+  return [ peds for size,peds in bins if peds ]
 
 
-def eliminate_parents(p1,p1genos,p2,p2genos,children,genos,saved_genos):
+def elimination_tasks(genos, groups, tables, blocksize, keep_masks):
   '''
-  Eliminate superfluous genotypes of parent1 with respect to parent2 and
-  their children.  Parent2 must be processed separately, since compatibility
-  is only thoroughly verified for parent1's genotypes.  Thus, this function
-  may be called with parent1 and parent2 reversed and all saved genotypes of
-  parent2 spared from consideration.
-
-  @param           p1: first parent
-  @type            p1: str
-  @param      p1genos: genotypes of the first parent
-  @type       p1genos: set
-  @param           p2: second parent
-  @type            p2: str
-  @param      p2genos: genotypes of the second parent
-  @type       p2genos: set
-  @param     children: children of the nuclear family
-  @type      children: list
-  @param        genos: current possible genotypes list for each person
-  @type         genos: dict
-  @param  saved_genos: current saved genotypes set for each person
-  @type   saved_genos: dict
+  Generate blocks of loci from an ldat genotype stream with a genotype
+  elimination task for each group of pedigrees
   '''
-  for p1geno in p1genos:
-    for p2geno in p2genos:
-      matchedgenos = compatible_genos(p1geno,p2geno,children,genos)
+  for block in chunk(genos, blocksize):
+    models  = [ g.descriptor[0] for lname,g in block ]
+    indices = np.array([ g.indices() for lname,g in block ], dtype=np.uint32).T
 
-      if matchedgenos:
-        saved_genos[p1].add(p1geno)
-        saved_genos[p2].add(p2geno)
-        for child,matched in matchedgenos.iteritems():
-          saved_genos[child].update(matched)
-        break
+    # Append a row of missing genotypes for members that were not genotyped
+    indices = np.vstack( [indices, np.zeros( (1,len(block)), dtype=np.uint32 )] )
 
-  # p1 is fully eliminated, so all unsaved genotypes may be discarded
-  genos[p1] = saved_genos[p1]
+    trans,share,full = tables.block_tables(models)
 
+    tasks = [ (peds,(trans,share,full,[ (indices[ped.rows],ped.families) for ped in peds ],keep_masks))
+              for peds in groups ]
+
+    yield block,tasks
 
-def eliminate_children(parents,children,genos,saved_genos):
-  '''
-  Eliminate superfluous genotypes of the children
-
-  @param       parents: ids for both parents
-  @type        parents: tuple
-  @param      children: ids for all the children
-  @type       children: list
-  @param         genos: current possible genotypes set for each person
-  @type          genos: dictionary
-  @param   saved_genos: current saved genotypes set for each person
-  @type    saved_genos: dictionary
-  '''
-  for child in children:
-    for cgeno in genos[child] - saved_genos[child]:
-      calleles = set(cgeno)
-      pgenos = ( (p1,p2) for p1 in saved_genos[parents[0]] if set(p1)&calleles
-                         for p2 in saved_genos[parents[1]] if set(p2)&calleles)
-
-      for p1geno,p2geno in pgenos:
-        matchedgenos = compatible_genos(p1geno,p2geno,children,genos)
-        if matchedgenos:
-          for child,matched in matchedgenos.iteritems():
-            saved_genos[child].update(matched)
-        else:
-          genos[child].discard(cgeno)
-          saved_genos[child].discard(cgeno)
-
-  # children are fully eliminated, so all unsaved genotypes may be discarded
-  for child in children:
-    genos[child] = saved_genos[child]
-
-
-def compatible_genos(p1geno,p2geno,children,genos):
-  '''
-  Check to see if the parents and children genotypes are matching
-
-  @param   p1geno: first parent genotype
-  @type    p1geno: str
-  @param   p2geno: second parent genotype
-  @type    p2geno: str
-  @param children: list of children
-  @type  children: list
-  @param    genos: individual to genotypes dictionary
-  @type     genos: dict
-  @return        : compatible or not and matched children genotypes
-  @rtype         : tuple
-  '''
-  cgenoset = build_children_genos(p1geno,p2geno)
-  matchedcgenos = {}
-  for child in children:
-    matchedcgenos[child] = cgenoset&genos[child]
-    if not matchedcgenos[child]:
-      return None
-  return matchedcgenos
 
+def merge_results(pedigrees, tasks, results):
+  merged = {}
+  for (peds,task),pedresults in izip(tasks,results):
+    merged.update(izip(peds,pedresults))
+  return [ (ped,merged[ped]) for ped in pedigrees ]
 
-def eliminate_inconsistency(geno, genoset):
+
+def genotype_elimination(genos, pedigrees, blocksize=1000, jobs=1, keep_masks=False):
   '''
-  Eliminate incompatible genotypes given a fixed genotype against a set of
-  either parent or offspring genotypes such at least one allele from the
-  fixed genotype must appear in each genotype of the genoset.  Any
-  impossible genotypes are removed from the genotype set.
-
-  @param    geno: Fixed genotype of either a parent or child in a nuclear family
-  @type     geno: string
-  @param genoset: Set of either parents or children of the fixed genotype
-                  that are to be eliminated
-  @type  genoset: set of string
-
-  >>> g = set(['AA','AB','BB'])
-  >>> eliminate_inconsistency('AA',g)
-  >>> sorted(g)
-  ['AA', 'AB']
-  >>> g = set(['AA','AB','BB'])
-  >>> eliminate_inconsistency('AB',g)
-  >>> sorted(g)
-  ['AA', 'AB', 'BB']
-  >>> g = set(['AA','AB','BB'])
-  >>> eliminate_inconsistency('CC',g)
-  >>> sorted(g)
-  []
+  Perform genotype elimination on an ldat genotype stream.  Loci are
+  processed in blocks and each pedigree is processed for all loci of a
+  block simultaneously.  When jobs>1, groups of pedigrees are processed by
+  a pool of worker processes.
+
+  Generates a block of loci and a list of pedigrees and the results of
+  check_pedigree for each block.
   '''
-  alleles = set(geno)
-  for po_geno in list(genoset):
-    po_alleles = set(po_geno)
-    if not alleles & po_alleles:
-      genoset.remove(po_geno)
+  groups = pedigree_groups(pedigrees, max(1,jobs))
+  tables = EliminationTables()
+  blocks = elimination_tasks(genos, groups, tables, blocksize, keep_masks)
 
+  if jobs<=1:
+    for block,tasks in blocks:
+      yield block,merge_results(pedigrees, tasks, [ check_pedigrees(task) for peds,task in tasks ])
+    return
 
-def getitem(seq):
-  assert len(seq)==1
-  return iter(seq).next()
+  from multiprocessing import Pool
 
+  pool    = Pool(jobs)
+  pending = deque()
 
-def eliminate_single_genotypes(parents,children,genos):
-  '''
-  Eliminate incompatible genotypes for ambiguous individuals based on the
-  unambiguous family member genotypes with a single genotype
-
-  @param  parents: ids for both parents
-  @type   parents: tuple
-  @param children: ids for all the children
-  @type  children: list
-  @param    genos: genotype list for each person
-  @type     genos: dict
-
-  >>> parents  = 'p1','p2'
-  >>> children = ['c1','c2']
-  >>> genos    = {'p1':set(['AA','AG','GG']),'p2':set(['AG']),'c1':set(['AA','AG','GG']),'c2':set(['AA'])}
-  >>> err = eliminate_single_genotypes(parents,children,genos)
-  >>> expected_genos = {'p2':set(['AG']),'c2':set(['AA']),'c1':set(['AA','AG','GG']),'p1':set(['AA','AG'])}
-  >>> if expected_genos == genos:
-  ...   print True
-  True
-  '''
-  for p in parents:
-    pgenos = genos[p]
+  try:
+    # Keep a bounded number of blocks in flight, so that results are
+    # produced in input order without reading the entire genotype stream
+    for block,tasks in blocks:
+      results = [ pool.apply_async(check_pedigrees,(task,)) for peds,task in tasks ]
+      pending.append( (block,tasks,results) )
 
-    for child in children:
-      cgenos = genos[child]
+      if len(pending)>2:
+        block,tasks,results = pending.popleft()
+        yield block,merge_results(pedigrees, tasks, [ r.get() for r in results ])
 
-      # if parent is fixed, check the genotype against each child
-      if len(pgenos) == 1:
-        pgeno = getitem(pgenos)
-        eliminate_inconsistency(pgeno,cgenos)
+    while pending:
+      block,tasks,results = pending.popleft()
+      yield block,merge_results(pedigrees, tasks, [ r.get() for r in results ])
 
-      # if child is fixed, check its genotypes against each parent
-      elif len(cgenos) == 1:
-        cgeno = getitem(cgenos)
-        eliminate_inconsistency(cgeno,pgenos)
+  finally:
+    pool.terminate()
 
 
-def invert_dict(errbyloc,simple=True):
-  '''
-  Invert a dict
-  '''
-  errbyped = defaultdict(set)
-  for locus,fams in errbyloc.iteritems():
-    if fams:
-      for inds in fams:
-        if simple:
-          fam=getitem(inds)
-          errbyped[inds].add(locus)
-        else:
-          for ind in inds:
-            errbyped[ind].add(locus)
-  return errbyped
-
-
-def count_by_family(errdict):
-  '''
-  Convert error count by individual to by family
-  '''
-  newdict = defaultdict(set)
+def mask_genotypes(model, mask, cache):
+  key = model,mask
+  genos = cache.get(key)
 
-  for key,valset in errdict.iteritems():
-    for vals in valset:
-      for val in vals:
-        newdict[key].add(val.split('_')[0])
+  if genos is None:
+    genos = cache[key] = ','.join(''.join(a or '' for a in g)
+                                  for i,g in enumerate(model.genotypes[1:]) if mask&(1<<i))
 
-  return newdict
+  return genos
 
 
-def concat_element(dataset):
+class EliminationErrors(object):
   '''
-  Format a set of tuples into a list
+  Accumulate genotype elimination errors by locus, pedigree and individual
   '''
-  return ';'.join(' '.join(d) for d in dataset)
+  def __init__(self):
+    self.loci     = []
+    self.errors1  = defaultdict(list)
+    self.errors2  = defaultdict(list)
+    self.peds1    = defaultdict(set)
+    self.peds2    = defaultdict(set)
+    self.peds3    = defaultdict(set)
+    self.pedlocus = defaultdict(lambda: (set(),set(),set()))
+    self.indlocus = defaultdict(lambda: (set(),set()))
+    self.pedinds  = defaultdict(set)
 
+  def update(self, block, ped, level1, level2, inconsistent):
+    members  = ped.members
+    bad      = set()
+    pedlocus = self.pedlocus[ped.name]
 
-def make_errbyloc3(errbyloc,errbylocf1,errbylocf2):
-  '''
-  Retrieve level 3 errors by subtracting level 1 and 2 errors from the total errors
-  '''
-  # FIXME: This used to not copy.  Who knows what was intended.
-  errbyloc3=errbyloc.copy()
-  for key,vals in errbyloc3.iteritems():
-    # FIXME: Is this guaranteed to be non-negative?
-    errbyloc3[key] -= errbylocf2.get(key,0) + errbylocf1.get(key,0)
-  return errbyloc3
+    for i,p,c in level1:
+      lname = block[i][0]
+      self.errors1[lname].append( (members[p],members[c]) )
+      self.peds1[lname].add(ped.name)
+      pedlocus[0].add(lname)
+      for m in (p,c):
+        self.indlocus[members[m]][0].add(lname)
+        self.pedinds[ped.name].add(members[m])
+      bad.add(i)
 
+    for i,p1,p2,c in level2:
+      lname = block[i][0]
+      self.errors2[lname].append( (members[p1],members[p2],members[c]) )
+      self.peds2[lname].add(ped.name)
+      pedlocus[1].add(lname)
+      for m in (p1,p2,c):
+        self.indlocus[members[m]][1].add(lname)
+        self.pedinds[ped.name].add(members[m])
+      bad.add(i)
+
+    for i in np.flatnonzero(inconsistent).tolist():
+      if i not in bad:
+        lname = block[i][0]
+        self.peds3[lname].add(ped.name)
+        pedlocus[2].add(lname)
+
+  def update_loci(self, block):
+    for lname,genos in block:
+      if lname in self.peds1 or lname in self.peds2 or lname in self.peds3:
+        self.loci.append(lname)
+
+  def write_loci(self, locsum, locdet):
+    outs = output_file(locsum,errbylochead1,errbylochead2) if locsum else None
+    outd = output_file(locdet,errbylochead1,errbylochead2) if locdet else None
+
+    for lname in self.loci:
+      errors1 = self.errors1.get(lname,[])
+      errors2 = self.errors2.get(lname,[])
+      peds1   = sorted(self.peds1.get(lname,[]))
+      peds2   = sorted(self.peds2.get(lname,[]))
+      peds3   = sorted(self.peds3.get(lname,[]))
+
+      if outs:
+        outs.writerow([lname,len(errors1),len(peds1),len(errors2),len(peds2),len(peds3)])
+
+      if outd:
+        outd.writerow([lname,concat_element(errors1),';'.join(peds1),
+                             concat_element(errors2),';'.join(peds2),';'.join(peds3)])
+
+  def write_pedigrees(self, pedigrees, pedsum, peddet):
+    outs = output_file(pedsum,errbypedhead) if pedsum else None
+    outd = output_file(peddet,errbypedhead) if peddet else None
+
+    for ped in pedigrees:
+      if ped.name not in self.pedlocus:
+        continue
 
-def emit_errbyloc(locus,errbyloc1,errbylocf1,errbyloc2,errbylocf2,errbyloc3):
-  '''
-  Output genotype errors by locus
-  '''
-  dind1,dfam1,dind2,dfam2,dfam3='','','','',''
-  sind1,sfam1,sind2,sfam2,sfam3=0,0,0,0,0
-
-  if locus in errbyloc1:
-    dind1=concat_element(errbyloc1[locus])
-    dfam1=';'.join(errbylocf1[locus])
-    sind1=len(errbyloc1[locus])
-    sfam1=len(errbylocf1[locus])
+      loci = self.pedlocus[ped.name]
 
-  if locus in errbyloc2:
-    dind2=concat_element(errbyloc2[locus])
-    dfam2=';'.join(errbylocf2[locus])
-    sind2=len(errbyloc2[locus])
-    sfam2=len(errbyloc2[locus])
+      if outs:
+        outs.writerow([ped.name,'']+[ len(l) for l in loci ])
+      if outd:
+        outd.writerow([ped.name,'']+[ ';'.join(sorted(l)) for l in loci ])
 
-  if locus in errbyloc3:
-    dfam3=';'.join(errbyloc3[locus])
-    sfam3=len(errbyloc3[locus])
+      for ind in ped.members:
+        if ind not in self.pedinds[ped.name]:
+          continue
 
-  rowd=[locus,dind1,dfam1,dind2,dfam2,dfam3]
-  rows=[locus,sind1,sfam1,sind2,sfam2,sfam3]
+        loci = self.indlocus[ind]
 
-  return rowd,rows
+        if outs:
+          outs.writerow(['',ind]+[ len(l) for l in loci ]+[''])
+        if outd:
+          outd.writerow(['',ind]+[ ';'.join(sorted(l)) for l in loci ]+[''])
 
 
-def emit_errbyfam(fam,errbypedf1,errbypedf2,errbyped3):
-  '''
-  Output genotype errors by family
-  '''
-  derrf1,derrf2,derrf3='','',''
-  serrf1,serrf2,serrf3=0,0,0
-  if fam in errbypedf1:
-    derrf1=';'.join(errbypedf1[fam])
-    serrf1=len(errbypedf1[fam])
-  if fam in errbypedf2:
-    derrf2=';'.join(errbypedf2[fam])
-    serrf2=len(errbypedf2[fam])
-  if fam in errbyped3:
-    derrf3=';'.join(errbyped3[fam])
-    serrf3=len(errbyped3[fam])
-  rowd=[fam,'',derrf1,derrf2,derrf3]
-  rows=[fam,'',serrf1,serrf2,serrf3]
-  return rowd,rows
-
-
-def emit_errbyind(ind,errbyped1,errbyped2):
+def concat_element(dataset):
   '''
-  Output genotype errors by individual
+  Format a sequence of tuples into a string
   '''
-  derr1,derr2='',''
-  serr1,serr2=0,0
-  if ind in errbyped1:
-    derr1=';'.join(errbyped1[ind])
-    serr1=len(errbyped1[ind])
-  if ind in errbyped2:
-    derr2=';'.join(errbyped2[ind])
-    serr2=len(errbyped2[ind])
-  rowd=['',ind,derr1,derr2,'']
-  rows=['',ind,serr1,serr2,'']
-  return rowd,rows
+  return ';'.join(' '.join(d) for d in dataset)
 
 
 def output_file(filename,*headers):
@@ -631,53 +596,40 @@ def main():
   genos = load_genostream(options.genotypes,format=options.informat,
                           genorepr=options.ingenorepr,
                           genome=options.loci,
-                          phenome=options.pedigree).as_ldat()
+                          phenome=options.pedigree,
+                          hyphen=sys.stdin).as_ldat()
+
+  pedigrees = build_pedigrees(genos.samples, genos.phenome)
+
+  if not pedigrees:
+    sys.stderr.write('[WARNING] No nuclear families found\n')
 
+  outdetails = None
   if options.errdetails:
-    outdetails = output_file(options.errdetails,['']+genos.samples)
-
-  nfams,numoffams = build_nuclear_families(genos)
-
-  errbyloc1,errbyloc2,errbyloc=genotype_elimination(nfams,genos,genos.samples,outdetails)
-  errbylocf1=count_by_family(errbyloc1)
-  errbylocf2=count_by_family(errbyloc2)
-
-  errbyloc3=make_errbyloc3(errbyloc,errbylocf1,errbylocf2)
-
-  # Output genotype errors by locus
-  if options.locdet and options.locsum:
-    outd = output_file(options.locdet,errbylochead1,errbylochead2)
-    outs = output_file(options.locsum,errbylochead1,errbylochead2)
-    for locus in sorted(set(chain(errbyloc1,errbyloc2,errbyloc3))):
-      rowd,rows=emit_errbyloc(locus,errbyloc1,errbylocf1,errbyloc2,errbylocf2,errbyloc3)
-      outd.writerow(rowd)
-      outs.writerow(rows)
-
-  # Invert dictionary from by locus to by family
-  errbyped1  = invert_dict(errbyloc1,False)
-  errbyped2  = invert_dict(errbyloc2,False)
-  errbyped3  = invert_dict(errbyloc3)
-  errbypedf1 = invert_dict(errbylocf1)
-  errbypedf2 = invert_dict(errbylocf2)
-
-  # Output genotype errors by pedigree
-  if options.peddet and options.pedsum:
-    outd = output_file(options.peddet,errbypedhead)
-    outs = output_file(options.pedsum,errbypedhead)
-
-    famdict={}
-    for ind in sorted(set(chain(errbyped1,errbyped2))):
-      fam=ind.split('_')[0]
-      if fam not in famdict:
-        famdict[fam]=1
-        rowd,rows=emit_errbyfam(fam,errbypedf1,errbypedf2,errbyped3)
-        outd.writerow(rowd)
-        outs.writerow(rows)
-
-      rowd,rows=emit_errbyind(ind,errbyped1,errbyped2)
-
-      outd.writerow(rowd)
-      outs.writerow(rows)
+    members    = [ m for ped in pedigrees for m in ped.members ]
+    outdetails = output_file(options.errdetails,['']+members)
+    genocache  = {}
+
+  errors  = EliminationErrors()
+  results = genotype_elimination(genos, pedigrees, options.blocksize, options.jobs,
+                                 keep_masks=outdetails is not None)
+
+  for block,pedresults in results:
+    for ped,(level1,level2,inconsistent,masks) in pedresults:
+      errors.update(block, ped, level1, level2, inconsistent)
+
+    errors.update_loci(block)
+
+    if outdetails:
+      rows = [ [lname] for lname,g in block ]
+      for ped,(level1,level2,inconsistent,masks) in pedresults:
+        for row,(lname,g),mask in izip(rows,block,masks.T.tolist()):
+          model = g.descriptor[0]
+          row.extend( mask_genotypes(model,m,genocache) for m in mask )
+      outdetails.writerows(rows)
+
+  errors.write_loci(options.locsum, options.locdet)
+  errors.write_pedigrees(pedigrees, options.pedsum, options.peddet)
 
 
 def _test():
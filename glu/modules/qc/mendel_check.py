@@ -12,9 +12,49 @@ import sys
 from   operator  import itemgetter
 from   itertools import repeat,izip
 
+import numpy as np
+
 from   glu.lib.utils             import percent
 from   glu.lib.fileutils         import table_writer
 from   glu.lib.genolib           import load_genostream,geno_options
+from   glu.lib.genolib.genoarray import genotype_indices
+
+
+# Codes of trio_code_table entries
+TRIO_UNINFORMATIVE,TRIO_CONCORDANT,TRIO_DISCORDANT = 0,1,2
+
+
+def trio_concordance(p1, p2, c):
+  '''
+  Return True if the genotype of a child is consistent with Mendelian
+  inheritance from the genotypes of its parents, False if it is not and
+  None if the genotypes are not informative.
+
+  >>> from glu.lib.genolib.genoarray import build_model
+  >>> NN,AA,AB,BB = build_model('AB').genotypes
+  >>> trio_concordance(AA,NN,AB)
+  True
+  >>> trio_concordance(BB,AA,AA)
+  False
+  >>> trio_concordance(NN,NN,AB) is None
+  True
+  '''
+  # Must have informative child and at least one parent genotype
+  if not c or not (p1 or p2):
+    return None
+
+  # If ensure that p1 is not missing
+  if not p1 and p2:
+    p1,p2 = p2,p1
+
+  a,b = c
+
+  # Check Parent1 -> Offspring case
+  if p1 and not p2:
+    return a in p1 or b in p1
+
+  # Check Parent1,Parent2 -> Offspring case
+  return (a in p1 and b in p2) or (b in p1 and a in p2)
 
 
 def parent_offspring_concordance(parent1, parent2, child, locusstats):
@@ -99,33 +139,126 @@ def parent_offspring_concordance(parent1, parent2, child, locusstats):
 
   concordant = comparisons = 0
   for p1,p2,c,locusstat in izip(parent1,parent2,child,locusstats):
-    # Must have informative child and at least one parent genotype
-    if not c or not (p1 or p2):
+    result = trio_concordance(p1,p2,c)
+
+    if result is None:
       continue
 
     locusstat[1] += 1
     comparisons  += 1
 
-    # If ensure that p1 is not missing
-    if not p1 and p2:
-      p1,p2 = p2,p1
-
-    a,b = c
-
-    # Check Parent1 -> Offspring case
-    if p1 and not p2:
-      if a in p1 or b in p1:
-        concordant   += 1
-        locusstat[0] += 1
-
-    # Check Parent1,Parent2 -> Offspring case
-    elif (a in p1 and b in p2) or (b in p1 and a in p2):
+    if result:
       concordant   += 1
       locusstat[0] += 1
 
   return concordant,comparisons
 
 
+def trio_code_table(model, size=None):
+  '''
+  Return a lookup table of trio_concordance results for all parent1, parent2
+  and child genotype indices of a model, encoded as TRIO_UNINFORMATIVE,
+  TRIO_CONCORDANT or TRIO_DISCORDANT.  The table may be padded to a given
+  number of genotypes.
+
+  >>> from glu.lib.genolib.genoarray import build_model
+  >>> model = build_model('AB',max_alleles=2)
+  >>> NN,AA,AB,BB = [ g.index for g in model.genotypes ]
+  >>> table = trio_code_table(model)
+  >>> table.shape
+  (4, 4, 4)
+  >>> table[AA,BB,AB],table[AA,AA,BB],table[NN,NN,AB],table[AA,NN,AB]
+  (1, 2, 0, 1)
+  '''
+  genos = model.genotypes
+  n     = len(genos)
+  size  = max(size or n, n)
+  table = np.zeros( (size,size,size), dtype=np.uint8 )
+
+  for i,p1 in enumerate(genos):
+    for j,p2 in enumerate(genos):
+      for k,c in enumerate(genos):
+        result = trio_concordance(p1,p2,c)
+        if result is not None:
+          table[i,j,k] = TRIO_CONCORDANT if result else TRIO_DISCORDANT
+
+  return table
+
+
+class TrioChecker(object):
+  '''
+  Vectorized Mendelian concordance checks for trios over a sequence of
+  loci.  A trio_code_table is built once for each distinct model and the
+  tables are stacked, so that the results for all loci of a trio are
+  obtained by a single gather from the genotype indices of the parents and
+  child.
+
+  >>> from glu.lib.genolib.genoarray import build_model
+  >>> model = build_model('AB',max_alleles=2)
+  >>> NN,AA,AB,BB = [ g.index for g in model.genotypes ]
+  >>> checker = TrioChecker([model]*4)
+  >>> checker.check([AA,AA,BB,NN],[BB,NN,AA,NN],[AB,BB,AB,AB])
+  (2, 3)
+  >>> checker.locus_concordant.tolist(),checker.locus_comparisons.tolist()
+  ([1, 0, 1, 0], [1, 1, 1, 0])
+  '''
+  def __init__(self, models):
+    index  = {}
+    unique = []
+    for model in models:
+      if model not in index:
+        index[model] = len(unique)
+        unique.append(model)
+
+    size   = max(len(model.genotypes) for model in unique) if unique else 1
+    tables = [ trio_code_table(model,size) for model in unique ] or [np.zeros( (1,1,1), dtype=np.uint8 )]
+
+    self.size   = size
+    self.tables = np.array(tables).ravel()
+    self.base   = np.array([ index[model] for model in models ], dtype=np.intp)*size**3
+
+    self.locus_concordant  = np.zeros(len(models), dtype=int)
+    self.locus_comparisons = np.zeros(len(models), dtype=int)
+
+  def codes(self, parent1, parent2, child):
+    '''
+    Return trio codes for each locus given arrays of genotype indices
+    '''
+    size    = self.size
+    parent1 = np.asarray(parent1, dtype=np.intp)
+    parent2 = np.asarray(parent2, dtype=np.intp)
+    child   = np.asarray(child,   dtype=np.intp)
+    return self.tables[self.base + (parent1*size + parent2)*size + child]
+
+  def check(self, parent1, parent2, child):
+    '''
+    Check a trio given arrays of genotype indices, update locus statistics
+    and return the number of concordant and informative loci
+    '''
+    codes       = self.codes(parent1,parent2,child)
+    concordant  = codes==TRIO_CONCORDANT
+    comparisons = codes!=TRIO_UNINFORMATIVE
+
+    self.locus_concordant  += concordant
+    self.locus_comparisons += comparisons
+
+    return int(concordant.sum()),int(comparisons.sum())
+
+
+def write_mendel_stats(samplestats, locusstats, output, locout=None):
+  '''
+  Write Mendelian concordance by sample and optionally by locus
+  '''
+  sampleout = table_writer(output,hyphen=sys.stdout)
+  sampleout.writerow( ['CHILD','PARENT1','PARENT2','CONCORDANT','TOTAL','RATE'] )
+  sampleout.writerows(samplestats)
+
+  if locout:
+    locout = table_writer(locout)
+    locout.writerow( ['LOCUS','CONCORDANT','TOTAL','RATE'] )
+    locout.writerows(locusstats)
+
+
 def option_parser():
   from glu.lib.glu_argparse import GLUArgumentParser
 
@@ -169,32 +302,32 @@ def main():
 
   # Initialize statistics
   samplestats = []
-  locusstats  = [ [0,0] for i in xrange(len(genos.loci)) ]
+  checker     = TrioChecker([ genos.genome.get_model(locus) for locus in genos.loci ])
 
-  # Check all parent child relationships
+  # Check all parent child relationships.  As with
+  # parent_offspring_concordance, both parents must be genotyped.
   for child in samples:
     phenos  = genos.phenome.get_phenos(child)
     parent1 = phenos.parent1
     parent2 = phenos.parent2
 
-    i,n = parent_offspring_concordance(samples.get(parent1), samples.get(parent2),
-                                       samples.get(child), locusstats)
+    if parent1 not in samples or parent2 not in samples:
+      continue
+
+    i,n = checker.check(genotype_indices(samples[parent1]),
+                        genotype_indices(samples[parent2]),
+                        genotype_indices(samples[child]))
     if i!=n:
       samplestats.append( (child,parent1,parent2,i,n,percent(i,n)) )
 
   # Build and sort resulting statistics
-  locusstats = sorted( (locus,i,n,percent(i,n)) for locus,(i,n) in zip(genos.loci,locusstats) )
+  locusstats = sorted( (locus,i,n,percent(i,n))
+                       for locus,i,n in izip(genos.loci,checker.locus_concordant.tolist(),
+                                                        checker.locus_comparisons.tolist()) )
   samplestats.sort(key=itemgetter(5))
 
   # Produce output
-  sampleout = table_writer(options.output,hyphen=sys.stdout)
-  sampleout.writerow( ['CHILD','PARENT1','PARENT2','CONCORDANT','TOTAL','RATE'] )
-  sampleout.writerows(samplestats)
-
-  if options.locout:
-    locout = table_writer(options.locout)
-    locout.writerow( ['LOCUS','CONCORDANT','TOTAL','RATE'] )
-    locout.writerows(locusstats)
+  write_mendel_stats(samplestats, locusstats, options.output, options.locout)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+__gluindex__  = True
+__abstract__  = 'Compute summary, HWP, Mendelian inheritance and plate QC statistics in a single pass'
+__copyright__ = 'Copyright (c) 2007-2009, BioInformed LLC and the U.S. Department of Health & Human Services. Funded by NCI under Contract N01-CO-12400.'
+__license__   = 'See GLU license for terms by running: glu license'
+__revision__  = '$Id$'
+
+
+import sys
+
+from   operator                  import itemgetter
+from   itertools                 import izip
+
+import numpy as np
+
+from   glu.lib.utils             import percent, chunk
+from   glu.lib.fileutils         import list_reader, map_reader, table_writer
+from   glu.lib.genolib           import load_genostream, geno_options
+from   glu.lib.genolib.genoarray import GenotypeArray, build_model, build_descr, locus_summary
+
+from   glu.modules.qc.summary      import write_summary, locus_hwp_counts, batch_hwps
+from   glu.modules.qc.mendel_check import trio_code_table, write_mendel_stats, \
+                                          TRIO_UNINFORMATIVE, TRIO_CONCORDANT
+
+
+# Accumulators of QC statistics are updated with each locus of an ldat
+# genotype stream.  They must be able to create empty copies of themselves
+# and to merge results, so that blocks of loci can be processed in parallel
+# and combined in input order.  Each accumulator provides:
+#
+#   empty()               return a new accumulator with the same
+#                         configuration and no accumulated results
+#   update(lname,genos)   add the statistics for one locus
+#   merge(other)          append the results of an accumulator that was
+#                         updated with the loci following those of this one
+#
+# and, when it produces output, write(genos,options) to write the
+# accumulated results once all loci have been processed.
+
+
+class SummaryAccumulator(object):
+  '''
+  Genotype counts by locus and genotype category counts by sample, as
+  computed by qc.summary
+  '''
+  def __init__(self, samples):
+    self.samples       = samples
+    self.loci          = []
+    self.locus_counts  = []
+    self.sample_counts = None
+
+  def empty(self):
+    return SummaryAccumulator(self.samples)
+
+  def update(self, lname, genos):
+    locus_count,self.sample_counts = locus_summary(genos,self.sample_counts)
+    self.loci.append(lname)
+    self.locus_counts.append(locus_count)
+
+  def merge(self, other):
+    self.loci.extend(other.loci)
+    self.locus_counts.extend(other.locus_counts)
+
+    if self.sample_counts is None:
+      self.sample_counts  = other.sample_counts
+    elif other.sample_counts is not None:
+      self.sample_counts += other.sample_counts
+
+  def write(self, genos, options, hwps=None):
+    sample_counts = self.sample_counts
+    if sample_counts is None:
+      sample_counts = []
+
+    write_summary(genos.genome,self.loci,self.locus_counts,self.samples,sample_counts,
+                  options,hwps=hwps)
+
+
+class HWPAccumulator(object):
+  '''
+  Genotype counts for Hardy-Weinberg proportion tests by locus.  The tests
+  are performed as a single batch once all loci have been counted.
+  '''
+  def __init__(self):
+    self.loci   = []
+    self.counts = []
+
+  def empty(self):
+    return HWPAccumulator()
+
+  def update(self, lname, genos):
+    self.loci.append(lname)
+    self.counts.append(locus_hwp_counts(genos.descriptor[0],genos.counts()))
+
+  def merge(self, other):
+    self.loci.extend(other.loci)
+    self.counts.extend(other.counts)
+
+  def hwps(self):
+    return batch_hwps(self.loci,self.counts)
+
+
+class MendelAccumulator(object):
+  '''
+  Mendelian concordance by parent-offspring trio and by locus, as computed
+  by qc.mendel_check.  All trios are checked at once for each locus by
+  gathering from a trio_code_table for the locus model.
+  '''
+  def __init__(self, samples, phenome):
+    self.trios = []
+
+    # As in qc.mendel_check, only children with both parents genotyped are
+    # compared
+    index = dict( (sample,i) for i,sample in enumerate(samples) )
+    for child in samples:
+      phenos  = phenome.get_phenos(child)
+      parent1 = phenos.parent1
+      parent2 = phenos.parent2
+      if parent1 in index and parent2 in index:
+        self.trios.append( (child,parent1,parent2,index[child],index[parent1],index[parent2]) )
+
+    self.init_stats()
+
+  def init_stats(self):
+    self.child_index   = np.array([ t[3] for t in self.trios ], dtype=int)
+    self.parent1_index = np.array([ t[4] for t in self.trios ], dtype=int)
+    self.parent2_index = np.array([ t[5] for t in self.trios ], dtype=int)
+    self.triostats     = np.zeros( (len(self.trios),2), dtype=int )
+    self.locusstats    = []
+
+    # Lookup tables by model are not picklable and are built on demand
+    self.tables        = {}
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['tables'] = {}
+    return state
+
+  def empty(self):
+    other       = MendelAccumulator.__new__(MendelAccumulator)
+    other.trios = self.trios
+    other.init_stats()
+    return other
+
+  def update(self, lname, genos):
+    model = genos.descriptor[0]
+    table = self.tables.get(model)
+
+    if table is None:
+      table = self.tables[model] = trio_code_table(model)
+
+    indices     = genos.indices()
+    codes       = table[indices[self.parent1_index],indices[self.parent2_index],indices[self.child_index]]
+    concordant  = codes==TRIO_CONCORDANT
+    comparisons = codes!=TRIO_UNINFORMATIVE
+
+    self.triostats[:,0] += concordant
+    self.triostats[:,1] += comparisons
+    self.locusstats.append( (lname,int(concordant.sum()),int(comparisons.sum())) )
+
+  def merge(self, other):
+    self.triostats += other.triostats
+    self.locusstats.extend(other.locusstats)
+
+  def write(self, genos, options):
+    samplestats = [ (child,parent1,parent2,i,n,percent(i,n))
+                    for (child,parent1,parent2,c,p1,p2),(i,n) in izip(self.trios,self.triostats.tolist())
+                    if i!=n ]
+    samplestats.sort(key=itemgetter(5))
+
+    locusstats  = sorted( (lname,i,n,percent(i,n)) for lname,i,n in self.locusstats )
+
+    write_mendel_stats(samplestats, locusstats, options.mendelout, options.mendellocusout)
+
+
+class PlateAccumulator(object):
+  '''
+  Missing genotype counts by plate
+  '''
+  def __init__(self, samples, platemap):
+    plates            = [ platemap.get(sample,'') for sample in samples ]
+    self.plates       = sorted(set(plates))
+    index             = dict( (plate,i) for i,plate in enumerate(self.plates) )
+    self.plate_index  = np.array([ index[plate] for plate in plates ], dtype=int)
+    self.plate_sizes  = np.bincount(self.plate_index, minlength=len(self.plates))
+    self.missing      = np.zeros(len(self.plates), dtype=int)
+    self.loci         = 0
+
+  def empty(self):
+    other         = PlateAccumulator.__new__(PlateAccumulator)
+    other.__dict__.update(self.__dict__)
+    other.missing = np.zeros_like(self.missing)
+    other.loci    = 0
+    return other
+
+  def update(self, lname, genos):
+    missing = self.plate_index[genos.indices()==0]
+    self.missing += np.bincount(missing, minlength=len(self.plates))
+    self.loci    += 1
+
+  def merge(self, other):
+    self.missing += other.missing
+    self.loci    += other.loci
+
+  def write(self, genos, options):
+    out = table_writer(options.plateout,hyphen=sys.stdout)
+    out.writerow(['PLATE','SAMPLES','MISSING_COUNT','TOTAL','MISSING_RATE'])
+
+    for plate,size,missing in izip(self.plates,self.plate_sizes.tolist(),self.missing.tolist()):
+      total = size*self.loci
+      out.writerow([plate or 'UNKNOWN',size,missing,total,missing/total if total else ''])
+
+
+def encode_block(block):
+  '''
+  Encode a block of (locus name, genotype array) pairs as picklable
+  genotype indices and model genotypes for transfer to worker processes
+  '''
+  encoded = []
+  for lname,genos in block:
+    model = genos.descriptor[0]
+    encoded.append( (lname,tuple(tuple(g) for g in model.genotypes[1:]),model.max_alleles,
+                           model.allow_hemizygote,genos.indices()) )
+  return encoded
+
+
+def decode_block(encoded):
+  '''
+  Rebuild the genotype arrays of a block encoded by encode_block
+
+  >>> from glu.lib.genolib.genoarray import build_model, build_descr, GenotypeArray
+  >>> model = build_model('AB',max_alleles=2)
+  >>> genos = GenotypeArray(build_descr(model,3),[('A','A'),('A','B'),(None,None)])
+  >>> [ (lname,g.tolist()) for lname,g in decode_block(encode_block([('l1',genos)])) ]
+  [('l1', [('A', 'A'), ('A', 'B'), (None, None)])]
+  '''
+  block  = []
+  descrs = {}
+
+  for lname,genotypes,max_alleles,allow_hemizygote,indices in encoded:
+    key   = genotypes,max_alleles,allow_hemizygote,len(indices)
+    descr = descrs.get(key)
+
+    if descr is None:
+      model = build_model(genotypes=genotypes,max_alleles=max_alleles,
+                          allow_hemizygote=allow_hemizygote)
+      descr = descrs[key] = build_descr(model,len(indices))
+
+    model = descr[0]
+    genos = GenotypeArray(descr,[ model.genotypes[i] for i in indices ])
+    block.append( (lname,genos) )
+
+  return block
+
+
+def update_accumulators(accumulators, block):
+  for lname,genos in block:
+    for accumulator in accumulators:
+      accumulator.update(lname,genos)
+
+
+# Per-process accumulator templates used by worker processes
+_worker_accumulators = None
+
+
+def _init_worker(accumulators):
+  global _worker_accumulators
+  _worker_accumulators = accumulators
+
+
+def _process_block(encoded):
+  accumulators = [ accumulator.empty() for accumulator in _worker_accumulators ]
+  update_accumulators(accumulators, decode_block(encoded))
+  return accumulators
+
+
+def run_accumulators(genos, accumulators, blocksize=100, jobs=1):
+  '''
+  Update accumulators with each locus of an ldat genotype stream, reading
+  the stream only once.  When jobs>1, blocks of loci are processed by a
+  pool of worker processes and merged in input order.
+  '''
+  blocks = chunk(genos,blocksize)
+
+  if jobs<=1:
+    for block in blocks:
+      update_accumulators(accumulators, block)
+    return
+
+  from multiprocessing import Pool
+
+  pool = Pool(jobs, _init_worker, ([ accumulator.empty() for accumulator in accumulators ],))
+
+  try:
+    for results in pool.imap(_process_block, (encode_block(block) for block in blocks)):
+      for accumulator,result in izip(accumulators,results):
+        accumulator.merge(result)
+
+  finally:
+    pool.terminate()
+
+
+def option_parser():
+  from glu.lib.glu_argparse import GLUArgumentParser
+
+  parser = GLUArgumentParser(description=__abstract__)
+
+  parser.add_argument('genotypes', help='Input genotype file')
+
+  geno_options(parser,input=True,filter=True)
+
+  parser.add_argument('--hwp', action='store_true',
+                    help='Test for deviation from Hardy-Weinberg proportions')
+  parser.add_argument('-s', '--summaryout', metavar='FILE',
+                    help='Summary output file name')
+  parser.add_argument('-o', '--locusout', metavar='FILE',
+                    help='Locus summary output table file name')
+  parser.add_argument('-O', '--sampleout', metavar='FILE',
+                    help='Sample summary output table file name')
+  parser.add_argument('--mendelout', metavar='FILE',
+                    help='Output Mendelian concordance by sample')
+  parser.add_argument('--mendellocusout', metavar='FILE',
+                    help='Output Mendelian concordance by locus')
+  parser.add_argument('--platemap', metavar='FILE',
+                    help='Mapping from sample name to plate')
+  parser.add_argument('--plateout', metavar='FILE',
+                    help='Output missing genotype rates by plate (requires --platemap)')
+  parser.add_argument('--blocksize', metavar='N', type=int, default=100,
+                    help='Number of loci processed per block (default=100)')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Number of worker processes (default=1)')
+  return parser
+
+
+def main():
+  parser  = option_parser()
+  options = parser.parse_args()
+
+  if options.plateout and not options.platemap:
+    parser.error('--plateout requires --platemap')
+
+  if options.hwp and not options.locusout:
+    parser.error('--hwp requires --locusout')
+
+  # Include lists are used to communicate the universe of attempted samples/loci
+  # Any not observed in the genotype data are classified as "missing"
+  includeloci    = set(list_reader(options.includeloci))    if options.includeloci    else None
+  includesamples = set(list_reader(options.includesamples)) if options.includesamples else None
+
+  options.includeloci    = includeloci
+  options.includesamples = includesamples
+
+  genos = load_genostream(options.genotypes,format=options.informat,genorepr=options.ingenorepr,
+                          genome=options.loci,phenome=options.pedigree,
+                          transform=options, hyphen=sys.stdin).as_ldat()
+
+  samples = genos.samples
+  summary = hwp = mendel = plate = None
+
+  if options.summaryout or options.locusout or options.sampleout:
+    summary = SummaryAccumulator(samples)
+  if options.hwp:
+    hwp     = HWPAccumulator()
+  if options.mendelout or options.mendellocusout:
+    mendel  = MendelAccumulator(samples, genos.phenome)
+  if options.plateout:
+    plate   = PlateAccumulator(samples, map_reader(options.platemap))
+
+  accumulators = [ a for a in (summary,hwp,mendel,plate) if a is not None ]
+
+  if not accumulators:
+    parser.error('No output requested')
+
+  run_accumulators(genos, accumulators, options.blocksize, options.jobs)
+
+  if summary:
+    summary.write(genos, options, hwps=hwp.hwps() if hwp else None)
+
+  if mendel:
+    if not options.mendelout:
+      options.mendelout = '-'
+    mendel.write(genos, options)
+
+  if plate:
+    plate.write(genos, options)
+
+
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
+if __name__=='__main__':
+  _test()
+  main()
@@ -16,8 +16,10 @@ from   itertools                 import izip
 import numpy as np
 
 from   glu.lib.fileutils         import autofile,hyphen,list_reader,table_writer
-from   glu.lib.hwp               import hwp_biallelic
+from   glu.lib.hwp               import hwp_biallelic, hwp_biallelic_batch, biallelic_counts, \
+                                        HWP_EXACT_THRESHOLD
 from   glu.lib.genolib           import load_genostream, geno_options
+from   glu.lib.genolib.io        import load_genostream_summary
 from   glu.lib.genolib.genoarray import locus_summary, sample_summary, \
                                         count_alleles_from_genocounts
 
@@ -46,7 +48,7 @@ def missing_rates(observed_missing,observed,empty,missing):
            rate(observed_missing-empty,  observed-empty) ]
 
 
-def locus_row(lname,locus,counts,empty_samples,missing_samples,compute_hwp):
+def locus_row(lname,locus,counts,empty_samples,missing_samples,compute_hwp,hwp=None):
   model   = locus.model
   m       = len(model.genotypes)
 
@@ -80,12 +82,9 @@ def locus_row(lname,locus,counts,empty_samples,missing_samples,compute_hwp):
   total   = counts.sum()
   rates   = missing_rates(missing,total,empty_samples,missing_samples)
 
-  hwp = ''
-  if compute_hwp:
-    try:
-      hwp = str(hwp_biallelic(model,counts))
-    except ValueError:
-      pass
+  # Use a precomputed HWP p-value, if one is supplied
+  if hwp is None:
+    hwp = locus_hwp(model,counts) if compute_hwp else ''
 
   return [lname,locus.chromosome or '', str(locus.location or ''), locus.strand or '',
                 str(len(alleles)),'|'.join(alleles),'|'.join(str(n) for n in acounts),maf,
@@ -93,6 +92,71 @@ def locus_row(lname,locus,counts,empty_samples,missing_samples,compute_hwp):
                 missing, sum(counts[1:])]+rates+[hwp]
 
 
+def locus_hwp(model,counts):
+  '''
+  Return the HWP p-value for a locus as a string or an empty string if the
+  locus is not biallelic
+  '''
+  try:
+    return str(hwp_biallelic(model,counts))
+  except ValueError:
+    return ''
+
+
+def locus_hwp_counts(model,counts):
+  '''
+  Return the homozygote and heterozygote counts of a locus for HWP testing
+  or None if the locus is not biallelic
+  '''
+  counts = counts[:len(model.genotypes)]
+  try:
+    return biallelic_counts(model,counts)
+  except ValueError:
+    return None
+
+
+def batch_hwps(lnames,hwp_counts):
+  '''
+  Return a dictionary of HWP p-value strings for a sequence of locus names
+  and counts computed by locus_hwp_counts, testing all loci as a batch.
+
+  The strings are identical to those of locus_hwp: the exact test returns
+  numpy floats for numpy counts and the asymptotic test returns Python
+  floats, which str formats with different precision.
+
+  >>> from glu.lib.genolib.genoarray import build_model
+  >>> model  = build_model('AB',max_alleles=2)
+  >>> counts = [np.array([0,n1,n2,n3]) for n1,n2,n3 in [(57,184,155),(3,47,5),(2600,5000,2400),(0,0,0)]]
+  >>> loci   = ['l1','l2','l3','l4']
+  >>> hwps   = batch_hwps(loci,[ locus_hwp_counts(model,c) for c in counts ])
+  >>> [ hwps[l] for l in loci ] == [ locus_hwp(model,c) for c in counts ]
+  True
+  >>> [ hwps[l] for l in loci ]
+  ['0.8310279634370558', '1.1629848615126043e-07', '0.96808036525', '1.0']
+  '''
+  hwps   = dict.fromkeys(lnames,'')
+  tested = [ (lname,c) for lname,c in izip(lnames,hwp_counts) if c is not None ]
+
+  if tested:
+    hom1,het,hom2 = np.array([ c for lname,c in tested ],dtype=int).T
+    pvalues       = hwp_biallelic_batch(hom1,het,hom2)
+    exact         = (2*np.minimum(hom1,hom2)+het<HWP_EXACT_THRESHOLD).tolist()
+
+    for (lname,c),p,e in izip(tested,pvalues,exact):
+      hwps[lname] = str(p) if e else str(float(p))
+
+  return hwps
+
+
+def locus_hwps(genome,loci,locus_counts):
+  '''
+  Return a dictionary of HWP p-value strings for all loci
+  '''
+  hwp_counts = [ locus_hwp_counts(genome.get_locus(lname).model,counts)
+                 for lname,counts in izip(loci,locus_counts) ]
+  return batch_hwps(loci,hwp_counts)
+
+
 def locus_total(counts,empty_samples,missing_samples):
   missing = counts[0]
   total   = counts.sum()
@@ -164,43 +228,15 @@ def format_rate(numerator, denominator):
   return (numerator,denominator,rate)
 
 
-def option_parser():
-  from glu.lib.glu_argparse import GLUArgumentParser
-
-  parser = GLUArgumentParser(description=__abstract__)
-
-  parser.add_argument('genotypes', help='Input genotype file')
-
-  geno_options(parser,input=True,filter=True)
-
-  parser.add_argument('--hwp', action='store_true',
-                    help='Test for deviation from Hardy-Weinberg proportions')
-  parser.add_argument('-s', '--summaryout', metavar='FILE', default='-',
-                    help='Summary output file name')
-  parser.add_argument('-o', '--locusout', metavar='FILE',
-                    help='Locus output table file name')
-  parser.add_argument('-O', '--sampleout', metavar='FILE',
-                    help='Sample output table file name')
-  return parser
-
+def write_summary(genome,loci,locus_counts,samples,sample_counts,options,hwps=None):
+  '''
+  Write the summary, sample and locus reports requested by options.
+  Precomputed HWP p-values may be supplied as a mapping from locus name to
+  p-value string.
+  '''
+  includeloci    = options.includeloci
+  includesamples = options.includesamples
 
-def main():
-  parser  = option_parser()
-  options = parser.parse_args()
-
-  # Include lists are used to communicate the universe of attempted samples/loci
-  # Any not observed in the genotype data are classified as "missing"
-  includeloci    = set(list_reader(options.includeloci))    if options.includeloci    else None
-  includesamples = set(list_reader(options.includesamples)) if options.includesamples else None
-
-  options.includeloci    = includeloci
-  options.includesamples = includesamples
-
-  genos = load_genostream(options.genotypes,format=options.informat,genorepr=options.ingenorepr,
-                          genome=options.loci,phenome=options.pedigree,
-                          transform=options, hyphen=sys.stdin)
-
-  loci,locus_counts,samples,sample_counts = summarize(genos)
   sample_totals = sum(sample_counts, np.zeros(4))
 
   assert len(loci)*len(samples) == sample_totals.sum()
@@ -253,14 +289,69 @@ def main():
     del sampleout
 
   if options.locusout:
+    if options.hwp and hwps is None:
+      hwps = locus_hwps(genome,loci,locus_counts)
+
     locusout  = table_writer(options.locusout,hyphen=sys.stdout)
     locusout.writerow(LOCUS_HEADER)
     for lname,locus_count in izip(loci,locus_counts):
-      locus = genos.genome.get_locus(lname)
-      locusout.writerow(locus_row(lname,locus,locus_count,empty_samples,missing_samples,options.hwp))
+      locus = genome.get_locus(lname)
+      hwp   = hwps.get(lname,'') if hwps is not None else None
+      locusout.writerow(locus_row(lname,locus,locus_count,empty_samples,missing_samples,options.hwp,hwp))
     locusout.writerow(locus_total(sample_totals,empty_genotypes,phantom_genotypes))
     del locusout
 
 
+def option_parser():
+  from glu.lib.glu_argparse import GLUArgumentParser
+
+  parser = GLUArgumentParser(description=__abstract__)
+
+  parser.add_argument('genotypes', help='Input genotype file')
+
+  geno_options(parser,input=True,filter=True)
+
+  parser.add_argument('--hwp', action='store_true',
+                    help='Test for deviation from Hardy-Weinberg proportions')
+  parser.add_argument('-s', '--summaryout', metavar='FILE', default='-',
+                    help='Summary output file name')
+  parser.add_argument('-o', '--locusout', metavar='FILE',
+                    help='Locus output table file name')
+  parser.add_argument('-O', '--sampleout', metavar='FILE',
+                    help='Sample output table file name')
+  return parser
+
+
+def main():
+  parser  = option_parser()
+  options = parser.parse_args()
+
+  # Include lists are used to communicate the universe of attempted samples/loci
+  # Any not observed in the genotype data are classified as "missing"
+  includeloci    = set(list_reader(options.includeloci))    if options.includeloci    else None
+  includesamples = set(list_reader(options.includesamples)) if options.includesamples else None
+
+  options.includeloci    = includeloci
+  options.includesamples = includesamples
+
+  # Use the summary statistics stored in binary genotype files when they
+  # describe the requested genotypes, avoiding decoding all genotypes
+  summary = load_genostream_summary(options.genotypes,format=options.informat,
+                                    genome=options.loci,transform=options)
+
+  if summary is not None:
+    write_summary(summary.genome,summary.loci,summary.locus_counts,
+                  summary.samples,summary.sample_counts,options)
+    return
+
+  genos = load_genostream(options.genotypes,format=options.informat,genorepr=options.ingenorepr,
+                          genome=options.loci,phenome=options.pedigree,
+                          transform=options, hyphen=sys.stdin)
+
+  loci,locus_counts,samples,sample_counts = summarize(genos)
+
+  write_summary(genos.genome,loci,locus_counts,samples,sample_counts,options)
+
+
 if __name__=='__main__':
   main()
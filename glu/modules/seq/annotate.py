@@ -11,6 +11,7 @@ __revision__  = '$Id$'
 import sys
 
 from   operator                     import itemgetter
+from   collections                  import deque
 
 import pysam
 
@@ -137,7 +138,25 @@ def aa_change(e):
   return '%s->%s' % (e.ref_aa,e.var_aa) if e.ref_aa or e.var_aa else ''
 
 
-def update_vcf_annotation(v, vs, cv, esp, kaviar, refvars, polyphen2, options):
+def annotate_records(vs, records, query):
+  '''
+  Annotate a stream of position-sorted records using the batch annotation
+  interface of VariantAnnotator.  query is a function that returns the
+  (chrom, start, end, variant) to annotate for each record.  Returns a
+  generator of records and their evidence.
+  '''
+  pending = deque()
+
+  def _queries():
+    for record in records:
+      pending.append(record)
+      yield query(record)
+
+  for evidence in vs.annotate_batch(_queries()):
+    yield pending.popleft(),evidence
+
+
+def update_vcf_annotation(v, vs, cv, esp, kaviar, refvars, polyphen2, options, evidence=None):
   new_info = []
 
   if vs:
@@ -147,7 +166,10 @@ def update_vcf_annotation(v, vs, cv, esp, kaviar, refvars, polyphen2, options):
     #return v
 
     # FIXME: Order genes and evidence consistently
-    evidence   = list(vs.annotate(v.chrom, v.start, v.end, v.var[0], nsonly=False))
+    if evidence is None:
+      evidence = vs.annotate(v.chrom, v.start, v.end, v.var[0], nsonly=False)
+
+    evidence   = list(evidence)
     #v.names   = sorted(set(str(v) for e in evidence for v in e.varid_exact)|set(v.names))
     cytoband   = sorted(set(e.cytoband    for e in evidence if e.cytoband))
     genes      = sorted(set(e.gene.symbol for e in evidence if e.gene and e.gene.symbol))
@@ -350,7 +372,7 @@ def update_vcf_annotation(v, vs, cv, esp, kaviar, refvars, polyphen2, options):
 
 
 def annotate_vcf(options):
-  vs       = VariantAnnotator(options.genedb, options.reference)
+  vs       = VariantAnnotator(options.genedb, options.reference, options.annocache)
   vcf      = VCFReader(options.variants,sys.stdin)
   cv       = CGFVariants(options.cgfvariants, options.reference) if options.cgfvariants else None
   esp      = VCFReader(options.esp) if options.esp else None
@@ -420,8 +442,10 @@ def annotate_vcf(options):
 
   out = VCFWriter(options.output, metadata, vcf.samples, options.reference)
 
-  for v in vcf:
-    update_vcf_annotation(v, vs, cv, esp, kaviar, refvars, polyphen2, options)
+  vcf_query = lambda v: (v.chrom, v.start, v.end, v.var[0])
+
+  for v,evidence in annotate_records(vs, vcf, vcf_query):
+    update_vcf_annotation(v, vs, cv, esp, kaviar, refvars, polyphen2, options, evidence)
 
     out.write_locus(v)
 
@@ -634,7 +658,7 @@ def annotate_ion(options):
 
   var_fields = itemgetter(*indices)
 
-  vs       = VariantAnnotator(options.genedb, options.reference)
+  vs       = VariantAnnotator(options.genedb, options.reference, options.annocache)
   cv       = CGFVariants(options.cgfvariants, options.reference) if options.cgfvariants else None
   esp      = VCFReader(options.esp) if options.esp else None
   polyphen2= pysam.Tabixfile(options.polyphen2) if options.polyphen2 else None
@@ -721,7 +745,7 @@ def valid_allele(a):
 
 
 def annotate_mastervar(options):
-  vs       = VariantAnnotator(options.genedb, options.reference)
+  vs       = VariantAnnotator(options.genedb, options.reference, options.annocache)
   cv       = CGFVariants(options.cgfvariants, options.reference) if options.cgfvariants else None
   out      = autofile(hyphen(options.output,sys.stdout),'w')
 
@@ -816,6 +840,10 @@ def option_parser():
                       help='Genedb genome annotation database name or file')
   parser.add_argument('-r', '--reference',   metavar='NAME', required=True,
                       help='Reference genome sequence (FASTA + FAI files)')
+  parser.add_argument('--annocache',   metavar='FILE',
+                      help='Cache of decoded transcripts to use or create, if it does not exist, '
+                           'to speed annotation startup.  The cache is rebuilt if the genedb or '
+                           'reference has changed since it was created')
   parser.add_argument('--cgfvariants',   metavar='NAME',
                       help='CGFvariant database annotation')
   parser.add_argument('--commonscore', metavar='T', type=float, default=0.05,
@@ -13,7 +13,7 @@ import csv
 
 from   collections import defaultdict
 from   operator    import attrgetter, itemgetter
-from   itertools   import groupby
+from   itertools   import groupby, islice, chain
 from   heapq       import heappush, heappop
 
 import numpy as np
@@ -190,6 +190,353 @@ def pileup_stats(target_intervals,options):
   return all_coverage,target_coverage
 
 
+def contig_event_batches(contig_regions,batch_size=65536):
+  '''
+  Generate arrays of the starts and ends of a sequence of intervals
+  provided as (start, end, name) in batches of up to batch_size intervals,
+  to avoid building one Python object per coordinate.
+
+  >>> for starts,ends in contig_event_batches([(1,5,'a'),(None,None,'b'),(2,4,'c')],batch_size=1):
+  ...   print starts.tolist(),ends.tolist()
+  [1] [5]
+  [2] [4]
+  '''
+  regions = ( (start,end) for start,end,name in contig_regions
+                          if start is not None and end is not None )
+
+  while True:
+    batch = list(islice(regions, batch_size))
+    if not batch:
+      break
+    batch = np.array(batch, dtype=np.int64)
+    yield batch[:,0],batch[:,1]
+
+
+def target_bounds(targets):
+  '''
+  Return arrays of the starts and ends of a sorted list of disjoint targets
+  '''
+  tstarts = np.array([ t[0] for t in targets ], dtype=np.int64).clip(0)
+  tends   = np.array([ t[1] for t in targets ], dtype=np.int64)
+  return tstarts,tends
+
+
+def segment_runs(starts,ends,lo,hi,tstarts,tends):
+  '''
+  Compute runs of constant coverage depth over [lo, hi) from arrays of
+  interval starts and ends that lie within it using a sparse difference
+  array.  Depth changes are collapsed by position and accumulated by a
+  cumulative sum, so the work done is proportional to the number of
+  intervals and not the length of the segment.  Runs are split at each
+  target boundary.  Returns arrays of run starts, run ends, depth, and the
+  index of the overlapping target (-1 for off-target runs).
+  '''
+  # Only target boundaries within the segment split runs
+  ts = tstarts[np.searchsorted(tstarts,lo,'left'):np.searchsorted(tstarts,hi,'right')]
+  te = tends[  np.searchsorted(tends,  lo,'left'):np.searchsorted(tends,  hi,'right')]
+
+  positions = np.concatenate([starts,ends,ts,te,np.array([lo,hi],dtype=np.int64)])
+  deltas    = np.concatenate([np.ones(len(starts),  dtype=np.int64),
+                             -np.ones(len(ends),    dtype=np.int64),
+                             np.zeros(len(ts)+len(te)+2, dtype=np.int64)])
+
+  order     = positions.argsort(kind='mergesort')
+  positions = positions[order]
+  deltas    = deltas[order]
+
+  # Collapse all events that occur at the same position
+  first     = np.flatnonzero(np.r_[True,positions[1:]!=positions[:-1]])
+  positions = positions[first]
+  depth     = np.add.reduceat(deltas,first).cumsum()[:-1]
+
+  run_starts = positions[:-1]
+  run_ends   = positions[1:]
+
+  target = np.searchsorted(tstarts, run_starts, 'right')-1
+  if len(tstarts):
+    on_target = (target>=0)&(run_starts<tends[target.clip(0)])
+    target[~on_target] = -1
+
+  return run_starts,run_ends,depth,target
+
+
+def coverage_runs(starts,ends,contig_len,targets):
+  '''
+  Compute runs of constant coverage depth from arrays of interval starts
+  and ends.  Runs are split at each target boundary and span [0,
+  contig_len) or the extent of the intervals and targets, whichever is
+  greater.
+
+  >>> runs = coverage_runs(np.array([2,3]),np.array([6,8]),10,[(4,7,'t1')])
+  >>> for r in zip(*runs): print r
+  (0, 2, 0, -1)
+  (2, 3, 1, -1)
+  (3, 4, 2, -1)
+  (4, 6, 2, 0)
+  (6, 7, 1, 0)
+  (7, 8, 1, -1)
+  (8, 10, 0, -1)
+  '''
+  tstarts,tends = target_bounds(targets)
+  extent        = max(ends.max() if len(ends) else 0, tends.max() if len(tends) else 0)
+  hi            = contig_len if contig_len>extent else extent
+
+  return segment_runs(starts,ends,0,hi,tstarts,tends)
+
+
+def contig_coverage_runs(batches,contig_len,targets):
+  '''
+  Generate runs of constant coverage depth, as computed by coverage_runs,
+  from batches of interval starts and ends sorted by start position.  All
+  runs before the last start of each batch are produced as soon as the
+  batch is read, so only the intervals that overlap that position are
+  retained.
+
+  >>> batches = [(np.array([2]),np.array([6])),(np.array([3]),np.array([8]))]
+  >>> for runs in contig_coverage_runs(batches,10,[(4,7,'t1')]):
+  ...   for r in zip(*runs): print r
+  (0, 2, 0, -1)
+  (2, 3, 1, -1)
+  (3, 4, 2, -1)
+  (4, 6, 2, 0)
+  (6, 7, 1, 0)
+  (7, 8, 1, -1)
+  (8, 10, 0, -1)
+  '''
+  tstarts,tends = target_bounds(targets)
+  lo            = 0
+  extent        = tends.max() if len(tends) else 0
+  pending       = np.zeros(0, dtype=np.int64)
+
+  for starts,ends in batches:
+    if starts[0]<lo or (starts[1:]<starts[:-1]).any():
+      raise ValueError('Intervals must be sorted by start position')
+
+    extent = max(extent,ends.max())
+
+    # Intervals that start at or after the last start of the batch may
+    # still be followed by intervals that start at the same position
+    hi = starts[-1]
+    k  = np.searchsorted(starts,hi,'left')
+
+    seg_ends = np.concatenate([pending,ends[:k]])
+    done     = seg_ends<=hi
+    pending  = np.concatenate([seg_ends[~done],ends[k:]])
+
+    if hi>lo:
+      # Intervals that continue past the segment are clipped to it
+      seg_starts = np.concatenate([np.repeat(lo,len(seg_ends)-k),starts[:k]])
+      yield segment_runs(seg_starts,np.minimum(seg_ends,hi),lo,hi,tstarts,tends)
+      lo = hi
+
+  hi = contig_len if contig_len>extent else extent
+
+  if hi>lo:
+    yield segment_runs(np.repeat(lo,len(pending)),pending,lo,hi,tstarts,tends)
+
+
+def coverage_run_stats(runs,ntargets,max_track,coverage_width):
+  '''
+  Tally the number of off-target and on-target bases at each coverage depth
+  for runs produced by coverage_runs.  Returns a (2,max_track+1) array of
+  off- and on-target base counts and a (ntargets,max_track+1) array of
+  counts per target.
+
+  >>> runs = coverage_runs(np.array([2,3]),np.array([6,8]),10,[(4,7,'t1')])
+  >>> contig_coverage,target_counts = coverage_run_stats(runs,1,2,1)
+  >>> contig_coverage.tolist()
+  [[4, 2, 1], [0, 1, 2]]
+  >>> target_counts.tolist()
+  [[0, 1, 2]]
+  '''
+  run_starts,run_ends,depth,target = runs
+
+  ntracks = max_track+1
+  sizes   = run_ends-run_starts
+  bucket  = np.minimum(depth//coverage_width, max_track)
+  on      = target>=0
+  off     = ~on
+
+  contig_coverage    = np.zeros( (2,ntracks), dtype=int )
+  contig_coverage[0] = np.bincount(bucket[off], weights=sizes[off], minlength=ntracks)
+  contig_coverage[1] = np.bincount(bucket[on],  weights=sizes[on],  minlength=ntracks)
+
+  target_counts = np.bincount(target[on]*ntracks+bucket[on], weights=sizes[on],
+                              minlength=ntargets*ntracks)
+  target_counts = target_counts.astype(int).reshape(ntargets,ntracks)
+
+  return contig_coverage,target_counts
+
+
+def write_coverage_runs(out,contig_name,runs):
+  '''
+  Write segments of runs produced by contig_coverage_runs in the same form
+  as output_intervals
+  '''
+  for run_starts,run_ends,depth,target in runs:
+    labels = np.where(target>=0,'<on target>','')
+
+    for row in zip(run_starts.tolist(),run_ends.tolist(),depth.tolist(),labels.tolist()):
+      out.writerow((contig_name,)+row)
+
+
+def _array_contig_stats(contig_name,contig_len,batches,ctargets,
+                        max_track,coverage_width,intervals):
+  '''
+  Compute coverage statistics for one contig from batches of interval
+  starts and ends.  Counts for targets that share a name are summed.
+
+  >>> batches = [(np.array([0,5]),np.array([20,40]))]
+  >>> targets = [(0,10,'GENE'),(30,50,'GENE')]
+  >>> name,coverage,target_coverage,runs = _array_contig_stats('chr1',60,batches,targets,2,1,False)
+  >>> target_coverage['GENE'].tolist()
+  [10, 15, 5]
+  '''
+  ntargets        = len(ctargets)
+  contig_coverage = np.zeros( (2,max_track+1), dtype=int )
+  target_counts   = np.zeros( (ntargets,max_track+1), dtype=int )
+  runs            = [] if intervals else None
+
+  for segment in contig_coverage_runs(batches,contig_len,ctargets):
+    coverage,counts  = coverage_run_stats(segment,ntargets,max_track,coverage_width)
+    contig_coverage += coverage
+    target_counts   += counts
+
+    if intervals:
+      runs.append(segment)
+
+  # Targets on a contig may share a name, as done for exons named by gene
+  target_coverage = {}
+  for (target_start,target_end,target_name),counts in zip(ctargets,target_counts):
+    if not counts.any():
+      continue
+    elif target_name in target_coverage:
+      target_coverage[target_name] += counts
+    else:
+      target_coverage[target_name]  = counts
+
+  return contig_name,contig_coverage,target_coverage,runs
+
+
+def _bam_contig_stats(args):
+  '''
+  Worker function that computes coverage statistics for one contig (or
+  region) of an indexed BAM file using its own file handle
+  '''
+  filename,contig_name,contig_len,region,ctargets,options = args
+
+  inbam = pysam.Samfile(filename, 'rb')
+
+  max_coverage   = options.maxcoverage[0]
+  coverage_width = options.maxcoverage[1]
+
+  try:
+    aligns  = inbam.fetch(region=region)
+    aligns  = filter_alignments(aligns, options.includealign, options.excludealign, options.minmapq)
+    aligns  = ( (align.pos,align.aend,None) for align in aligns )
+    batches = contig_event_batches(aligns)
+    first   = next(batches,None)
+
+    if first is None:
+      return None
+
+    return _array_contig_stats(contig_name,contig_len,chain([first],batches),ctargets,
+                               max_coverage//coverage_width,coverage_width,
+                               bool(options.intervalout))
+
+  finally:
+    inbam.close()
+
+
+def _accumulate_array_stats(results,options):
+  max_coverage    = options.maxcoverage[0]
+  coverage_width  = options.maxcoverage[1]
+  max_track       = max_coverage//coverage_width
+  targetout       = options.targetout
+  intervalout     = options.intervalout
+  all_coverage    = np.zeros( (2,max_track+1), dtype=int )
+  target_coverage = defaultdict(lambda: np.zeros(max_track+1, dtype=int )) if targetout else None
+
+  if intervalout:
+    out = table_writer(intervalout)
+    out.writerow(['contig','start','end','depth','target'])
+
+  for result in results:
+    if result is None:
+      continue
+
+    contig_name,contig_coverage,contig_targets,runs = result
+
+    all_coverage += contig_coverage
+
+    if targetout:
+      for target_name,counts in contig_targets.iteritems():
+        target_coverage[contig_name,target_name] += counts
+
+    if intervalout:
+      write_coverage_runs(out,contig_name,runs)
+
+  return all_coverage,target_coverage
+
+
+def array_pileup_stats(regions,targets,options):
+  '''
+  Compute coverage depth statistics equivalent to pileup_stats using
+  vectorized per-contig difference arrays.  Input is a sequence of contig
+  name, contig length, and (start, end, name) intervals as produced by
+  load_regions.
+  '''
+  max_coverage   = options.maxcoverage[0]
+  coverage_width = options.maxcoverage[1]
+  max_track      = max_coverage//coverage_width
+  intervals      = bool(options.intervalout)
+
+  def _results():
+    for contig_name,contig_len,contig_regions in regions:
+      batches  = contig_event_batches(contig_regions)
+      ctargets = targets.get(contig_name,[])
+
+      yield _array_contig_stats(contig_name,contig_len,batches,ctargets,
+                                max_track,coverage_width,intervals)
+
+  return _accumulate_array_stats(_results(),options)
+
+
+def parallel_pileup_stats(filename,targets,options):
+  '''
+  Compute coverage depth statistics equivalent to pileup_stats for an
+  indexed BAM file, processing each contig in a separate worker process.
+  '''
+  from multiprocessing import Pool
+
+  inbam = pysam.Samfile(filename, 'rb')
+
+  try:
+    contigs = zip(inbam.references,inbam.lengths)
+  finally:
+    inbam.close()
+
+  if options.region:
+    contig_name = options.region.split(':')[0]
+    contigs     = [ (name,length,options.region) for name,length in contigs if name==contig_name ]
+  else:
+    contigs     = [ (name,length,name) for name,length in contigs ]
+
+  tasks = [ (filename,name,length,region,targets.get(name,[]),options)
+            for name,length,region in contigs ]
+
+  pool = Pool(options.jobs)
+
+  try:
+    results = pool.imap(_bam_contig_stats, tasks)
+    results = progress_loop(results, label='Processing contigs: ', units='contigs', length=len(tasks))
+
+    return _accumulate_array_stats(results,options)
+
+  finally:
+    pool.terminate()
+
+
 def load_bam(filename,options):
   inbam = pysam.Samfile(filename, 'rb')
 
@@ -360,6 +707,12 @@ def option_parser():
                     help='Per-target coverage statistics')
   parser.add_argument('--intervalout', metavar='FILE',
                     help='Output coverage by position interval')
+  parser.add_argument('--engine', metavar='NAME', default='array', choices=['array','interval'],
+                    help='Coverage engine: "array" computes depth with vectorized difference arrays, '
+                         '"interval" uses the original streaming interval pileup.  Default=array')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Number of worker processes used to process contigs of an indexed BAM '
+                         'file in parallel (array engine only).  Default=1')
 
   return parser
 
@@ -370,16 +723,27 @@ def main():
 
   parse_maxcoverage(options)
 
-  regions = load_regions(options.bamfile,options)
   targets = read_features(options.targets)
+  format  = guess_format(options.bamfile, ['bam','bed','sam'])
+
+  if options.engine=='array' and options.jobs>1 and format=='bam':
+    filename = parse_augmented_name(options.bamfile,{})
+    all_coverage,target_coverage = parallel_pileup_stats(filename, targets, options)
 
-  contig_intervals = interval_pileup(regions)
-  target_intervals = target_pileup(contig_intervals, targets)
+  elif options.engine=='array':
+    regions = load_regions(options.bamfile,options)
+    all_coverage,target_coverage = array_pileup_stats(regions, targets, options)
+
+  else:
+    regions = load_regions(options.bamfile,options)
 
-  if options.intervalout:
-    target_intervals = output_intervals(target_intervals, options)
+    contig_intervals = interval_pileup(regions)
+    target_intervals = target_pileup(contig_intervals, targets)
 
-  all_coverage,target_coverage = pileup_stats(target_intervals, options)
+    if options.intervalout:
+      target_intervals = output_intervals(target_intervals, options)
+
+    all_coverage,target_coverage = pileup_stats(target_intervals, options)
 
   if options.output:
     output_summary_coverage(all_coverage, options)
@@ -388,5 +752,10 @@ def main():
     output_target_coverage(targets, target_coverage, options)
 
 
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
 if __name__=='__main__':
   main()
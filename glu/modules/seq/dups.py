@@ -12,8 +12,10 @@ __revision__  = '$Id$'
 import sys
 import random
 
+from   collections                  import deque
 from   operator                     import attrgetter, itemgetter
 from   itertools                    import groupby
+from   heapq                        import heappush, heappop
 
 import pysam
 
@@ -21,7 +23,7 @@ from   glu.lib.utils                import gcdisabled
 from   glu.lib.union_find           import union_find
 from   glu.lib.progressbar          import progress_loop
 
-from   glu.modules.seq.filter       import sink_file
+from   glu.modules.seq.filter       import sink_file, sink_null
 
 
 def read_start_generic(align):
@@ -50,16 +52,20 @@ def read_start_454(align):
     return align_end
 
 
-def read_groups(aligns,platform):
+def read_start_function(platform):
   platform = platform.lower()
 
   if platform=='454':
-    get_read_start = read_start_454
+    return read_start_454
   elif platform in ('','neutral'):
-    get_read_start = read_start_generic
+    return read_start_generic
   else:
     raise ValueError('Unknown platform specified: %s' % platform)
 
+
+def read_groups(aligns,platform):
+  get_read_start = read_start_function(platform)
+
   for tid,contig_aligns in groupby(aligns,attrgetter('tid')):
     if tid==-1:
       continue
@@ -102,9 +108,8 @@ def handle_duplicates(alignments, action, duplicates):
     raise ValueError('Invalid action: %s' % action)
 
 
-def pick_duplicates(groups, method):
-  duplicates = set()
-  method     = method.lower()
+def pick_function(method):
+  method = method.lower()
 
   if method=='random':
     def _pick(group):
@@ -120,6 +125,13 @@ def pick_duplicates(groups, method):
   else:
     raise ValueError('Invalid primary alignment action: %s' % method)
 
+  return _pick
+
+
+def pick_duplicates(groups, method):
+  duplicates = set()
+  _pick      = pick_function(method)
+
   for group in groups:
     if len(group)>1:
       group = _pick(list(group))
@@ -130,6 +142,154 @@ def pick_duplicates(groups, method):
   return duplicates
 
 
+class DuplicateStats(object):
+  def __init__(self):
+    self.reads      = 0
+    self.bases      = 0
+    self.duplicates = 0
+
+
+def stream_duplicates(aligns, platform, method, action, stats=None):
+  '''
+  Mark or remove duplicate alignments from a coordinate-sorted alignment
+  stream in a single pass.
+
+  Alignments are grouped by contig, strand and read start as done by
+  read_groups, but only groups whose start may still receive alignments are
+  kept open.  A group is closed, and a primary alignment picked, as soon as
+  the input advances past its read start.  Alignments are then released in
+  their original order once the fate of all preceding alignments is known,
+  so memory is bounded by the span of the longest alignment rather than by
+  the size of a contig.
+
+  The mate of a duplicate alignment is also marked when it follows the
+  duplicate in the input.  Unlike pick_duplicates, mates that precede the
+  duplicate have already been written and are left unchanged.  Names of
+  duplicates are forgotten once output passes the position of their mate.
+
+  Input that is not sorted by coordinate raises a ValueError.
+  '''
+  get_read_start = read_start_function(platform)
+  _pick          = pick_function(method)
+  action         = action.lower()
+
+  if action not in ('keep','drop'):
+    raise ValueError('Invalid action: %s' % action)
+
+  if stats is None:
+    stats = DuplicateStats()
+
+  # Alignments pending output as [align, is_duplicate] in input order,
+  # where is_duplicate is None until the alignment's group is closed
+  pending     = deque()
+
+  # Open groups keyed by (read start, strand) with a heap of their keys
+  groups      = {}
+  group_heap  = []
+
+  # Duplicate alignments by name whose mates have yet to be written, with
+  # a heap of their mate positions
+  dup_mates   = {}
+  mate_heap   = []
+
+  def _close_groups(pos):
+    while group_heap and (pos is None or group_heap[0][0]<pos):
+      group = groups.pop(heappop(group_heap))
+
+      if len(group)==1:
+        group[0][1] = False
+        continue
+
+      primary = _pick([ align for align,is_duplicate in group ])[0]
+
+      for entry in group:
+        align    = entry[0]
+        entry[1] = align is not primary
+
+        if entry[1]:
+          stats.duplicates += 1
+
+          if align.is_paired and not align.mate_is_unmapped and (align.mrnm>align.tid
+                  or (align.mrnm==align.tid and align.mpos>=align.pos)):
+            mate = align.mrnm,align.mpos
+            dup_mates[align.qname] = mate,align
+            heappush(mate_heap, mate+(align.qname,))
+
+  def _release():
+    while pending and pending[0][1] is not None:
+      align,is_duplicate = pending.popleft()
+      qname = align.qname
+      dup   = dup_mates.get(qname)
+
+      if dup is not None and dup[1] is not align:
+        del dup_mates[qname]
+        is_duplicate = True
+
+      # Mates of duplicates at earlier positions have already been written
+      if align.tid!=-1:
+        here = align.tid,align.pos
+        while mate_heap and mate_heap[0][:2]<here:
+          mtid,mpos,mname = heappop(mate_heap)
+          dup = dup_mates.get(mname)
+          if dup is not None and dup[0]==(mtid,mpos):
+            del dup_mates[mname]
+
+      if is_duplicate:
+        if action=='drop':
+          continue
+        align.is_duplicate = True
+
+      yield align
+
+  current_tid = None
+  current_pos = None
+
+  for align in aligns:
+    tid = align.tid
+    pos = align.pos
+
+    # Unmapped alignments without a contig follow all others
+    if tid!=-1 and current_tid is not None and (current_tid==-1
+                                                or (tid,pos)<(current_tid,current_pos)):
+      raise ValueError('Alignments must be sorted by coordinate')
+
+    current_pos = pos
+
+    if tid!=current_tid:
+      _close_groups(None)
+      current_tid = tid
+    else:
+      _close_groups(pos)
+
+    for out in _release():
+      yield out
+
+    if tid==-1:
+      pending.append([align,False])
+      continue
+
+    if not align.is_secondary and not align.is_read2:
+      stats.reads += 1
+      stats.bases += align.rlen
+
+    read_start = max(pos,get_read_start(align))
+    key        = read_start,align.is_reverse
+    entry      = [align,None]
+
+    group = groups.get(key)
+    if group is None:
+      group = groups[key] = []
+      heappush(group_heap, key)
+
+    group.append(entry)
+    pending.append(entry)
+
+  _close_groups(None)
+
+  for out in _release():
+    yield out
+
+
 def option_parser():
   from glu.lib.glu_argparse import GLUArgumentParser
 
@@ -143,16 +303,56 @@ def option_parser():
                     help='Action to perform for duplicate reads: keep, drop.  Default=keep')
   parser.add_argument('--pick', metavar='METHOD', default='best',
                     help='Method of selecting primary alignment when keeping duplicate reads: best, random.  Default=best')
+  parser.add_argument('--engine', metavar='NAME', default='stream', choices=['stream','twopass'],
+                    help='Duplicate detection engine: "stream" marks duplicates of coordinate-sorted '
+                         'input in a single pass with bounded memory, "twopass" collects all read '
+                         'groups before writing output.  Unlike twopass, stream only marks the mate '
+                         'of a duplicate when the mate follows it in the input and does not merge '
+                         'groups of reads that share names, so it may mark different alignments.  '
+                         'Default=stream')
   parser.add_argument('-o', '--output', metavar='FILE',
                     help='Output BAM file')
 
   return parser
 
 
-def main():
-  parser   = option_parser()
-  options  = parser.parse_args()
+def print_stats(filename, total_len, total_count, dup_count):
+  print
+  print 'Statistics for %s:'   % filename
+  print '  Total  Mbps: %0.2f' % (total_len/1000000)
+  print '  Total Reads: %8d'   % total_count
+  print '    Dup Reads: %8d'   % dup_count
+  print '  %% Dup Reads: %0.2f' % (dup_count/total_count*100 if total_count else 0)
+  print
+
+
+def open_output(filename, template):
+  flags = 'wb' if filename.endswith('.bam') else 'wh'
+  return pysam.Samfile(filename, flags, template=template)
+
 
+def stream_main(options):
+  inbam  = pysam.Samfile(options.bamfile,'rb')
+
+  try:
+    stats  = DuplicateStats()
+    aligns = inbam.fetch(until_eof=True)
+    aligns = progress_loop(aligns, label='Processing BAM file: ', units='alignments')
+    aligns = stream_duplicates(aligns, options.platform, options.pick, options.action, stats)
+
+    if options.output:
+      sink_file(open_output(options.output, inbam), aligns)
+    else:
+      sink_null(aligns)
+
+  finally:
+    inbam.close()
+
+  if options.output!='-':
+    print_stats(options.bamfile, stats.bases, stats.reads, stats.duplicates)
+
+
+def twopass_main(options):
   inbam    = pysam.Samfile(options.bamfile,'rb')
   aligns   = inbam.fetch()
   aligns   = progress_loop(aligns, label='Loading BAM file: ', units='alignments')
@@ -182,13 +382,7 @@ def main():
   total_count = len(seen)
 
   if options.output!='-':
-    print
-    print 'Statistics for %s:'   % options.bamfile
-    print '  Total  Mbps: %0.2f' % (total_len/1000000)
-    print '  Total Reads: %8d'   % total_count
-    print '    Dup Reads: %8d'   % dup_count
-    print '  %% Dup Reads: %0.2f' % (dup_count/total_count*100)
-    print
+    print_stats(options.bamfile, total_len, total_count, dup_count)
 
   if options.output:
     duplicates = pick_duplicates(groups, options.pick)
@@ -198,7 +392,17 @@ def main():
     aligns   = progress_loop(aligns, label='Saving BAM file: ', units='alignments')
     aligns   = handle_duplicates(aligns, options.action, duplicates)
 
-    sink_file(options.output, inbam, aligns)
+    sink_file(open_output(options.output, inbam), aligns)
+
+
+def main():
+  parser   = option_parser()
+  options  = parser.parse_args()
+
+  if options.engine=='stream':
+    stream_main(options)
+  else:
+    twopass_main(options)
 
 
 if __name__=='__main__':
@@ -7,9 +7,14 @@ __revision__  = '$Id$'
 
 import os
 import sys
+import shutil
+import tempfile
+
+import cPickle as pickle
 
 from   operator                     import attrgetter
-from   itertools                    import groupby, izip
+from   itertools                    import groupby, izip, islice
+from   collections                  import namedtuple
 
 from   glu.lib.utils                import unique
 from   glu.lib.imerge               import imerge
@@ -41,10 +46,19 @@ CHROMOSOMES = ['chr1','chr2','chr3','chr4','chr5','chr6','chr7','chr8','chr9','c
                'chr20','chr21','chr22','chrX','chrY','chrM']
 
 
+MergeVariant = namedtuple('MergeVariant', 'chromosome begin end reference allele1Seq allele2Seq '
+                                           'allele1Function allele2Function allele1XRef allele2XRef '
+                                           'individual')
+
+
+def mastervar_name(filename):
+  name = os.path.basename(filename)
+  return name.split('.')[0]
+
+
 def mastervar_variants(filename):
   attrs,header,records = cga_reader(filename,extra='individual',skip_ref=True)
-  name = os.path.basename(filename)
-  name = name.split('.')[0]
+  name = mastervar_name(filename)
 
   def _records():
     for v in records:
@@ -54,6 +68,126 @@ def mastervar_variants(filename):
   return name,_records()
 
 
+def project_variants(filename):
+  '''
+  Read a mastervar file and project each variant record on to only the
+  fields required to merge it, with allele functions pre-formatted.  The
+  full CGA records are discarded as soon as they are projected.
+  '''
+  name,records = mastervar_variants(filename)
+
+  for v in records:
+    xref1 = getattr(v,'allele1XRef',None) or getattr(v,'xRef',None)
+    xref2 = getattr(v,'allele2XRef',None) or getattr(v,'xRef',None)
+
+    yield MergeVariant(v.chromosome, v.begin, v.end, v.reference,
+                       v.allele1Seq, v.allele2Seq,
+                       function_records(v.allele1Gene),
+                       function_records(v.allele2Gene),
+                       xref1, xref2, name)
+
+
+def write_variant_run(variants, filename, chunksize=8192):
+  '''
+  Write a sorted stream of projected variants to a binary run file as a
+  sequence of pickled chunks of plain tuples.
+
+  >>> import tempfile
+  >>> f = tempfile.NamedTemporaryFile()
+  >>> vs = [ MergeVariant('chr1',i,i+1,'A','A','G','','','','','s1') for i in range(5) ]
+  >>> write_variant_run(vs, f.name, chunksize=2)
+  5
+  >>> list(read_variant_run(f.name)) == vs
+  True
+  '''
+  n = 0
+  with open(filename,'wb') as out:
+    variants = iter(variants)
+    while 1:
+      chunk = [ tuple(v) for v in islice(variants,chunksize) ]
+      if not chunk:
+        break
+      n += len(chunk)
+      pickle.dump(chunk, out, pickle.HIGHEST_PROTOCOL)
+
+  return n
+
+
+def read_variant_run(filename):
+  '''
+  Read projected variants from a run file written by write_variant_run.
+  '''
+  make = MergeVariant._make
+
+  with open(filename,'rb') as run:
+    while 1:
+      try:
+        chunk = pickle.load(run)
+      except EOFError:
+        break
+
+      for v in chunk:
+        yield make(v)
+
+
+def merge_variant_files(filenames, mergekey, batchsize=64, tmpdir=None):
+  '''
+  Merge variants from many mastervar files into a single sorted stream
+  while holding at most batchsize input files open at once.
+
+  When there are more files than fit in a single batch, each batch is
+  merged into a sorted binary run file of projected variants and the runs
+  are merged in turn, recursively, until a single final merge remains.
+  Batches are formed in input order and merges are stable, so variants
+  with equal keys are produced in the same order as a single merge over
+  all files.
+  '''
+  if batchsize<2:
+    raise ValueError('Merge batch size must be at least 2')
+
+  sources = [ (project_variants,filename) for filename in filenames ]
+
+  if len(sources)<=batchsize:
+    return imerge([ reader(f) for reader,f in sources ], key=mergekey)
+
+  return _merge_variant_runs(sources, mergekey, batchsize, tmpdir)
+
+
+def _merge_variant_runs(sources, mergekey, batchsize, tmpdir):
+  rundir = tempfile.mkdtemp(prefix='merge_var', dir=tmpdir)
+
+  try:
+    level = 0
+
+    while len(sources)>batchsize:
+      runs = []
+
+      for i in xrange(0,len(sources),batchsize):
+        batch = sources[i:i+batchsize]
+
+        if len(batch)==1:
+          runs.extend(batch)
+          continue
+
+        runname  = os.path.join(rundir,'run%d_%d.bin' % (level,len(runs)))
+        variants = imerge([ reader(f) for reader,f in batch ], key=mergekey)
+        write_variant_run(variants, runname)
+        runs.append( (read_variant_run,runname) )
+
+        for reader,f in batch:
+          if reader is read_variant_run:
+            os.unlink(f)
+
+      sources = runs
+      level  += 1
+
+    for v in imerge([ reader(f) for reader,f in sources ], key=mergekey):
+      yield v
+
+  finally:
+    shutil.rmtree(rundir, ignore_errors=True)
+
+
 def function_records(gene):
   if not gene:
     return ''
@@ -83,25 +217,25 @@ def merge_sparse(loci):
       if a1 not in allelemap:
         alleles.append(a1)
         allelemap[a1] = len(alleles)
-        function.append(function_records(var.allele1Gene))
+        function.append(var.allele1Function)
         xrefs.append(var.allele1XRef or '')
 
       if a2 not in allelemap:
         alleles.append(a2)
         allelemap[a2] = len(alleles)
-        function.append(function_records(var.allele2Gene))
+        function.append(var.allele2Function)
         xrefs.append(var.allele2XRef or '')
 
       individuals.append(var.individual)
       genotypes.append('%s/%s' % (allelemap[a1],allelemap[a2]))
 
-  yield [chromosome,begin,end,
-                    exemplar.reference,
-                    ','.join(alleles),
-                    ','.join(xrefs),
-                    ','.join(function),
-                    ','.join(individuals),
-                    ','.join(genotypes)]
+    yield [chromosome,begin,end,
+                      exemplar.reference,
+                      ','.join(alleles),
+                      ','.join(xrefs),
+                      ','.join(function),
+                      ','.join(individuals),
+                      ','.join(genotypes)]
 
 
 def merge_dense(loci,names):
@@ -125,13 +259,13 @@ def merge_dense(loci,names):
       if a1 not in allelemap:
         alleles.append(a1)
         allelemap[a1] = len(alleles)
-        function.append(function_records(var.allele1Gene))
+        function.append(var.allele1Function)
         xrefs.append(var.allele1XRef or '')
 
       if a2 not in allelemap:
         alleles.append(a2)
         allelemap[a2] = len(alleles)
-        function.append(function_records(var.allele2Gene))
+        function.append(var.allele2Function)
         xrefs.append(var.allele2XRef or '')
 
       genotypes[ indmap[var.individual] ] = '%s/%s' % (allelemap[a1],allelemap[a2])
@@ -154,6 +288,11 @@ def option_parser():
                       help='Output format: sparse or dense (default)')
   parser.add_argument('-o', '--output', metavar='FILE', default='-',
                     help='Output variant file')
+  parser.add_argument('--batchsize', metavar='N', type=int, default=64,
+                    help='Maximum number of input files to merge at once.  Larger inputs are merged '
+                         'hierarchically via temporary sorted run files.  Default=64')
+  parser.add_argument('--tmpdir', metavar='DIR',
+                    help='Directory for temporary run files (default=system temporary directory)')
   return parser
 
 
@@ -162,20 +301,13 @@ def main():
   options    = parser.parse_args()
 
   refmap     = dict( (r,i) for i,r in enumerate(CHROMOSOMES) )
-  variants   = []
-  names      = []
-
-  for filename in options.variants:
-    name,vars = mastervar_variants(filename)
-    names.append(name)
-    variants.append(vars)
-
-  names.sort()
+  names      = sorted( mastervar_name(filename) for filename in options.variants )
 
   def mergekey(v):
     return refmap[v.chromosome],v.begin,v.end
 
-  variants   = imerge(variants, key=mergekey)
+  variants   = merge_variant_files(options.variants, mergekey,
+                                   batchsize=options.batchsize, tmpdir=options.tmpdir)
 
   out        = table_writer(options.output,hyphen=sys.stdout)
 
@@ -194,6 +326,11 @@ def main():
     out.writerow(row)
 
 
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
 if __name__=='__main__':
   if 1:
     main()
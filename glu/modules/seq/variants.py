@@ -11,8 +11,8 @@ __revision__  = '$Id$'
 import os
 import sys
 
-from   collections              import defaultdict
-from   itertools                import groupby
+from   collections              import defaultdict, deque
+from   itertools                import groupby, izip
 from   operator                 import itemgetter
 
 import numpy as np
@@ -345,10 +345,50 @@ def extend_variant(pos, loc, ref_seq, pileup, exclude_start=False, fixed_end=Non
   return loc,end
 
 
-def pileup_iter(inbam, locations=None):
-  # Full scan over pileup locations
+class ReferenceWindow(object):
+  '''
+  Upper-case reference sequence for a window of a contig that is indexed
+  and sliced using contig coordinates
+
+  >>> class Fasta(object):
+  ...   def fetch(self, chrom, start, end): return 'acgtacgtac'[start:end]
+  >>> ref = ReferenceWindow(Fasta(), 'chr1', 2, 8)
+  >>> ref[2],ref[7],ref[3:6]
+  ('G', 'T', 'TAC')
+  '''
+  def __init__(self, reference, chrom, start, end):
+    self.start = start
+    self.seq   = reference.fetch(chrom,start,end).upper()
+
+  def __len__(self):
+    return self.start+len(self.seq)
+
+  def __getitem__(self, i):
+    offset = self.start
+
+    if isinstance(i,slice):
+      return self.seq[i.start-offset:i.stop-offset]
+
+    if i<offset:
+      raise IndexError('reference window index out of range')
+
+    return self.seq[i-offset]
+
+
+def pileup_iter(inbam, chrom=None, start=None, end=None):
+  # Full scan over pileup locations, optionally limited to [start,end) of
+  # a single contig
   references = inbam.references
-  for p in inbam.pileup():
+
+  if chrom is None:
+    pileup = inbam.pileup()
+  else:
+    pileup = inbam.pileup(chrom,start,end)
+
+  for p in pileup:
+    if chrom is not None and not start<=p.pos<end:
+      continue
+
     if 0:
       seed = seed_variant(p)
     else:
@@ -358,30 +398,155 @@ def pileup_iter(inbam, locations=None):
       yield references[p.tid],p.pos,p.n,seed
 
 
-def location_iter(inbam, locations):
-  # Scan over pre-defined locations
+def location_groups(locations, max_gap=1000, max_span=100000):
+  '''
+  Group sorted and unique locations on the same contig that are separated
+  by no more than max_gap bases so they can be served by a single pileup.
+  Groups are also split so that no pileup spans more than max_span bases.
+
+  >>> locs = [('1',10,11,'A','G'),('1',500,501,'C','T'),('1',5000,5001,'C','T'),('2',10,11,'A','G')]
+  >>> for group in location_groups(locs): print [ (l[0],l[1]) for l in group ]
+  [('1', 10), ('1', 500)]
+  [('1', 5000)]
+  [('2', 10)]
+  >>> for group in location_groups(locs, max_gap=5000, max_span=1000): print [ (l[0],l[1]) for l in group ]
+  [('1', 10), ('1', 500)]
+  [('1', 5000)]
+  [('2', 10)]
+  '''
   locations = unique(sorted(locations))
 
-  for chrom,start,end,a1,a2 in locations:
-    pileup = inbam.pileup(chrom,start-1,end+1)
-    locs   = []
+  group       = []
+  group_start = group_end = None
+
+  for location in locations:
+    chrom,start,end = location[:3]
+
+    if group and (chrom!=group[0][0] or start-1>group_end+max_gap
+                                     or max(group_end,end+1)-group_start>max_span):
+      yield group
+      group = []
+
+    if not group:
+      group_start = start-1
+      group_end   = end+1
+
+    group.append(location)
+    group_end = max(group_end,end+1)
+
+  if group:
+    yield group
+
+
+def location_iter(inbam, locations, max_gap=1000, max_span=100000):
+  '''
+  Scan over pre-defined locations, sharing one pileup among nearby
+  locations.  The pileup is streamed and only columns that fall within
+  one base of a pending location are retained.
+
+  >>> class Column(object):
+  ...   def __init__(self, pos, bases): self.pos,self.n,self.bases = pos,len(bases),bases
+  >>> class Bam(object):
+  ...   def pileup(self, chrom, start, end):
+  ...     return [ Column(pos,'A'*(pos%4)) for pos in xrange(start,end+2) ]
+  >>> locs = [('1',10,11,'A','G'),('1',14,18,'C','T'),('1',19,20,'C','T')]
+  >>> for chrom,start,end,a1,a2,locs in location_iter(Bam(), locs):
+  ...   print start,end,[ l[1] for l in locs ]
+  10 11 [9, 10, 11]
+  14 18 [13, 14, 15]
+  19 20 [18, 19]
+  '''
+  for group in location_groups(locations, max_gap, max_span):
+    chrom       = group[0][0]
+    group_start = group[0][1]-1
+    group_end   = max(location[2] for location in group)+1
+
+    wanted      = set()
+    for location in group:
+      wanted.update(xrange(location[1]-1,location[2]+2))
+
+    pending     = deque(group)
+    columns     = deque()
+
+    def _location_columns(location):
+      chrom,start,end,a1,a2 = location
+      locs = []
+
+      for pos,depth,seed in columns:
+        if pos>end+1:
+          break
+        elif pos<start-1:
+          continue
+        elif not seed:
+          break
 
-    while 1:
-      p = next(pileup,None)
+        locs.append( (chrom,pos,depth,seed) )
 
-      if p is None:
-        break
-      elif not start-1<=p.pos<=end+1:
-        continue
+      return chrom,start,end,a1,a2,locs
 
-      seed = p.bases
+    def _retire():
+      location = pending.popleft()
+      result   = _location_columns(location)
+
+      # Locations are ordered by start, so columns before the next pending
+      # location are no longer needed
+      if pending:
+        next_start = pending[0][1]-1
+        while columns and columns[0][0]<next_start:
+          columns.popleft()
+
+      return result
+
+    for p in inbam.pileup(chrom,group_start,group_end):
+      pos = p.pos
 
-      if not seed:
+      while pending and pending[0][2]+1<pos:
+        yield _retire()
+
+      if not pending or pos>group_end:
         break
 
-      locs.append( (chrom,p.pos,p.n,seed) )
+      if pos in wanted:
+        columns.append( (pos,p.n,p.bases) )
+
+    while pending:
+      yield _retire()
+
+
+def call_variant(chrom, start, depth, loc, ref_seq, pileup):
+  '''
+  Extend a variant seeded at start using subsequent pileup columns, compute
+  genotype probabilities and apply the standard filters.  Returns a Variant
+  or None if the site does not pass.
+  '''
+  loc,end = extend_variant(start, loc, ref_seq, pileup)
+
+  ref_nuc = ref_seq[start:end]
+  geno    = geno_prob(start,end,loc,ref_nuc,min_variant=2,collapse=True)
+
+  start,end,ref,a1,d1,a2,d2,ratio,pAA,pAB,pBB = geno
+
+  # Here come the filters
+  if not a1 or not a2:
+    return None
+
+  if ref==a1:
+    if d2<2:
+      return None
+
+    if (a1=='-' or a2=='-') and pAA>0.25:
+      return None
+
+    if pAA>0.95:
+      return None
+
+  elif max(d1,d2)<2:
+    return None
 
-    yield chrom,start,end,a1,a2,locs
+  #print '   ext=',loc
+  #print '  geno=',geno
+
+  return Variant(chrom,start,end,depth,ref,a1,d1,a2,d2,ratio,pAA,pAB,pBB)
 
 
 def call_variants_all(inbam, reference):
@@ -399,41 +564,99 @@ def call_variants_all(inbam, reference):
     #print
     #print chrom,start,depth
 
-    loc,end = extend_variant(start, loc, ref_seq, pileup)
+    variant = call_variant(chrom, start, depth, loc, ref_seq, pileup)
 
-    ref_nuc = ref_seq[start:end]
-    geno    = geno_prob(start,end,loc,ref_nuc,min_variant=2,collapse=True)
+    if variant is not None:
+      yield variant
 
-    start,end,ref,a1,d1,a2,d2,ratio,pAA,pAB,pBB = geno
 
-    # Here come the filters
-    if not a1 or not a2:
-      continue
+def call_variants_window(inbam, reference, chrom, start, end, overlap):
+  '''
+  Call variants seeded within [start,end) of a contig.  The pileup is
+  started overlap bases before the window so that columns consumed by
+  variants extended from the previous window are not used as new seeds, and
+  continues up to overlap bases beyond it so that variants seeded near the
+  end of the window may be fully extended.
+  '''
+  pileup_start = max(0,start-overlap)
+  pileup_end   = end+overlap
 
-    if ref==a1:
-      if d2<2:
-        continue
+  ref_seq = ReferenceWindow(reference, chrom, pileup_start, pileup_end)
+  pileup  = pileup_iter(inbam, chrom, pileup_start, pileup_end)
+  pileup  = iter_queue(pileup)
 
-      if (a1=='-' or a2=='-') and pAA>0.25:
-        continue
+  for chrom,seed_start,depth,loc in pileup:
+    if seed_start>=end:
+      break
 
-      if pAA>0.95:
-        continue
+    variant = call_variant(chrom, seed_start, depth, loc, ref_seq, pileup)
 
-    elif max(d1,d2)<2:
-      continue
+    if variant is not None and seed_start>=start:
+      yield variant
 
-    #print '   ext=',loc
-    #print '  geno=',geno
 
-    ref_nuc = ref_seq[start:end]
-    yield Variant(chrom,start,end,depth,ref,a1,d1,a2,d2,ratio,pAA,pAB,pBB)
+def region_windows(references, lengths, window_size):
+  '''
+  Split contigs into windows of at most window_size bases
+
+  >>> list(region_windows(['chr1','chr2'], [25,10], 10))
+  [('chr1', 0, 10), ('chr1', 10, 20), ('chr1', 20, 25), ('chr2', 0, 10)]
+  '''
+  for chrom,length in izip(references,lengths):
+    for start in xrange(0,length,window_size):
+      yield chrom,start,min(start+window_size,length)
+
+
+# Per-process BAM and reference handles used by region worker processes
+_worker_inbam     = None
+_worker_reference = None
+
+
+def _init_region_worker(bamfile, reference):
+  global _worker_inbam, _worker_reference
+
+  _worker_inbam     = pysam.Samfile(bamfile, 'rb')
+  _worker_reference = pysam.Fastafile(reference)
+
 
+def _call_region_window(args):
+  chrom,start,end,overlap = args
+  return list(call_variants_window(_worker_inbam, _worker_reference, chrom, start, end, overlap))
 
-def call_variants_locations(inbam, reference, locations):
+
+def call_variants_regions(bamfile, reference, jobs, window_size=10000000, overlap=1000):
+  '''
+  Call variants over all contigs of an indexed BAM file by splitting each
+  contig into windows that are processed by a pool of worker processes,
+  each with its own BAM and reference file handles.  Windows are returned
+  in contig order, so the resulting variants are in the same order as
+  produced by call_variants_all.
+  '''
+  from multiprocessing import Pool
+
+  inbam = pysam.Samfile(bamfile, 'rb')
+
+  try:
+    windows = [ (chrom,start,end,overlap)
+                for chrom,start,end in region_windows(inbam.references,inbam.lengths,window_size) ]
+  finally:
+    inbam.close()
+
+  pool = Pool(jobs, _init_region_worker, (bamfile, reference))
+
+  try:
+    for variants in pool.imap(_call_region_window, windows):
+      for variant in variants:
+        yield variant
+
+  finally:
+    pool.terminate()
+
+
+def call_variants_locations(inbam, reference, locations, max_gap=1000, max_span=100000):
   last_chrom = None
 
-  pileup_locations = location_iter(inbam, locations)
+  pileup_locations = location_iter(inbam, locations, max_gap, max_span)
 
   for chrom,start,end,a1,a2,pileup in pileup_locations:
     #print
@@ -517,14 +740,33 @@ def call_variants_locations(inbam, reference, locations):
 
 
 def annotate_variants(variants, gene_db, reference):
-  va = VariantAnnotator(gene_db, reference)
+  va      = VariantAnnotator(gene_db, reference)
+  pending = deque()
 
-  for v in variants:
-    evidence = []
-    if v.ref!=v.a2: #  and (v.ref!=v.a1 or v.pAA<0.95):
-      evidence.extend(va.classify(v.chrom, v.start, v.end, v.a2, False))
-    if v.ref!=v.a1 or (v.ref==v.a1==v.a2): #  and (v.ref!=v.a2 or v.pBB<0.95):
-      evidence.extend(va.classify(v.chrom, v.start, v.end, v.a1, False))
+  # Queue one or two alleles per variant for batch annotation.  The batch
+  # annotator consumes queries lazily, so each variant is queued just
+  # before the evidence for its first allele is returned.
+  def _queries():
+    for v in variants:
+      alleles = []
+      if v.ref!=v.a2: #  and (v.ref!=v.a1 or v.pAA<0.95):
+        alleles.append(v.a2)
+      if v.ref!=v.a1 or (v.ref==v.a1==v.a2): #  and (v.ref!=v.a2 or v.pBB<0.95):
+        alleles.append(v.a1)
+
+      pending.append( (v,len(alleles)) )
+
+      for allele in alleles:
+        yield v.chrom, v.start, v.end, allele
+
+  batch = va.annotate_batch(_queries())
+
+  for first in batch:
+    v,n = pending.popleft()
+
+    evidence = list(first)
+    for i in xrange(n-1):
+      evidence.extend(next(batch))
 
     #if 'NON-SYNONYMOUS' not in [ e[6] for e in evidence ]:
     #  continue
@@ -553,6 +795,20 @@ def option_parser():
                     help='Reference genome sequence (FASTA + FAI files)')
   parser.add_argument('--locations', metavar='FILE',
                     help='Locations at which to call variants')
+  parser.add_argument('--max-gap', metavar='N', type=int, default=1000,
+                    help='Maximum distance between locations that share a single pileup scan.  '
+                         'Default=1000')
+  parser.add_argument('--max-span', metavar='N', type=int, default=100000,
+                    help='Maximum number of bases spanned by a single pileup scan over locations.  '
+                         'Default=100000')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Number of worker processes used to call variants over regions of an '
+                         'indexed BAM file in parallel.  Default=1')
+  parser.add_argument('--window', metavar='N', type=int, default=10000000,
+                    help='Size of regions processed by each worker process.  Default=10000000')
+  parser.add_argument('--overlap', metavar='N', type=int, default=1000,
+                    help='Number of bases by which worker regions overlap to allow variants to be '
+                         'extended across region boundaries.  Default=1000')
   parser.add_argument('-o', '--output', metavar='FILE', default='-',
                     help='Output variant file')
   return parser
@@ -575,7 +831,11 @@ def main():
 
   if options.locations:
     locations = parse_locations(options.locations)
-    variants = call_variants_locations(inbam, reference, locations)
+    variants = call_variants_locations(inbam, reference, locations,
+                                       options.max_gap, options.max_span)
+  elif options.jobs>1 and options.bamfile.endswith('.bam'):
+    variants = call_variants_regions(options.bamfile, options.reference, options.jobs,
+                                     options.window, options.overlap)
   else:
     variants = call_variants_all(inbam, reference)
 
@@ -588,5 +848,10 @@ def main():
   out.writerows(variants)
 
 
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
 if __name__ == '__main__':
   main()
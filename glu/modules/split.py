@@ -10,13 +10,26 @@ __revision__  = '$Id$'
 
 import os
 import sys
+import shutil
+import tempfile
+import traceback
+import cPickle
 
 from   collections               import defaultdict
 
+import numpy as np
+
 from   glu.lib.fileutils         import map_reader
 from   glu.lib.genolib.io        import load_genostream, guess_outformat, geno_options, \
                                         get_genostream_writer
-from   glu.lib.genolib.genoarray import GenotypeArrayDescriptor, GenotypeArray, pick
+from   glu.lib.genolib.genoarray import GenotypeArrayDescriptor, GenotypeArray, pick, \
+                                        build_model, build_descr
+
+
+# Maximum number of bytes of packed genotypes per batch sent to a writer
+# process and buffered in memory for each spooled output
+BATCH_BYTES = 1<<20
+SPOOL_BYTES = 1<<18
 
 
 # FIXME: This function exists only to pander to limitations in the binary
@@ -57,23 +70,31 @@ def genomatrix_multiplexer_packed(genos, samplegroups, locusgroups, defaultsampl
         if columngroup:
           groupcols[columngroup].append(i)
 
-    if genos.format == 'sdat':
-      groupcols = [ (key,indices,
-                         GenotypeArrayDescriptor(pick(genos.models,indices)),
-                         pick(genos.columns,indices))
-                    for key,indices in groupcols.iteritems() ]
-    else:
-      descrcache = {}
-      groupcols = [ (key,indices,
-                         None,
-                         pick(genos.columns,indices))
-                    for key,indices in groupcols.iteritems() ]
+    descrcache = {}
+    groupcols  = [ (key,indices,
+                        None,
+                        pick(genos.columns,indices))
+                   for key,indices in groupcols.iteritems() ]
+
+  # Models of sdat columns may be replaced as the stream is decoded, so
+  # column group descriptors are rebuilt whenever the row models change
+  sdat      = genos.format == 'sdat'
+  rowmodels = None
+
+  def sdat_groupcols(models):
+    return [ (key,indices,GenotypeArrayDescriptor(pick(models,indices)),header)
+             for key,indices,_,header in groupcols ]
 
   # This used to be a single loop, but performance is an issue and breaking
   # out the cases helps significantly.  One day Python will have a JIT and
   # take care of this for me...
   if columngroups and rowgroups:
     for rowkey,row in genos:
+      if sdat:
+        models = list(row.descriptor)
+        if models != rowmodels:
+          rowmodels = models
+          groupcols = sdat_groupcols(models)
       for rowgroup in rowgroups.get(rowkey) or rdefault:
         if not rowgroup:
           continue
@@ -89,6 +110,11 @@ def genomatrix_multiplexer_packed(genos, samplegroups, locusgroups, defaultsampl
 
   elif columngroups:
     for rowkey,row in genos:
+      if sdat:
+        models = list(row.descriptor)
+        if models != rowmodels:
+          rowmodels = models
+          groupcols = sdat_groupcols(models)
       for columngroup,indices,descr,header in groupcols:
         if not descr:
           n     = len(indices)
@@ -184,6 +210,14 @@ def genotriple_multiplexer(triples, samplegroups, locusgroups, sampledefault, lo
   based on sample and locus using supplied mappings from row and column
   labels to group identifiers.  No buffering is performed, so partial
   results are returned tagged by group keys.
+
+  >>> from glu.lib.genolib import GenotripleStream
+  >>> triples = [('s1','l1',('A','A')),('s2','l1',('A','G')),('s1','l2',('C','C'))]
+  >>> triples = GenotripleStream.from_tuples(triples)
+  >>> for key,header,(sample,locus,geno) in genotriple_multiplexer(triples,{'s1':['g1']},{'l1':['c1']},None,'c0'):
+  ...   print key,sample,locus,geno
+  ('g1', 'c1') s1 l1 ('A', 'A')
+  ('g1', 'c0') s1 l2 ('C', 'C')
   '''
   sdefault = [sampledefault] if sampledefault else []
   ldefault = [locusdefault ] if locusdefault  else []
@@ -194,7 +228,7 @@ def genotriple_multiplexer(triples, samplegroups, locusgroups, sampledefault, lo
   if samplegroups and locusgroups:
     for sample,locus,geno in triples:
       for samplegroup in samplegroups.get(sample, sdefault):
-        for locusgroup in samplegroups.get(locus, ldefault):
+        for locusgroup in locusgroups.get(locus, ldefault):
           yield (samplegroup,locusgroup),None,(sample,locus,geno)
 
   elif samplegroups:
@@ -338,6 +372,462 @@ class FileMap(object):
     self.close()
 
 
+class ParallelFileMap(FileMap):
+  '''
+  Container for writers that are run by a pool of writer processes.  Rows
+  for each output are always handled by the same process and are sent in
+  batches through a bounded queue, so every output receives its rows in the
+  order they were emitted while encoding and compression proceed in
+  parallel.  Genotypes are sent as packed data along with the definitions
+  of any models and loci the process has not yet seen.
+
+  Each process keeps at most maxopen/jobs outputs open at once.  Rows for
+  any additional outputs are spooled to temporary files and written after
+  all input has been consumed.
+
+  Writer processes inherit the genome and phenome when they are started,
+  which occurs when the first row is emitted, and thus require a platform
+  that supports fork.
+
+  >>> import shutil,tempfile
+  >>> from glu.lib.genolib import GenotripleStream
+  >>> triples = [('s1','l1',('A','A')),('s2','l1',('A','G')),('s3','l2',('C','C')),
+  ...            ('s1','l2',('C','T')),('s2','l2',('T','T')),('s3','l1',('G','G'))]
+  >>> triples = GenotripleStream.from_tuples(triples)
+  >>> groups  = {'s1':['a'],'s2':['b'],'s3':['c']}
+  >>> destdir = tempfile.mkdtemp()
+  >>> with ParallelFileMap(destdir+'/out','tdat','tdat',triples.genome,triples.phenome,jobs=2,maxopen=2) as filemap:
+  ...   filemap.emit_sequence(genotriple_multiplexer(triples,groups,None,None,None))
+  >>> for group in 'abc':
+  ...   for line in open('%s/out_%s.tdat' % (destdir,group)):
+  ...     print ' '.join(line.split())
+  s1 l1 AA
+  s1 l2 CT
+  s2 l1 AG
+  s2 l2 TT
+  s3 l2 CC
+  s3 l1 GG
+  >>> shutil.rmtree(destdir)
+  '''
+  def __init__(self, prefix, suffix, format, genome, phenome, outformat=None, genorepr=None, maxrows=None,
+                     jobs=2, maxopen=None, queuesize=4, batchsize=1000):
+    self.procs     = []
+    FileMap.__init__(self, prefix, suffix, format, genome, phenome, outformat=outformat,
+                           genorepr=genorepr, maxrows=maxrows)
+    self.jobs      = max(1,jobs)
+    self.maxopen   = max(1,maxopen//self.jobs) if maxopen else None
+    self.queuesize = queuesize
+    self.batchsize = batchsize
+    self.assigned  = {}
+
+  def emit(self, keys, header, row):
+    proc = self.assigned.get(keys)
+    if proc is None:
+      proc = self.assign(keys, header)
+    proc.send(keys, row)
+
+  def emit_sequence(self, seq):
+    assigned = self.assigned
+    for keys,header,row in seq:
+      proc = assigned.get(keys)
+      if proc is None:
+        proc = self.assign(keys, header)
+      proc.send(keys, row)
+
+  def assign(self, keys, header):
+    if not self.procs:
+      args = (self.prefix,self.suffix,self.format,self.genome,self.phenome,
+              self.outformat,self.genorepr,self.maxrows)
+      self.procs = [ WriterProcess(args,self.maxopen,self.queuesize,self.batchsize)
+                     for i in xrange(self.jobs) ]
+
+    proc = min(self.procs, key=lambda p: p.outputs)
+    proc.open(keys, header)
+    self.assigned[keys] = proc
+    return proc
+
+  def get_writer(self, keys, header=None):
+    raise NotImplementedError('Writers are owned by the writer processes')
+
+  def close(self):
+    procs,self.procs = self.procs,[]
+
+    if not procs:
+      return
+
+    try:
+      for proc in procs:
+        proc.finish()
+      errors = [ proc.wait() for proc in procs ]
+    except:
+      for proc in procs:
+        proc.terminate()
+      raise
+
+    errors = [ e for e in errors if e ]
+    if errors:
+      raise IOError('Split writer process failed:\n%s' % errors[0])
+
+  def terminate(self):
+    procs,self.procs = self.procs,[]
+    for proc in procs:
+      proc.terminate()
+
+  def __exit__(self, *exc_info):
+    if exc_info[0] is None:
+      self.close()
+    else:
+      self.terminate()
+
+
+class WriterProcess(object):
+  '''
+  Parent side of a split writer process.  Rows are encoded as packed
+  genotype data and accumulated into batches of operations, preceded by the
+  definitions of any genotype models and loci needed to decode them.
+  '''
+  def __init__(self, args, maxopen, queuesize, batchsize):
+    from multiprocessing import Process, Queue
+
+    self.format    = args[2]
+    self.genome    = args[3]
+    self.batchsize = batchsize
+    self.batch     = []
+    self.size      = 0
+    self.outputs   = 0
+    self.models    = []
+    self.modelids  = {}
+    self.loci      = set()
+    self.columns   = {}
+
+    self.queue     = Queue(queuesize)
+    self.errors    = Queue()
+    self.process   = Process(target=_writer_main, args=(self.queue,self.errors,args,maxopen))
+    self.process.daemon = True
+    self.process.start()
+
+  def model_id(self, model, ops):
+    # Models may gain genotypes while the input is decoded, so each size
+    # of a model is sent as a new definition.  Parent models are retained
+    # to ensure their ids are not reused.
+    key = id(model),len(model.genotypes)
+    mid = self.modelids.get(key)
+
+    if mid is None:
+      mid = self.modelids[key] = len(self.models)
+      self.models.append(model)
+      ops.append( ('model',mid,tuple(model.genotuples[1:]),model.max_alleles,model.allow_hemizygote) )
+
+    return mid
+
+  def send_locus(self, name, ops):
+    self.loci.add(name)
+    loc = self.genome.loci.get(name)
+    if loc is not None:
+      ops.append( ('locus',name,loc.chromosome,loc.location,loc.strand) )
+
+  def open(self, keys, header):
+    self.outputs += 1
+    batch = self.batch
+
+    if self.format == 'sdat':
+      loci = self.loci
+      for name in header:
+        if name not in loci:
+          self.send_locus(name, batch)
+      self.columns[keys] = None,None
+
+    batch.append( ('open',keys,header) )
+
+  def send(self, keys, row):
+    batch = self.batch
+
+    if self.format == 'ldat':
+      rowkey,genos = row
+      if rowkey not in self.loci:
+        self.send_locus(rowkey, batch)
+      data = genos.data.tostring()
+      batch.append( ('row',keys,rowkey,self.model_id(genos.descriptor[0],batch),data) )
+      self.size += len(data)
+
+    elif self.format == 'sdat':
+      # Descriptors may be shared by rows and updated in place, so compare
+      # the models they contain
+      rowkey,genos = row
+      models = list(genos.descriptor)
+      if self.columns[keys][0] != models:
+        mids = [ self.model_id(model,batch) for model in models ]
+        self.columns[keys] = models,mids
+        batch.append( ('columns',keys,mids) )
+      data = genos.data.tostring()
+      batch.append( ('row',keys,rowkey,None,data) )
+      self.size += len(data)
+
+    else:
+      sample,locus,geno = row
+      if locus not in self.loci:
+        self.send_locus(locus, batch)
+      batch.append( ('geno',keys,sample,locus,self.model_id(geno.model,batch),geno.index) )
+
+    if len(batch) >= self.batchsize or self.size >= BATCH_BYTES:
+      self.flush()
+
+  def flush(self):
+    batch = self.batch
+
+    # Column models that gained genotypes must be updated before any rows
+    # that may use them
+    if self.format == 'sdat':
+      sync = []
+      for keys,(models,mids) in self.columns.iteritems():
+        if models is not None:
+          new_mids = [ self.model_id(model,sync) for model in models ]
+          if new_mids != mids:
+            self.columns[keys] = models,new_mids
+            sync.append( ('columns',keys,new_mids) )
+      if sync:
+        batch[:0] = sync
+
+    if batch:
+      self.put(batch)
+
+    self.batch = []
+    self.size  = 0
+
+  def put(self, item):
+    from Queue import Full
+
+    while 1:
+      try:
+        self.queue.put(item, True, 1)
+        return
+      except Full:
+        if not self.process.is_alive():
+          raise IOError('Split writer process exited unexpectedly:\n%s' % self.error())
+
+  def error(self):
+    from Queue import Empty
+
+    try:
+      return self.errors.get(True, 1)
+    except Empty:
+      return 'exit code %s' % self.process.exitcode
+
+  def finish(self):
+    self.flush()
+    self.put(None)
+
+  def wait(self):
+    from Queue import Empty
+
+    while 1:
+      try:
+        error = self.errors.get(True, 1)
+        break
+      except Empty:
+        if not self.process.is_alive():
+          error = self.error()
+          break
+
+    self.process.join()
+    return error
+
+  def terminate(self):
+    self.queue.cancel_join_thread()
+    self.process.terminate()
+    self.process.join()
+
+
+def _writer_main(queue, errors, args, maxopen):
+  try:
+    writer = SplitWriter(FileMap(*args), maxopen)
+    try:
+      while 1:
+        batch = queue.get()
+        if batch is None:
+          break
+        writer.process(batch)
+      writer.close()
+    finally:
+      writer.cleanup()
+
+  except:
+    errors.put(traceback.format_exc())
+  else:
+    errors.put(None)
+
+
+class SplitOutput(object):
+  '''
+  State of an output owned by a split writer process
+  '''
+  __slots__ = ('keys','header','writer','descr','pending','size','spool')
+
+  def __init__(self, keys, header):
+    self.keys    = keys
+    self.header  = header
+    self.writer  = None
+    self.descr   = None
+    self.pending = None
+    self.size    = 0
+    self.spool   = None
+
+
+class SplitWriter(object):
+  '''
+  Writer process side of ParallelFileMap.  Applies batches of operations
+  by rebuilding genotype models and packed genotype arrays and writing them
+  to outputs obtained from a FileMap.  At most maxopen outputs are open at
+  once; operations for any others are spooled and replayed when closed.
+  '''
+  def __init__(self, filemap, maxopen=None):
+    self.filemap  = filemap
+    self.genome   = filemap.genome
+    self.format   = filemap.format
+    self.maxopen  = maxopen
+    self.models   = []
+    self.outputs  = {}
+    self.spooled  = []
+    self.descrs   = {}
+    self.spooldir = None
+    self.live     = 0
+
+    self.handlers = {'model'  : self.add_model,
+                     'locus'  : self.set_locus,
+                     'open'   : self.open,
+                     'columns': self.set_columns,
+                     'row'    : self.write_row,
+                     'geno'   : self.write_geno}
+
+  def process(self, batch):
+    handlers = self.handlers
+    for op in batch:
+      handlers[op[0]](*op[1:])
+
+  def add_model(self, mid, genotypes, max_alleles, allow_hemizygote):
+    assert mid == len(self.models)
+    self.models.append(build_model(genotypes=genotypes,max_alleles=max_alleles,
+                                   allow_hemizygote=allow_hemizygote))
+
+  def set_locus(self, name, chromosome, location, strand):
+    self.genome.set_locus(name, chromosome=chromosome, location=location, strand=strand)
+
+  def open(self, keys, header):
+    output = self.outputs[keys] = SplitOutput(keys, header)
+
+    if self.maxopen is None or self.live < self.maxopen:
+      self.live    += 1
+      output.writer = self.filemap.get_writer(keys, header)
+    else:
+      output.pending = []
+      self.spooled.append(output)
+
+  def set_columns(self, keys, mids):
+    output = self.outputs[keys]
+
+    if output.writer is None:
+      self.spool(output, ('columns',keys,mids), 0)
+      return
+
+    models = self.models
+    loci   = self.genome.loci
+    for name,mid in zip(output.header,mids):
+      loci[name].model = models[mid]
+
+    output.descr = GenotypeArrayDescriptor([ models[mid] for mid in mids ])
+
+  def write_row(self, keys, rowkey, mid, data):
+    output = self.outputs[keys]
+
+    if output.writer is None:
+      self.spool(output, ('row',keys,rowkey,mid,data), len(data))
+      return
+
+    if mid is None:
+      descr = output.descr
+    else:
+      model = self.models[mid]
+      self.genome.get_locus(rowkey).model = model
+
+      n     = len(output.header)
+      descr = self.descrs.get( (model,n) )
+      if descr is None:
+        descr = self.descrs[model,n] = build_descr(model,n)
+
+    genos      = GenotypeArray(descr)
+    genos.data = np.frombuffer(data,dtype=np.uint8)
+
+    output.writer.writerow(rowkey,genos)
+
+  def write_geno(self, keys, sample, locus, mid, index):
+    output = self.outputs[keys]
+
+    if output.writer is None:
+      self.spool(output, ('geno',keys,sample,locus,mid,index), 32)
+      return
+
+    model = self.models[mid]
+    self.genome.get_locus(locus).model = model
+    output.writer.writerow(sample,locus,model.genotypes[index])
+
+  def spool(self, output, op, size):
+    output.pending.append(op)
+    output.size += size
+
+    if output.size >= SPOOL_BYTES:
+      self.flush_spool(output)
+
+  def flush_spool(self, output):
+    if not output.pending:
+      return
+
+    if output.spool is None:
+      if self.spooldir is None:
+        self.spooldir = tempfile.mkdtemp(prefix='glu_split')
+      output.spool = os.path.join(self.spooldir, str(len(os.listdir(self.spooldir))))
+
+    with open(output.spool,'ab') as spool:
+      cPickle.dump(output.pending, spool, 2)
+
+    output.pending = []
+    output.size    = 0
+
+  def replay(self, output):
+    '''
+    Open a spooled output and apply all of its operations
+    '''
+    pending,output.pending = output.pending,None
+    output.writer = self.filemap.get_writer(output.keys, output.header)
+
+    if output.spool is not None:
+      with open(output.spool,'rb') as spool:
+        while 1:
+          try:
+            self.process(cPickle.load(spool))
+          except EOFError:
+            break
+      os.unlink(output.spool)
+
+    self.process(pending)
+
+    self.filemap.writers.pop(output.keys).close()
+    output.writer = None
+
+  def close(self):
+    spooled,self.spooled = self.spooled,[]
+
+    # Close live outputs first to remain within the open file limit
+    self.filemap.close()
+
+    for output in spooled:
+      self.replay(output)
+
+  def cleanup(self):
+    if self.spooldir is not None:
+      shutil.rmtree(self.spooldir, ignore_errors=True)
+      self.spooldir = None
+
+
 def build_filename(prefix, suffix, keys):
   filename = prefix
 
@@ -386,12 +876,20 @@ def split(genos, outformat, prefix, suffix, options):
   locusgroups  = map_reader(options.locusgroups, unique=False,default=options.defaultlocusgroup)  if options.locusgroups  else None
   samplegroups = map_reader(options.samplegroups,unique=False,default=options.defaultsamplegroup) if options.samplegroups else None
 
+  jobs         = getattr(options,'jobs',1) or 1
+
   if samplegroups is not None or locusgroups is not None:
-    filecache = FileMap(prefix,suffix,genos.format,genos.genome,genos.phenome,outformat=outformat,
-                        genorepr=options.ingenorepr,maxrows=options.maxrows)
+    if jobs>1:
+      filecache = ParallelFileMap(prefix,suffix,genos.format,genos.genome,genos.phenome,outformat=outformat,
+                                  genorepr=options.ingenorepr,maxrows=options.maxrows,
+                                  jobs=jobs,maxopen=getattr(options,'maxopen',None))
+    else:
+      filecache = FileMap(prefix,suffix,genos.format,genos.genome,genos.phenome,outformat=outformat,
+                          genorepr=options.ingenorepr,maxrows=options.maxrows)
 
-    # Binary matrix writer currently requires packed genotypes
-    if genos.format in ('sdat','ldat') and outformat in ('lbat','sbat'):
+    # Binary matrix writer currently requires packed genotypes, as do
+    # writer processes
+    if genos.format in ('sdat','ldat') and (outformat in ('lbat','sbat') or jobs>1):
       mplx = genomatrix_multiplexer_packed(genos,samplegroups,locusgroups,
                                     options.defaultsamplegroup,options.defaultlocusgroup)
     elif genos.format in ('sdat','ldat'):
@@ -437,6 +935,10 @@ def option_parser():
                     help='Default group for any unmapped locus')
   parser.add_argument('--template', metavar='NAME', type=str,
                     help='The template for names of the output files')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Number of processes used to write output files when splitting into groups (default=1)')
+  parser.add_argument('--maxopen', metavar='N', type=int, default=256,
+                    help='Maximum number of output files open at once when using multiple jobs (default=256)')
 
   return parser
 
@@ -463,5 +965,11 @@ def main():
   split(genos, outformat, prefix, suffix, options)
 
 
+def _test():
+  import doctest
+  return doctest.testmod()
+
+
 if __name__ == '__main__':
+  _test()
   main()
@@ -13,7 +13,7 @@ import sys
 
 import numpy as np
 
-from   itertools                 import izip
+from   itertools                 import izip, islice
 
 from   glu.lib.fileutils         import table_writer, table_reader
 from   glu.lib.progressbar       import progress_loop
@@ -26,6 +26,7 @@ from   glu.lib.genolib.genoarray import genotype_count_matrix, genotype_indices,
 EPSILON=np.finfo(float).eps
 ABSTOL=1e-6
 RELTOL=1e-9
+BOUNDTOL=1e-12
 
 
 def admixture_log_likelihood_python(f,x):
@@ -342,6 +343,319 @@ def estimate_admixture_sqp(f, x0, failover=True):
   return x,fx,iters[0]
 
 
+def block_frequencies(populations,inds):
+  '''
+  Return the (b x k x n) tensor of population genotype frequencies for a
+  block of b individuals with (b x n) genotype indices inds, along with a
+  (b x n) mask of non-missing genotypes.
+
+  >>> pops = np.array([[[0,0.25,0.50,0.25],[0,0.5,0.25,0.25]],
+  ...                  [[0,0.50,0.25,0.25],[0,0.5,0.50,0.00]]])
+  >>> f,mask = block_frequencies(pops,np.array([[1,2],[0,3]]))
+  >>> f[0]
+  array([[0.25, 0.25],
+         [0.5 , 0.5 ]])
+  >>> f[1,:,1]
+  array([0.25, 0.  ])
+  >>> mask
+  array([[ True,  True],
+         [False,  True]])
+  '''
+  k,n,g = populations.shape
+  inds  = np.asarray(inds)
+  f     = populations[:,np.arange(n)[np.newaxis,:],inds].transpose(1,0,2).copy()
+  mask  = inds>0
+  return f,mask
+
+
+def block_mixture(f,w,x):
+  '''
+  Compute the (b x n) mixture probabilities F*x for a block of individuals,
+  with unobserved loci set to one
+  '''
+  u = np.einsum('skn,sk->sn',f,x)
+  u[w==0] = 1
+  return u
+
+
+def block_log_likelihood(f,w,x):
+  '''
+  Compute the log-likelihood of a block of individuals with frequencies
+  f, locus weights w and admixture coefficients x
+  '''
+  with np.errstate(divide='ignore',invalid='ignore'):
+    return (w*np.log(block_mixture(f,w,x))).sum(axis=1)
+
+
+def newton_simplex_step(g,h,free):
+  '''
+  Solve for Newton steps d that maximize a quadratic model with gradients
+  g and negative Hessians h over the free coefficients of each row, such
+  that sum(d)==0:
+
+    H*d + mu*e = g,  e'*d = 0,  d[fixed] = 0
+
+  where e is the indicator vector of free coefficients.
+  '''
+  b,k = g.shape
+  e   = free.astype(float)
+  eye = np.eye(k)
+
+  a = np.zeros( (b,k+1,k+1) )
+  a[:,:k,:k] = np.where(free[:,:,np.newaxis] & free[:,np.newaxis,:], h, eye)
+  a[:,:k,:k] += eye*1e-10
+  a[:,:k,k]  = e
+  a[:,k,:k]  = e
+  a[:,k,k]   = np.where(e.sum(axis=1)>0,0,1)
+
+  rhs = np.zeros( (b,k+1) )
+  rhs[:,:k] = g*e
+
+  try:
+    d = np.linalg.solve(a,rhs[:,:,np.newaxis])[:,:k,0]
+  except np.linalg.LinAlgError:
+    d = np.array([ np.linalg.lstsq(ai,ri,rcond=None)[0][:k] for ai,ri in izip(a,rhs) ])
+
+  d[~free] = 0
+
+  return d
+
+
+def estimate_admixture_block(f, mask, iters=1, maxiters=50):
+  '''
+  Estimate admixture coefficients for a block of b individuals at once.
+
+  Let F be a (b x k x n) tensor of known genotype frequencies for each
+  individual at n loci from k populations and mask a (b x n) matrix that
+  is true for loci with observed genotypes.  Each individual's
+  log-likelihood
+
+    lnL(x) = sum(ln(F*x))
+
+    subject to sum(x) == 1
+               min(x) >= 0
+
+  is maximized independently.  Starting values are found by a fixed number
+  of EM iterations, as done by estimate_admixture_em, and refined by
+  projected Newton iterations on the simplex.  Coefficients at the bound
+  whose gradients point outside of the feasible region are held fixed,
+  Newton steps are taken over the remaining coefficients subject to the
+  equality constraint, and steps are truncated at the boundary and halved
+  until the likelihood increases.  All operations are applied to the
+  whole block, so the cost per individual is a few vector operations over
+  loci per iteration rather than a call to a general purpose solver.
+
+  Returns the (b x k) matrix of estimates, the vector of log-likelihoods
+  and the number of Newton iterations performed.
+
+  >>> f = np.array([[0.25, 0.50, 0.25],
+  ...               [0.50, 0.25, 1.00],
+  ...               [0.50, 1.00, 1.00],
+  ...               [0.25, 0.50, 0.50],
+  ...               [0.75, 0.25, 0.25]])
+  >>> x,l,it = estimate_admixture_block(f.T[np.newaxis],np.ones( (1,5),dtype=bool))
+  >>> x2,l2,it2 = estimate_admixture_sqp(f,np.ones(3)/3)
+  >>> np.allclose(x,x2,atol=1e-4)
+  True
+  '''
+  b,k,n = f.shape
+  w     = np.asarray(mask,dtype=float)
+  nobs  = w.sum(axis=1)
+  nobs[nobs==0] = 1
+
+  # Feasible starting values from EM
+  x = np.ones( (b,k) )/k
+
+  for i in xrange(iters):
+    r  = w/block_mixture(f,w,x)
+    x *= np.einsum('skn,sn->sk',f,r)/nobs[:,np.newaxis]
+
+  x /= x.sum(axis=1)[:,np.newaxis]
+  u  = block_mixture(f,w,x)
+
+  active = np.ones(b,dtype=bool)
+  it     = 0
+
+  for it in xrange(maxiters):
+    idx = np.flatnonzero(active)
+
+    if not len(idx):
+      break
+
+    if len(idx)==b:
+      fa,wa,xa,ua = f,w,x,u
+    else:
+      fa,wa,xa,ua = f[idx],w[idx],x[idx],u[idx]
+
+    # Gradient and negative Hessian of the log-likelihood
+    r  = wa/ua
+    g  = np.einsum('skn,sn->sk',fa,r)
+    r *= r
+    h  = np.empty( (len(idx),k,k) )
+
+    for i in xrange(k):
+      fr = fa[:,i]*r
+      for j in xrange(i+1):
+        h[:,i,j] = h[:,j,i] = np.einsum('sn,sn->s',fr,fa[:,j])
+
+    # Coefficients are free unless at the bound and the gradient points
+    # further outside the feasible region (the Lagrange multiplier of the
+    # equality constraint at the optimum is the number of observed loci)
+    free = (xa>0) | (g>nobs[idx,np.newaxis])
+
+    # Newton step over the free coefficients.  Coefficients at the bound
+    # that the step would make infeasible are then fixed and the step
+    # recomputed.
+    for i in xrange(k):
+      d = newton_simplex_step(g,h,free)
+
+      blocked = free & (xa==0) & (d<0)
+
+      if not blocked.any():
+        break
+
+      free &= ~blocked
+
+    # Newton decrement, d'*H*d = g'*d, estimates twice the remaining
+    # improvement in log-likelihood, which is scaled by the number of
+    # observed loci
+    decrement = (g*d).sum(axis=1)
+    converged = decrement <= 2*RELTOL*nobs[idx]
+
+    # Truncate steps at the boundary of the feasible region
+    with np.errstate(divide='ignore',invalid='ignore'):
+      limit = np.where(d<0,-xa/d,np.inf).min(axis=1)
+
+    step = np.minimum(1,limit)
+
+    # Halve steps until the directional derivative of the log-likelihood
+    # no longer falls below minus half of its initial value, the point at
+    # which a quadratic model would stop improving.  This requires only the
+    # mixture probabilities, which are retained for the next iteration.
+    fd   = np.einsum('skn,sk->sn',fa,d)
+    done = converged.copy()
+    xnew = xa.copy()
+    unew = ua.copy()
+
+    for j in xrange(20):
+      todo = np.flatnonzero(~done)
+      if not len(todo):
+        break
+
+      # Snap coefficients that reach the boundary to it, so they may be
+      # fixed in the next iteration
+      xt = xa[todo]+step[todo,np.newaxis]*d[todo]
+      xt[xt<BOUNDTOL] = 0
+
+      if len(todo)==len(idx):
+        ut = block_mixture(fa,wa,xt)
+        dd = (wa*fd/ut).sum(axis=1)
+      else:
+        ut = block_mixture(fa[todo],wa[todo],xt)
+        dd = (wa[todo]*fd[todo]/ut).sum(axis=1)
+
+      better = (dd>=-0.5*decrement[todo]) | (j==19)
+      xnew[todo[better]] = xt[better]
+      unew[todo[better]] = ut[better]
+      done[todo[better]] = True
+      step[todo] /= 2
+
+    x[idx] = xnew
+    u[idx] = unew
+    active[idx[converged]] = False
+
+  x  = np.clip(x,0,1)
+  x /= x.sum(axis=1)[:,np.newaxis]
+  l  = block_log_likelihood(f,w,x)
+
+  return x,l,it
+
+
+def estimate_admixture_samples(test,pops):
+  '''
+  Estimate admixture coefficients for each sample of an sdat genotype
+  stream individually.  Results are generated as (sample, coefficients)
+  pairs in input order.
+  '''
+  for sample,genos in test:
+    # Compute genotype frequencies
+    f      = individual_frequencies(pops,genotype_indices(genos))
+
+    # Find feasible starting values
+    x0     = estimate_admixture_em(f,iters=10)
+
+    # Estimate admixture
+    x,l,it = estimate_admixture_sqp(f, x0)
+
+    yield sample,x
+
+
+def block_indices(test,blocksize):
+  '''
+  Generate blocks of sample names and (b x n) genotype index matrices from
+  an sdat genotype stream
+  '''
+  test = iter(test)
+
+  while 1:
+    block = list(islice(test,blocksize))
+
+    if not block:
+      break
+
+    samples = [ sample for sample,genos in block ]
+    inds    = np.array([ genotype_indices(genos) for sample,genos in block ], dtype=int)
+
+    yield samples,inds
+
+
+def estimate_admixture_indices(pops,inds):
+  f,mask = block_frequencies(pops,inds)
+  x,l,it = estimate_admixture_block(f,mask)
+  return x
+
+
+# Per-process population frequencies used by block worker processes
+_worker_pops = None
+
+
+def _init_block_worker(pops):
+  global _worker_pops
+  _worker_pops = pops
+
+
+def _estimate_block(args):
+  samples,inds = args
+  return samples,estimate_admixture_indices(_worker_pops,inds)
+
+
+def estimate_admixture_blocks(test,pops,blocksize=100,jobs=1):
+  '''
+  Estimate admixture coefficients for all samples of an sdat genotype
+  stream in blocks, optionally using a pool of worker processes.  Results
+  are generated as (sample, coefficients) pairs in input order.
+  '''
+  blocks = block_indices(test,blocksize)
+
+  if jobs<=1:
+    for samples,inds in blocks:
+      for sample,x in izip(samples,estimate_admixture_indices(pops,inds)):
+        yield sample,x
+    return
+
+  from multiprocessing import Pool
+
+  pool = Pool(jobs, _init_block_worker, (pops,))
+
+  try:
+    for samples,xs in pool.imap(_estimate_block, blocks):
+      for sample,x in izip(samples,xs):
+        yield sample,x
+
+  finally:
+    pool.terminate()
+
+
 def classify_ancestry(labels,x,threshold):
   '''
   An individual is considered of a given ancestry based on the supplied
@@ -593,6 +907,15 @@ def option_parser():
                     help='output table file name')
   parser.add_argument('-P', '--progress', action='store_true',
                     help='Show analysis progress bar, if possible')
+  parser.add_argument('--engine', metavar='NAME', default='sample', choices=['sample','block'],
+                    help='Estimation engine: "sample" uses a general purpose constrained optimizer '
+                         'for each sample, "block" solves for blocks of samples at once using '
+                         'vectorized EM and projected Newton iterations and may use multiple '
+                         'processes.  Default=sample')
+  parser.add_argument('--blocksize', metavar='N', type=int, default=100,
+                    help='Number of samples estimated together by the block engine.  Default=100')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Number of worker processes used by the block engine.  Default=1')
 
   return parser
 
@@ -614,16 +937,12 @@ def main():
   if options.progress and test.samples:
     test = progress_loop(test, length=len(test.samples), units='samples')
 
-  for sample,genos in test:
-    # Compute genotype frequencies
-    f      = individual_frequencies(pops,genotype_indices(genos))
-
-    # Find feasible starting values
-    x0     = estimate_admixture_em(f,iters=10)
-
-    # Estimate admixture
-    x,l,it = estimate_admixture_sqp(f, x0)
+  if options.engine=='block':
+    estimates = estimate_admixture_blocks(test,pops,options.blocksize,options.jobs)
+  else:
+    estimates = estimate_admixture_samples(test,pops)
 
+  for sample,x in estimates:
     ipop   = classify_ancestry(labels, x, options.threshold)
 
     out.writerow([sample]+['%.4f' % a for a in x] + [ipop])
@@ -17,58 +17,120 @@ try:
 except ImportError:
   cvxopt = None
 
-from   glu.lib.fileutils         import table_writer
+from   glu.lib.fileutils         import table_reader, table_writer
 
 from   glu.lib.genolib           import load_genostream, geno_options
 from   glu.lib.genolib.genoarray import count_genotypes, count_alleles_from_genocounts, \
-                                        major_allele_from_allelecounts
+                                        major_allele_from_allelecounts, genotype_index_matrix
 
 
-def encode_loci(genos):
+def locus_standardization(model,genocounts):
+  '''
+  Return the major and minor alleles, mean and scale used to standardize an
+  informative bi-allelic locus from its genotype counts, or None if the
+  locus is uninformative, monomorphic or not bi-allelic.
+  '''
+  allelecounts = count_alleles_from_genocounts(model,genocounts)
+
+  try:
+    major,freq = major_allele_from_allelecounts(model,allelecounts)
+  except ValueError:
+    major = None
+
+  # Uninformative
+  if major is None:
+    return None
+
+  other = [ a for a,n in izip(model.alleles[1:],allelecounts[1:]) if a!=major and n ]
+
+  # Monomorphic or non-biallelic
+  if len(other) != 1:
+    return None
+
+  other = other[0]
+
+  # Mean center and normalize scale of numeric encoding (0,.5,1)
+  n1   = genocounts[model[major,major].index]
+  n2   = genocounts[model[other,major].index]
+  n3   = genocounts[model[other,other].index]
+  s,n  = 0.5*n2+n3,n1+n2+n3
+  avg  = s/n
+  p    = (s+0.5)/(n+1)
+  norm = np.sqrt(p*(1-p))
+
+  return major,other,avg,norm
+
+
+def score_table(model,major,other,avg,norm):
+  '''
+  Return an array mapping genotype indices of model to standardized scores.
+  Missing genotypes and genotypes with other alleles score zero.
+  '''
+  table = np.zeros(len(model.genotypes), dtype=float)
+  table[model[major,major].index] = (0.0-avg)/norm
+  table[model[other,major].index] = (0.5-avg)/norm
+  table[model[other,other].index] = (1.0-avg)/norm
+  return table
+
+
+def encode_locus_tables(genos):
+  '''
+  Generate locus, genotype index array, score table and standardization
+  parameters for each informative bi-allelic locus
+  '''
   genos = genos.as_ldat()
 
   for (locus,geno),model in izip(genos,genos.models):
-    genocounts   = count_genotypes(geno)
-    allelecounts = count_alleles_from_genocounts(model,genocounts)
+    std = locus_standardization(model,count_genotypes(geno))
 
-    try:
-      major,freq = major_allele_from_allelecounts(model,allelecounts)
-    except ValueError:
-      major = None
+    if std is not None:
+      yield locus,geno.indices(),score_table(model,*std),std
 
-    # Uninformative
-    if major is None:
-      continue
 
-    other = [ a for a,n in izip(model.alleles[1:],allelecounts[1:]) if a!=major and n ]
+def encode_loci(genos):
+  for locus,indices,table,std in encode_locus_tables(genos):
+    yield table[indices]
+
 
-    # Monomorphic or non-biallelic
-    if len(other) != 1:
-      continue
+def encode_locus_blocks(genos,chunksize=500):
+  '''
+  Generate matrices of standardized scores for blocks of informative
+  bi-allelic loci, one row per locus.  Each block of genotypes is decoded
+  once into a reusable index matrix and scored with a single table lookup.
+  '''
+  genos = genos.as_ldat()
+  data  = izip(genos,genos.models)
+  buf   = np.empty( (chunksize,len(genos.samples)), dtype=np.int8 )
+
+  while 1:
+    chunk = list(islice(data,chunksize))
+
+    if not chunk:
+      break
 
-    other = other[0]
+    rows,models = zip(*chunk)
+    rows        = [ geno for locus,geno in rows ]
+
+    try:
+      indices = genotype_index_matrix(rows,buf)
+    except OverflowError:
+      # Loci with very many alleles do not fit in an int8 matrix
+      indices = np.array([ geno.indices() for geno in rows ], dtype=int)
 
-    # Form numeric encoding of informative data (0,.5,1)
-    # NB: dicts are faster than lists here-- sigh.
-    gmap = { model[major,major]:0.0,
-             model[other,major]:0.5,
-             model[other,other]:1.0 }
-    inf  = [ gmap[g] for g in geno if g ]
+    width  = max(len(model.genotypes) for model in models)
+    tables = np.zeros( (len(rows),width), dtype=float)
+    keep   = []
 
-    # Mean center and normalize scale
-    s,n  = sum(inf),len(inf)
-    avg  = s/n
-    p    = (s+0.5)/(n+1)
-    norm = np.sqrt(p*(1-p))
+    for i,model in enumerate(models):
+      n   = len(model.genotypes)
+      std = locus_standardization(model,np.bincount(indices[i],minlength=n))
 
-    # Form genotype to score mapping
-    # NB: dicts are faster than lists here-- sigh.
-    gmap = { model[None,None]  :  0.0,
-             model[major,major]: (0.0-avg)/norm,
-             model[other,major]: (0.5-avg)/norm,
-             model[other,other]: (1.0-avg)/norm }
+      if std is not None:
+        tables[i,:n] = score_table(model,*std)
+        keep.append(i)
 
-    yield [ gmap[g] for g in geno ]
+    if keep:
+      yield tables[keep][np.arange(len(keep))[:,np.newaxis],indices[keep]]
 
 
 def pca_cov_numpy(cov,n=None):
@@ -117,16 +179,8 @@ def pca_sequence_numpy(genos,n=None,chunksize=500):
   s,m = len(genos.samples),0
   cov = np.zeros( (s,s), dtype=float )
 
-  data = encode_loci(genos)
-
-  while 1:
-    chunk = list(islice(data,chunksize))
-
-    if not chunk:
-      break
-
+  for chunk in encode_locus_blocks(genos,chunksize):
     m    += len(chunk)
-    chunk = np.array(chunk, dtype=float)
     cov  += np.dot(chunk.T, chunk)
 
   return pca_cov_numpy(cov/m,n)
@@ -194,6 +248,187 @@ def pca_sequence_cvxopt(genos,n=None,chunksize=500):
   return pca_cov_cvxopt(cov/m,n)
 
 
+class LocusSpool(object):
+  '''
+  Temporary on-disk store of encoded loci that may be read in blocks any
+  number of times.  Each block holds genotype indices (one byte per
+  genotype when possible) and per-locus score tables, so that the dense
+  standardized matrix need never be held in memory.
+  '''
+  def __init__(self,genos,chunksize=1000,dir=None):
+    import tempfile
+
+    self.samples = genos.samples
+    self.loci    = []
+    self.params  = []
+    self.file    = tempfile.TemporaryFile(dir=dir)
+
+    data = encode_locus_tables(genos)
+
+    while 1:
+      chunk = list(islice(data,chunksize))
+
+      if not chunk:
+        break
+
+      loci,indices,tables,params = zip(*chunk)
+
+      width   = max(len(t) for t in tables)
+      dtype   = np.uint8 if width<=256 else np.uint16
+      indices = np.array(indices, dtype=dtype)
+      table   = np.zeros( (len(tables),width), dtype=float)
+
+      for i,t in enumerate(tables):
+        table[i,:len(t)] = t
+
+      np.save(self.file, indices)
+      np.save(self.file, table)
+
+      self.loci.extend(loci)
+      self.params.extend(params)
+
+  def __len__(self):
+    return len(self.loci)
+
+  def __iter__(self):
+    '''
+    Generate blocks of standardized data as (loci x samples) matrices
+    '''
+    f = self.file
+    f.seek(0)
+
+    m = len(self.loci)
+    i = 0
+
+    while i<m:
+      indices = np.load(f)
+      table   = np.load(f)
+      rows    = np.arange(len(table))[:,np.newaxis]
+      i      += len(table)
+
+      yield table[rows,indices]
+
+  def close(self):
+    self.file.close()
+
+
+def spool_cov_dot(spool,q):
+  '''
+  Compute dot(cov,q) for the (samples x samples) covariance matrix of the
+  spooled data without forming it
+  '''
+  result = np.zeros( (len(spool.samples),q.shape[1]), dtype=float )
+
+  for block in spool:
+    result += np.dot(block.T, np.dot(block,q))
+
+  return result/len(spool)
+
+
+def pca_spool_randomized(spool,n=10,oversample=10,iterations=4,seed=0):
+  '''
+  Compute the top n principle components of spooled genotype data using
+  randomized subspace iteration.
+
+  Let
+     s be the number of subjects
+     m be the number of loci
+     l=n+oversample be the dimension of the search subspace
+
+  Each iteration requires a pass over the spooled data with time
+  complexity O(m*s*l) and the working space is O(s*l), so the s x s
+  covariance matrix is never formed.
+  '''
+  import scipy.linalg
+
+  s = len(spool.samples)
+  n = min(n or s,s)
+  l = min(n+oversample,s)
+
+  if not len(spool):
+    raise ValueError('No informative loci found for PCA')
+
+  rand = np.random.RandomState(seed)
+  y    = spool_cov_dot(spool,rand.standard_normal( (s,l) ))
+
+  for i in xrange(iterations):
+    q,r = scipy.linalg.qr(y, mode='economic')
+    y   = spool_cov_dot(spool,q)
+
+  q,r = scipy.linalg.qr(y, mode='economic')
+  z   = spool_cov_dot(spool,q)
+
+  values,vectors = scipy.linalg.eigh(np.dot(q.T,z))
+
+  # eigh returns eigenvalues and vectors in ascending order,
+  # so reverse them and keep the top n
+  values  = values[::-1][:n]
+  vectors = np.dot(q,vectors[:,::-1][:,:n]).T
+
+  return values,vectors
+
+
+def pca_loadings(spool,values,vectors):
+  '''
+  Compute per-locus loadings such that the projection of the standardized
+  genotypes of any sample onto the loadings recovers its principle
+  component coordinates.
+  '''
+  m     = len(spool)
+  scale = np.asarray(values)*m
+  scale[scale==0] = 1
+  w     = np.asarray(vectors).T/scale
+
+  return np.concatenate([ np.dot(block,w) for block in spool ])
+
+
+def save_loadings(filename,spool,loadings):
+  out = table_writer(filename)
+  out.writerow(['LOCUS','MAJOR','OTHER','MEAN','SCALE'] + [ 'EV%d' % (i+1) for i in range(loadings.shape[1]) ])
+
+  for locus,(major,other,avg,norm),w in izip(spool.loci,spool.params,loadings):
+    out.writerow([locus,major,other,'%.8g' % avg,'%.8g' % norm] + [ '%.8g' % v for v in w ])
+
+
+def load_loadings(filename):
+  rows   = table_reader(filename)
+  header = next(rows)
+  n      = len(header)-5
+  loci   = {}
+
+  for row in rows:
+    locus,major,other,avg,norm = row[:5]
+    loci[locus] = major,other,float(avg),float(norm),np.array(row[5:5+n],dtype=float)
+
+  return loci
+
+
+def project_samples(genos,loadings):
+  '''
+  Project the samples in genos onto saved per-locus loadings.  Loci absent
+  from the loadings are ignored and missing genotypes contribute nothing.
+  '''
+  genos = genos.as_ldat()
+  n     = len(next(loadings.itervalues())[4]) if loadings else 0
+  proj  = np.zeros( (len(genos.samples),n), dtype=float )
+
+  for (locus,geno),model in izip(genos,genos.models):
+    params = loadings.get(locus)
+
+    if params is None:
+      continue
+
+    major,other,avg,norm,w = params
+
+    if major not in model.alleles or other not in model.alleles:
+      continue
+
+    scores = score_table(model,major,other,avg,norm)[geno.indices()]
+    proj  += np.outer(scores,w)
+
+  return proj.T
+
+
 def do_pca(genos,n=None):
   genos = genos.as_ldat()
 
@@ -219,6 +454,20 @@ def option_parser():
 
   parser.add_argument('--vectors', metavar='N', type=int, default=10,
                     help='Output the top N eigenvectors.  Set to 0 for all.  Default=10')
+  parser.add_argument('--engine', metavar='NAME', default='exact', choices=['exact','randomized'],
+                    help='PCA engine: "exact" decomposes the full sample covariance matrix, '
+                         '"randomized" uses randomized subspace iteration over loci spooled to '
+                         'disk and never forms the covariance matrix.  Default=exact')
+  parser.add_argument('--iterations', metavar='N', type=int, default=4,
+                    help='Number of subspace iterations for the randomized engine.  Default=4')
+  parser.add_argument('--oversample', metavar='N', type=int, default=10,
+                    help='Additional subspace dimensions for the randomized engine.  Default=10')
+  parser.add_argument('--tmpdir', metavar='DIR',
+                    help='Directory for the randomized engine locus spool (default=system temporary directory)')
+  parser.add_argument('--saveloadings', metavar='FILE',
+                    help='Save per-locus loadings to FILE (randomized engine only)')
+  parser.add_argument('--project', metavar='FILE',
+                    help='Project samples onto loadings previously saved to FILE rather than performing PCA')
   return parser
 
 
@@ -229,11 +478,34 @@ def main():
   genos   = load_genostream(options.genotypes,format=options.informat,genorepr=options.ingenorepr,
                             genome=options.loci,phenome=options.pedigree,transform=options).as_ldat()
 
-  values,vectors = do_pca(genos,n=options.vectors or None)
+  if options.saveloadings and options.engine!='randomized':
+    raise ValueError('Loadings may only be saved by the randomized engine')
+
+  if options.project:
+    loadings = load_loadings(options.project)
+    vectors  = project_samples(genos,loadings)[:options.vectors or None]
+    values   = []
+
+  elif options.engine=='randomized':
+    spool = LocusSpool(genos,dir=options.tmpdir)
+
+    try:
+      values,vectors = pca_spool_randomized(spool,n=options.vectors or None,
+                                            oversample=options.oversample,
+                                            iterations=options.iterations)
+
+      if options.saveloadings:
+        save_loadings(options.saveloadings,spool,pca_loadings(spool,values,vectors))
+
+    finally:
+      spool.close()
+
+  else:
+    values,vectors = do_pca(genos,n=options.vectors or None)
 
   if options.output:
     out = table_writer(options.output,hyphen=sys.stdout)
-    out.writerow(['ID'] + [ 'EV%d' % (i+1) for i in range(len(values)) ])
+    out.writerow(['ID'] + [ 'EV%d' % (i+1) for i in range(len(vectors)) ])
     for i,sample in enumerate(genos.samples):
       out.writerow( [sample]+['%7.4f' % v for v in vectors[:,i]] )
 